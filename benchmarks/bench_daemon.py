@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+#--------------------------------------------------------------------------------
+# """bench_daemon.py: Time from asking for a failover to its first Vault API
+#    call being answered, cold start of the script vs. trigger of the warm daemon"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# A cold start pays for the interpreter, the imports (boto3 and requests once
+# the run needs them), the config, the clients and the handshakes to the
+# clusters before the first Vault API call. This benchmark measures
+#
+#   * the interpreter start and imports, by running "import run_vault_dr" in a
+#     new python3 process,
+#   * a cold DRController: config, clients and a failover without pre-warmed
+#     connections, from the start of the controller until its first API call
+#     is answered,
+#   * the warm daemon: from sending a trigger over its socket to the first
+#     API call being answered,
+#
+# against two mock Vault clusters and a stubbed Route 53, and prints the p50
+# and p95 of each.
+#
+# Usage: ./bench_daemon.py [runs] [handshake latency in seconds]
+#--------------------------------------------------------------------------------
+import sys, os, io, contextlib, subprocess, tempfile, threading, time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCH_DIR, '..', 'src')
+sys.path.insert(0, SRC_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import run_vault_dr
+from vault_dr import daemon
+from mock_vault import MockVaultCluster
+from mock_route53 import StubRoute53
+from bench_failover import percentile
+
+REQUIRED_KEYS = 3
+
+CONFIG = """[Vault-Cluster-Bench]
+primary_vault_cluster_domain=%s
+secondary_vault_cluster_domain=%s
+cluster_cname=vault.bench.acme.com
+[AWS-Route-53]
+HostedZoneID=ZBENCH
+[DNS-Propagation]
+poll_interval=0.05
+[Journal]
+path=vault_dr_journal.jsonl
+[Tracing]
+trace_file=
+prometheus_textfile=
+"""
+
+def import_time():
+  start = time.monotonic()
+  subprocess.run([sys.executable, '-c', 'import run_vault_dr'], cwd=SRC_DIR, check=True)
+  return time.monotonic() - start
+
+def reset(clusters):
+  clusters[0].reset('primary')
+  clusters[1].reset('secondary')
+
+def cold_run(clusters):
+  reset(clusters)
+  start = time.monotonic()
+  with contextlib.redirect_stdout(io.StringIO()):
+    controller = run_vault_dr.DRController('bench-token', 'bench', 'bench')
+    controller.load_config()
+    controller.connect()
+    controller.run('failover', ['bench'], triggered=start)
+    controller.close()
+  return controller.first_request
+
+def warm_trigger(clusters, token):
+  reset(clusters)
+  start = time.monotonic()
+  first_line = []
+  with contextlib.redirect_stdout(io.StringIO()):
+    answer = daemon.trigger(daemon.DEFAULT_SOCKET_PATH, token,
+                            {'mode': 'failover', 'environments': ['bench']},
+                            lambda message: first_line.append(time.monotonic() - start))
+  return answer.get('first_request_seconds'), first_line[0]
+
+def main():
+  runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+  handshake_latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+
+  for i in range(1, REQUIRED_KEYS + 1):
+    os.environ['VAULT_RECOVERY_KEY_' + str(i)] = 'bench-recovery-key-' + str(i)
+  os.environ['DNS_PROPAGATION_DELAY'] = '5'
+
+  clusters = [MockVaultCluster(name, mode, REQUIRED_KEYS, handshake_latency).start()
+              for name, mode in (('west', 'primary'), ('east', 'secondary'))]
+  # The controller creates its Route 53 client through route53_client()
+  run_vault_dr.route53_client = lambda aws_aki, aws_sk: StubRoute53(0.05)
+
+  imports = [import_time() for run in range(runs)]
+
+  os.chdir(tempfile.mkdtemp(prefix='bench_daemon'))
+  with open('vault_dr.cfg', 'w') as f:
+    f.write(CONFIG % (clusters[0].url, clusters[1].url))
+
+  cold = [cold_run(clusters) for run in range(runs)]
+
+  with contextlib.redirect_stdout(io.StringIO()):
+    controller = run_vault_dr.DRController('bench-token', 'bench', 'bench')
+    controller.load_config()
+    controller.connect()
+    controller.warm(controller.cluster_domains(list(controller.cluster_pairs.values())), wait=True)
+  threading.Thread(target=controller.serve, daemon=True).start()
+  while not os.path.exists(daemon.DEFAULT_TOKEN_FILE) or not os.path.exists(daemon.DEFAULT_SOCKET_PATH):
+    time.sleep(0.01)
+  token = daemon.read_token(daemon.DEFAULT_TOKEN_FILE)
+  warm = [warm_trigger(clusters, token) for run in range(runs)]
+
+  print("Handshake latency:", handshake_latency, "seconds,", runs, "runs")
+  print("%-46s %10s %10s" % ("", "p50 (s)", "p95 (s)"))
+  for label, values in (("Interpreter start + import run_vault_dr", imports),
+                        ("Cold controller: start to first API answer", cold),
+                        ("Daemon: trigger to acknowledgement", [ack for first, ack in warm]),
+                        ("Daemon: trigger to first API answer", [first for first, ack in warm])):
+    print("%-46s %10.4f %10.4f" % (label, percentile(values, 50), percentile(values, 95)))
+
+if __name__ == '__main__':
+  main()
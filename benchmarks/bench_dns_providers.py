@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+#--------------------------------------------------------------------------------
+# """bench_dns_providers.py: CNAME cut-over in Route 53 and an RFC 2136 name
+#    server, one provider after the other and concurrently"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# Moves the CNAMEs of a number of cluster pairs between two targets in the
+# Route 53 stub and in a local mock name server that applies TSIG-signed RFC
+# 2136 updates, each taking a given time to have the change in sync. Every run
+# is timed once changing and waiting for one provider after the other and once
+# as Step 4 does it: all providers changed at once and polled until each has
+# the change in sync. It exits with status 1 if a CNAME does not point to its
+# new target in both providers, or if the concurrent cut-over takes longer than
+# the slowest provider plus --slack seconds.
+#
+# Usage: ./bench_dns_providers.py [--pairs N] [--runs N] [--route53-insync SECONDS]
+#                                 [--rfc2136-insync SECONDS] [--slack SECONDS]
+#--------------------------------------------------------------------------------
+import sys, os, argparse, base64, statistics, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from vault_dr import dns_propagation, dns_providers, events
+from mock_dns import MockDnsServer
+from mock_route53 import StubRoute53
+
+ZONE = 'acme.com'
+HOSTED_ZONE_ID = 'ZBENCH'
+TSIG_KEY_NAME = 'vault-dr'
+TSIG_SECRET = base64.b64encode(b'bench-tsig-secret-of-32-bytes!!!').decode()
+POLL_INTERVAL = 0.02
+
+def parse_args():
+  parser = argparse.ArgumentParser(description='CNAME cut-over in Route 53 and an RFC 2136 name '
+                                               'server, sequential and concurrent')
+  parser.add_argument('--pairs', type=int, default=3,
+                      help='cluster pairs whose CNAMEs are moved in each run (default 3)')
+  parser.add_argument('--runs', type=int, default=5,
+                      help='cut-overs of each kind, the median is printed (default 5)')
+  parser.add_argument('--route53-insync', type=float, default=0.5,
+                      help='seconds until a Route 53 change is INSYNC (default 0.5)')
+  parser.add_argument('--rfc2136-insync', type=float, default=0.3,
+                      help='seconds until the name server answers with an update (default 0.3)')
+  parser.add_argument('--slack', type=float, default=0.25,
+                      help='seconds the concurrent cut-over may take beyond the slowest '
+                           'provider (default 0.25)')
+  return parser.parse_args()
+
+#--------------------------------------------------------------------------------
+# Functions to move the CNAMEs in every provider and wait until all of them
+# have the change in sync, one provider after the other or all at once.
+# Return the time it took.
+#--------------------------------------------------------------------------------
+def cut_over_sequential(providers, records):
+  start = time.monotonic()
+  for provider in providers:
+    change_id = provider.change(records, 30)
+    pending = dns_propagation.wait_for_changes([(provider, change_id)], start + 30, POLL_INTERVAL)
+    if pending:
+      raise RuntimeError('change not in sync in ' + ', '.join(pending))
+  return time.monotonic() - start
+
+def cut_over_concurrent(providers, records):
+  start = time.monotonic()
+  changes = dns_providers.change_all(providers, records, 30)
+  pending = dns_propagation.wait_for_changes([(provider, changes[provider.name])
+                                              for provider in providers],
+                                             start + 30, POLL_INTERVAL, start)
+  if pending:
+    raise RuntimeError('change not in sync in ' + ', '.join(pending))
+  return time.monotonic() - start
+
+#--------------------------------------------------------------------------------
+# Function to return the CNAMEs of records that do not point to their target in
+# both providers
+#--------------------------------------------------------------------------------
+def check_records(route53, server, records):
+  wrong = []
+  for source, target in records:
+    record = route53.record(HOSTED_ZONE_ID, source)
+    if (record == None or record['ResourceRecords'][0]['Value'] != target or
+        server.cname(source) != dns_propagation.normalize_dns_name(target)):
+      wrong.append(source)
+  return wrong
+
+def main():
+  args = parse_args()
+  events.logger.configure('', False)
+  route53 = StubRoute53(insync_after=args.route53_insync)
+  server = MockDnsServer(ZONE, TSIG_KEY_NAME, TSIG_SECRET, apply_after=args.rfc2136_insync).start()
+  providers = [dns_providers.Route53Provider('route53', route53, HOSTED_ZONE_ID),
+               dns_providers.Rfc2136Provider('internal', server.server, ZONE, TSIG_KEY_NAME,
+                                             TSIG_SECRET)]
+  names = ['vault-' + str(i) + '.' + ZONE for i in range(args.pairs)]
+  targets = ['west.' + ZONE, 'east.' + ZONE]
+
+  sequential = []
+  concurrent = []
+  wrong = []
+  errors = []
+  for run in range(args.runs):
+    for times, cut_over in ((sequential, cut_over_sequential), (concurrent, cut_over_concurrent)):
+      records = [(name, targets[len(times) % 2]) for name in names]
+      try:
+        times.append(cut_over(providers, records))
+      except Exception as e:
+        errors.append(str(e))
+      wrong += check_records(route53, server, records)
+  for provider in providers:
+    provider.close()
+  server.stop()
+
+  slowest = max(args.route53_insync, args.rfc2136_insync)
+  print("%d pairs, Route 53 in sync after %g s, RFC 2136 after %g s, %d runs" %
+        (args.pairs, args.route53_insync, args.rfc2136_insync, args.runs))
+  print("%-36s %10s" % ("Cut-over in both providers", "p50 (s)"))
+  if sequential:
+    print("%-36s %10.3f" % ("one provider after the other", statistics.median(sequential)))
+  if concurrent:
+    print("%-36s %10.3f" % ("concurrently (Step 4)", statistics.median(concurrent)))
+  print("Name server: %d updates over %d connections, %d refused" %
+        (server.updates, server.connections, server.refused))
+
+  failed = errors + ['CNAME ' + name + ' not changed in both providers' for name in wrong]
+  if server.refused:
+    failed.append(str(server.refused) + ' updates refused by the name server')
+  if concurrent and statistics.median(concurrent) > slowest + args.slack:
+    failed.append('the concurrent cut-over took %.3f s, more than the slowest provider (%g s) '
+                  'plus %g s' % (statistics.median(concurrent), slowest, args.slack))
+  for problem in failed:
+    print("FAILED", problem)
+  if failed or not concurrent:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+#--------------------------------------------------------------------------------
+# """bench_failover.py: RTO of repeated failover/failback cycles against mock
+#    Vault clusters and a stubbed Route 53"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# Runs the full DR operation (run_dr) back and forth between two local mock
+# Vault clusters: every cycle is a failover followed by a failback. Each run
+# is timed from its start to
+#
+#   * RTO: the end of Step 4 (the CNAME points at the new primary and the
+#     change has propagated), which is when clients can use Vault again, and
+#   * total: the end of Step 5 (the old primary is a DR secondary again),
+#     including a deferred demotion if the health probe of the old primary
+#     failed,
+#
+# and the p50/p95/p99 of both are printed, with the p50/p95 time of every step.
+# Request latency, injected 503 errors, the number of recovery key shards and
+# the Route 53 propagation time are all configurable, so an RTO regression
+# shows up here, offline, before the next game day. With --max-p95 the exit
+# status is non-zero if the p95 RTO is above the given number of seconds.
+#
+# Every run waits until the mock clusters are in a steady state, as a drill of
+# run_vault_dr.py --drill does. With --results the runs are appended to a drill
+# results file as environment "bench", and the exit status is non-zero if the
+# p95 RTO regressed by more than --tolerance against the last drill that passed
+# (see vault_dr/drill.py).
+#
+# With --fencing the old primary is fenced as soon as the secondary is
+# promoted (see vault_dr/fencing.py) and the dual-primary window of the runs,
+# from the promotion until the old primary was fenced or demoted, is printed
+# too. With --max-dual-primary the exit status is non-zero if its p95 is above
+# the given number of seconds.
+#
+# Usage: ./bench_failover.py [--cycles N] [--latency S] [--error-rate F] ...
+#--------------------------------------------------------------------------------
+import sys, os, io, contextlib, time, argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import run_vault_dr
+from vault_dr import http_pool, drill, events, multi_pair, readiness, fencing, tracing
+from vault_dr.drill import percentile
+from vault_dr.scheduler import StepScheduler
+from mock_vault import MockVaultCluster
+from mock_route53 import StubRoute53
+
+CLUSTER_CNAME = 'vault.bench.acme.com'
+HOSTED_ZONE_ID = 'ZBENCH'
+
+# Probe an old primary that failed its health probe again quickly, so that a
+# deferred demotion finishes before the next run starts
+RECONCILE_CONFIG = {'probe_interval': 0.05, 'probe_timeout': 2, 'max_wait': 60}
+
+class RunResult:
+
+  def __init__(self, direction, ok, rto, total, step_times, error=None, dual_primary=None):
+    self.direction = direction
+    self.ok = ok
+    self.rto = rto
+    self.total = total
+    self.step_times = step_times
+    self.error = error
+    self.dual_primary = dual_primary
+
+#--------------------------------------------------------------------------------
+# Function to run one DR operation from primary to secondary and time it
+#--------------------------------------------------------------------------------
+def run_once(direction, primary, secondary, route53, sessions, args, fence=None):
+  scheduler = StepScheduler()
+  start = time.monotonic()
+  error = None
+  output = io.StringIO()
+  try:
+    with contextlib.redirect_stdout(output):
+      deferred = run_vault_dr.run_dr('bench', primary.url, secondary.url, CLUSTER_CNAME,
+                                     HOSTED_ZONE_ID, 'bench-token', route53, [],
+                                     args.dns_poll_interval, args.dns_propagation_delay,
+                                     sessions, RECONCILE_CONFIG, scheduler=scheduler, fence=fence)
+      if deferred != None and not deferred.join():
+        raise RuntimeError('deferred demotion of the old primary failed')
+  except BaseException as e:
+    if isinstance(e, KeyboardInterrupt):
+      raise
+    error = e
+  total = time.monotonic() - start
+
+  step_times = dict((name, step.duration()) for name, step in scheduler.steps.items()
+                    if step.start != None and step.end != None)
+  cutover = scheduler.steps.get('4-wait')
+  rto = (cutover.end - start) if cutover != None and cutover.end != None else None
+  # The span of the run has the dual-primary window, unless the old primary was
+  # only demoted by a deferred demotion
+  runs = [span for span in tracing.tracer.finished(tracing.RUN) if span.start >= start]
+  dual_primary = runs[0].attributes.get('dual_primary_window') if runs else None
+  if error != None:
+    # The last lines of the output say why the run aborted, once the event log
+    # has written them
+    events.flush()
+    print("Run", direction, "failed:", repr(error), "|",
+          ' | '.join(output.getvalue().strip().splitlines()[-2:]))
+  return RunResult(direction, error == None, rto, total, step_times, error, dual_primary)
+
+def parse_args():
+  parser = argparse.ArgumentParser(description='RTO of repeated failover/failback cycles '
+                                               'against mock Vault clusters')
+  parser.add_argument('--cycles', type=int, default=10,
+                      help='failover + failback cycles to run (default 10)')
+  parser.add_argument('--latency', type=float, default=0.02,
+                      help='latency of every Vault API call in seconds (default 0.02)')
+  parser.add_argument('--latency-jitter', type=float, default=0.01,
+                      help='extra random latency of up to this many seconds (default 0.01)')
+  parser.add_argument('--handshake-latency', type=float, default=0.05,
+                      help='latency of every new connection in seconds (default 0.05)')
+  parser.add_argument('--error-rate', type=float, default=0.0,
+                      help='fraction of Vault API calls answered with a 503 (default 0)')
+  parser.add_argument('--required', type=int, default=3,
+                      help='recovery key shards needed for an operation token (default 3)')
+  parser.add_argument('--insync-after', type=float, default=0.5,
+                      help='seconds before a Route 53 change is INSYNC (default 0.5)')
+  parser.add_argument('--dns-poll-interval', type=float, default=0.05,
+                      help='seconds between Route 53 GetChange polls (default 0.05)')
+  parser.add_argument('--dns-propagation-delay', type=float, default=60,
+                      help='upper bound of the propagation wait in seconds (default 60)')
+  parser.add_argument('--max-p95', type=float, default=None,
+                      help='exit with status 1 if the p95 RTO is above this many seconds')
+  parser.add_argument('--results', default=None,
+                      help='drill results file to append the runs to and compare with')
+  parser.add_argument('--tolerance', type=float, default=drill.DEFAULT_TOLERANCE,
+                      help='fraction by which the p95 RTO may exceed the baseline (default %g)'
+                           % drill.DEFAULT_TOLERANCE)
+  parser.add_argument('--fencing', choices=fencing.MODES, default=fencing.OFF,
+                      help='how the old primary is fenced after the promotion (default off)')
+  parser.add_argument('--fence-deadline', type=float, default=fencing.DEFAULT_DEADLINE,
+                      help='seconds the fence may take (default %g)' % fencing.DEFAULT_DEADLINE)
+  parser.add_argument('--fence-hook', default='true',
+                      help='command of --fencing hook (default true)')
+  parser.add_argument('--max-dual-primary', type=float, default=None,
+                      help='exit with status 1 if the p95 dual-primary window is above this '
+                           'many seconds')
+  return parser.parse_args()
+
+def print_report(results, args):
+  succeeded = [result for result in results if result.ok]
+  print()
+  print("%d runs, %d succeeded; latency %g + %g s, error rate %g, %d key shards, "
+        "INSYNC after %g s" % (len(results), len(succeeded), args.latency, args.latency_jitter,
+                               args.error_rate, args.required, args.insync_after))
+  print("%-22s %10s %10s %10s %10s" % ("", "p50 (s)", "p95 (s)", "p99 (s)", "max (s)"))
+  for direction in ('failover', 'failback', None):
+    runs = [result for result in succeeded if direction == None or result.direction == direction]
+    for label, values in (('RTO', [result.rto for result in runs if result.rto != None]),
+                          ('total', [result.total for result in runs]),
+                          ('dual-primary', [result.dual_primary for result in runs
+                                            if result.dual_primary != None])):
+      if not values:
+        continue
+      print("%-22s %10.3f %10.3f %10.3f %10.3f" % ((direction or 'all') + ' ' + label,
+                                                   percentile(values, 50), percentile(values, 95),
+                                                   percentile(values, 99), max(values)))
+
+  print()
+  print("%-12s %6s %10s %10s %10s" % ("Step", "Runs", "p50 (s)", "p95 (s)", "mean (s)"))
+  names = []
+  for result in succeeded:
+    for name in result.step_times:
+      if name not in names:
+        names.append(name)
+  for name in names:
+    values = [result.step_times[name] for result in succeeded if name in result.step_times]
+    print("%-12s %6d %10.3f %10.3f %10.3f" % (name, len(values), percentile(values, 50),
+                                              percentile(values, 95), sum(values) / len(values)))
+
+def main():
+  args = parse_args()
+
+  for i in range(1, args.required + 1):
+    os.environ['VAULT_RECOVERY_KEY_' + str(i)] = 'bench-recovery-key-' + str(i)
+
+  clusters = [MockVaultCluster(name, mode, args.required, args.handshake_latency, args.latency,
+                               args.latency_jitter, args.error_rate).start()
+              for name, mode in (('west', 'primary'), ('east', 'secondary'))]
+  route53 = StubRoute53(args.insync_after)
+  fence = None
+  if args.fencing == fencing.DEMOTE:
+    fence = fencing.DemoteFence(args.fence_deadline)
+  elif args.fencing == fencing.HOOK:
+    fence = fencing.HookFence(args.fence_hook, args.fence_deadline)
+  sessions = http_pool.SessionPool()
+  for thread in sessions.prewarm([cluster.url for cluster in clusters]):
+    thread.join()
+
+  monitor = readiness.ReadinessMonitor([multi_pair.ClusterPair(
+    'bench', clusters[0].url, clusters[1].url, CLUSTER_CNAME, HOSTED_ZONE_ID)])
+  drill_results = drill.Results(args.results) if args.results != None else None
+  drill_id = drill_results.start('bench', args.cycles) if drill_results != None else None
+  problem = None
+
+  results = []
+  try:
+    for cycle in range(args.cycles):
+      for direction in ('failover', 'failback'):
+        primary, secondary = clusters if direction == 'failover' else clusters[::-1]
+        steady, state = drill.wait_for_steady_state(monitor.sample, primary.url, secondary.url,
+                                                    10, 0.05)
+        if not steady:
+          problem = "no steady state before the " + direction + " of cycle " + str(cycle + 1)
+          print(problem + ":", state)
+          break
+        result = run_once(direction, primary, secondary, route53, sessions, args, fence)
+        results.append(result)
+        if drill_results != None:
+          drill_results.run(drill_id, 'bench', cycle + 1, direction, result.ok, result.rto,
+                            result.total, result.step_times,
+                            repr(result.error) if result.error != None else None)
+        if not result.ok:
+          # Start the next run from a clean pair of clusters
+          primary.reset('secondary' if direction == 'failback' else 'primary')
+          secondary.reset('primary' if direction == 'failback' else 'secondary')
+          if direction == 'failover':
+            break
+      if problem != None:
+        break
+  except KeyboardInterrupt:
+    print("Interrupted")
+  finally:
+    monitor.close()
+    sessions.close()
+    for cluster in clusters:
+      cluster.stop()
+
+  print_report(results, args)
+
+  rtos = [result.rto for result in results if result.ok and result.rto != None]
+  failed = False
+  if drill_results != None:
+    # Failed runs are retried from clean clusters and do not fail the benchmark
+    runs = [{'ok': True, 'rto': rto} for rto in rtos]
+    summary = drill.summarize(runs, drill_results.baseline('bench', drill_id), args.tolerance,
+                              problem)
+    drill_results.end(drill_id, 'bench', summary)
+    print()
+    if summary['baseline_p95_rto'] == None:
+      print("Drill", drill_id, "recorded in", args.results + ", no baseline yet")
+    else:
+      print("Drill", drill_id, "p95 RTO %.3f s against %.3f s of drill %s (tolerance %g%%)%s" %
+            (summary['p95_rto'], summary['baseline_p95_rto'], summary['baseline_drill'],
+             args.tolerance * 100, ", REGRESSED" if summary['regressed'] else ""))
+    failed = not summary['passed']
+  if args.max_p95 != None and (not rtos or percentile(rtos, 95) > args.max_p95):
+    print("p95 RTO above", args.max_p95, "seconds")
+    failed = True
+  windows = [result.dual_primary for result in results
+             if result.ok and result.dual_primary != None]
+  if args.max_dual_primary != None and (not windows or
+                                        percentile(windows, 95) > args.max_dual_primary):
+    print("p95 dual-primary window above", args.max_dual_primary, "seconds")
+    failed = True
+  if failed:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+#--------------------------------------------------------------------------------
+# """bench_http_pool.py: Handshakes and wall time of a failover, with and
+#    without the per-cluster keep-alive session pool"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# Runs the full failover (run_dr) against two local mock Vault clusters and a
+# stubbed Route 53, once with a new connection per API call (the old
+# behaviour) and once with a pre-warmed SessionPool, and prints the number of
+# handshakes and the wall time of each.
+#
+# Usage: ./bench_http_pool.py [runs] [handshake latency in seconds]
+#--------------------------------------------------------------------------------
+import sys, os, io, contextlib, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import run_vault_dr
+from vault_dr import http_pool
+from mock_vault import MockVaultCluster
+from mock_route53 import StubRoute53
+
+REQUIRED_KEYS = 3
+
+# Stands in for the SessionPool when measuring the old behaviour: every call
+# gets session None and therefore goes through requests.request().
+class NoSessionPool:
+  def get(self, cluster_domain):
+    return None
+  def close(self):
+    pass
+
+def run_failover(primary, secondary, sessions):
+  primary.reset('primary')
+  secondary.reset('secondary')
+  start = time.monotonic()
+  with contextlib.redirect_stdout(io.StringIO()):
+    run_vault_dr.run_dr('test', primary.url, secondary.url, 'vault.test.acme.com',
+                        'ZBENCH', 'bench-token', StubRoute53(), [], 0.05, 5, sessions)
+  elapsed = time.monotonic() - start
+  return elapsed, primary.connections + secondary.connections
+
+def main():
+  runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+  handshake_latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+
+  for i in range(1, REQUIRED_KEYS + 1):
+    os.environ['VAULT_RECOVERY_KEY_' + str(i)] = 'bench-recovery-key-' + str(i)
+
+  primary = MockVaultCluster('primary', 'primary', REQUIRED_KEYS, handshake_latency).start()
+  secondary = MockVaultCluster('secondary', 'secondary', REQUIRED_KEYS, handshake_latency).start()
+
+  print("Handshake latency:", handshake_latency, "seconds,", runs, "runs per mode")
+  print("%-28s %12s %14s" % ("Mode", "Handshakes", "Wall time (s)"))
+  for mode in ('new connection per call', 'pooled, keep-alive'):
+    total_time = 0.0
+    total_handshakes = 0
+    for run in range(runs):
+      if mode == 'pooled, keep-alive':
+        # Pre-warming happens while the operator is at the prompts, so it is
+        # not part of the measured failover.
+        sessions = http_pool.SessionPool()
+        for thread in sessions.prewarm([secondary.url, primary.url]):
+          thread.join()
+      else:
+        sessions = NoSessionPool()
+      elapsed, handshakes = run_failover(primary, secondary, sessions)
+      sessions.close()
+      total_time += elapsed
+      total_handshakes += handshakes
+    print("%-28s %12.1f %14.3f" % (mode, total_handshakes / runs, total_time / runs))
+
+  primary.stop()
+  secondary.stop()
+
+if __name__ == '__main__':
+  main()
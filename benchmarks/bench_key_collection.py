@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+#--------------------------------------------------------------------------------
+# """bench_key_collection.py: Time of Step 3-D with the recovery keys prompted
+#    for one after the other vs. collected concurrently from the custodians"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# Every custodian is scripted: they get to their keyboard at a random time
+# within the arrival spread after the failover starts, and then take the
+# typing time to enter their key.
+#
+#   * Prompted: getpass is replaced by the script, so key n can only be typed
+#     once key n-1 has been entered, the terminal has been handed over to
+#     custodian n (the handoff time, e.g. reading the key over the phone or
+#     walking over) and custodian n has arrived.
+#   * Collected: every custodian sends their key over the key collection
+#     socket as soon as they have typed it.
+#
+# Both run the full failover against two mock Vault clusters and a stubbed
+# Route 53. The p50 and p95 time from the start of the run until Step 3-D has
+# the operation token are printed.
+#
+# Usage: ./bench_key_collection.py [--runs N] [--custodians N]
+#                                  [--arrival-spread S] [--typing S] [--handoff S]
+#--------------------------------------------------------------------------------
+import sys, os, io, contextlib, argparse, random, tempfile, threading, time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'src'))
+sys.path.insert(0, BENCH_DIR)
+
+import run_vault_dr
+from vault_dr import daemon, http_pool, key_collection
+from vault_dr.scheduler import StepScheduler
+from mock_vault import MockVaultCluster
+from mock_route53 import StubRoute53
+from bench_failover import percentile
+
+def failover(clusters, sessions, key_collector=None):
+  clusters[0].reset('primary')
+  clusters[1].reset('secondary')
+  scheduler = StepScheduler()
+  run_vault_dr.run_dr('bench', clusters[0].url, clusters[1].url, 'vault.bench.acme.com', 'ZBENCH',
+                      'bench-token', StubRoute53(0.01), [], 0.01, 0, sessions,
+                      scheduler=scheduler, key_collector=key_collector)
+  return scheduler.steps['3-D'].end - scheduler.run_start
+
+def prompted(clusters, sessions, arrivals, typing, handoff):
+  start = time.monotonic()
+  keys = iter(range(len(arrivals)))
+  def scripted_getpass(prompt=''):
+    i = next(keys)
+    # Custodian i starts typing once prompted, handed the terminal and arrived
+    ready = max(time.monotonic() + (handoff if i > 0 else 0.0), start + arrivals[i])
+    time.sleep(ready - time.monotonic() + typing)
+    return 'bench-recovery-key-' + str(i + 1)
+  run_vault_dr.getpass.getpass = scripted_getpass
+  return failover(clusters, sessions)
+
+def collected(clusters, sessions, collector, token, arrivals, typing):
+  start = time.monotonic()
+  def custodian(i):
+    time.sleep(max(0.0, start + arrivals[i] + typing - time.monotonic()))
+    key_collection.submit_key(key_collection.DEFAULT_SOCKET_PATH, token, 'bench',
+                              'bench-recovery-key-' + str(i + 1), 'custodian-' + str(i + 1))
+  threads = [threading.Thread(target=custodian, args=(i,), daemon=True)
+             for i in range(len(arrivals))]
+  for thread in threads:
+    thread.start()
+  seconds = failover(clusters, sessions, collector)
+  for thread in threads:
+    thread.join()
+  return seconds
+
+def main():
+  parser = argparse.ArgumentParser(description='Compare prompted and collected recovery keys.')
+  parser.add_argument('--runs', type=int, default=5)
+  parser.add_argument('--custodians', type=int, default=3,
+                      help='recovery key shards needed for an operation token (default 3)')
+  parser.add_argument('--arrival-spread', type=float, default=1.0,
+                      help='custodians arrive within this many seconds (default 1.0)')
+  parser.add_argument('--typing', type=float, default=0.3,
+                      help='seconds a custodian takes to enter a key (default 0.3)')
+  parser.add_argument('--handoff', type=float, default=0.5,
+                      help='seconds to hand the prompt to the next custodian (default 0.5)')
+  args = parser.parse_args()
+
+  for name in list(os.environ):
+    if name.startswith('VAULT_RECOVERY_KEY_'):
+      del os.environ[name]
+  clusters = [MockVaultCluster(name, mode, args.custodians).start()
+              for name, mode in (('west', 'primary'), ('east', 'secondary'))]
+  sessions = http_pool.SessionPool()
+  os.chdir(tempfile.mkdtemp(prefix='bench_key_collection'))
+  collector = key_collection.KeyCollector(timeout=60)
+  token = daemon.read_token(key_collection.DEFAULT_TOKEN_FILE)
+
+  results = {'prompted': [], 'collected': []}
+  with contextlib.redirect_stdout(io.StringIO()):
+    collector.start()
+    for run in range(args.runs):
+      arrivals = [random.uniform(0, args.arrival_spread) for i in range(args.custodians)]
+      results['prompted'].append(prompted(clusters, sessions, arrivals, args.typing, args.handoff))
+      results['collected'].append(collected(clusters, sessions, collector, token, arrivals,
+                                            args.typing))
+  collector.stop()
+
+  print("%d runs, %d custodians arriving within %g s, %g s to type a key, %g s handoff" %
+        (args.runs, args.custodians, args.arrival_spread, args.typing, args.handoff))
+  print("%-40s %10s %10s" % ("Start of run to operation token", "p50 (s)", "p95 (s)"))
+  for label, values in results.items():
+    print("%-40s %10.3f %10.3f" % (label, percentile(values, 50), percentile(values, 95)))
+
+if __name__ == '__main__':
+  main()
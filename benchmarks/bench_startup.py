@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+#--------------------------------------------------------------------------------
+# """bench_startup.py: Import time of each entry point of run_vault_dr.py
+#    against a time budget"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# boto3 and requests are imported by the functions that need them, so that
+# --help, a usage error, --trigger, --submit-key and a plan, plan --diff or
+# execute that fails its checks start without paying for them. This
+# benchmark runs each entry point in a new python3 process with
+# "python -X importtime", adds up the time of the top-level imports and prints
+# the median over the runs against the budget of the entry point. It exits
+# with status 1 if an entry point is over its budget or imports one of the
+# modules it must not need, so a start-up regression (a new top-level import
+# of boto3, say) shows up before it slows down an incident.
+#
+# The --trigger and --submit-key runs find no daemon and no DR operation to
+# talk to, plan finds no cluster pair bench and plan --diff and execute no
+# plan file, which is fine: the imports are done by then.
+#
+# Usage: ./bench_startup.py [--runs N] [--budget ENTRY_POINT=MS ...]
+#--------------------------------------------------------------------------------
+import sys, os, subprocess, tempfile, argparse, statistics
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(BENCH_DIR, '..', 'src', 'run_vault_dr.py')
+
+CONFIG = """[Daemon]
+socket_path=%(dir)s/missing_daemon.sock
+token_file=%(dir)s/vault_dr.token
+[Key-Collection]
+socket_path=%(dir)s/missing_keys.sock
+token_file=%(dir)s/vault_dr.token
+"""
+
+# Modules that none of the entry points below may import
+HEAVY_MODULES = ('boto3', 'botocore', 'requests', 'urllib3', 'pdb')
+
+# Entry point: (arguments of run_vault_dr.py, budget in milliseconds)
+ENTRY_POINTS = {
+  'usage':       (['--help'], 250),
+  'usage-error': (['--bogus'], 250),
+  'trigger':     (['--trigger', 'failover', 'bench'], 250),
+  'submit-key':  (['--submit-key', 'bench'], 250),
+  'plan':        (['plan', 'failover', 'bench'], 250),
+  'plan-diff':   (['plan', '--diff', 'missing_plan.json'], 250),
+  'execute':     (['execute', 'missing_plan.json'], 250),
+}
+
+# Credentials of the runs, so that none of them prompts
+ENVIRONMENT = {'VAULT_TOKEN': 'bench-token', 'AWS_ACCESS_KEY_ID': 'bench', 'AWS_SECRET_KEY': 'bench'}
+
+#--------------------------------------------------------------------------------
+# Function to return the total import time in milliseconds and the names of
+# the imported modules from the stderr of "python -X importtime"
+#--------------------------------------------------------------------------------
+def parse_importtime(stderr):
+  total = 0
+  modules = set()
+  for line in stderr.splitlines():
+    if not line.startswith('import time:') or line.endswith('imported package'):
+      continue
+    fields = line[len('import time:'):].split('|')
+    name = fields[2][1:]
+    modules.add(name.strip())
+    # Only the top-level imports, their cumulative time includes the nested ones
+    if not name.startswith(' '):
+      total += int(fields[1])
+  return total / 1000.0, modules
+
+def run_once(args, work_dir):
+  result = subprocess.run([sys.executable, '-X', 'importtime', SCRIPT] + args, cwd=work_dir,
+                          input='bench-recovery-key\n', capture_output=True, text=True,
+                          start_new_session=True, env=dict(os.environ, **ENVIRONMENT))
+  return parse_importtime(result.stderr)
+
+def parse_args():
+  parser = argparse.ArgumentParser(description='Import time of each entry point of '
+                                               'run_vault_dr.py against a time budget')
+  parser.add_argument('--runs', type=int, default=5,
+                      help='runs of each entry point, the median is compared (default 5)')
+  parser.add_argument('--budget', action='append', default=[], metavar='ENTRY_POINT=MS',
+                      help='budget of an entry point in milliseconds (' +
+                           ', '.join(name + '=' + str(budget)
+                                     for name, (args, budget) in ENTRY_POINTS.items()) + ')')
+  args = parser.parse_args()
+  budgets = dict((name, budget) for name, (arguments, budget) in ENTRY_POINTS.items())
+  for budget in args.budget:
+    name, _, ms = budget.partition('=')
+    if name not in budgets:
+      parser.error('unknown entry point ' + name)
+    budgets[name] = float(ms)
+  return args, budgets
+
+def main():
+  args, budgets = parse_args()
+  work_dir = tempfile.mkdtemp(prefix='bench_startup')
+  with open(os.path.join(work_dir, 'vault_dr.cfg'), 'w') as f:
+    f.write(CONFIG % {'dir': work_dir})
+  with open(os.path.join(work_dir, 'vault_dr.token'), 'w') as f:
+    f.write('bench-token\n')
+
+  failed = False
+  print("%-12s %10s %10s  %s" % ("", "p50 (ms)", "budget", "heavy imports"))
+  for name, (arguments, budget) in ENTRY_POINTS.items():
+    times = []
+    heavy = set()
+    for run in range(args.runs):
+      total, modules = run_once(arguments, work_dir)
+      times.append(total)
+      heavy |= set(module for module in modules if module.split('.')[0] in HEAVY_MODULES)
+    median = statistics.median(times)
+    over = median > budgets[name]
+    failed = failed or over or bool(heavy)
+    print("%-12s %10.1f %10.1f  %s%s" % (name, median, budgets[name],
+                                         ', '.join(sorted(heavy)) or '-',
+                                         '  OVER BUDGET' if over else ''))
+  if failed:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+#--------------------------------------------------------------------------------
+# """bench_vault_client.py: DR status polls and failovers of many cluster
+#    pairs, one blocking call at a time and concurrently from one event loop"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# Starts pairs of local mock Vault clusters and times a poll of the DR status
+# of all of them, once one cluster after the other (as ReadinessMonitor.sample()
+# does for the drill) and once with the vault_client coroutines awaited
+# together from one event loop (as the monitor thread does). It then fails over every pair
+# with the typed VaultClient calls only, all pairs at once from one event loop:
+# operation token on the secondary, promote, demote, secondary token and
+# update-primary. It exits with status 1 if a pair does not end up with its
+# roles swapped or if an injected error does not come back as a VaultError.
+#
+# Usage: ./bench_vault_client.py [--pairs N] [--runs N] [--latency SECONDS]
+#--------------------------------------------------------------------------------
+import sys, os, argparse, asyncio, statistics, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from vault_dr import multi_pair, readiness, vault_client
+from mock_vault import MockVaultCluster
+
+REQUIRED_KEYS = 3
+
+def parse_args():
+  parser = argparse.ArgumentParser(description='DR status polls and failovers of many cluster '
+                                               'pairs, sequential and from one event loop')
+  parser.add_argument('--pairs', type=int, default=10,
+                      help='mock cluster pairs (default 10)')
+  parser.add_argument('--runs', type=int, default=5,
+                      help='polls of each kind, the median is printed (default 5)')
+  parser.add_argument('--latency', type=float, default=0.05,
+                      help='seconds each mock API call takes (default 0.05)')
+  return parser.parse_args()
+
+#--------------------------------------------------------------------------------
+# Function to fail over one pair with the VaultClient calls. Returns the time
+# it took.
+#--------------------------------------------------------------------------------
+async def fail_over(primary, secondary, pool):
+  start = time.monotonic()
+  old = vault_client.VaultClient(primary.url, 'bench-token', pool)
+  new = vault_client.VaultClient(secondary.url, 'bench-token', pool)
+
+  status = await new.dr_status()
+  if not status.healthy_secondary():
+    raise RuntimeError(secondary.url + ' is not a healthy DR secondary')
+  promote_token = await operation_token(new)
+  await new.promote(promote_token)
+  await old.demote()
+  secondary_token = await new.secondary_token('bench-' + primary.name)
+  update_token = await operation_token(old)
+  await old.update_primary(update_token, secondary_token.token)
+  return time.monotonic() - start
+
+async def operation_token(client):
+  await client.cancel_operation_token()
+  attempt = await client.start_operation_token()
+  for i in range(1, attempt.required + 1):
+    attempt = await client.update_operation_token('bench-recovery-key-' + str(i), attempt.nonce)
+  if not attempt.complete:
+    raise RuntimeError(client.cluster_domain + ': operation token not complete after ' +
+                       str(attempt.required) + ' keys')
+  return vault_client.decode_operation_token(attempt)
+
+async def fail_over_all(pairs):
+  pool = vault_client.ConnectionPool()
+  try:
+    return await asyncio.gather(*[fail_over(primary, secondary, pool)
+                                  for primary, secondary in pairs], return_exceptions=True)
+  finally:
+    await pool.close()
+
+#--------------------------------------------------------------------------------
+# Function to check that an error answer raises a VaultError with its status
+#--------------------------------------------------------------------------------
+async def injected_error(cluster):
+  cluster.inject_fault(vault_client.DR_PREFIX + '/status', 503)
+  pool = vault_client.ConnectionPool()
+  try:
+    await vault_client.VaultClient(cluster.url, pool=pool).dr_status()
+  except vault_client.VaultError as e:
+    return e.status == 503
+  finally:
+    await pool.close()
+  return False
+
+def main():
+  args = parse_args()
+  pairs = [(MockVaultCluster('west-' + str(i), 'primary', REQUIRED_KEYS, latency=args.latency).start(),
+            MockVaultCluster('east-' + str(i), 'secondary', REQUIRED_KEYS, latency=args.latency).start())
+           for i in range(args.pairs)]
+  cluster_pairs = [multi_pair.ClusterPair('bench-' + str(i), primary.url, secondary.url, '', '')
+                   for i, (primary, secondary) in enumerate(pairs)]
+
+  monitor = readiness.ReadinessMonitor(cluster_pairs, timeout=10)
+  cluster_domains = list(monitor.history)
+  sequential = []
+  concurrent = []
+  for run in range(args.runs):
+    start = time.monotonic()
+    samples = [monitor.sample(cluster_domain) for cluster_domain in cluster_domains]
+    sequential.append(time.monotonic() - start)
+    start = time.monotonic()
+    concurrent_samples = monitor.sample_all(cluster_domains)
+    concurrent.append(time.monotonic() - start)
+  errors = [sample.error for sample in samples + list(concurrent_samples.values())
+            if sample.error != None]
+  monitor.close()
+
+  print("%d pairs, %g s per API call, %d runs" % (args.pairs, args.latency, args.runs))
+  print("%-36s %10s" % ("DR status of all clusters", "p50 (s)"))
+  print("%-36s %10.3f" % ("one call after the other", statistics.median(sequential)))
+  print("%-36s %10.3f" % ("concurrently from one event loop", statistics.median(concurrent)))
+
+  loop = asyncio.new_event_loop()
+  start = time.monotonic()
+  results = loop.run_until_complete(fail_over_all(pairs))
+  elapsed = time.monotonic() - start
+  failed = [(primary.name, result) for (primary, secondary), result in zip(pairs, results)
+            if isinstance(result, BaseException)]
+  failed += [(primary.name, 'roles not swapped') for primary, secondary in pairs
+             if primary.mode != 'secondary' or primary.state != 'stream-wals' or
+                secondary.mode != 'primary']
+  durations = [result for result in results if not isinstance(result, BaseException)]
+  print()
+  print("Failover of all %d pairs from one event loop: %.3f s (p50 of a pair %.3f s)" %
+        (args.pairs, elapsed, statistics.median(durations) if durations else float('nan')))
+  if not loop.run_until_complete(injected_error(pairs[0][0])):
+    failed.append((pairs[0][0].name, 'a 503 answer did not raise a VaultError with status 503'))
+  loop.close()
+
+  for name, problem in failed:
+    print("FAILED", name + ":", problem)
+  for error in errors:
+    print("FAILED DR status poll:", error)
+  for primary, secondary in pairs:
+    primary.stop()
+    secondary.stop()
+  if failed or errors:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,219 @@
+#--------------------------------------------------------------------------------
+# """mock_dns.py: Local stand-in for an internal DNS server with RFC 2136
+#    dynamic updates"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# A MockDnsServer is authoritative for one zone on 127.0.0.1. It answers CNAME
+# queries over UDP, as dns_propagation.query_cname() sends them, and applies
+# DNS UPDATE messages (RFC 2136) sent over TCP, as the Rfc2136Provider sends
+# them. Only the update operations that provider uses are supported: delete
+# the CNAME RRset of a name and add a CNAME. With a TSIG key, an update must
+# carry a valid TSIG record of that key or it is answered with NOTAUTH.
+#
+# Every update is delayed by latency seconds. Its records are served
+# apply_after seconds after it is acknowledged, to emulate a hidden primary
+# that acknowledges before the name servers have the change. With truncate,
+# every answer over UDP is empty with the TC flag set, so that the client has
+# to ask again over TCP. With rcode, every update is answered with that RCODE
+# (5 for REFUSED, say) and not applied. drop_connections() closes the TCP
+# connections of the clients, as a server restart would.
+#--------------------------------------------------------------------------------
+import base64, hmac, socket, socketserver, struct, threading, time
+from vault_dr import dns_propagation, dns_providers
+
+class MockDnsServer:
+
+  def __init__(self, zone, tsig_key_name=None, tsig_secret=None, latency=0.0, apply_after=0.0,
+               truncate=False, rcode=0):
+    self.zone = dns_propagation.normalize_dns_name(zone)
+    self.truncate = truncate
+    self.rcode = rcode
+    self.tsig_key_name = tsig_key_name
+    self.tsig_secret = tsig_secret
+    self.latency = latency
+    self.apply_after = apply_after
+    self.lock = threading.Lock()
+    # Name -> (target, time from which it is served)
+    self.records = {}
+    self.updates = 0
+    self.refused = 0
+    self.connections = 0
+    self.queries = 0
+    # Open TCP connections of the clients
+    self.sockets = set()
+    # UDP and TCP on the same port, like a real name server
+    while True:
+      self.udp = socketserver.ThreadingUDPServer(('127.0.0.1', 0), UdpHandler)
+      port = self.udp.server_address[1]
+      try:
+        self.tcp = socketserver.ThreadingTCPServer(('127.0.0.1', port), TcpHandler)
+        break
+      except OSError:
+        self.udp.server_close()
+    for server in (self.udp, self.tcp):
+      server.daemon_threads = True
+      server.dns = self
+    self.server = '127.0.0.1:%d' % port
+
+  def start(self):
+    for server in (self.udp, self.tcp):
+      threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    return self
+
+  def stop(self):
+    for server in (self.udp, self.tcp):
+      server.shutdown()
+      server.server_close()
+
+  def drop_connections(self):
+    with self.lock:
+      sockets = list(self.sockets)
+    for sock in sockets:
+      try:
+        sock.shutdown(socket.SHUT_RDWR)
+      except OSError:
+        pass
+
+  def set(self, name, target):
+    with self.lock:
+      self.records[dns_propagation.normalize_dns_name(name)] = (
+        dns_propagation.normalize_dns_name(target), 0)
+
+  def cname(self, name):
+    with self.lock:
+      record = self.records.get(dns_propagation.normalize_dns_name(name))
+    return record[0] if record != None and record[1] <= time.monotonic() else None
+
+  #------------------------------------------------------------------------------
+  # Function to answer a CNAME query
+  #------------------------------------------------------------------------------
+  def query(self, message, truncate=False):
+    query_id, flags, qdcount = struct.unpack('!HHH', message[:6])
+    name, offset = dns_propagation.decode_name(message, 12)
+    question = message[12:offset + 4]
+    with self.lock:
+      self.queries += 1
+    if truncate:
+      return struct.pack('!HHHHHH', query_id, 0x8380, 1, 0, 0, 0) + question
+    target = self.cname(name)
+    if target == None:
+      return struct.pack('!HHHHHH', query_id, 0x8183, 1, 0, 0, 0) + question
+    rdata = dns_propagation.encode_name(target)
+    answer = (dns_propagation.encode_name(name) +
+              struct.pack('!HHIH', dns_propagation.DNS_TYPE_CNAME, dns_propagation.DNS_CLASS_IN,
+                          30, len(rdata)) + rdata)
+    return struct.pack('!HHHHHH', query_id, 0x8180, 1, 1, 0, 0) + question + answer
+
+  #------------------------------------------------------------------------------
+  # Function to apply an UPDATE message and return the answer
+  #------------------------------------------------------------------------------
+  def update(self, message):
+    if self.latency > 0:
+      time.sleep(self.latency)
+    query_id, flags, zocount, prcount, upcount, adcount = struct.unpack('!HHHHHH', message[:12])
+    zone, offset = dns_propagation.decode_name(message, 12)
+    offset += 4
+    changes = []
+    for i in range(upcount):
+      name, offset = dns_propagation.decode_name(message, offset)
+      rtype, rclass, ttl, rdlength = struct.unpack('!HHIH', message[offset:offset + 10])
+      offset += 10
+      if rclass == dns_providers.DNS_CLASS_ANY:
+        changes.append((name, None))
+      else:
+        target, ignore = dns_propagation.decode_name(message, offset)
+        changes.append((name, target))
+      offset += rdlength
+    rcode = self.rcode
+    if rcode == 0 and dns_propagation.normalize_dns_name(zone) != self.zone:
+      rcode = 9
+    elif rcode == 0 and self.tsig_key_name != None and not self.verify(message, offset, adcount):
+      rcode = 9
+    with self.lock:
+      if rcode != 0:
+        self.refused += 1
+      else:
+        self.updates += 1
+        served = time.monotonic() + self.apply_after
+        for name, target in changes:
+          name = dns_propagation.normalize_dns_name(name)
+          if target == None:
+            self.records.pop(name, None)
+          else:
+            self.records[name] = (dns_propagation.normalize_dns_name(target), served)
+    return struct.pack('!HHHHHH', query_id, 0xA800 | rcode, 0, 0, 0, 0)
+
+  def verify(self, message, offset, adcount):
+    if adcount != 1:
+      return False
+    start = offset
+    key_name, offset = dns_propagation.decode_name(message, offset)
+    rtype, rclass, ttl, rdlength = struct.unpack('!HHIH', message[offset:offset + 10])
+    offset += 10
+    algorithm, rdata_offset = dns_propagation.decode_name(message, offset)
+    time_high, time_low, fudge, mac_size = struct.unpack('!HIHH', message[rdata_offset:rdata_offset + 10])
+    mac = message[rdata_offset + 10:rdata_offset + 10 + mac_size]
+    signed = message[:10] + struct.pack('!H', adcount - 1) + message[12:start]
+    expected = hmac.new(base64.b64decode(self.tsig_secret),
+                        signed + dns_propagation.encode_name(key_name) +
+                        struct.pack('!HI', dns_providers.DNS_CLASS_ANY, 0) +
+                        dns_propagation.encode_name(algorithm) +
+                        struct.pack('!HIHHH', time_high, time_low, fudge, 0, 0),
+                        dns_providers.TSIG_ALGORITHMS[algorithm.lower()]).digest()
+    return (rtype == dns_providers.DNS_TYPE_TSIG and
+            key_name.lower() == self.tsig_key_name.lower() and hmac.compare_digest(mac, expected) and
+            abs(time.time() - ((time_high << 32) | time_low)) <= fudge)
+
+class UdpHandler(socketserver.BaseRequestHandler):
+
+  def handle(self):
+    message, sock = self.request
+    try:
+      sock.sendto(self.server.dns.query(message, self.server.dns.truncate), self.client_address)
+    except (ValueError, IndexError, struct.error):
+      pass
+
+class TcpHandler(socketserver.BaseRequestHandler):
+
+  def handle(self):
+    dns = self.server.dns
+    with dns.lock:
+      dns.connections += 1
+      dns.sockets.add(self.request)
+    try:
+      while True:
+        header = self.receive(2)
+        if header == None:
+          return
+        message = self.receive(struct.unpack('!H', header)[0])
+        if message == None:
+          return
+        opcode = (struct.unpack('!H', message[2:4])[0] >> 11) & 0xF
+        answer = (dns.update(message) if opcode == dns_providers.DNS_OPCODE_UPDATE else
+                  dns.query(message))
+        self.request.sendall(struct.pack('!H', len(answer)) + answer)
+    except OSError:
+      return
+    finally:
+      with dns.lock:
+        dns.sockets.discard(self.request)
+
+  def receive(self, length):
+    data = b''
+    while len(data) < length:
+      chunk = self.request.recv(length - len(data))
+      if not chunk:
+        return None
+      data += chunk
+    return data
@@ -0,0 +1,83 @@
+#--------------------------------------------------------------------------------
+# """mock_route53.py: In-process stand-in for the boto3 Route 53 client"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# StubRoute53 implements the Route 53 calls the script makes,
+# change_resource_record_sets(), get_change(), get_hosted_zone(),
+# list_resource_record_sets() and create_health_check(). A change stays PENDING
+# for insync_after seconds and is INSYNC after that.
+#--------------------------------------------------------------------------------
+import threading, time, uuid
+
+class StubRoute53:
+
+  def __init__(self, insync_after=0.0):
+    self.insync_after = insync_after
+    self.lock = threading.Lock()
+    self.records = {}
+    self.changes = {}
+    self.health_checks = {}
+    self.calls = 0
+
+  def change_resource_record_sets(self, HostedZoneId, ChangeBatch):
+    with self.lock:
+      self.calls += 1
+      for change in ChangeBatch.get('Changes'):
+        record = change.get('ResourceRecordSet')
+        key = (HostedZoneId, record.get('Name'), record.get('Type'), record.get('SetIdentifier'))
+        if change.get('Action') == 'DELETE':
+          self.records.pop(key, None)
+        else:
+          self.records[key] = record
+      change_id = '/change/C' + uuid.uuid4().hex[:12].upper()
+      self.changes[change_id] = time.monotonic()
+      return {'ChangeInfo': {'Id': change_id, 'Status': 'PENDING',
+                             'Comment': ChangeBatch.get('Comment')}}
+
+  def get_change(self, Id):
+    with self.lock:
+      self.calls += 1
+      submitted = self.changes.get(Id)
+      if submitted == None:
+        raise KeyError('NoSuchChange: ' + Id)
+      status = 'INSYNC' if time.monotonic() - submitted >= self.insync_after else 'PENDING'
+      return {'ChangeInfo': {'Id': Id, 'Status': status}}
+
+  def get_hosted_zone(self, Id):
+    with self.lock:
+      self.calls += 1
+      return {'HostedZone': {'Id': '/hostedzone/' + Id, 'Name': 'acme.com.'}}
+
+  def list_resource_record_sets(self, HostedZoneId, StartRecordName, StartRecordType, MaxItems='100'):
+    with self.lock:
+      self.calls += 1
+      records = sorted(((key[1], key[2], key[3] or ''), record) for key, record in self.records.items()
+                       if key[0] == HostedZoneId and (key[1], key[2]) >= (StartRecordName, StartRecordType))
+      return {'ResourceRecordSets': [record for key, record in records][:int(MaxItems)]}
+
+  def create_health_check(self, CallerReference, HealthCheckConfig):
+    with self.lock:
+      self.calls += 1
+      health_check_id = self.health_checks.setdefault(CallerReference, uuid.uuid4().hex)
+      return {'HealthCheck': {'Id': health_check_id, 'CallerReference': CallerReference,
+                              'HealthCheckConfig': HealthCheckConfig}}
+
+  def record(self, hosted_zone_id, name, set_identifier=None):
+    with self.lock:
+      return self.records.get((hosted_zone_id, name, 'CNAME', set_identifier))
+
+  def cname(self, hosted_zone_id, name):
+    with self.lock:
+      record = self.records.get((hosted_zone_id, name, 'CNAME', None))
+      return record.get('ResourceRecords')[0].get('Value') if record else None
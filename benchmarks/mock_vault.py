@@ -0,0 +1,333 @@
+#--------------------------------------------------------------------------------
+# """mock_vault.py: Local mock of the Vault DR replication API"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# A MockVaultCluster serves the /v1/sys/replication/dr/* endpoints used by
+# run_vault_dr.py over plain HTTP on 127.0.0.1. It keeps just enough state
+# (replication mode, operation token attempt, issued secondary tokens) for a
+# full failover or failback to run against a pair of them.
+#
+# The mock counts the connections it accepts. Each accepted connection stands
+# for one TCP + TLS handshake to a real ELB, and handshake_latency seconds are
+# spent on it before the first request is answered to emulate the cross-region
+# round trips of those handshakes.
+#
+# To emulate a real cluster further away or under stress, every request can
+# be delayed by latency (+ up to latency_jitter) seconds, a fraction error_rate
+# of the requests can be answered with a 503, and inject_fault() makes the next
+# requests to a path fail with a given status code. required is the number of
+# recovery key shards needed for an operation token.
+#
+# A cluster created with performance_mode 'secondary' is a performance
+# secondary and serves the /v1/sys/replication/performance/* endpoints that
+# re-point it; every DR primary acts as its performance primary.
+#
+# Each mock stands for one node. With standby 'standby' or 'perfstandby' it
+# answers /v1/sys/health like a standby (429) or performance standby (473)
+# node unless standbyok or perfstandbyok is set. ha_nodes are the (hostname,
+# URL) nodes listed by /v1/sys/ha-status, the mock itself by default.
+#--------------------------------------------------------------------------------
+import base64, json, random, string, threading, time, uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DR_PREFIX = '/v1/sys/replication/dr'
+PERFORMANCE_PREFIX = '/v1/sys/replication/performance'
+
+# Secondary activation tokens issued by any mock cluster, shared so that a
+# cluster can check an update-primary token issued by its peer.
+issued_secondary_tokens = set()
+
+# DR operation batch tokens and when they expire (monotonic). Batch tokens are
+# not stored by Vault, so every cluster that shares the keyring accepts them.
+batch_tokens = {}
+
+def issue_batch_token(ttl):
+  token = 'hvb.' + random_string(24)
+  batch_tokens[token] = time.monotonic() + ttl
+  return token
+
+def random_string(length):
+  return ''.join(random.choice(string.ascii_letters + string.digits) for i in range(length))
+
+class MockVaultCluster:
+
+  def __init__(self, name, mode, required=3, handshake_latency=0.0, latency=0.0,
+               latency_jitter=0.0, error_rate=0.0, performance_mode='disabled', standby=None):
+    self.name = name
+    self.standby = standby
+    self.performance_mode = performance_mode
+    self.required = required
+    self.handshake_latency = handshake_latency
+    self.latency = latency
+    self.latency_jitter = latency_jitter
+    self.error_rate = error_rate
+    self.faults = {}
+    self.lock = threading.Lock()
+    self.reset(mode)
+    self.server = ThreadingHTTPServer(('127.0.0.1', 0), MockVaultHandler)
+    self.server.daemon_threads = True
+    self.server.cluster = self
+    self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+    self.ha_nodes = [(self.name, self.url)]
+    self.thread = None
+
+  #------------------------------------------------------------------------------
+  # Function to put the cluster back in a given replication mode and clear the
+  # counters, e.g. between benchmark runs
+  #------------------------------------------------------------------------------
+  def reset(self, mode):
+    with self.lock:
+      self.mode = mode
+      self.state = 'stream-wals' if mode == 'secondary' else 'running'
+      self.performance_state = 'stream-wals' if self.performance_mode == 'secondary' else 'idle'
+      self.last_remote_wal = 0
+      self.merkle_root = random_string(40).lower()
+      self.attempt = None
+      self.dr_operation_token = None
+      self.connections = 0
+      self.requests = 0
+      self.errors = 0
+
+  def start(self):
+    self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  #------------------------------------------------------------------------------
+  # Function to make the next count requests to path (without the query string)
+  # fail with the given status code
+  #------------------------------------------------------------------------------
+  def inject_fault(self, path, status=503, count=1):
+    with self.lock:
+      self.faults[path] = (status, count)
+
+  #------------------------------------------------------------------------------
+  # Function to return the error (status code, JSON body) to inject into a
+  # request, or None to handle it normally
+  #------------------------------------------------------------------------------
+  def injected_error(self, path):
+    fault = self.faults.get(path)
+    if fault != None:
+      status, count = fault
+      if count <= 1:
+        del self.faults[path]
+      else:
+        self.faults[path] = (status, count - 1)
+      return status, {'errors': ['injected fault']}
+    if self.error_rate > 0 and random.random() < self.error_rate:
+      return 503, {'errors': ['injected error']}
+    return None
+
+  #------------------------------------------------------------------------------
+  # Function to handle one API call. Returns (status code, JSON body or None).
+  #------------------------------------------------------------------------------
+  def handle(self, verb, path, body):
+    delay = self.latency + random.uniform(0, self.latency_jitter)
+    if delay > 0:
+      time.sleep(delay)
+    with self.lock:
+      self.requests += 1
+      path, _, query = path.partition('?')
+
+      error = self.injected_error(path)
+      if error != None:
+        self.errors += 1
+        return error
+
+      if path == '/v1/sys/health':
+        status = 200
+        if self.standby == 'standby' and 'standbyok=true' not in query:
+          status = 429
+        elif self.standby == 'perfstandby' and 'perfstandbyok=true' not in query:
+          status = 473
+        return status, {'initialized': True, 'sealed': False, 'standby': self.standby != None,
+                        'performance_standby': self.standby == 'perfstandby',
+                        'replication_dr_mode': self.mode}
+
+      if verb == 'GET' and path == DR_PREFIX + '/status':
+        data = {'cluster_id': self.name, 'mode': self.mode, 'state': self.state,
+                'merkle_root': self.merkle_root}
+        if self.mode == 'secondary':
+          data['last_remote_wal'] = self.last_remote_wal
+        else:
+          data['last_wal'] = self.last_remote_wal
+        return 200, {'data': data}
+
+      if verb == 'GET' and path == '/v1/sys/ha-status':
+        return 200, {'data': {'nodes': [{'hostname': hostname, 'api_address': url,
+                                         'active_node': url == self.url and self.standby == None}
+                                        for hostname, url in self.ha_nodes]}}
+
+      if verb == 'GET' and path == '/v1/auth/token/lookup-self':
+        return 200, {'data': {'ttl': 0, 'type': 'service', 'policies': ['root']}}
+
+      if verb == 'POST' and path == '/v1/auth/token/lookup':
+        expires = batch_tokens.get(body.get('token'))
+        if expires == None or expires <= time.monotonic():
+          return 403, {'errors': ['bad token']}
+        return 200, {'data': {'ttl': int(expires - time.monotonic()), 'type': 'batch',
+                              'policies': ['dr-operation']}}
+
+      if path == DR_PREFIX + '/secondary/generate-operation-token/attempt':
+        if verb == 'GET':
+          if self.attempt != None:
+            return 200, self.attempt_status()
+          return 200, {'started': False, 'nonce': '', 'progress': 0, 'required': self.required,
+                       'encoded_token': '', 'otp': '', 'otp_length': 24, 'complete': False}
+        if verb == 'DELETE':
+          self.attempt = None
+          return 204, None
+        if self.mode != 'secondary':
+          return 400, {'errors': ['cluster is not a DR secondary']}
+        self.attempt = {'nonce': str(uuid.uuid4()), 'otp': random_string(24), 'keys': 0,
+                        'provided': set()}
+        return 200, self.attempt_status()
+
+      if verb == 'POST' and path == DR_PREFIX + '/secondary/generate-operation-token/update':
+        if self.attempt == None or body.get('nonce') != self.attempt['nonce']:
+          return 400, {'errors': ['no matching operation token attempt in progress']}
+        if not body.get('key'):
+          return 400, {'errors': ['missing key']}
+        if body.get('key') in self.attempt['provided']:
+          return 400, {'errors': ['given key has already been provided during this generation operation']}
+        self.attempt['provided'].add(body.get('key'))
+        self.attempt['keys'] += 1
+        return 200, self.attempt_status()
+
+      if verb == 'POST' and path == DR_PREFIX + '/secondary/promote':
+        if self.mode != 'secondary':
+          return 400, {'errors': ['cluster is not a DR secondary']}
+        if not self.check_operation_token(body):
+          return 400, {'errors': ['invalid DR operation token']}
+        self.mode = 'primary'
+        self.state = 'running'
+        return 200, {'warnings': None}
+
+      if verb == 'POST' and path == DR_PREFIX + '/primary/demote':
+        if self.mode != 'primary':
+          return 400, {'errors': ['cluster is not a DR primary']}
+        self.mode = 'secondary'
+        self.state = 'idle'
+        return 204, None
+
+      if verb == 'POST' and path == DR_PREFIX + '/primary/secondary-token':
+        if self.mode != 'primary':
+          return 400, {'errors': ['cluster is not a DR primary']}
+        token = str(uuid.uuid4())
+        issued_secondary_tokens.add(token)
+        return 200, {'request_id': '', 'lease_id': '', 'lease_duration': 0,
+                     'renewable': False, 'data': None, 'warnings': None,
+                     'wrap_info': {'token': token, 'ttl': 300,
+                                   'creation_time': time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                   'wrapped_accessor': ''}}
+
+      if verb == 'POST' and path == DR_PREFIX + '/secondary/update-primary':
+        if self.mode != 'secondary':
+          return 400, {'errors': ['cluster is not a DR secondary']}
+        if not self.check_operation_token(body):
+          return 400, {'errors': ['invalid DR operation token']}
+        if body.get('token') not in issued_secondary_tokens:
+          return 500, {'errors': ['error response unwrapping secondary token']}
+        issued_secondary_tokens.discard(body.get('token'))
+        self.state = 'stream-wals'
+        return 204, None
+
+      if verb == 'GET' and path == PERFORMANCE_PREFIX + '/status':
+        return 200, {'data': {'cluster_id': self.name, 'mode': self.performance_mode,
+                              'state': self.performance_state}}
+
+      if verb == 'POST' and path == PERFORMANCE_PREFIX + '/primary/secondary-token':
+        if self.mode != 'primary':
+          return 400, {'errors': ['cluster is not a performance primary']}
+        token = str(uuid.uuid4())
+        issued_secondary_tokens.add(token)
+        return 200, {'data': None, 'wrap_info': {'token': token, 'ttl': 300}}
+
+      if verb == 'POST' and path == PERFORMANCE_PREFIX + '/secondary/update-primary':
+        if self.performance_mode != 'secondary':
+          return 400, {'errors': ['cluster is not a performance secondary']}
+        if body.get('token') not in issued_secondary_tokens:
+          return 500, {'errors': ['error response unwrapping secondary token']}
+        issued_secondary_tokens.discard(body.get('token'))
+        self.performance_state = 'stream-wals'
+        return 204, None
+
+      return 404, {'errors': []}
+
+  def attempt_status(self):
+    status = {'started': True, 'nonce': self.attempt['nonce'],
+              'progress': self.attempt['keys'], 'required': self.required,
+              'otp': self.attempt['otp'], 'otp_length': 24,
+              'encoded_token': '', 'complete': False}
+    if self.attempt['keys'] >= self.required:
+      self.dr_operation_token = random_string(24)
+      encoded = bytes(a ^ b for a, b in zip(self.dr_operation_token.encode(),
+                                             self.attempt['otp'].encode()))
+      status['complete'] = True
+      status['encoded_token'] = base64.b64encode(encoded).decode()
+      self.attempt = None
+    return status
+
+  def check_operation_token(self, body):
+    expires = batch_tokens.get(body.get('dr_operation_token'))
+    if expires != None:
+      return expires > time.monotonic()
+    valid = (self.dr_operation_token != None and
+             body.get('dr_operation_token') == self.dr_operation_token)
+    self.dr_operation_token = None
+    return valid
+
+class MockVaultHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # Send headers and body in one segment so that Nagle's algorithm and delayed
+  # ACKs do not add latency to keep-alive connections.
+  wbufsize = 65536
+  disable_nagle_algorithm = True
+
+  def setup(self):
+    BaseHTTPRequestHandler.setup(self)
+    cluster = self.server.cluster
+    with cluster.lock:
+      cluster.connections += 1
+    if cluster.handshake_latency > 0:
+      time.sleep(cluster.handshake_latency)
+
+  def log_message(self, format, *args):
+    pass
+
+  def handle_any(self):
+    length = int(self.headers.get('Content-Length') or 0)
+    raw = self.rfile.read(length) if length > 0 else b''
+    try:
+      body = json.loads(raw) if raw else {}
+    except ValueError:
+      body = {}
+    status, response = self.server.cluster.handle(self.command, self.path, body or {})
+    payload = json.dumps(response).encode() if response != None else b''
+    self.send_response(status)
+    if payload:
+      self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(payload)))
+    self.end_headers()
+    if payload:
+      self.wfile.write(payload)
+
+  do_GET = handle_any
+  do_POST = handle_any
+  do_PUT = handle_any
+  do_DELETE = handle_any
@@ -16,10 +16,43 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #--------------------------------------------------------------------------------
-import sys, os, requests, json, pdb, base64, getpass, time, random, configparser, boto3
+import time
+# Start of this script, for the start-up and time-to-first-request reports
+STARTED = time.monotonic()
+import sys, os, json, base64, getpass, random, configparser, threading, contextlib
+# requests and boto3 take a good part of a second to import and are imported by
+# the functions that need them, so that the usage errors, --trigger and
+# --submit-key do not pay for them
+from vault_dr import dns_propagation, http_pool, retry_policy, reconciler, multi_pair, tracing, daemon
+from vault_dr import readiness, promotion_gate, key_collection, prepare, dns_strategy, verification
+from vault_dr import topology, warmup, events, fencing
+from vault_dr import journal as dr_journal
+from vault_dr import drill as dr_drill
+from vault_dr import plan as dr_plan
+from vault_dr import dns_providers as dr_dns_providers
+from urllib.parse import urlsplit
+from vault_dr.scheduler import StepScheduler
 
 debug = False
 
+# Retry policy of all Vault API calls, read from the config in main()
+retry = retry_policy.RetryPolicy()
+
+# Serializes operator prompts when several cluster pairs fail over at once
+prompt_lock = threading.Lock()
+
+# Seconds between re-opening the keep-alive connections of the daemon
+DEFAULT_KEEPALIVE_INTERVAL = 30
+
+# DNS strategy of runs not given one: UPSERT the CNAME with a TTL of 300
+STATIC_DNS = dns_strategy.DnsStrategy()
+
+# Options that change the DNS records of the CNAMEs outside of a DR operation
+DNS_OPTIONS = ('--lower-ttl', '--restore-ttl', '--setup-dns')
+
+# Commands that compile a plan file, show what it would change or run it
+PLAN_COMMANDS = ('plan', 'execute')
+
 # HTTP verbs
 GET='GET'
 POST='POST'
@@ -31,12 +64,58 @@ DELETE='DELETE'
 #--------------------------------------------------------------------------------
 
 def print_usage():
-    print ("Usage:", sys.argv[0], "{failover|failback} {prod|staging|test}")
+    print ("Usage:", sys.argv[0], "[--resume] [--trigger] {failover|failback} {prod|staging|test|all} [...]")
+    print ("      ", sys.argv[0], "--daemon")
+    print ("      ", sys.argv[0], "--drill {prod|staging|test} [cycles]")
+    print ("      ", sys.argv[0], "--submit-key [prod|staging|test]")
+    print ("      ", sys.argv[0], "{--lower-ttl|--restore-ttl|--setup-dns} {failover|failback} {prod|staging|test|all} [...]")
+    print ("      ", sys.argv[0], "plan {failover|failback} {prod|staging|test|all} [...]")
+    print ("      ", sys.argv[0], "plan --diff [plan_file]")
+    print ("      ", sys.argv[0], "[--resume] execute [plan_file]")
     sys.exit()
 
+#--------------------------------------------------------------------------------
+# Functions to split the command line into options (--resume, --daemon,
+# --trigger, --submit-key, --drill, --lower-ttl, --restore-ttl, --setup-dns,
+# --diff) and arguments
+#--------------------------------------------------------------------------------
+def options():
+  return [arg for arg in sys.argv[1:] if arg.startswith('--')]
+
+def arguments():
+  return [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+
 def check_usage():
 # Check for the correct number of arguments. If no argument is specified, error out.
-  if len(sys.argv) <= 2:
+  if any(option not in ('--resume', '--daemon', '--trigger', '--submit-key', '--drill', '--diff') +
+         DNS_OPTIONS for option in options()):
+    print ("Error: Too few or incorrect arguments.")
+    print_usage()
+  if '--daemon' in options():
+    return
+  if '--drill' in options():
+    if len(arguments()) not in (1, 2) or (len(arguments()) == 2 and not arguments()[1].isdigit()):
+      print ("Error: Too few or incorrect arguments.")
+      print_usage()
+    return
+  if arguments() and arguments()[0] in PLAN_COMMANDS:
+    if arguments()[0] == 'plan' and '--diff' not in options():
+      if len(arguments()) <= 2:
+        print ("Error: Too few or incorrect arguments.")
+        print_usage()
+    elif len(arguments()) > 2:
+      print ("Error: Too many arguments.")
+      print_usage()
+    return
+  if '--diff' in options():
+    print ("Error: --diff only applies to plan.")
+    print_usage()
+  if '--submit-key' in options():
+    if len(arguments()) > 1:
+      print ("Error: Too many arguments.")
+      print_usage()
+    return
+  if len(arguments()) <= 1:
     print ("Error: Too few or incorrect arguments.")
     print_usage()
 
@@ -56,421 +135,742 @@ def xor_bytes(s1, s2):
   return buf.decode()
 
 #--------------------------------------------------------------------------------
-# Function to make HTTP requests
+# Function to make HTTP requests. Failed attempts are retried as the retry
+# policy decides, until the step deadline passes. A request that fails for good
+# aborts the script, or raises its error if abort is False. A response that is
+# not JSON, such as the empty body of a 204, is returned as {}.
 #--------------------------------------------------------------------------------
-def http_request(session, verb, url, payload, hdrs):
-  MAX_RETRIES=10  
-  num_retries = 0
-  while num_retries <= MAX_RETRIES:
-    try:
-      if session == None:
-        response = requests.request(verb, url, json=payload, headers=hdrs, verify=False)
-      else:
-        response = session.request(verb, url, data=payload, headers=hdrs, verify=False)
-      response.raise_for_status()
-      return response.json()
-    except json.decoder.JSONDecodeError as jde:
-      return response
-    except requests.exceptions.HTTPError as errh:
-        print ("HTTPError:", errh, "occurred while executing",verb,":",url)
-        print ("Details:", response.text)
-        num_retries += 1
-        if num_retries > MAX_RETRIES: 
+def http_request(session, verb, url, payload, hdrs, deadline=None, abort=True):
+  import requests
+  # Keep the tokens and keys sent and received out of the event log
+  events.logger.secrets_in(payload)
+  events.logger.secrets_in(hdrs)
+  if deadline == None:
+    deadline = retry.step_deadline(None)
+  policy = deadline.policy
+  with tracing.tracer.span(verb + ' ' + urlsplit(url).path, tracing.HTTP, step=deadline.step,
+                           verb=verb, url=url, retries=0, status=None, bytes=0) as span:
+    attempt = 0
+    delay = 0
+    target_url = url
+    target_hdrs = hdrs
+    tried_nodes = set()
+    while True:
+      attempt += 1
+      response = None
+      try:
+        timeout = policy.timeouts(deadline)
+        if session == None:
+          response = requests.request(verb, target_url, json=payload, headers=target_hdrs,
+                                      verify=False, timeout=timeout)
+        else:
+          response = session.request(verb, target_url, json=payload, headers=target_hdrs,
+                                     verify=False, timeout=timeout)
+        span.attributes['status'] = response.status_code
+        span.attributes['bytes'] = len(response.content)
+        response.raise_for_status()
+        result = response.json()
+        events.logger.secrets_in(result)
+        return result
+      except json.decoder.JSONDecodeError as jde:
+        if response.text.strip() != '':
+          events.log("Response to", verb, url, "is not JSON:", jde, level=events.WARNING)
+        return {}
+      except requests.exceptions.RequestException as err:
+        error = err
+        events.log(type(err).__name__ + ":", err, "occurred while executing", verb, ":", url,
+                   level=events.WARNING)
+        if response != None:
+          events.log("Details:", response.text, level=events.WARNING)
+        error_class = policy.classify(err, response, verb)
+        if error_class == retry_policy.FAIL_FAST:
+          policy.log_decision(deadline, verb, url, attempt, error_class, err, "not retrying")
           break
-        backoff_before_retry(num_retries)
-        continue
-    except requests.exceptions.ConnectionError as errc:
-        print ("ConnectionError:", errc, "occurred while executing", verb,":",url)
-        print ("Details:", response.text)
-        if hasattr(errc, 'message'):
-          print ("Message:", errc.message)
-        num_retries += 1
-        if num_retries > MAX_RETRIES: 
+        delay = policy.next_delay(delay)
+        if deadline.remaining() - delay < policy.base_delay:
+          policy.log_decision(deadline, verb, url, attempt, error_class, err,
+                              "giving up since the step deadline would pass")
           break
-        backoff_before_retry(num_retries)
-        continue
-    except requests.exceptions.Timeout as errt:
-        print ("Timeout:", errt, "occurred while executing", verb,":",url)
-        print ("Details:", response.text)
-        if hasattr(errt, 'message'):
-          print ("Message:", errt.message)
-        num_retries += 1
-        if num_retries > MAX_RETRIES: 
-          break
-        backoff_before_retry(num_retries)
-        continue
-    except requests.exceptions.RequestException as err:
-        print ("RequestException:", err, "occurred while executing", verb, ":",url)
-        print ("Details:", response.text)
-        if hasattr(err, 'message'):
-          print ("Message:", err.message)
-        num_retries += 1
-        if num_retries > MAX_RETRIES: 
-          break
-        backoff_before_retry(num_retries)
-        continue
-  if num_retries > MAX_RETRIES:
-    print("Exceeded maximum of", MAX_RETRIES, "retries.")
-    print("Aborting script")
+        decision = "retrying"
+        if error_class == retry_policy.RETRY_OTHER_NODE:
+          target_url, host = policy.nodes.other_node(url, tried_nodes)
+          if host != None:
+            target_hdrs = dict(hdrs, Host=host)
+            decision = "retrying on node " + target_url
+          else:
+            target_url, target_hdrs = url, hdrs
+        policy.log_decision(deadline, verb, url, attempt, error_class, err, decision, delay)
+        span.attributes['retries'] = attempt
+        tracing.tracer.sleep(delay, 'retry')
+    if not abort:
+      raise error
+    events.log("Aborting script", level=events.ERROR)
     sys.exit()
 
 #--------------------------------------------------------------------------------
-# Function to perform exponential backoff
+# Function to create the AWS Route 53 client
 #--------------------------------------------------------------------------------
-def backoff_before_retry(num_retries):
-
-  jitter = random.randint(1,999)/1000
-
-  backoff_interval = 2**(num_retries-1)*30 + jitter
-
-  print(time.strftime("[%a, %d %b %Y %H:%M:%S]", time.localtime()),
-        "*** Retry attempt",num_retries,"after exponential backoff of", 
-        str(format(backoff_interval,'.3f')), "seconds")
-
-  time.sleep(backoff_interval)
-
-  return
+def route53_client(aws_aki, aws_sk):
+  import boto3
+  return boto3.client( 'route53',
+                       aws_access_key_id=aws_aki,
+                       aws_secret_access_key=aws_sk)
 
 #--------------------------------------------------------------------------------
-# Function to change the CNAME of the Vault Cluster in AWS Route 53
+# Function to change the CNAMEs of Vault Clusters in every DNS provider of a
+# pair at once (see dns_providers.py). records is a list of (source, target)
+# pairs. change(provider), if given, makes the change in one provider instead,
+# e.g. through the CnameBatcher. Returns a dict of provider name -> change ID
+# so that propagation can be tracked.
 #--------------------------------------------------------------------------------
-def update_cname_record(hosted_zone_id, source, target, aws_aki, aws_sk):
-
-  client = boto3.client( 'route53',
-                        aws_access_key_id=aws_aki,
-                        aws_secret_access_key=aws_sk)
+def update_cname_records(providers, records, ttl=dns_strategy.DEFAULT_TTL, change=None):
 
   try:
-    response = client.change_resource_record_sets(HostedZoneId=hosted_zone_id,
-                                  ChangeBatch= {
-                                     'Comment': 'update %s -> %s' % (source, target),
-                                     'Changes': [{
-                                       'Action': 'UPSERT',
-                                       'ResourceRecordSet': {
-                                         'Name': source,
-                                         'Type': 'CNAME',
-                                         'TTL': 300,
-                                         'ResourceRecords': [{'Value': target}]
-                                       }
-                                     }]
-                                  })
+    return dr_dns_providers.change_all(providers, records, ttl, change)
   except Exception as e:
-    print(e)
+    events.log(e, level=events.ERROR)
     sys.exit()
+
 #--------------------------------------------------------------------------------
-# Main program
+# Function to return the DNS provider of the hosted zone of a pair that names
+# no providers: Route 53, through client
 #--------------------------------------------------------------------------------
-check_usage()
-
-# Disable all requests warnings
-requests.packages.urllib3.disable_warnings()
-
-# Check to see if the vault token environment variable is set
-vault_token = os.getenv('VAULT_TOKEN')
-# If not, prompt the operator for token
-if vault_token == None:
-  while vault_token == None or vault_token == '':
-    vault_token = getpass.getpass(prompt="Enter Vault Token:")
-
-# Get the AWS access key id and secret key
-aws_aki = os.getenv('AWS_ACCESS_KEY_ID')
-aws_sk = os.getenv('AWS_SECRET_KEY')
-
-if aws_aki == None:
-  while aws_aki == None or aws_aki == '':
-    aws_aki = input("Enter AWS ACCESS KEY ID:") 
-if aws_sk == None:
-  while aws_sk == None or aws_sk == '':
-    aws_sk = getpass.getpass("Enter AWS SECRET KEY:")
-
-# Read the first argument as the dr_mode: 'failover' or 'failback'
-dr_mode = sys.argv[1]
-# Read the second argument as the environment
-environment = sys.argv[2]
-
- 
-# Read the config file to get all the cluster domain names & DNS server.
-config = configparser.RawConfigParser()
-config.read('vault_dr.cfg')
-
-# Read variables for primary and secondary domains based on environment and dr_mode
-prod_primary_vault_cluster_domain = config.get('Vault-Cluster-Prod', 
-                                               'prod_primary_vault_cluster_domain')
-
-prod_secondary_vault_cluster_domain = config.get('Vault-Cluster-Prod', 
-                                               'prod_secondary_vault_cluster_domain')
-prod_cluster_cname = config.get('Vault-Cluster-Prod', 'prod_cluster_cname')
-
-staging_primary_vault_cluster_domain = config.get('Vault-Cluster-Staging', 
-                                               'staging_primary_vault_cluster_domain')
-
-staging_secondary_vault_cluster_domain = config.get('Vault-Cluster-Staging', 
-                                               'staging_secondary_vault_cluster_domain')
-staging_cluster_cname = config.get('Vault-Cluster-Staging', 'staging_cluster_cname')
-
-test_primary_vault_cluster_domain = config.get('Vault-Cluster-Test', 
-                                               'test_primary_vault_cluster_domain')
-
-test_secondary_vault_cluster_domain = config.get('Vault-Cluster-Test', 
-                                               'test_secondary_vault_cluster_domain')
-test_cluster_cname = config.get('Vault-Cluster-Test', 'test_cluster_cname')
-
-# Read the Route 53 Hosted Zone ID for the Vault cluster
-vault_cluster_zone_id = config.get('AWS-Route-53', 'HostedZoneID')
-
-# Depending on the dr_mode, assign the primary and secondary clusters based on environment
-if dr_mode == 'failover':
-  if environment == 'prod': 
-    primary_vault_cluster_domain=prod_primary_vault_cluster_domain
-    secondary_vault_cluster_domain=prod_secondary_vault_cluster_domain
-    cluster_cname=prod_cluster_cname
-  elif environment == 'staging':
-    primary_vault_cluster_domain=staging_primary_vault_cluster_domain
-    secondary_vault_cluster_domain=staging_secondary_vault_cluster_domain
-    cluster_cname=staging_cluster_cname
-  elif environment == 'test':
-    primary_vault_cluster_domain=test_primary_vault_cluster_domain
-    secondary_vault_cluster_domain=test_secondary_vault_cluster_domain
-    cluster_cname=test_cluster_cname
-  else:
-    print_usage()
-elif dr_mode == 'failback':
-  if environment == 'prod': 
-    secondary_vault_cluster_domain=prod_primary_vault_cluster_domain
-    primary_vault_cluster_domain=prod_secondary_vault_cluster_domain
-    cluster_cname=prod_cluster_cname
-  elif environment == 'staging':
-    secondary_vault_cluster_domain=staging_primary_vault_cluster_domain
-    primary_vault_cluster_domain=staging_secondary_vault_cluster_domain
-    cluster_cname=staging_cluster_cname
-  elif environment == 'test':
-    secondary_vault_cluster_domain=test_primary_vault_cluster_domain
-    primary_vault_cluster_domain=test_secondary_vault_cluster_domain
-    cluster_cname=test_cluster_cname
-  else:
-    print_usage()
-else:
-  print_usage()
+def route53_provider(client, hosted_zone_id):
+  return dr_dns_providers.Route53Provider(dr_dns_providers.ROUTE53, client, hosted_zone_id)
 
-# Set the vault token
-hdrs = {'X-Vault-Token': vault_token } 
+#--------------------------------------------------------------------------------
+# State of one Disaster Recovery run, shared by its steps. The secondary cluster
+# becomes the new primary and the primary cluster becomes the new secondary.
+#--------------------------------------------------------------------------------
+class DRRun:
+
+  def __init__(self, environment, primary_vault_cluster_domain, secondary_vault_cluster_domain,
+               cluster_cname, vault_cluster_zone_id, vault_token, route53,
+               dns_resolvers, dns_poll_interval, dns_propagation_delay, sessions,
+               reconcile_config=None, cname_batcher=None, readiness=None, promotion_gate=None,
+               key_collector=None, preparation=None, dns_strategy=None, verification=None,
+               followers=(), secondary_id=None, dns_providers=None, fence=None,
+               prepare_in_run=False, min_token_ttl=prepare.DEFAULT_MIN_TOKEN_TTL):
+    self.environment = environment
+    self.name = environment
+    self.primary_vault_cluster_domain = primary_vault_cluster_domain
+    self.secondary_vault_cluster_domain = secondary_vault_cluster_domain
+    self.cluster_cname = cluster_cname
+    self.vault_cluster_zone_id = vault_cluster_zone_id
+    self.route53 = route53
+    # DNS systems the CNAME is changed in, the hosted zone in Route 53 by default
+    self.dns_providers = (list(dns_providers) if dns_providers != None else
+                          [route53_provider(route53, vault_cluster_zone_id)])
+    self.dns_resolvers = dns_resolvers
+    self.dns_poll_interval = dns_poll_interval
+    self.dns_propagation_delay = dns_propagation_delay
+    self.sessions = sessions
+    self.reconcile_config = reconcile_config if reconcile_config != None else {}
+    # Combines the CNAME update with those of concurrent pairs, if set
+    self.cname_batcher = cname_batcher
+    # Cached replication status of the clusters, if a ReadinessMonitor runs
+    self.readiness = readiness
+    # Settings of the replication lag gate before Step 3-E, if enabled
+    self.promotion_gate = promotion_gate
+    # Collects the recovery keys from the custodians concurrently, if set
+    self.key_collector = key_collector
+    # What the prepare phase did ahead of the run, if it ran
+    self.preparation = preparation
+    # Whether the run prepares itself in a step alongside Steps 3-A and 3-B,
+    # and the TTL the tokens must have left
+    self.prepare_in_run = prepare_in_run and preparation == None
+    self.min_token_ttl = min_token_ttl
+    # How Step 4 moves the CNAME, see dns_strategy.py
+    self.dns_strategy = dns_strategy if dns_strategy != None else STATIC_DNS
+    # Settings of the verification of the new primary, if enabled
+    self.verification = verification
+    # Further DR and performance secondaries to re-point at the new primary
+    self.followers = [topology.Follower(*follower) for follower in followers]
+    # Fences the old primary right after the promotion, if set, see fencing.py
+    self.fence = fence
+    # ID of the secondary token of the old primary, resolved by the plan if there is one
+    self.secondary_id = (secondary_id if secondary_id != None else
+                         topology.secondary_id(primary_vault_cluster_domain))
+    self.started = None
+    self.deadline = None
+    # Journal of the completed steps, the ID of this run in it and the steps
+    # committed so far (with their outputs)
+    self.journal = None
+    self.journal_id = None
+    self.committed = {}
+    # Set the vault token
+    self.hdrs = {'X-Vault-Token': vault_token }
+    # Outputs of the steps
+    self.recovery_keys = list(preparation.recovery_keys) if preparation != None else []
+    self.old_primary_reachable = None
+    self.promotion_attempt = None
+    self.dr_operation_token = None
+    self.wal_lag = None
+    self.data_loss_window = None
+    # Change ID of the CNAME update in each DNS provider, by provider name
+    self.changes = {}
+    self.secondary_token = None
+    self.demotion_attempt = None
+    self.new_secondary_dr_operation_token = None
+    # When and how the old primary stopped taking writes: fencing.DEMOTE or
+    # fencing.HOOK by the fence, or '5-A'
+    self.fenced_at = None
+    self.fenced_by = None
 
 #---------------------------------------------------------------------------------------
 # Note: STEPS 1 & 2 (ENABLING DR REPLICATION ON PRIMARY & SECONDARY) are assumed to be
 # already done either via the UI or via CLI or API.  The rest of the steps are 
-# implemented here.
-#---------------------------------------------------------------------------------------
-# STEP 3: PROMOTE DR SECONDARY TO PRIMARY
-#---------------------------------------------------------------------------------------
+# implemented here, each as a function of the DRRun.
 #---------------------------------------------------------------------------------------
-# Step 3-A: Ensure that the secondary has replication in the correct state
+# Functions to generate a DR operation token on a DR secondary, shared by
+# Steps 3-C/3-D and 5-C/5-D
 #---------------------------------------------------------------------------------------
-print(time.strftime("[%a, %d %b %Y %H:%M:%S]", time.localtime()),
-     "*** About to check the replication status on the secondary cluster:", 
-     secondary_vault_cluster_domain)
-
-url = secondary_vault_cluster_domain + '/v1/sys/replication/dr/status'
-  
-payload =  {}
-
-if debug:
-  print('URL=',url,'Payload=',payload,'Headers=',hdrs)
-
-response = http_request(None, GET, url, payload, hdrs)
-
-if debug:
-  print(response)
-
-# The response from the secondary will be a JSON document like this:
-#{
-#  "data": {
-#    "cluster_id": "d4095d41-3aee-8791-c421-9bc7f88f7c3e",
-#    "known_primary_cluster_addrs": [
-#      "https://127.0.0.1:8201"
-#    ],
-#    "last_remote_wal": 241,
-#    "merkle_root": "56794a98e52598f35974024fba6691f047e772e9",
-#    "mode": "secondary",
-#    "primary_cluster_addr": "https://127.0.0.1:8201",
-#    "secondary_id": "3",
-#    "state": "stream-wals"
-#  },
-#}
-
-response_dict = json.loads(json.dumps(response))
-
-repl_mode = response_dict.get('data').get('mode')
-repl_state = response_dict.get('data').get('state')
-
-if repl_mode != 'secondary': 
-  print("Error: The current secondary vault cluster", secondary_vault_cluster_domain,
-        "has a replication mode of", repl_mode)
-  print("Aborting script")
-  sys.exit()
-if repl_state != 'stream-wals':
-  print("Error: The current secondary vault cluster", secondary_vault_cluster_domain,
-        "has a replication state of", repl_state)
-  print("Aborting script")
-  sys.exit()
+def start_operation_token(run, cluster_domain, step):
+  url = cluster_domain + '/v1/sys/replication/dr/secondary/generate-operation-token/attempt' 
+  payload =  {}
+
+  if debug:
+    events.log("Request", url, level=events.DEBUG, payload=payload, headers=run.hdrs)
+  response = http_request(run.sessions.get(cluster_domain), POST, url, payload, run.hdrs,
+                          retry.step_deadline(step, run.deadline))
+  if debug:
+    events.log("Response", level=events.DEBUG, response=response)
+
+  # The response will be a JSON document like this:
+  #{
+  #  "started": true,
+  #  "nonce": "2dbd10f1-8528-6246-09e7-82b25b8aba63",
+  #  "progress": 0,
+  #  "required": 3,
+  #  "encoded_token": "",
+  #  "otp": "2vPFYG8gUSW9npwzyvxXMug0",
+  #  "otp_length" :24,
+  #  "complete": false
+  #}
+  return json.loads(json.dumps(response))
+
+def recovery_key(run, i):
+  # Reuse a recovery key entered earlier in this run
+  if i <= len(run.recovery_keys):
+    return run.recovery_keys[i-1]
+  # Check to see if the recovery key environment variable of this cluster pair
+  # or the secondary vault recovery key environment variable is set
+  unseal_key = os.getenv('VAULT_RECOVERY_KEY_'+run.name.upper()+'_'+str(i),
+                         os.getenv('VAULT_RECOVERY_KEY_'+str(i)))
+  # If not, prompt for the recovery key, one prompt at a time across pairs
+  if unseal_key == None:
+    with prompt_lock:
+      while unseal_key == None or unseal_key == '':
+        unseal_key = getpass.getpass(prompt="Enter Vault Recovery Key " + str(i) +
+                                     " for " + run.name + ":")
+  events.logger.secret(unseal_key)
+  run.recovery_keys.append(unseal_key)
+  return unseal_key
 
 #---------------------------------------------------------------------------------------
-# Step 3-B: Cancel any DR token generation process on the secondary if any are active
+# Function to collect the recovery keys from the custodians concurrently, see
+# key_collection.py. The keys of the environment and those entered earlier in
+# this run are submitted first. Returns the final response of the attempt.
 #---------------------------------------------------------------------------------------
-print(time.strftime("[%a, %d %b %Y %H:%M:%S]", time.localtime()),
-   "*** About to cancel any active DR token generation process on the secondary cluster:", 
-   secondary_vault_cluster_domain)
+def collect_recovery_keys(run, cluster_domain, attempt, step):
+  url = cluster_domain + '/v1/sys/replication/dr/secondary/generate-operation-token/update'
 
-url = secondary_vault_cluster_domain +\
-   '/v1/sys/replication/dr/secondary/generate-operation-token/attempt' 
-  
-payload =  {}
+  def submit(key):
+    return http_request(run.sessions.get(cluster_domain), POST, url,
+                        {"key": key, "nonce": attempt.get('nonce')}, run.hdrs,
+                        retry.step_deadline(step, run.deadline), abort=False)
 
-if debug:
-  print('URL=',url,'Payload=',payload,'Headers=',hdrs)
+  collection = run.key_collector.open(run.name, attempt, submit)
+  try:
+    known = list(run.recovery_keys)
+    for i in range(1, (attempt.get('required') or 0) + 1):
+      key = os.getenv('VAULT_RECOVERY_KEY_'+run.name.upper()+'_'+str(i),
+                      os.getenv('VAULT_RECOVERY_KEY_'+str(i)))
+      if key not in (None, '') and key not in known:
+        known.append(key)
+    for key in known:
+      if collection.complete():
+        break
+      collection.add(key, 'the environment' if key not in run.recovery_keys else 'an earlier step')
+    response_dict = collection.wait(run.key_collector.timeout)
+  finally:
+    run.key_collector.close(run.name)
+  # Keep the keys for Step 5-D and a deferred demotion
+  run.recovery_keys = list(collection.keys)
+  if response_dict == None:
+    events.log("Error: Only", collection.progress, "of", collection.required, "recovery keys for",
+               run.name, "arrived within", run.key_collector.timeout, "seconds", level=events.ERROR)
+    events.log("Aborting script", level=events.ERROR)
+    sys.exit()
+  return response_dict
+
+def continue_operation_token(run, cluster_domain, attempt, step, collect=True):
+  url = cluster_domain + '/v1/sys/replication/dr/secondary/generate-operation-token/update' 
+  complete = attempt.get('complete') 
+  otp = attempt.get('otp')
+  nonce = attempt.get('nonce')
+  response_dict = attempt
+  i = 1
+
+  if complete == False and run.key_collector != None and collect:
+    response_dict = collect_recovery_keys(run, cluster_domain, attempt, step)
+    complete = True
+
+  while complete == False:
+    payload = { "key": recovery_key(run, i), "nonce": nonce }
+
+    if debug:
+      events.log("Request", url, level=events.DEBUG, payload=payload, headers=run.hdrs)
+    response = http_request(run.sessions.get(cluster_domain), POST, url, payload, run.hdrs,
+                            retry.step_deadline(step, run.deadline))
+    if debug:
+      events.log("Response", level=events.DEBUG, response=response)
+    # The intermediate response will be a JSON document like this:
+    #{
+    #  "started": true,
+    #  "nonce": "2dbd10f1-8528-6246-09e7-82b25b8aba63",
+    #  "progress": 1 or 2,
+    #  "required": 3,
+    #  "encoded_token": "",
+    #  "otp": "2vPFYG8gUSW9npwzyvxXMug0",
+    #  "otp_length" :24,
+    #  "complete": false
+    #}
+
+    response_dict = json.loads(json.dumps(response))
+    # So, let's parse out the complete status
+    complete = response_dict.get('complete') 
+    i+=1
+  # The final response will be a JSON document like this:
+  #{
+  #  "started": true,
+  #  "nonce": "2dbd10f1-8528-6246-09e7-82b25b8aba63",
+  #  "progress": 3,
+  #  "required": 3,
+  #  "pgp_fingerprint": "",
+  #  "complete": true,
+  #  "encoded_token": "FPzkNBvwNDeFh4SmGA8c+w=="
+  #}
+  if response_dict.get('encoded_token') in (None, '') or otp == None:
+    events.log("Error: No encoded DR operation token in the final response from", cluster_domain,
+               level=events.ERROR)
+    events.log("Aborting script", level=events.ERROR)
+    sys.exit()
+  ##Decode the encoded token
+  dr_operation_token = xor_bytes(base64.b64decode(response_dict.get('encoded_token') + '==').decode(),otp)
+
+  if dr_operation_token == None:
+    events.log("Unable to decode a valid DR operation token. Length of decoded token is",
+               len(base64.b64decode(response_dict.get('encoded_token') + '==')),
+               "while length of OTP is",len(otp),"- unable to perform XOR operation.",
+               level=events.ERROR)
+    sys.exit()
 
-response = http_request(None, DELETE, url, payload, hdrs)
+  events.logger.secret(dr_operation_token)
+  return dr_operation_token
 
-if debug:
-  print(response)
 #---------------------------------------------------------------------------------------
-# Step 3-C: Start the DR operation token generation process
+# PREPARE: everything that can be done before the promotion starts, see prepare.py.
+# Problems are reported rather than aborting, the run may not need what is missing.
+# primary_reachable, if known, saves probing the primary again; without
+# check_vault_token the TTL of the Vault token is not looked up.
 #---------------------------------------------------------------------------------------
-print(time.strftime("[%a, %d %b %Y %H:%M:%S]", time.localtime()),
-   "*** About to start the DR token generation process on the secondary cluster:", 
-   secondary_vault_cluster_domain)
+def prepare_dr(environment, primary_vault_cluster_domain, secondary_vault_cluster_domain,
+               vault_cluster_zone_id, vault_token, route53, sessions, collect_keys=False,
+               min_token_ttl=prepare.DEFAULT_MIN_TOKEN_TTL, known_keys=(), prompt=True,
+               dns_providers=None, primary_reachable=None, check_vault_token=True,
+               run_deadline=None):
+  import requests
+  start = time.monotonic()
+  preparation = prepare.Preparation(environment, primary_vault_cluster_domain,
+                                    secondary_vault_cluster_domain, min_token_ttl)
+  preparation.collect_keys = collect_keys
+  hdrs = {'X-Vault-Token': vault_token }
+
+  def lookup(cluster_domain, verb, path, payload):
+    return http_request(sessions.get(cluster_domain), verb, cluster_domain + path, payload, hdrs,
+                        retry.step_deadline('prepare', run_deadline), abort=False)
+
+  # Check the TTLs of the Vault token and of a pre-staged DR operation batch
+  # token on the current primary, probing it unless the caller already did
+  batch_token = staged_batch_token(environment)
+  if check_vault_token or batch_token not in (None, ''):
+    if primary_reachable == None:
+      primary_reachable = reconciler.probe(sessions.get(primary_vault_cluster_domain),
+                                           primary_vault_cluster_domain,
+                                           reconciler.DEFAULT_PROBE_TIMEOUT)
+    if primary_reachable:
+      if check_vault_token:
+        try:
+          ttl = (lookup(primary_vault_cluster_domain, GET, '/v1/auth/token/lookup-self', {})
+                 .get('data') or {}).get('ttl') or 0
+          if ttl > 0:
+            preparation.vault_token_expires = time.monotonic() + ttl
+            if ttl < min_token_ttl:
+              preparation.problems.append('the Vault token expires in ' + str(ttl) + ' seconds')
+        except requests.exceptions.RequestException as e:
+          preparation.problems.append('the Vault token could not be looked up: ' + str(e))
+      if batch_token not in (None, ''):
+        try:
+          data = lookup(primary_vault_cluster_domain, POST, '/v1/auth/token/lookup',
+                        {'token': batch_token}).get('data') or {}
+          if data.get('type') != 'batch':
+            preparation.problems.append('VAULT_DR_OPERATION_TOKEN is not a batch token')
+          else:
+            preparation.batch_token = batch_token
+            preparation.batch_token_expires = time.monotonic() + (data.get('ttl') or 0)
+            if (data.get('ttl') or 0) < min_token_ttl:
+              preparation.problems.append('the DR operation batch token expires in ' +
+                                          str(data.get('ttl')) + ' seconds, generating tokens instead')
+        except requests.exceptions.RequestException as e:
+          preparation.problems.append('the DR operation batch token is not valid: ' + str(e))
+    else:
+      preparation.problems.append('the primary is unreachable, token TTLs were not checked')
+      if batch_token not in (None, ''):
+        preparation.batch_token = batch_token
+
+  # Find out how many recovery keys an operation token needs and gather them,
+  # unless the batch token makes them unnecessary or the custodians send them
+  try:
+    preparation.required_keys = lookup(secondary_vault_cluster_domain, GET,
+                                       '/v1/sys/replication/dr/secondary/generate-operation-token/attempt',
+                                       {}).get('required')
+  except requests.exceptions.RequestException as e:
+    preparation.problems.append('the number of recovery keys could not be read: ' + str(e))
+  preparation.recovery_keys = list(known_keys)
+  for i in range(len(preparation.recovery_keys) + 1, (preparation.required_keys or 0) + 1):
+    unseal_key = os.getenv('VAULT_RECOVERY_KEY_'+environment.upper()+'_'+str(i),
+                           os.getenv('VAULT_RECOVERY_KEY_'+str(i)))
+    if (unseal_key == None and prompt and not collect_keys and
+        preparation.operation_token() == None):
+      with prompt_lock:
+        while unseal_key == None or unseal_key == '':
+          unseal_key = getpass.getpass(prompt="Enter Vault Recovery Key " + str(i) +
+                                       " for " + environment + ":")
+    if unseal_key in (None, ''):
+      break
+    preparation.recovery_keys.append(unseal_key)
+
+  # Check the AWS credentials and the hosted zone, and any other DNS provider
+  if dns_providers == None:
+    dns_providers = [route53_provider(route53, vault_cluster_zone_id)]
+  for provider in dns_providers:
+    try:
+      provider.check()
+    except Exception as e:
+      preparation.problems.append('the DNS provider ' + provider.describe() +
+                                  ' could not be used: ' + str(e))
+
+  preparation.seconds = time.monotonic() - start
+  return preparation
+
+def staged_batch_token(environment):
+  batch_token = os.getenv('VAULT_DR_OPERATION_TOKEN_' + environment.upper(),
+                          os.getenv('VAULT_DR_OPERATION_TOKEN'))
+  events.logger.secret(batch_token)
+  return batch_token
+
+def prepared_operation_token(run):
+  if run.preparation == None:
+    return None
+  return run.preparation.operation_token()
 
-url = secondary_vault_cluster_domain +\
-   '/v1/sys/replication/dr/secondary/generate-operation-token/attempt' 
-  
-payload =  {}
+#---------------------------------------------------------------------------------------
+# Prepare phase of a run without a preparation, run alongside Steps 3-A and 3-B
+# so that it is part of the run rather than ahead of it. It takes whether the
+# old primary is reachable from the probe step, which it waits for only if a
+# batch token has to be looked up there. It leaves out the TTL of the Vault
+# token, which Step 3-A uses at once, and the DNS providers, whose Route 53
+# hosted zones the warm-up already checked.
+#---------------------------------------------------------------------------------------
+def prepare_run(run):
+  run.preparation = prepare_dr(run.environment, run.primary_vault_cluster_domain,
+                               run.secondary_vault_cluster_domain, run.vault_cluster_zone_id,
+                               run.hdrs['X-Vault-Token'], run.route53, run.sessions,
+                               run.key_collector != None, run.min_token_ttl, run.recovery_keys,
+                               dns_providers=[], primary_reachable=run.old_primary_reachable,
+                               check_vault_token=False, run_deadline=run.deadline)
+  run.preparation.report()
+  run.recovery_keys = list(run.preparation.recovery_keys)
 
-if debug:
-  print('URL=',url,'Payload=',payload,'Headers=',hdrs)
-response = http_request(None, POST, url, payload, hdrs)
+#---------------------------------------------------------------------------------------
+# STEP 3: PROMOTE DR SECONDARY TO PRIMARY
+#---------------------------------------------------------------------------------------
+#---------------------------------------------------------------------------------------
+# Step 3-A: Ensure that the secondary has replication in the correct state
+#---------------------------------------------------------------------------------------
+def step_3a_check_replication_status(run):
+  # A recent enough status of a healthy secondary from the readiness monitor
+  # saves the round trip; an unhealthy or stale one is checked live
+  if run.readiness != None:
+    sample, age = run.readiness.fresh_healthy_secondary(run.secondary_vault_cluster_domain)
+    if sample != None:
+      events.log("*** Replication status of the secondary cluster",
+                 run.secondary_vault_cluster_domain,
+                 "was", sample.mode, sample.state, format(age, '.1f'),
+                 "seconds ago, skipping the live check")
+      return
 
-if debug:
-  print(response)
+  events.log("*** About to check the replication status on the secondary cluster:",
+             run.secondary_vault_cluster_domain)
 
-# The response will be a JSON document like this:
-#{
-#  "started": true,
-#  "nonce": "2dbd10f1-8528-6246-09e7-82b25b8aba63",
-#  "progress": 0,
-#  "required": 3,
-#  "encoded_token": "",
-#  "otp": "2vPFYG8gUSW9npwzyvxXMug0",
-#  "otp_length" :24,
-#  "complete": false
-#}
+  url = run.secondary_vault_cluster_domain + '/v1/sys/replication/dr/status'
 
+  payload =  {}
 
-response_dict = json.loads(json.dumps(response))
-complete = response_dict.get('complete') 
-otp = response_dict.get('otp')
-nonce = response_dict.get('nonce')
+  if debug:
+    events.log("Request", url, level=events.DEBUG, payload=payload, headers=run.hdrs)
+
+  response = http_request(run.sessions.get(run.secondary_vault_cluster_domain), GET, url, payload,
+                          run.hdrs, retry.step_deadline('3-A', run.deadline))
 
-payload =  {}
-i = 1
+  if debug:
+    events.log("Response", level=events.DEBUG, response=response)
+
+  # The response from the secondary will be a JSON document like this:
+  #{
+  #  "data": {
+  #    "cluster_id": "d4095d41-3aee-8791-c421-9bc7f88f7c3e",
+  #    "known_primary_cluster_addrs": [
+  #      "https://127.0.0.1:8201"
+  #    ],
+  #    "last_remote_wal": 241,
+  #    "merkle_root": "56794a98e52598f35974024fba6691f047e772e9",
+  #    "mode": "secondary",
+  #    "primary_cluster_addr": "https://127.0.0.1:8201",
+  #    "secondary_id": "3",
+  #    "state": "stream-wals"
+  #  },
+  #}
+
+  response_dict = json.loads(json.dumps(response))
+
+  repl_mode = (response_dict.get('data') or {}).get('mode')
+  repl_state = (response_dict.get('data') or {}).get('state')
+
+  if repl_mode != 'secondary': 
+    events.log("Error: The current secondary vault cluster", run.secondary_vault_cluster_domain,
+               "has a replication mode of", repl_mode, level=events.ERROR)
+    events.log("Aborting script", level=events.ERROR)
+    sys.exit()
+  if repl_state != 'stream-wals':
+    events.log("Error: The current secondary vault cluster", run.secondary_vault_cluster_domain,
+               "has a replication state of", repl_state, level=events.ERROR)
+    events.log("Aborting script", level=events.ERROR)
+    sys.exit()
 
 #---------------------------------------------------------------------------------------
-# Step 3-D: Continue the DR token generation process by prompting for the Recovery keys
+# Step 3-B: Cancel any DR token generation process on the secondary if any are active
 #---------------------------------------------------------------------------------------
-print(time.strftime("[%a, %d %b %Y %H:%M:%S]", time.localtime()),
-      "*** About to continue the DR token generation process on the secondary cluster:", 
-      secondary_vault_cluster_domain)
+def step_3b_cancel_token_generation(run):
+  events.log("*** About to cancel any active DR token generation process on the secondary cluster:",
+             run.secondary_vault_cluster_domain)
 
-url = secondary_vault_cluster_domain + '/v1/sys/replication/dr/secondary/generate-operation-token/update' 
+  url = run.secondary_vault_cluster_domain +\
+     '/v1/sys/replication/dr/secondary/generate-operation-token/attempt' 
 
-while complete == False:
-# Check to see if the secondary vault recovery key environment variable is set
-  unseal_key = os.getenv('VAULT_RECOVERY_KEY_'+str(i))
-# If not, prompt for the recovery key
-  if unseal_key == None:
-    while unseal_key == None or unseal_key == '':
-     unseal_key = getpass.getpass(prompt="Enter Vault Recovery Key " + str(i) + ":")
-
-  os.putenv('VAULT_RECOVERY_KEY_'+str(i),unseal_key)
-  payload = { "key": unseal_key, "nonce": nonce }
+  payload =  {}
 
   if debug:
-    print('URL=',url,'Payload=',payload,'Headers=',hdrs)
-  response = http_request(None, POST, url, payload, hdrs)
+    events.log("Request", url, level=events.DEBUG, payload=payload, headers=run.hdrs)
+
+  response = http_request(run.sessions.get(run.secondary_vault_cluster_domain), DELETE, url, payload,
+                          run.hdrs, retry.step_deadline('3-B', run.deadline))
+
   if debug:
-    print(response)
-  # The intermediate response will be a JSON document like this:
-  #{
-  #  "started": true,
-  #  "nonce": "2dbd10f1-8528-6246-09e7-82b25b8aba63",
-  #  "progress": 1 or 2,
-  #  "required": 3,
-  #  "encoded_token": "",
-  #  "otp": "2vPFYG8gUSW9npwzyvxXMug0",
-  #  "otp_length" :24,
-  #  "complete": false
-  #}
+    events.log("Response", level=events.DEBUG, response=response)
+
+#---------------------------------------------------------------------------------------
+# Check, in parallel with Step 3, whether the old primary is reachable at all. If it
+# is not, Step 5 is deferred until it comes back.
+#---------------------------------------------------------------------------------------
+def probe_old_primary(run):
+  events.log("*** About to check whether the old primary is reachable",
+             run.primary_vault_cluster_domain)
+  run.old_primary_reachable = reconciler.probe(
+    run.sessions.get(run.primary_vault_cluster_domain), run.primary_vault_cluster_domain,
+    run.reconcile_config.get('probe_timeout', reconciler.DEFAULT_PROBE_TIMEOUT))
+  return run.old_primary_reachable
+
+#---------------------------------------------------------------------------------------
+# Step 3-C: Start the DR operation token generation process
+#---------------------------------------------------------------------------------------
+def step_3c_start_token_generation(run):
+  if prepared_operation_token(run) != None:
+    events.log("*** Using the pre-staged DR operation batch token for the secondary cluster:",
+               run.secondary_vault_cluster_domain)
+    return
+  events.log("*** About to start the DR token generation process on the secondary cluster:",
+             run.secondary_vault_cluster_domain)
+  run.promotion_attempt = start_operation_token(run, run.secondary_vault_cluster_domain, '3-C')
+
+#---------------------------------------------------------------------------------------
+# Step 3-D: Continue the DR token generation process by prompting for the Recovery keys
+#---------------------------------------------------------------------------------------
+def step_3d_continue_token_generation(run):
+  if prepared_operation_token(run) != None:
+    run.dr_operation_token = prepared_operation_token(run)
+    return
+  events.log("*** About to continue the DR token generation process on the secondary cluster:",
+             run.secondary_vault_cluster_domain)
+  run.dr_operation_token = continue_operation_token(run, run.secondary_vault_cluster_domain,
+                                                    run.promotion_attempt, '3-D')
+
+#---------------------------------------------------------------------------------------
+# Promotion gate: wait, up to max_wait seconds, until the secondary is at most
+# max_wal_lag WALs behind a reachable old primary, and record the data-loss window
+#---------------------------------------------------------------------------------------
+def promotion_gate_wait(run):
+  if run.old_primary_reachable:
+    events.log("*** About to compare the WALs of the old primary", run.primary_vault_cluster_domain,
+               "and the secondary", run.secondary_vault_cluster_domain)
+
+    import requests
+    unreachable = []
+
+    # A cluster that stops answering opens the gate instead of aborting the run
+    def sample():
+      wals = []
+      for cluster_domain, wal in ((run.primary_vault_cluster_domain, 'last_wal'),
+                                  (run.secondary_vault_cluster_domain, 'last_remote_wal')):
+        try:
+          status = replication_status(run, cluster_domain, 'gate', abort=False)
+        except requests.exceptions.RequestException as err:
+          unreachable.append(cluster_domain)
+          return None
+        wals.append(status.get(wal) or 0)
+      return tuple(wals)
+
+    estimator, reason = promotion_gate.wait_for_catch_up(
+      sample, run.promotion_gate.get('max_wal_lag', promotion_gate.DEFAULT_MAX_WAL_LAG),
+      run.promotion_gate.get('max_wait', promotion_gate.DEFAULT_MAX_WAIT),
+      run.promotion_gate.get('sample_interval', promotion_gate.DEFAULT_SAMPLE_INTERVAL))
+    if reason == promotion_gate.UNREACHABLE:
+      # The WALs the secondary has not received are unknown
+      run.wal_lag = None
+      run.data_loss_window = None
+      if run.primary_vault_cluster_domain in unreachable:
+        # Defer Step 5 as if the probe had not reached the old primary
+        run.old_primary_reachable = False
+      events.log("***", unreachable[0], "stopped answering during the promotion gate, not waiting;",
+                 "data-loss window unknown", level=events.WARNING)
+    else:
+      run.wal_lag = estimator.lag()
+      run.data_loss_window = estimator.data_loss_window()
+      events.log("*** Secondary is", run.wal_lag, "WALs behind" +
+                 (" after the promotion gate timed out" if reason == promotion_gate.DEADLINE else "") +
+                 "; estimated data-loss window", promotion_gate.format_seconds(run.data_loss_window))
+  else:
+    # Writes the secondary had received by the last time the readiness monitor
+    # saw the primary cannot be lost
+    replicated = None
+    if run.readiness != None:
+      replicated = run.readiness.replicated_until(run.primary_vault_cluster_domain,
+                                                  run.secondary_vault_cluster_domain)
+    if replicated != None:
+      run.data_loss_window = time.monotonic() - replicated
+    events.log("*** Old primary", run.primary_vault_cluster_domain, "is unreachable, not waiting;",
+               "data-loss window at most", promotion_gate.format_seconds(run.data_loss_window))
+  span = tracing.tracer.current()
+  if span != None:
+    span.attributes['wal_lag'] = run.wal_lag
+    span.attributes['data_loss_window'] = run.data_loss_window
 
-  response_dict = json.loads(json.dumps(response))
-  # So, let's parse out the complete status
-  complete = response_dict.get('complete') 
-  i+=1
-# The final response will be a JSON document like this:
-#{
-#  "started": true,
-#  "nonce": "2dbd10f1-8528-6246-09e7-82b25b8aba63",
-#  "progress": 3,
-#  "required": 3,
-#  "pgp_fingerprint": "",
-#  "complete": true,
-#  "encoded_token": "FPzkNBvwNDeFh4SmGA8c+w=="
-#}
-##Decode the encoded token
-dr_operation_token = xor_bytes(base64.b64decode(response_dict.get('encoded_token') + '==').decode(),otp)
-
-if dr_operation_token == None:
-  print("Unable to decode a valid DR operation token. Length of decoded token is", 
-         len(base64.b64decode(response_dict.get('encoded_token') + '==')),
-         "while length of OTP is",len(otp),"- unable to perform XOR operation.")
-  sys.exit()
-  
 #---------------------------------------------------------------------------------------
 # Step 3-E: Finally promote the secondary to primary
 #---------------------------------------------------------------------------------------
-print(time.strftime("[%a, %d %b %Y %H:%M:%S]", time.localtime()),
-      "*** About to promote the current secondary to a primary on the secondary cluster:", secondary_vault_cluster_domain)
-payload = { "dr_operation_token": dr_operation_token }
+def step_3e_promote_secondary(run):
+  events.log("*** About to promote the current secondary to a primary on the secondary cluster:",
+             run.secondary_vault_cluster_domain)
+  payload = { "dr_operation_token": run.dr_operation_token }
 
-url = secondary_vault_cluster_domain + '/v1/sys/replication/dr/secondary/promote' 
+  url = run.secondary_vault_cluster_domain + '/v1/sys/replication/dr/secondary/promote' 
+
+  if debug:
+    events.log("Request", url, level=events.DEBUG, payload=payload, headers=run.hdrs)
+  response = http_request(run.sessions.get(run.secondary_vault_cluster_domain), POST, url, payload,
+                          run.hdrs, retry.step_deadline('3-E', run.deadline))
+  if debug:
+    events.log("Response", level=events.DEBUG, response=response)
 
-if debug:
-  print('URL=',url,'Payload=',payload,'Headers=',hdrs)
-response = http_request(None, POST, url, payload, hdrs)
-if debug:
-  print(response)
 #---------------------------------------------------------------------------------------
 # STEP 4: UPDATE THE DNS CNAME TO POINT TO THE NEW PRIMARY
 #---------------------------------------------------------------------------------------
-# Update the CNAME of the Vault Cluster in AWS Route 53
-print(time.strftime("[%a, %d %b %Y %H:%M:%S]", time.localtime()),
-      "*** About to change the CNAME", cluster_cname, "in DNS to point to the new primary", secondary_vault_cluster_domain)
+def step_4_update_cname(run):
+  span = tracing.tracer.current()
+  if span != None:
+    span.attributes['dns_max_staleness'] = run.dns_strategy.max_staleness(run.cluster_cname)
+  if not run.dns_strategy.updates_records():
+    # Route 53 failover routing moves the CNAME once the health checks flip
+    events.log("*** DNS strategy", run.dns_strategy.mode + ":",
+               run.dns_strategy.describe(run.cluster_cname))
+    return
+
+  # Update the CNAME of the Vault Cluster in AWS Route 53
+  events.log("*** About to change the CNAME", run.cluster_cname,
+             "in DNS to point to the new primary",
+             run.secondary_vault_cluster_domain, "with a TTL of", run.dns_strategy.cutover_ttl(),
+             "seconds")
+  events.log("*** DNS strategy", run.dns_strategy.mode + ":",
+             run.dns_strategy.describe(run.cluster_cname))
+
+  # Every DNS provider of the pair at once, the step is done when all have the change
+  change = None
+  if run.cname_batcher != None:
+    change = lambda provider: run.cname_batcher.submit(provider.key(), run.cluster_cname,
+                                                       run.secondary_vault_cluster_domain)
+  run.changes = update_cname_records(run.dns_providers,
+                                     [(run.cluster_cname, run.secondary_vault_cluster_domain)],
+                                     run.dns_strategy.cutover_ttl(), change)
 
-update_cname_record(vault_cluster_zone_id, cluster_cname, secondary_vault_cluster_domain, aws_aki, aws_sk)
+#---------------------------------------------------------------------------------------
+# Take the CNAME of a run that will not reach Step 4 out of the batches of the
+# concurrent pairs
+#---------------------------------------------------------------------------------------
+def withdraw_cname(run):
+  if run.cname_batcher != None:
+    for provider in run.dns_providers:
+      run.cname_batcher.withdraw(provider.key(), run.cluster_cname)
 
 #---------------------------------------------------------------------------------------
-# Sleep and wait for DNS changes to propagate
+# Wait for DNS changes to propagate
 #---------------------------------------------------------------------------------------
-dns_propagation_delay = os.getenv('DNS_PROPAGATION_DELAY')
+def step_4_wait_for_propagation(run):
+  # Wait until every DNS provider has the change in sync (Route 53 reports it as
+  # INSYNC) and the configured resolvers return the new primary, for at most
+  # dns_propagation_delay seconds, so that the new secondary is ready to be updated.
+  events.log("*** About to wait up to", run.dns_propagation_delay,
+              "seconds for DNS changes to propagate to", run.cluster_cname)
+  dns_propagation.wait_for_dns_propagation([(provider, run.changes.get(provider.name))
+                                            for provider in run.dns_providers],
+                                           run.cluster_cname, run.secondary_vault_cluster_domain,
+                                           run.dns_resolvers, run.dns_propagation_delay,
+                                           run.dns_poll_interval, run.dns_strategy.updates_records())
 
-if dns_propagation_delay == None:
-  dns_propagation_delay = 60
-else:
-  dns_propagation_delay = int(dns_propagation_delay)
+#---------------------------------------------------------------------------------------
+# Restore the TTL of the CNAME once the cut-over has propagated, if it was
+# lowered for the failover
+#---------------------------------------------------------------------------------------
+def step_4_restore_ttl(run):
+  run.dns_strategy.after_cutover(
+    lambda records, ttl: update_cname_records(run.dns_providers, records, ttl),
+    run.cluster_cname, run.secondary_vault_cluster_domain)
 
-# Sleep for dns_propagation_delay seconds so that the new secondary is ready to be updated.
-print(time.strftime("[%a, %d %b %Y %H:%M:%S]", time.localtime()),
-      "*** About to sleep for", dns_propagation_delay, 
-       "seconds for DNS changes to propagate before demoting old primary", 
-       primary_vault_cluster_domain)
-time.sleep(dns_propagation_delay)
+#---------------------------------------------------------------------------------------
+# Verify that the new primary serves clients on every one of its nodes, through
+# its ELB and through the CNAME, concurrently with Step 5. Returns whether it
+# passed.
+#---------------------------------------------------------------------------------------
+def verify_new_primary(run):
+  events.log("*** About to verify the new primary", run.secondary_vault_cluster_domain,
+             "on each of its nodes, through its ELB and through", run.cluster_cname)
+  result = verification.verify(run.secondary_vault_cluster_domain, run.cluster_cname,
+                               run.hdrs, **run.verification)
+  result.report(run.name)
+  span = tracing.tracer.current()
+  if span != None:
+    span.attributes['passed'] = result.passed()
+  return result.passed()
 
 #---------------------------------------------------------------------------------------
 # STEP 5: DEMOTE DR PRIMARY TO SECONDARY
@@ -478,161 +878,1458 @@ time.sleep(dns_propagation_delay)
 #---------------------------------------------------------------------------------------
 # Step 5-A: Demote the primary to a secondary
 #---------------------------------------------------------------------------------------
-print(time.strftime("[%a, %d %b %Y %H:%M:%S]", time.localtime()),
-      "*** About to demote the old primary to a secondary", primary_vault_cluster_domain)
-hdrs = {'X-Vault-Token': vault_token } 
-url = primary_vault_cluster_domain + '/v1/sys/replication/dr/primary/demote' 
+def step_5a_demote_primary(run):
+  if run.fenced_by == fencing.DEMOTE:
+    events.log("*** The old primary", run.primary_vault_cluster_domain,
+               "was already demoted by the fence")
+    return
+  events.log("*** About to demote the old primary to a secondary", run.primary_vault_cluster_domain)
+  demote_primary(run, retry.step_deadline('5-A', run.deadline))
+  if run.fenced_at == None:
+    run.fenced_at = time.monotonic()
+    run.fenced_by = '5-A'
+
+def demote_primary(run, deadline, abort=True):
+  url = run.primary_vault_cluster_domain + '/v1/sys/replication/dr/primary/demote' 
+  payload = {}
 
-if debug:
-  print('URL=',url,'Payload=',payload,'Headers=',hdrs)
-response = http_request(None, POST, url, {}, hdrs)
-if debug:
-  print(response)
+  if debug:
+    events.log("Request", url, level=events.DEBUG, payload=payload, headers=run.hdrs)
+  response = http_request(run.sessions.get(run.primary_vault_cluster_domain), POST, url, payload,
+                          run.hdrs, deadline, abort)
+  if debug:
+    events.log("Response", level=events.DEBUG, response=response)
 
-if environment == 'prod':
-  secondary_id = primary_vault_cluster_domain[17:25]
-elif environment == 'staging':
-  secondary_id = primary_vault_cluster_domain[17:28]
-elif environment == 'test':
-  secondary_id = primary_vault_cluster_domain[17:25]
+#---------------------------------------------------------------------------------------
+# Fence the old primary as soon as the secondary is promoted, concurrently with
+# Step 4, so that it stops taking writes within the fence deadline rather than
+# after the CNAME has propagated. A fence that does not succeed in time leaves
+# the old primary to Step 5-A. Returns whether the old primary was fenced.
+#---------------------------------------------------------------------------------------
+def fence_old_primary(run):
+  events.log("*** About to fence the old primary", run.primary_vault_cluster_domain + ":",
+             run.fence.describe())
+  deadline = retry_policy.Deadline(run.fence.deadline, 'fence', retry, run.deadline)
+  error = run.fence.run(run.name, run.primary_vault_cluster_domain,
+                        run.secondary_vault_cluster_domain,
+                        lambda deadline: demote_primary(run, deadline, abort=False), deadline)
+  span = tracing.tracer.current()
+  if span != None:
+    span.attributes['fenced'] = error == None
+  if error != None:
+    events.log("Error: Could not fence the old primary", run.primary_vault_cluster_domain,
+               "within", run.fence.deadline, "seconds:", error,
+               "- it takes writes until Step 5-A demotes it", level=events.ERROR)
+    return False
+  run.fenced_at = time.monotonic()
+  run.fenced_by = run.fence.mode
+  events.log("*** Fenced the old primary", run.primary_vault_cluster_domain, "after",
+             format(deadline.elapsed(), '.3f'), "seconds")
+  return True
 
 #---------------------------------------------------------------------------------------
 # Step 5-B: Generate a new secondary activation token on the new secondary cluster
 #---------------------------------------------------------------------------------------
+def step_5b_generate_secondary_token(run):
+  events.log("*** About to generate a new secondary-token from the new primary",
+             run.secondary_vault_cluster_domain)
+
+  payload = { "id":  run.secondary_id+str(random.randint(1,9999999999)) }
+  # Concatenate the primary cluster domain and the token command to form the URL
+  url = run.secondary_vault_cluster_domain + '/v1/sys/replication/dr/primary/secondary-token'
+  ##
+  # Send the POST request to generate a secondary token.
+  if debug:
+    events.log("Request", url, level=events.DEBUG, payload=payload, headers=run.hdrs)
+  response = http_request(run.sessions.get(run.secondary_vault_cluster_domain), POST, url, payload,
+                          run.hdrs, retry.step_deadline('5-B', run.deadline))
+
+  if debug:
+    events.log("Response", level=events.DEBUG, response=response)
+  # The response will be a JSON document like this:
+  #{ 
+  # "request_id": "",
+  # "lease_id": "",
+  # "lease_duration": 0,
+  # "renewable": false,
+  # "data": null,
+  # "warnings": null,
+  # "wrap_info": {
+  #   "token": "fb79b9d3-d94e-9eb6-4919-c559311133d6",
+  #   "ttl": 300,
+  #   "creation_time": "2016-09-28T14:41:00.56961496-04:00",
+  #   "wrapped_accessor": ""
+  # }
+  #} 
+
+  # So, let's parse out the secondary token
+  response_dict = json.loads(json.dumps(response))
+  run.secondary_token = (response_dict.get('wrap_info') or {}).get('token')
+  if run.secondary_token == None:
+    events.log("Error: The new primary vault cluster", run.secondary_vault_cluster_domain,
+               "did not return a secondary token", level=events.ERROR)
+    events.log("Aborting script", level=events.ERROR)
+    sys.exit()
 
-print(time.strftime("[%a, %d %b %Y %H:%M:%S]", time.localtime()),
-      "*** About to generate a new secondary-token from the new primary", secondary_vault_cluster_domain)
-
-payload = { "id":  secondary_id+str(random.randint(1,9999999999)) }
-# Concatenate the primary cluster domain and the token command to form the URL
-url = secondary_vault_cluster_domain + '/v1/sys/replication/dr/primary/secondary-token'
-##
-# Send the POST request to generate a secondary token.
-if debug:
-  print('URL=',url,'Payload=',payload,'Headers=',hdrs)
-response = http_request(None, POST, url, payload, hdrs)
-
-if debug:
-  print(response)
-# The response will be a JSON document like this:
-#{ 
-# "request_id": "",
-# "lease_id": "",
-# "lease_duration": 0,
-# "renewable": false,
-# "data": null,
-# "warnings": null,
-# "wrap_info": {
-#   "token": "fb79b9d3-d94e-9eb6-4919-c559311133d6",
-#   "ttl": 300,
-#   "creation_time": "2016-09-28T14:41:00.56961496-04:00",
-#   "wrapped_accessor": ""
-# }
-#} 
-
-# So, let's parse out the secondary token
-response_dict = json.loads(json.dumps(response))
-secondary_token = response_dict.get('wrap_info').get('token')
 #---------------------------------------------------------------------------------------
 # Step 5-C: Generate a DR token on the new secondary cluster
 #---------------------------------------------------------------------------------------
-print(time.strftime("[%a, %d %b %Y %H:%M:%S]", time.localtime()),
-      "*** About to start generating a new DR operation token on the new secondary", primary_vault_cluster_domain)
-url = primary_vault_cluster_domain + '/v1/sys/replication/dr/secondary/generate-operation-token/attempt' 
-  
-payload =  {}
-
-if debug:
-  print('URL=',url,'Payload=',payload,'Headers=',hdrs)
-response = http_request(None, POST, url, payload, hdrs)
-# The response will be a JSON document like this:
-#{
-#  "started": true,
-#  "nonce": "2dbd10f1-8528-6246-09e7-82b25b8aba63",
-#  "progress": 0,
-#  "required": 3,
-#  "encoded_token": "",
-#  "otp": "2vPFYG8gUSW9npwzyvxXMug0",
-#  "otp_length" :24,
-#  "complete": false
-#}
-
-response_dict = json.loads(json.dumps(response))
-# So, let's parse out the complete status, otp and nonce
-complete = response_dict.get('complete') 
-otp = response_dict.get('otp')
-nonce = response_dict.get('nonce')
-
-payload =  {}
-i = 1
+def step_5c_start_token_generation(run):
+  if prepared_operation_token(run) != None:
+    events.log("*** Using the pre-staged DR operation batch token for the new secondary",
+               run.primary_vault_cluster_domain)
+    return
+  events.log("*** About to start generating a new DR operation token on the new secondary",
+             run.primary_vault_cluster_domain)
+  run.demotion_attempt = start_operation_token(run, run.primary_vault_cluster_domain, '5-C')
 
 #---------------------------------------------------------------------------------------
 # Step 5-D: Continue the DR token generation process by prompting for the Recovery keys
 #---------------------------------------------------------------------------------------
-print(time.strftime("[%a, %d %b %Y %H:%M:%S]", time.localtime()),
-      "*** About to continue generating a new DR operation token on the new secondary", primary_vault_cluster_domain)
-while complete == False:
-  # Check to see if the secondary vault recovery key environment variable is set
-  unseal_key = os.getenv('VAULT_RECOVERY_KEY_'+str(i))
-  # If not, prompt for the recovery key
-  if unseal_key == None:
-    while unseal_key == None or unseal_key == '':
-	      unseal_key = getpass.getpass(prompt="Enter Vault Recovery Key " + str(i) + ":")
-  payload = { "key": unseal_key, "nonce": nonce }
-  url = primary_vault_cluster_domain + '/v1/sys/replication/dr/secondary/generate-operation-token/update' 
+def step_5d_continue_token_generation(run):
+  if prepared_operation_token(run) != None:
+    run.new_secondary_dr_operation_token = prepared_operation_token(run)
+    return
+  events.log("*** About to continue generating a new DR operation token on the new secondary",
+             run.primary_vault_cluster_domain)
+  run.new_secondary_dr_operation_token = continue_operation_token(
+    run, run.primary_vault_cluster_domain, run.demotion_attempt, '5-D')
 
+#---------------------------------------------------------------------------------------
+# Step 5-E: Update DR Secondary with new Secondary token
+#---------------------------------------------------------------------------------------
+def step_5e_update_primary(run):
+  events.log("*** About to update the new secondary with the secondary token",
+             run.primary_vault_cluster_domain)
+  payload = { "dr_operation_token": run.new_secondary_dr_operation_token, 
+              "token": run.secondary_token,
+              "primary_api_addr": "https://"+run.cluster_cname 
+            }
+  url = run.primary_vault_cluster_domain + '/v1/sys/replication/dr/secondary/update-primary'
   if debug:
-    print('URL=',url,'Payload=',payload,'Headers=',hdrs)
-  response = http_request(None, POST, url, payload, hdrs)
-  # The intermediate response will be a JSON document like this:
-  #{
-  #  "started": true,
-  #  "nonce": "2dbd10f1-8528-6246-09e7-82b25b8aba63",
-  #  "progress": 1,
-  #  "required": 3,
-  #  "encoded_token": "",
-  #  "otp": "2vPFYG8gUSW9npwzyvxXMug0",
-  #  "otp_length" :24,
-  #  "complete": false
-  #}
+    events.log("Request", url, level=events.DEBUG, payload=payload, headers=run.hdrs)
+  response = http_request(run.sessions.get(run.primary_vault_cluster_domain), POST, url, payload,
+                          run.hdrs, retry.step_deadline('5-E', run.deadline))
+  if debug:
+    events.log("Response", level=events.DEBUG, response=response)
 
-  response_dict = json.loads(json.dumps(response))
-  # So, let's parse out the complete status
-  complete = response_dict.get('complete') 
-  i+=1
-# The final response will be a JSON document like this:
-#{
-#  "started": true,
-#  "nonce": "2dbd10f1-8528-6246-09e7-82b25b8aba63",
-#  "progress": 3,
-#  "required": 3,
-#  "pgp_fingerprint": "",
-#  "complete": true,
-#  "encoded_token": "FPzkNBvwNDeFh4SmGA8c+w=="
-#}
-##Decode the encoded token
-dr_operation_token = xor_bytes(base64.b64decode(response_dict.get('encoded_token') + '==').decode(),otp)
+#---------------------------------------------------------------------------------------
+# Step 5-F: Issue a secondary token on the new primary for every further DR and
+# performance secondary, and generate the DR operation token every further DR
+# secondary needs, all concurrently
+#---------------------------------------------------------------------------------------
+def follower_operation_token(run, follower):
+  if prepared_operation_token(run) != None:
+    return prepared_operation_token(run)
+  # Cancel any stale attempt first, as Step 3-B does on the secondary
+  url = follower.cluster_domain + '/v1/sys/replication/dr/secondary/generate-operation-token/attempt'
+  http_request(run.sessions.get(follower.cluster_domain), DELETE, url, {}, run.hdrs,
+               retry.step_deadline('5-F', run.deadline), abort=False)
+  attempt = start_operation_token(run, follower.cluster_domain, '5-F')
+  # The recovery keys of Step 3-D are submitted again, not collected again
+  return continue_operation_token(run, follower.cluster_domain, attempt, '5-F', collect=False)
+
+def step_5f_issue_follower_tokens(run):
+  events.log("*** About to generate secondary tokens from the new primary",
+             run.secondary_vault_cluster_domain, "for", len(run.followers), "further secondaries")
+
+  def issue(follower):
+    url = run.secondary_vault_cluster_domain + follower.path('primary/secondary-token')
+    payload = { "id": follower.secondary_id() + str(random.randint(1,9999999999)) }
+    response = http_request(run.sessions.get(run.secondary_vault_cluster_domain), POST, url, payload,
+                            run.hdrs, retry.step_deadline('5-F', run.deadline), abort=False)
+    follower.secondary_token = (json.loads(json.dumps(response)).get('wrap_info') or {}).get('token')
+    if follower.secondary_token == None:
+      raise RuntimeError(run.secondary_vault_cluster_domain + ' did not return a secondary token')
+    if follower.kind == topology.DR:
+      follower.operation_token = follower_operation_token(run, follower)
+
+  topology.fan_out(run.followers, issue)
 
 #---------------------------------------------------------------------------------------
-# Step 5-E: Update DR Secondary with new Secondary token
+# Step 5-G: Point every further secondary at the new primary with its secondary
+# token, concurrently and each with its own retries, and wait until it streams
+# again. Returns whether all of them converged.
 #---------------------------------------------------------------------------------------
-print(time.strftime("[%a, %d %b %Y %H:%M:%S]", time.localtime()),
-      "*** About to update the new secondary with the secondary token", primary_vault_cluster_domain)
-payload = { "dr_operation_token": dr_operation_token, 
-            "token": secondary_token,
-            "primary_api_addr": "https://"+cluster_cname 
-          }
-url = primary_vault_cluster_domain + '/v1/sys/replication/dr/secondary/update-primary'
-if debug:
-  print('URL=',url,'Payload=',payload,'Headers=',hdrs)
-response = http_request(None, POST, url, payload, hdrs)
-if debug:
-  print(response)
-
-
-print(time.strftime("[%a, %d %b %Y %H:%M:%S]", time.localtime()),
-      "*** Vault Disaster Recovery Operation Successful. Failed over from", 
-        primary_vault_cluster_domain, "to", secondary_vault_cluster_domain)
+def step_5g_update_followers(run):
+  events.log("*** About to update", len(run.followers),
+             "further secondaries with their secondary tokens")
+
+  def update(follower):
+    session = run.sessions.get(follower.cluster_domain)
+    deadline = retry.step_deadline('5-G', run.deadline)
+    payload = { "token": follower.secondary_token,
+                "primary_api_addr": "https://"+run.cluster_cname }
+    if follower.kind == topology.DR:
+      payload["dr_operation_token"] = follower.operation_token
+    http_request(session, POST, follower.cluster_domain + follower.path('secondary/update-primary'),
+                 payload, run.hdrs, deadline, abort=False)
+    follower.updated = time.monotonic()
+    while True:
+      response = http_request(session, GET, follower.cluster_domain + follower.path('status'), {},
+                              run.hdrs, deadline, abort=False)
+      data = json.loads(json.dumps(response)).get('data') or {}
+      if data.get('mode') == 'secondary' and data.get('state') == 'stream-wals':
+        follower.converged = time.monotonic()
+        return
+      if deadline.remaining() <= 0:
+        raise RuntimeError('not streaming before the step deadline, state ' + str(data.get('state')))
+      tracing.tracer.sleep(min(topology.DEFAULT_POLL_INTERVAL, deadline.remaining()), 'topology-poll')
+
+  topology.fan_out(run.followers, update)
+  passed = topology.report(run.name, run.followers, run.started)
+  span = tracing.tracer.current()
+  if span != None:
+    span.attributes['passed'] = passed
+  return passed
+
+#--------------------------------------------------------------------------------
+# Function to print when the whole topology of a run followed the new primary:
+# the old primary (Step 5-E) and the further secondaries
+#--------------------------------------------------------------------------------
+def report_topology(run, scheduler, run_span):
+  converged = [follower.converged for follower in run.followers]
+  old_primary = scheduler.steps['5-E']
+  if old_primary.end != None and not old_primary.failed and not old_primary.restored:
+    converged.append(old_primary.end)
+  elif old_primary.end == None:
+    converged.append(None)
+  if None in converged:
+    events.log("*** Topology of", run.name, "has not fully converged:",
+               sum(1 for follower in run.followers if follower.converged != None), "of",
+               len(run.followers), "further secondaries follow the new primary" +
+               ("" if old_primary.end != None else ", the old primary is not re-pointed yet"))
+    return
+  run_span.attributes['topology_converged'] = max(converged) - run.started
+  events.log("*** Topology of", run.name, "converged", format(max(converged) - run.started, '.3f'),
+             "seconds after the start of the run: the old primary and", len(run.followers),
+             "further secondaries follow the new primary")
+
+#--------------------------------------------------------------------------------
+# Function to add the Step 5 nodes to a scheduler. Only the demotion and the
+# update of the old primary wait for DNS propagation; the secondary token is
+# generated on the new primary as soon as it is promoted.
+#--------------------------------------------------------------------------------
+def add_step_5(scheduler, run, promoted=(), propagated=(), condition=None):
+  scheduler.add('5-A', lambda: step_5a_demote_primary(run), propagated, condition=condition)
+  scheduler.add('5-B', lambda: step_5b_generate_secondary_token(run), promoted, condition=condition)
+  scheduler.add('5-C', lambda: step_5c_start_token_generation(run), ['5-A'])
+  scheduler.add('5-D', lambda: step_5d_continue_token_generation(run), ['5-C'])
+  scheduler.add('5-E', lambda: step_5e_update_primary(run), ['5-B', '5-D'])
+
+#--------------------------------------------------------------------------------
+# Steps that are not run again on resume once they are in the journal: their
+# effect is permanent and their outputs are journalled. The other steps only
+# check state or produce secrets, and run again if a later step needs them.
+#--------------------------------------------------------------------------------
+RESUMABLE_STEPS = ('3-E', '4', '4-wait', '5-A', '5-E')
+
+#--------------------------------------------------------------------------------
+# Functions to return the outputs of a step that are written to the journal, and
+# to restore them on resume. Tokens, OTPs and recovery keys are never written.
+#--------------------------------------------------------------------------------
+def journal_outputs(run, step):
+  if step == '3-C' and run.promotion_attempt != None:
+    return {'nonce': run.promotion_attempt.get('nonce')}
+  if step == 'gate':
+    return {'wal_lag': run.wal_lag, 'data_loss_window': run.data_loss_window}
+  if step == '4':
+    return {'changes': run.changes}
+  if step == '5-C' and run.demotion_attempt != None:
+    return {'nonce': run.demotion_attempt.get('nonce')}
+  return {}
+
+def restore_outputs(run, step, outputs):
+  if step == 'gate':
+    run.wal_lag = outputs.get('wal_lag')
+    run.data_loss_window = outputs.get('data_loss_window')
+  if step == '4':
+    run.changes = outputs.get('changes') or {}
+    if outputs.get('change_id') != None:
+      # Journals written before the DNS providers only have the Route 53 change
+      run.changes = {run.dns_providers[0].name: outputs.get('change_id')}
+
+def journal_step(run, step, source='run'):
+  run.committed[step] = journal_outputs(run, step)
+  if run.journal != None:
+    run.journal.commit(run.journal_id, run.name, step, run.committed[step], source)
+
+#--------------------------------------------------------------------------------
+# Function to return the data of the DR replication status of a cluster
+#--------------------------------------------------------------------------------
+def replication_status(run, cluster_domain, step='resume', abort=True):
+  url = cluster_domain + '/v1/sys/replication/dr/status'
+  response = http_request(run.sessions.get(cluster_domain), GET, url, {}, run.hdrs,
+                          retry.step_deadline(step, run.deadline), abort)
+  return json.loads(json.dumps(response)).get('data') or {}
+
+#--------------------------------------------------------------------------------
+# Function to check the live state of the clusters against the journal before
+# resuming. A promotion or demotion that went through just before the script
+# died is committed from the live state; a journal that claims a promotion the
+# new primary does not show aborts the resume.
+#--------------------------------------------------------------------------------
+def check_live_state(run):
+  events.log("*** About to check the live replication state before resuming",
+             run.name, "after steps", ', '.join(run.committed))
+
+  new_primary = replication_status(run, run.secondary_vault_cluster_domain)
+  if new_primary.get('mode') == 'primary' and '3-E' not in run.committed:
+    events.log("The secondary vault cluster", run.secondary_vault_cluster_domain,
+               "was already promoted; committing Step 3-E from the live state")
+    journal_step(run, '3-E', 'live-state')
+  elif new_primary.get('mode') != 'primary' and '3-E' in run.committed:
+    events.log("Error: The journal says that", run.secondary_vault_cluster_domain,
+               "was promoted, but it has a replication mode of", new_primary.get('mode'), level=events.ERROR)
+    events.log("Aborting script", level=events.ERROR)
+    sys.exit()
+
+  if reconciler.probe(run.sessions.get(run.primary_vault_cluster_domain),
+                      run.primary_vault_cluster_domain,
+                      run.reconcile_config.get('probe_timeout', reconciler.DEFAULT_PROBE_TIMEOUT)):
+    old_primary = replication_status(run, run.primary_vault_cluster_domain)
+    if old_primary.get('mode') == 'secondary' and '5-A' not in run.committed:
+      events.log("The old primary vault cluster", run.primary_vault_cluster_domain,
+                 "was already demoted; committing Step 5-A from the live state")
+      journal_step(run, '5-A', 'live-state')
+    if (old_primary.get('mode') == 'secondary' and old_primary.get('state') == 'stream-wals' and
+        '5-E' not in run.committed):
+      events.log("The old primary vault cluster", run.primary_vault_cluster_domain,
+                 "already replicates from the new primary; committing Step 5-E from the live state")
+      journal_step(run, '5-E', 'live-state')
+
+#--------------------------------------------------------------------------------
+# Function to mark the steps that need not run again as done, and to journal
+# every step that completes
+#--------------------------------------------------------------------------------
+def resume_steps(run, scheduler):
+  for name in dr_journal.plan_resume(scheduler, run.committed, RESUMABLE_STEPS, ['probe']):
+    restore_outputs(run, name, run.committed.get(name, {}))
+    scheduler.restore(name)
+  scheduler.on_step_done = lambda step: journal_step(run, step.name)
+
+#--------------------------------------------------------------------------------
+# Function to print how much of the critical path of a run went into generating
+# DR operation tokens
+#--------------------------------------------------------------------------------
+TOKEN_STEPS = ('3-C', '3-D', '5-C', '5-D')
+
+def report_token_workflow(scheduler):
+  path, slack = scheduler.critical_path()
+  steps = [name for name in path if name in TOKEN_STEPS]
+  events.log("*** Operation token workflow on the critical path:",
+             format(sum(scheduler.steps[name].duration() for name in steps), '.3f'), "of",
+             format(sum(scheduler.steps[name].duration() for name in path), '.3f'), "seconds" +
+             (" (" + ', '.join(steps) + ")" if steps else ""))
+
+#--------------------------------------------------------------------------------
+# Function to print how long both clusters were primaries, from the start of
+# the promotion until the old primary was fenced or demoted
+#--------------------------------------------------------------------------------
+def report_dual_primary_window(run, scheduler, run_span):
+  promotion = scheduler.steps['3-E']
+  if promotion.start == None or promotion.failed:
+    return
+  window = fencing.dual_primary_window(promotion.start, run.fenced_at)
+  if window == None:
+    if run.old_primary_reachable:
+      events.log("*** The old primary", run.primary_vault_cluster_domain, "of", run.name,
+                 "was neither fenced nor demoted and may still take writes", level=events.WARNING)
+    else:
+      events.log("*** Dual-primary window of", run.name + ": until the deferred demotion of the",
+                 "unreachable old primary", run.primary_vault_cluster_domain)
+    return
+  run_span.attributes['dual_primary_window'] = window
+  events.log("*** Dual-primary window of", run.name + ": at most", format(window, '.3f'),
+             "seconds, until the old primary was",
+             {fencing.DEMOTE: "demoted by the fence", fencing.HOOK: "fenced by the hook"}.get(
+               run.fenced_by, "demoted in Step 5-A"))
+
+#--------------------------------------------------------------------------------
+# Function to run Step 5 on its own, demoting the old primary and re-pointing it
+# at the new primary. Reuses the recovery keys entered in Step 3-D.
+#--------------------------------------------------------------------------------
+def demote_old_primary(run):
+  scheduler = StepScheduler()
+  add_step_5(scheduler, run)
+  resume_steps(run, scheduler)
+  with tracing.tracer.span('deferred demotion', tracing.RUN, run=run.name) as run_span:
+    scheduler.run(run_span)
+  scheduler.report()
+  events.log("*** Old primary", run.primary_vault_cluster_domain,
+             "is now a DR secondary of", run.secondary_vault_cluster_domain)
+
+#--------------------------------------------------------------------------------
+# Function to add the steps of a run (Steps 3 to 5) to a scheduler, as run_dr
+# runs them and a plan lists them
+#--------------------------------------------------------------------------------
+def add_steps(scheduler, run):
+  scheduler.add('3-A', lambda: step_3a_check_replication_status(run))
+  scheduler.add('3-B', lambda: step_3b_cancel_token_generation(run))
+  scheduler.add('probe', lambda: probe_old_primary(run))
+  if run.prepare_in_run:
+    scheduler.add('prepare', lambda: prepare_run(run),
+                  ['probe'] if staged_batch_token(run.environment) not in (None, '') else [])
+    scheduler.add('3-C', lambda: step_3c_start_token_generation(run), ['3-A', '3-B', 'prepare'])
+  else:
+    scheduler.add('3-C', lambda: step_3c_start_token_generation(run), ['3-A', '3-B'])
+  scheduler.add('3-D', lambda: step_3d_continue_token_generation(run), ['3-C'])
+  if run.promotion_gate != None:
+    # Right before the promotion, so that the lag is measured as late as possible
+    scheduler.add('gate', lambda: promotion_gate_wait(run), ['3-D', 'probe'])
+    scheduler.add('3-E', lambda: step_3e_promote_secondary(run), ['3-D', 'gate'])
+  else:
+    scheduler.add('3-E', lambda: step_3e_promote_secondary(run), ['3-D'])
+  scheduler.add('4', lambda: step_4_update_cname(run), ['3-E'])
+  scheduler.add('4-wait', lambda: step_4_wait_for_propagation(run), ['4'])
+  if run.dns_strategy.restores_ttl():
+    scheduler.add('4-ttl', lambda: step_4_restore_ttl(run), ['4-wait'])
+  # Promotion and DNS cut-over are all that clients need. Step 5 only runs now if
+  # the old primary answered; otherwise it is deferred until it comes back so that
+  # the run does not wait on an unreachable region. With failover routing, DNS
+  # only moves once the old primary fails its health check, so its demotion
+  # must not wait for DNS.
+  propagated = ['4-wait', 'probe'] if run.dns_strategy.updates_records() else ['4', 'probe']
+  # The fence starts with the cut-over. Step 5 still waits for DNS: Step 5-E
+  # points the old primary at the CNAME, and Step 5-A has to demote an old
+  # primary the fence could not demote. After a demotion by the fence, Step 5-A
+  # has nothing left to do. The hook also runs if the old primary did not answer
+  # the probe.
+  if run.fence != None:
+    if run.fence.mode == fencing.DEMOTE:
+      scheduler.add('fence', lambda: fence_old_primary(run), ['3-E', 'probe'],
+                    condition=lambda: run.old_primary_reachable and '5-A' not in run.committed)
+      propagated = propagated + ['fence']
+    else:
+      scheduler.add('fence', lambda: fence_old_primary(run), ['3-E'],
+                    condition=lambda: '5-A' not in run.committed)
+  add_step_5(scheduler, run, ['3-E', 'probe'], propagated,
+             condition=lambda: run.old_primary_reachable)
+  if run.verification != None:
+    scheduler.add('verify', lambda: verify_new_primary(run), ['4-wait'])
+  # The further secondaries follow the new primary whether or not the old
+  # primary answers
+  if run.followers:
+    scheduler.add('5-F', lambda: step_5f_issue_follower_tokens(run), ['3-E'])
+    scheduler.add('5-G', lambda: step_5g_update_followers(run), ['5-F', '4-wait'])
+
+#--------------------------------------------------------------------------------
+# Function to run the actual Disaster Recovery steps (3 to 5) as a DAG, each step
+# starting as soon as the steps it depends on are done. All Vault API calls go
+# through the keep-alive session of the cluster they target, taken from
+# sessions. The steps are added to scheduler (a new StepScheduler by default),
+# which keeps their timings. Every completed step is written to journal, if
+# given; with resume, the last unfinished run of the pair in the journal is
+# continued after checking the live state. Returns the Reconciler running the
+# deferred demotion of the old primary, or None if the old primary was demoted.
+#--------------------------------------------------------------------------------
+def run_dr(environment, primary_vault_cluster_domain, secondary_vault_cluster_domain,
+           cluster_cname, vault_cluster_zone_id, vault_token, route53,
+           dns_resolvers, dns_poll_interval, dns_propagation_delay, sessions,
+           reconcile_config=None, cname_batcher=None, scheduler=None, journal=None,
+           resume=False, readiness=None, promotion_gate=None, key_collector=None,
+           preparation=None, dns_strategy=None, verification=None, followers=(),
+           secondary_id=None, dns_providers=None, fence=None, prepare_in_run=False,
+           min_token_ttl=prepare.DEFAULT_MIN_TOKEN_TTL):
+
+  run = DRRun(environment, primary_vault_cluster_domain, secondary_vault_cluster_domain,
+              cluster_cname, vault_cluster_zone_id, vault_token, route53,
+              dns_resolvers, dns_poll_interval, dns_propagation_delay, sessions,
+              reconcile_config, cname_batcher, readiness, promotion_gate, key_collector,
+              preparation, dns_strategy, verification, followers, secondary_id, dns_providers,
+              fence, prepare_in_run, min_token_ttl)
+
+  # Start the run deadline of the retry policy
+  run.deadline = retry.start_run()
+
+  if scheduler == None:
+    scheduler = StepScheduler()
+  add_steps(scheduler, run)
+
+  if journal != None:
+    run.journal = journal
+    if resume:
+      run.journal_id, run.committed, finished = journal.last_run(
+        environment, primary_vault_cluster_domain, secondary_vault_cluster_domain)
+      if finished:
+        events.log("*** The last run of", environment, "from", primary_vault_cluster_domain, "to",
+                   secondary_vault_cluster_domain, "already completed, nothing to resume")
+        withdraw_cname(run)
+        return None
+      if run.journal_id == None:
+        events.log("*** No unfinished run of", environment,
+                   "in the journal, starting from Step 3-A")
+    if run.journal_id == None:
+      run.journal_id = journal.start(environment, primary_vault_cluster_domain,
+                                     secondary_vault_cluster_domain, cluster_cname)
+    elif run.committed:
+      check_live_state(run)
+  resume_steps(run, scheduler)
+  if scheduler.steps['4'].restored:
+    withdraw_cname(run)
+
+  # The events of the run carry its journal ID, or a random one without a journal
+  correlation = run.journal_id if run.journal_id != None else '%012x' % random.getrandbits(48)
+  with tracing.tracer.span(environment, tracing.RUN, run=environment,
+                           correlation=correlation) as run_span:
+    run.started = run_span.start
+    try:
+      scheduler.run(run_span)
+    finally:
+      # Clients could not use Vault from the start of the run until the new
+      # CNAME had propagated
+      cutover = scheduler.steps['4-wait']
+      if cutover.end != None and not cutover.failed:
+        tracing.tracer.record('downtime', tracing.DOWNTIME, run_span.start, cutover.end,
+                              run_span)
+  scheduler.report()
+  report_token_workflow(scheduler)
+  report_dual_primary_window(run, scheduler, run_span)
+  if run.followers:
+    report_topology(run, scheduler, run_span)
+
+  if verification != None and scheduler.result('verify') == False:
+    events.log("*** Vault Disaster Recovery Operation completed, but the new primary FAILED its",
+               "verification. Failed over from", primary_vault_cluster_domain, "to",
+               secondary_vault_cluster_domain)
+  elif run.followers and scheduler.result('5-G') != True:
+    events.log("*** Vault Disaster Recovery Operation completed, but NOT all further secondaries",
+               "follow the new primary. Failed over from", primary_vault_cluster_domain, "to",
+               secondary_vault_cluster_domain)
+  else:
+    events.log("*** Vault Disaster Recovery Operation Successful. Failed over from",
+                 primary_vault_cluster_domain, "to", secondary_vault_cluster_domain)
+
+  if run.old_primary_reachable or '5-E' in run.committed:
+    if journal != None:
+      journal.end(run.journal_id, environment)
+    return None
+
+  def deferred_demote():
+    # Start a new run deadline, the old primary may have been down for a long time
+    run.deadline = retry.start_run()
+    demote_old_primary(run)
+    if journal != None:
+      journal.end(run.journal_id, environment)
+
+  events.log("*** Old primary", primary_vault_cluster_domain, "is unreachable,",
+             "deferring its demotion until it answers health probes again")
+  return reconciler.Reconciler(sessions.get(primary_vault_cluster_domain),
+                               primary_vault_cluster_domain, deferred_demote,
+                               **run.reconcile_config).start()
+
+#--------------------------------------------------------------------------------
+# The DR controller holds everything a DR operation needs besides the operator's
+# decision: the config, the Route 53 client, the keep-alive sessions and the
+# resolved addresses of the clusters. The script builds one per invocation; in
+# daemon mode (--daemon) it is built ahead of any incident and kept warm, and a
+# failover is started over its local trigger socket.
+#--------------------------------------------------------------------------------
+class DRController:
+
+  def __init__(self, vault_token, aws_aki, aws_sk, config_path='vault_dr.cfg'):
+    self.vault_token = vault_token
+    self.aws_aki = aws_aki
+    self.aws_sk = aws_sk
+    for secret in (vault_token, aws_aki, aws_sk):
+      events.logger.secret(secret)
+    self.config_path = config_path
+    self.config = None
+    self.sessions = None
+    self.route53 = None
+    self.readiness = None
+    self.key_collector = None
+    # Network preparation running while the operator types, see warmup.py
+    self.warmup = None
+    self.hosted_zone_ids = []
+    # DNS providers of the [DNS-Provider-<Name>] sections, see dns_providers.py
+    self.dns_providers = dr_dns_providers.DnsProviders()
+    # Preparation of each pair by name, see prepare.py
+    self.prepared = {}
+    self.deferred = []
+    # Seconds spent in each phase of the start-up, and from the trigger of the
+    # last DR operation until its first Vault API call was answered
+    self.startup = {}
+    self.first_request = None
+    # One DR operation at a time
+    self.busy = threading.Lock()
+    self.stopped = threading.Event()
+
+  def timed(self, phase, start):
+    self.startup[phase] = time.monotonic() - start
+
+  #------------------------------------------------------------------------------
+  # Function to read the config file, or the snapshot of it in a plan if config
+  # is given
+  #------------------------------------------------------------------------------
+  def load_config(self, config=None):
+    start = time.monotonic()
+    # Read the config file to get all the cluster domain names & DNS server.
+    if config == None:
+      config = configparser.RawConfigParser()
+      config.read(self.config_path)
+    self.config = config
+
+    # Read the primary and secondary domains of every [Vault-Cluster-<Name>] section
+    self.cluster_pairs = multi_pair.read_cluster_pairs(config)
+
+    # Read the DNS providers the pairs change their CNAMEs in besides Route 53
+    self.dns_providers.close()
+    self.dns_providers = dr_dns_providers.from_config(config)
+    for pair in self.cluster_pairs.values():
+      for name in pair.dns_providers:
+        if name != dr_dns_providers.ROUTE53 and name not in self.dns_providers.sections:
+          raise ValueError('unknown DNS provider ' + name + ' of cluster pair ' + pair.name)
+
+    # Read the resolvers that must see the new CNAME before the old primary is demoted
+    self.dns_resolvers = [resolver.strip() for resolver in
+                          config.get('DNS-Propagation', 'resolvers', fallback='').split(',')
+                          if resolver.strip() != '']
+    self.dns_poll_interval = config.getfloat('DNS-Propagation', 'poll_interval',
+                                             fallback=dns_propagation.DEFAULT_POLL_INTERVAL)
+
+    dns_propagation_delay = os.getenv('DNS_PROPAGATION_DELAY')
+
+    if dns_propagation_delay == None:
+      self.dns_propagation_delay = 60
+    else:
+      self.dns_propagation_delay = int(dns_propagation_delay)
+
+    # Read the retry policy of the Vault API calls
+    global retry
+    retry = retry_policy.from_config(config)
+
+    # Read how to watch an unreachable old primary before demoting it
+    self.reconcile_config = {
+      'probe_interval': config.getfloat('Reconciler', 'probe_interval',
+                                        fallback=reconciler.DEFAULT_PROBE_INTERVAL),
+      'probe_timeout': config.getfloat('Reconciler', 'probe_timeout',
+                                       fallback=reconciler.DEFAULT_PROBE_TIMEOUT),
+      'max_wait': config.getfloat('Reconciler', 'max_wait',
+                                  fallback=reconciler.DEFAULT_MAX_WAIT)
+    }
+
+    # Read whether and how long to wait for the secondary to catch up before promoting it
+    self.promotion_gate = None
+    if config.getboolean('Promotion-Gate', 'enabled', fallback=False):
+      self.promotion_gate = {
+        'max_wal_lag': config.getint('Promotion-Gate', 'max_wal_lag',
+                                     fallback=promotion_gate.DEFAULT_MAX_WAL_LAG),
+        'max_wait': config.getfloat('Promotion-Gate', 'max_wait',
+                                    fallback=promotion_gate.DEFAULT_MAX_WAIT),
+        'sample_interval': config.getfloat('Promotion-Gate', 'sample_interval',
+                                           fallback=promotion_gate.DEFAULT_SAMPLE_INTERVAL)
+      }
+
+    # Read how Step 4 moves the CNAMEs and which TTLs they get
+    self.dns_strategy = dns_strategy.from_config(config)
+
+    # Read how and how fast the old primary is fenced once the secondary is promoted
+    self.fence = fencing.from_config(config)
+
+    # Read whether and how to verify the new primary once the CNAME has propagated
+    self.verification = None
+    if config.getboolean('Verification', 'enabled', fallback=False):
+      self.verification = {
+        'deadline': config.getfloat('Verification', 'deadline', fallback=verification.DEFAULT_DEADLINE),
+        'timeout': config.getfloat('Verification', 'timeout', fallback=verification.DEFAULT_TIMEOUT),
+        'successes': config.getint('Verification', 'successes',
+                                   fallback=verification.DEFAULT_SUCCESSES),
+        'interval': config.getfloat('Verification', 'interval', fallback=verification.DEFAULT_INTERVAL),
+        'synthetic_path': config.get('Verification', 'synthetic_path',
+                                     fallback=verification.DEFAULT_SYNTHETIC_PATH)
+      }
+
+    # Read whether to prepare the runs before promoting, and for how long the
+    # daemon may reuse a preparation
+    self.prepare_enabled = config.getboolean('Prepare', 'enabled', fallback=True)
+    self.min_token_ttl = config.getfloat('Prepare', 'min_token_ttl',
+                                         fallback=prepare.DEFAULT_MIN_TOKEN_TTL)
+    self.prepare_max_age = config.getfloat('Prepare', 'max_age', fallback=prepare.DEFAULT_MAX_AGE)
+
+    # Read where to journal the completed steps
+    self.journal = dr_journal.Journal(config.get('Journal', 'path',
+                                                 fallback=dr_journal.DEFAULT_JOURNAL_PATH))
+
+    # Read where to export the trace of the run and the error budget to report against
+    self.trace_file = config.get('Tracing', 'trace_file', fallback='')
+    self.prometheus_textfile = config.get('Tracing', 'prometheus_textfile', fallback='')
+    self.error_budget = config.getfloat('Tracing', 'error_budget',
+                                        fallback=tracing.DEFAULT_ERROR_BUDGET)
+
+    # Read where to write the event log and whether to print the events too
+    events.logger.configure(config.get('Event-Log', 'path', fallback=events.DEFAULT_EVENT_LOG),
+                            config.getboolean('Event-Log', 'console', fallback=True))
+    self.timed('config', start)
+
+  #------------------------------------------------------------------------------
+  # Function to create the keep-alive session pool and, with route53, the Route
+  # 53 client
+  #------------------------------------------------------------------------------
+  def connect(self, route53=True):
+    start = time.monotonic()
+    self.sessions = http_pool.SessionPool(self.config.getint('HTTP-Session-Pool', 'pool_maxsize',
+                                                             fallback=http_pool.DEFAULT_POOL_MAXSIZE))
+    if route53:
+      self.route53 = route53_client(self.aws_aki, self.aws_sk)
+    # Let the custodians send their recovery keys from the start
+    if self.config.getboolean('Key-Collection', 'enabled', fallback=False):
+      self.key_collector = key_collection.KeyCollector(
+        self.config.get('Key-Collection', 'socket_path', fallback=key_collection.DEFAULT_SOCKET_PATH),
+        self.config.get('Key-Collection', 'token_file', fallback=key_collection.DEFAULT_TOKEN_FILE),
+        self.config.getfloat('Key-Collection', 'timeout', fallback=key_collection.DEFAULT_TIMEOUT),
+        self.config.get('Key-Collection', 'group', fallback='') or None).start()
+    self.timed('clients', start)
+
+  #------------------------------------------------------------------------------
+  # Function to open keep-alive connections to the given clusters and resolve
+  # the addresses of their nodes. With wait, returns once the connections are
+  # open; otherwise they are opened in the background.
+  #------------------------------------------------------------------------------
+  def warm(self, cluster_domains, wait=False):
+    start = time.monotonic()
+    threads = self.sessions.prewarm(cluster_domains,
+                                    self.config.getint('HTTP-Session-Pool', 'prewarm_connections',
+                                                       fallback=http_pool.DEFAULT_PREWARM_CONNECTIONS))
+    for cluster_domain in cluster_domains:
+      parts = urlsplit(cluster_domain)
+      retry.nodes.resolve(parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+    if wait:
+      for thread in threads:
+        thread.join()
+    self.timed('prewarm', start)
+
+  #------------------------------------------------------------------------------
+  # Function to start resolving the nodes of the clusters of the given pairs
+  # and opening connections to them in the background, before the operator is
+  # prompted for anything. The Route 53 client follows with start_route53()
+  # once the AWS keys are known.
+  #------------------------------------------------------------------------------
+  def warm_up(self, pairs):
+    start = time.monotonic()
+    self.warmup = warmup.Warmup()
+    num_connections = min(self.config.getint('HTTP-Session-Pool', 'prewarm_connections',
+                                             fallback=http_pool.DEFAULT_PREWARM_CONNECTIONS),
+                          self.sessions.pool_maxsize)
+    for cluster_domain in self.cluster_domains(pairs):
+      parts = urlsplit(cluster_domain)
+      self.warmup.add('resolve', lambda parts=parts: retry.nodes.resolve(
+        parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80)))
+      session = self.sessions.get(cluster_domain)
+      for i in range(num_connections):
+        self.warmup.add('connect', lambda session=session, cluster_domain=cluster_domain:
+                        self.sessions.open_connection(session, cluster_domain,
+                                                      http_pool.DEFAULT_PREWARM_TIMEOUT))
+    self.hosted_zone_ids = sorted(set(pair.hosted_zone_id for pair in pairs))
+    self.timed('warm-up', start)
+
+  #------------------------------------------------------------------------------
+  # Function to create the Route 53 client in the background, checking the AWS
+  # keys with a cheap call on each hosted zone so that wrong keys show up now
+  # rather than in Step 4
+  #------------------------------------------------------------------------------
+  def start_route53(self):
+    def create():
+      client = route53_client(self.aws_aki, self.aws_sk)
+      self.route53 = client
+      for hosted_zone_id in self.hosted_zone_ids:
+        client.get_hosted_zone(Id=hosted_zone_id)
+    self.warmup.add('Route 53', create)
+
+  #------------------------------------------------------------------------------
+  # Function to wait for the Route 53 client, creating it if it was not created
+  # in the background
+  #------------------------------------------------------------------------------
+  def wait_for_route53(self):
+    if self.warmup != None:
+      self.warmup.wait('Route 53')
+      self.warmup.report_failures('Route 53')
+    if self.route53 == None:
+      self.route53 = route53_client(self.aws_aki, self.aws_sk)
+
+  #------------------------------------------------------------------------------
+  # Functions to prompt the operator for the AWS keys and the Vault token that
+  # are not set in the environment, timing the input if the network is being
+  # prepared meanwhile
+  #------------------------------------------------------------------------------
+  def prompt(self, read):
+    return self.warmup.prompt(read) if self.warmup != None else read()
+
+  def prompt_aws_keys(self):
+    while self.aws_aki == None or self.aws_aki == '':
+      self.aws_aki = self.prompt(lambda: input("Enter AWS ACCESS KEY ID:"))
+    while self.aws_sk == None or self.aws_sk == '':
+      self.aws_sk = self.prompt(lambda: getpass.getpass("Enter AWS SECRET KEY:"))
+    events.logger.secret(self.aws_aki)
+    events.logger.secret(self.aws_sk)
+
+  def prompt_vault_token(self):
+    while self.vault_token == None or self.vault_token == '':
+      self.vault_token = self.prompt(lambda: getpass.getpass(prompt="Enter Vault Token:"))
+    events.logger.secret(self.vault_token)
+
+  #------------------------------------------------------------------------------
+  # Function to prepare the runs of the given pairs concurrently, reusing a
+  # preparation of the same pair and direction up to max_age seconds old. Only
+  # prompts for missing recovery keys with prompt.
+  #------------------------------------------------------------------------------
+  def prepare(self, pairs, max_age=None, prompt=True):
+    if max_age == None:
+      max_age = self.prepare_max_age
+    self.wait_for_route53()
+
+    def prepare_pair(pair):
+      preparation = self.fresh_preparation(pair, max_age)
+      if preparation != None:
+        return preparation
+      preparation = self.prepared.get(pair.name)
+      known_keys = preparation.recovery_keys if preparation != None else []
+      preparation = prepare_dr(pair.name, pair.primary_vault_cluster_domain,
+                               pair.secondary_vault_cluster_domain, pair.hosted_zone_id,
+                               os.getenv('VAULT_TOKEN_' + pair.name.upper(), self.vault_token),
+                               self.route53, self.sessions, self.key_collector != None,
+                               self.min_token_ttl, known_keys, prompt,
+                               self.pair_dns_providers(pair))
+      preparation.report()
+      self.prepared[pair.name] = preparation
+      return preparation
+
+    results = multi_pair.run_pairs(pairs, prepare_pair,
+                                   self.config.getint('Multi-Pair', 'max_concurrency',
+                                                      fallback=multi_pair.DEFAULT_MAX_CONCURRENCY))
+    return dict((name, result) for name, (ok, result) in results.items() if ok)
+
+  def fresh_preparation(self, pair, max_age=None):
+    preparation = self.prepared.get(pair.name)
+    if (preparation != None and
+        preparation.age() <= (max_age if max_age != None else self.prepare_max_age) and
+        preparation.matches(pair.primary_vault_cluster_domain, pair.secondary_vault_cluster_domain)):
+      return preparation
+    return None
+
+  #------------------------------------------------------------------------------
+  # Function to return the cluster pairs of a DR operation, with the roles of
+  # the clusters swapped for a failback. Raises ValueError for unknown input.
+  #------------------------------------------------------------------------------
+  def select_pairs(self, dr_mode, environments):
+    # Depending on the dr_mode, assign the primary and secondary clusters based on environment
+    environments = [environment.lower() for environment in environments]
+    if environments == ['all']:
+      environments = list(self.cluster_pairs)
+    if not environments:
+      raise ValueError('no environment given')
+    pairs = []
+    for environment in environments:
+      if environment not in self.cluster_pairs:
+        raise ValueError('unknown environment ' + environment)
+      if dr_mode == 'failover':
+        pairs.append(self.cluster_pairs[environment])
+      elif dr_mode == 'failback':
+        pairs.append(self.cluster_pairs[environment].reversed())
+      else:
+        raise ValueError('unknown DR mode ' + str(dr_mode))
+    return pairs
+
+  #------------------------------------------------------------------------------
+  # Function to return the DNS providers the CNAME of pair is changed in
+  #------------------------------------------------------------------------------
+  def pair_dns_providers(self, pair):
+    return self.dns_providers.get(pair.dns_providers, self.route53, pair.hosted_zone_id)
+
+  def cluster_domains(self, pairs):
+    domains = []
+    for domain in ([pair.secondary_vault_cluster_domain for pair in pairs] +
+                   [pair.primary_vault_cluster_domain for pair in pairs]):
+      if domain not in domains:
+        domains.append(domain)
+    return domains
+
+  #------------------------------------------------------------------------------
+  # Function to change the DNS records of the CNAMEs of the given pairs outside
+  # of a DR operation: lower or restore their TTLs, or replace them by failover
+  # records (option is one of DNS_OPTIONS)
+  #------------------------------------------------------------------------------
+  def update_dns(self, option, pairs):
+    self.wait_for_route53()
+    strategy = self.dns_strategy
+    if option == '--setup-dns' and strategy.updates_records():
+      print("Error: --setup-dns needs mode=failover-routing in the [DNS-Strategy] section")
+      sys.exit(1)
+    if option != '--setup-dns' and not strategy.updates_records():
+      print("Error:", option, "does not apply to the failover records of mode=failover-routing")
+      sys.exit(1)
+    for pair in pairs:
+      def update_records(records, ttl, pair=pair):
+        return update_cname_records(self.pair_dns_providers(pair), records, ttl)
+      # The CNAME points to the current primary
+      if option == '--setup-dns':
+        strategy.setup(self.route53, pair.hosted_zone_id, pair.cluster_cname,
+                       pair.primary_vault_cluster_domain, pair.secondary_vault_cluster_domain)
+      elif option == '--lower-ttl':
+        strategy.lower(update_records, pair.cluster_cname, pair.primary_vault_cluster_domain)
+      else:
+        strategy.restore(update_records, pair.cluster_cname, pair.primary_vault_cluster_domain)
+
+  #------------------------------------------------------------------------------
+  # Function to return the steps a run of pair would run, in order, as listed
+  # in a plan
+  #------------------------------------------------------------------------------
+  def planned_steps(self, pair):
+    scheduler = StepScheduler()
+    add_steps(scheduler, DRRun(pair.name, pair.primary_vault_cluster_domain,
+                               pair.secondary_vault_cluster_domain, pair.cluster_cname,
+                               pair.hosted_zone_id, '', None, self.dns_resolvers,
+                               self.dns_poll_interval, self.dns_propagation_delay, None,
+                               promotion_gate=self.promotion_gate, dns_strategy=self.dns_strategy,
+                               verification=self.verification, followers=pair.followers,
+                               secondary_id=pair.secondary_id, fence=self.fence))
+    return [{'name': name, 'depends_on': list(scheduler.steps[name].depends_on),
+             'conditional': scheduler.steps[name].condition != None} for name in scheduler.order]
+
+  #------------------------------------------------------------------------------
+  # Function to compile a DR operation into a plan file, see plan.py. Exits
+  # without writing it if the config is invalid or a check fails.
+  #------------------------------------------------------------------------------
+  def compile_plan(self, dr_mode, environments, path=dr_plan.DEFAULT_PLAN_FILE):
+    try:
+      pairs = self.select_pairs(dr_mode, environments)
+    except ValueError as e:
+      print("Error:", e)
+      sys.exit(1)
+    problems = dr_plan.validate(pairs)
+    for problem in problems:
+      print("Error:", problem)
+    if problems:
+      print("The plan was not written")
+      sys.exit(1)
+
+    disable_request_warnings()
+    self.wait_for_route53()
+    checks = dr_plan.check_reachability(pairs, self.route53, providers=self.pair_dns_providers)
+    for check in checks:
+      events.log("*** Check", check['check'], "of", check['target'] + ":",
+                 "ok" if check['ok'] else "FAILED", "(" + check['detail'] + ")")
+    if not all(check['ok'] for check in checks):
+      print("Error:", sum(1 for check in checks if not check['ok']), "checks failed,",
+            "the plan was not written")
+      sys.exit(1)
+
+    document = dr_plan.build(dr_mode, environments, pairs,
+                             dict((pair.name, self.planned_steps(pair)) for pair in pairs),
+                             self.config, self.config_path, checks)
+    dr_plan.write(document, path)
+    for pair in pairs:
+      events.log("*** Plan of", pair.name + ":", pair.primary_vault_cluster_domain, "->",
+                 pair.secondary_vault_cluster_domain, "as", pair.cluster_cname, "in hosted zone",
+                 pair.hosted_zone_id + ", secondary ID", pair.secondary_id + ", steps",
+                 ' '.join(step['name'] for step in document['pairs'][pairs.index(pair)]['steps']))
+    events.log("*** Compiled the", dr_mode, "of", ', '.join(pair.name for pair in pairs), "into",
+               path)
+
+  #------------------------------------------------------------------------------
+  # Function to print what running a plan would change, and how vault_dr.cfg
+  # changed since the plan was compiled. The config must be loaded from the
+  # plan.
+  #------------------------------------------------------------------------------
+  def diff_plan(self, plan):
+    self.wait_for_route53()
+    print("Plan:", plan.describe())
+    for pair in plan.pairs:
+      hdrs = {'X-Vault-Token': os.getenv('VAULT_TOKEN_' + pair.name.upper(), self.vault_token)}
+      print(pair.name + ":")
+      for line in dr_plan.diff(pair, dr_plan.live_state(pair, hdrs, self.route53),
+                               self.dns_strategy):
+        print(line)
+    if dr_plan.file_sha256(plan.config_file) != plan.config_sha256:
+      config = configparser.RawConfigParser()
+      config.read(plan.config_file)
+      print(plan.config_file, "changed since the plan was compiled; the plan runs with its snapshot:")
+      for line in dr_plan.config_drift(plan, config):
+        print(line)
+
+  #------------------------------------------------------------------------------
+  # Function to print how long the start-up took, from the start of the import
+  # of this script
+  #------------------------------------------------------------------------------
+  def report_startup(self):
+    events.log("*** DR controller ready", format(time.monotonic() - STARTED, '.3f'),
+               "seconds after start (" + ', '.join(phase + ' ' + format(seconds, '.3f') + 's'
+                                                   for phase,
+               seconds in self.startup.items()) + ")")
+
+  #------------------------------------------------------------------------------
+  # Function to run a DR operation on the given pairs concurrently. triggered is
+  # the monotonic time the operation was asked for, to report how long it took
+  # until the first Vault API call was answered. Returns a dict of pair name -> (succeeded,
+  # Reconciler of a deferred demotion or error). A single pair is run in the
+  # calling thread, so that a failure aborts the script as it always has.
+  # busy_held tells that the caller already holds the busy lock.
+  #------------------------------------------------------------------------------
+  def run(self, dr_mode, environments, resume=False, triggered=None, busy_held=False):
+    return self.run_pairs(self.select_pairs(dr_mode, environments), resume, triggered, busy_held)
+
+  def run_pairs(self, pairs, resume=False, triggered=None, busy_held=False):
+    if triggered == None:
+      triggered = time.monotonic()
+    self.wait_for_route53()
+    with contextlib.nullcontext() if busy_held else self.busy:
+      tracing.tracer.reset()
+      # Reuse the preparations the daemon keeps fresh; a pair without one is
+      # prepared by its run, alongside Steps 3-A and 3-B
+      preparations = {}
+      for pair in pairs:
+        if self.prepare_enabled and self.fresh_preparation(pair) != None:
+          preparations[pair.name] = self.fresh_preparation(pair)
+
+      # Combine the CNAME updates of pairs in the same hosted zone, or zone of
+      # another DNS provider, into one change
+      cname_batcher = None
+      providers_by_key = {}
+      for pair in pairs:
+        for provider in self.pair_dns_providers(pair):
+          providers_by_key[provider.key()] = provider
+      if len(pairs) > 1 and self.dns_strategy.updates_records():
+        cname_batcher = multi_pair.CnameBatcher(
+          lambda key, records: update_cname_records([providers_by_key[key]], records,
+                                                    self.dns_strategy.cutover_ttl())[
+                                                      providers_by_key[key].name],
+          self.config.getfloat('Multi-Pair', 'batch_window', fallback=multi_pair.DEFAULT_BATCH_WINDOW))
+        for pair in pairs:
+          for provider in self.pair_dns_providers(pair):
+            cname_batcher.expect(provider.key())
+
+      def run_pair(pair):
+        # A pair may have its own token in VAULT_TOKEN_<NAME>
+        return run_dr(pair.name, pair.primary_vault_cluster_domain,
+                      pair.secondary_vault_cluster_domain, pair.cluster_cname, pair.hosted_zone_id,
+                      os.getenv('VAULT_TOKEN_' + pair.name.upper(), self.vault_token),
+                      self.route53, self.dns_resolvers, self.dns_poll_interval,
+                      self.dns_propagation_delay, self.sessions, self.reconcile_config,
+                      cname_batcher, journal=self.journal, resume=resume,
+                      readiness=self.readiness, promotion_gate=self.promotion_gate,
+                      key_collector=self.key_collector,
+                      preparation=preparations.get(pair.name), dns_strategy=self.dns_strategy,
+                      verification=self.verification, followers=pair.followers,
+                      secondary_id=pair.secondary_id, dns_providers=self.pair_dns_providers(pair),
+                      fence=self.fence, prepare_in_run=self.prepare_enabled,
+                      min_token_ttl=self.min_token_ttl)
+
+      def withdraw_pair(pair):
+        # Do not hold the CNAME batch open for a pair that failed before Step 4
+        if cname_batcher != None:
+          for provider in self.pair_dns_providers(pair):
+            cname_batcher.withdraw(provider.key(), pair.cluster_cname)
+
+      try:
+        if len(pairs) == 1:
+          results = {pairs[0].name: (True, run_pair(pairs[0]))}
+        else:
+          results = multi_pair.run_pairs(pairs, run_pair,
+                                         self.config.getint('Multi-Pair', 'max_concurrency',
+                                                            fallback=multi_pair.DEFAULT_MAX_CONCURRENCY),
+                                         withdraw_pair)
+        # A pair whose new primary failed its verification, or whose further
+        # secondaries did not converge, did not succeed. Its deferred demotion
+        # still goes ahead.
+        for span in tracing.tracer.finished(tracing.STEP):
+          name = span.inherited('run')
+          if span.name in ('verify', '5-G') and span.attributes.get('passed') == False and name in results:
+            results[name] = (False, results[name][1])
+        if len(pairs) > 1:
+          events.log("*** Cluster pairs:", ', '.join(name + (' succeeded' if ok else ' FAILED')
+                                                      for name, (ok, result) in results.items()))
+      finally:
+        self.first_request = tracing.tracer.first_end(tracing.HTTP, triggered)
+        if self.first_request != None:
+          self.first_request -= triggered
+          events.log("*** First Vault API call answered", format(self.first_request, '.3f'),
+                     "seconds after the DR operation was triggered")
+      tracing.tracer.print_budget_report(self.error_budget)
+      self.deferred += [(pair, results[pair.name][1]) for pair in pairs
+                        if isinstance(results[pair.name][1], reconciler.Reconciler)]
+      return results
+
+  #------------------------------------------------------------------------------
+  # Function to wait for the deferred demotions of the old primaries. Returns
+  # whether all of them succeeded.
+  #------------------------------------------------------------------------------
+  def join_deferred(self):
+    done = True
+    while self.deferred:
+      pair, deferred = self.deferred.pop(0)
+      try:
+        done = deferred.join() and done
+      except KeyboardInterrupt:
+        done = False
+        events.log("Deferred demotion of", pair.primary_vault_cluster_domain, "interrupted.",
+                   "It must be demoted and re-pointed manually.")
+    return done
+
+  #------------------------------------------------------------------------------
+  # Function to run a drill of cycles failover/failback cycles on pair, waiting
+  # for a steady state before every run, see drill.py. Returns whether the drill
+  # passed.
+  #------------------------------------------------------------------------------
+  def drill(self, pair, cycles=None):
+    if cycles == None:
+      cycles = self.config.getint('Drill', 'cycles', fallback=dr_drill.DEFAULT_CYCLES)
+    tolerance = self.config.getfloat('Drill', 'tolerance', fallback=dr_drill.DEFAULT_TOLERANCE)
+    timeout = self.config.getfloat('Drill', 'steady_state_timeout',
+                                   fallback=dr_drill.DEFAULT_STEADY_STATE_TIMEOUT)
+    interval = self.config.getfloat('Drill', 'steady_state_interval',
+                                    fallback=dr_drill.DEFAULT_STEADY_STATE_INTERVAL)
+    results = dr_drill.Results(self.config.get('Drill', 'results_file',
+                                               fallback=dr_drill.DEFAULT_RESULTS_FILE))
+    # Only used for its status samples, it is not started
+    monitor = readiness.ReadinessMonitor([pair])
+    drill_id = results.start(pair.name, cycles)
+    runs = []
+    problem = None
+    events.log("*** Drill", drill_id, "of", pair.name + ":", cycles, "failover/failback cycles")
+    for cycle in range(1, cycles + 1):
+      for direction, run_pair in (('failover', pair), ('failback', pair.reversed())):
+        steady, state = dr_drill.wait_for_steady_state(monitor.sample,
+                                                       run_pair.primary_vault_cluster_domain,
+                                                       run_pair.secondary_vault_cluster_domain,
+                                                       timeout, interval)
+        if not steady:
+          problem = ("no steady state before the " + direction + " of cycle " + str(cycle) +
+                     " within " + format(timeout, 'g') + " seconds: " + state)
+          break
+        error = None
+        try:
+          ok = self.run_pairs([run_pair])[pair.name][0]
+          # The next run needs the old primary to be a DR secondary again
+          if not self.join_deferred():
+            ok, error = False, 'the deferred demotion of the old primary failed'
+        except BaseException as e:
+          if isinstance(e, KeyboardInterrupt):
+            raise
+          ok, error = False, repr(e)
+        steps = dict((span.name, span.duration()) for span in tracing.tracer.finished(tracing.STEP))
+        downtime = tracing.tracer.finished(tracing.DOWNTIME)
+        run_spans = tracing.tracer.finished(tracing.RUN)
+        run = {'cycle': cycle, 'direction': direction, 'ok': ok, 'steps': steps,
+               'rto': downtime[0].duration() if downtime else None,
+               'total': run_spans[0].duration() if run_spans else None}
+        results.run(drill_id, pair.name, cycle, direction, ok, run['rto'], run['total'], steps, error)
+        runs.append(run)
+        if not ok:
+          problem = "the " + direction + " of cycle " + str(cycle) + " failed"
+          break
+      if problem != None:
+        break
+    if problem == None:
+      steady, state = dr_drill.wait_for_steady_state(monitor.sample, pair.primary_vault_cluster_domain,
+                                                     pair.secondary_vault_cluster_domain,
+                                                     timeout, interval)
+      if not steady:
+        problem = "no steady state after the last cycle: " + state
+    monitor.close()
+
+    summary = dr_drill.summarize(runs, results.baseline(pair.name, drill_id), tolerance, problem)
+    results.end(drill_id, pair.name, summary)
+    dr_drill.print_report(pair.name, runs, summary)
+    return summary['passed']
+
+  #------------------------------------------------------------------------------
+  # Function to export the trace of the last DR operation
+  #------------------------------------------------------------------------------
+  def export(self):
+    if self.trace_file != '':
+      tracing.tracer.write_trace(self.trace_file)
+    if self.prometheus_textfile != '':
+      tracing.tracer.write_prometheus(self.prometheus_textfile, self.error_budget)
+
+  #------------------------------------------------------------------------------
+  # Function to answer a request of the trigger socket
+  #------------------------------------------------------------------------------
+  def handle_trigger(self, request, reply):
+    triggered = time.monotonic()
+    try:
+      self.select_pairs(request.get('mode'), request.get('environments') or [])
+    except ValueError as e:
+      reply({'error': str(e)})
+      return
+    # Take the lock before accepting, so that of two triggers at the same time
+    # only one is accepted
+    if not self.busy.acquire(blocking=False):
+      reply({'error': 'a DR operation is already running'})
+      return
+    try:
+      reply({'accepted': True})
+      events.log("*** Triggered", request.get('mode'), "of",
+                 ', '.join(request.get('environments')))
+      self.first_request = None
+      try:
+        results = self.run(request.get('mode'), request.get('environments'),
+                           bool(request.get('resume')), triggered, busy_held=True)
+        answer = {'results': dict((name, ok) for name, (ok, result) in results.items())}
+      except BaseException as e:
+        if isinstance(e, KeyboardInterrupt):
+          raise
+        answer = {'error': 'DR operation failed: ' + repr(e)}
+      finally:
+        self.export()
+      answer['first_request_seconds'] = self.first_request
+      answer['downtime_seconds'] = dict((span.inherited('run', ''), span.duration())
+                                        for span in tracing.tracer.finished(tracing.DOWNTIME))
+    finally:
+      self.busy.release()
+    reply(answer)
+
+  #------------------------------------------------------------------------------
+  # Function to start polling the replication status of all the cluster pairs,
+  # unless poll_interval of the [Readiness] section is 0
+  #------------------------------------------------------------------------------
+  def monitor(self):
+    poll_interval = self.config.getfloat('Readiness', 'poll_interval',
+                                         fallback=readiness.DEFAULT_POLL_INTERVAL)
+    if poll_interval <= 0:
+      return
+    self.readiness = readiness.ReadinessMonitor(
+      list(self.cluster_pairs.values()), poll_interval,
+      self.config.getint('Readiness', 'history', fallback=readiness.DEFAULT_HISTORY),
+      self.config.getfloat('Readiness', 'max_status_age', fallback=readiness.DEFAULT_MAX_STATUS_AGE),
+      self.config.getint('Readiness', 'max_wal_lag', fallback=readiness.DEFAULT_MAX_WAL_LAG),
+      self.config.getfloat('Readiness', 'stall_after', fallback=readiness.DEFAULT_STALL_AFTER)).start()
+
+  #------------------------------------------------------------------------------
+  # Function to serve the trigger socket until stopped, re-opening the keep-alive
+  # connections every keepalive_interval seconds so that the ELBs do not close
+  # them as idle
+  #------------------------------------------------------------------------------
+  def serve(self):
+    socket_path = self.config.get('Daemon', 'socket_path', fallback=daemon.DEFAULT_SOCKET_PATH)
+    token = daemon.read_or_create_token(self.config.get('Daemon', 'token_file',
+                                                        fallback=daemon.DEFAULT_TOKEN_FILE))
+    keepalive_interval = self.config.getfloat('Daemon', 'keepalive_interval',
+                                              fallback=DEFAULT_KEEPALIVE_INTERVAL)
+    domains = self.cluster_domains(list(self.cluster_pairs.values()))
+
+    def keep_warm():
+      while not self.stopped.wait(keepalive_interval):
+        if not self.busy.locked():
+          self.warm(domains)
+          # Refresh the preparations before they are too old to be reused
+          if self.prepare_enabled:
+            self.prepare(list(self.cluster_pairs.values()), self.prepare_max_age / 2, prompt=False)
+    threading.Thread(target=keep_warm, daemon=True).start()
+    self.monitor()
+
+    server = daemon.TriggerServer(socket_path, token, self.handle_trigger)
+    events.log("*** DR controller listening on", socket_path)
+    try:
+      server.serve_forever()
+    finally:
+      self.stopped.set()
+      if self.readiness != None:
+        self.readiness.stop()
+      server.server_close()
+
+  def close(self):
+    self.stopped.set()
+    if self.readiness != None:
+      self.readiness.stop()
+    if self.key_collector != None:
+      self.key_collector.stop()
+    if self.sessions != None:
+      self.sessions.close()
+    self.dns_providers.close()
+
+#--------------------------------------------------------------------------------
+# Function to send the DR operation of the command line to a running daemon
+#--------------------------------------------------------------------------------
+def trigger_daemon(dr_mode, environments, resume):
+  config = configparser.RawConfigParser()
+  config.read('vault_dr.cfg')
+  socket_path = config.get('Daemon', 'socket_path', fallback=daemon.DEFAULT_SOCKET_PATH)
+  token = daemon.read_token(config.get('Daemon', 'token_file', fallback=daemon.DEFAULT_TOKEN_FILE))
+  answer = daemon.trigger(socket_path, token, {'mode': dr_mode, 'environments': environments,
+                                               'resume': resume},
+                          lambda message: print(json.dumps(message)))
+  if answer == None or 'error' in answer or not all(answer.get('results', {}).values()):
+    sys.exit(1)
+
+#--------------------------------------------------------------------------------
+# Function to send a recovery key of a custodian to the running DR operation
+#--------------------------------------------------------------------------------
+def submit_recovery_key(environment):
+  config = configparser.RawConfigParser()
+  config.read('vault_dr.cfg')
+  socket_path = config.get('Key-Collection', 'socket_path', fallback=key_collection.DEFAULT_SOCKET_PATH)
+  token = daemon.read_token(config.get('Key-Collection', 'token_file',
+                                       fallback=key_collection.DEFAULT_TOKEN_FILE))
+  key = None
+  while key == None or key == '':
+    key = getpass.getpass(prompt="Enter Vault Recovery Key" +
+                          (" for " + environment if environment != None else "") + ":")
+  answer = key_collection.submit_key(socket_path, token, environment, key, getpass.getuser(),
+                                     lambda message: print(json.dumps(message)))
+  if answer == None or 'error' in answer:
+    sys.exit(1)
+
+#--------------------------------------------------------------------------------
+# Function to disable all requests warnings, once the command line and the plan
+# are known to be valid, so that an error does not wait for requests to load
+#--------------------------------------------------------------------------------
+def disable_request_warnings():
+  import requests
+  requests.packages.urllib3.disable_warnings()
+
+#--------------------------------------------------------------------------------
+# Main program
+#--------------------------------------------------------------------------------
+def main():
+  check_usage()
+
+  # With plan or execute first, the DR operation is compiled into or read from
+  # a plan file
+  command = arguments()[0] if arguments() and arguments()[0] in PLAN_COMMANDS else None
+  args = arguments()[1:] if command != None else arguments()
+  plan_file = dr_plan.DEFAULT_PLAN_FILE
+  if command == 'execute' or '--diff' in options():
+    plan_file = args[0] if args else plan_file
+    args = []
+  # Read the first argument as the dr_mode: 'failover' or 'failback'
+  dr_mode = args[0] if args else None
+  # Read the remaining arguments as the environments (cluster pairs), or 'all'
+  environments = [environment.lower() for environment in args[1:]]
+  # With --resume, continue the last unfinished run of each pair from the journal
+  resume = '--resume' in options()
+
+  # With --submit-key, send a recovery key to the running DR operation
+  if '--submit-key' in options():
+    # The only argument is the environment
+    submit_recovery_key(dr_mode.lower() if dr_mode != None else None)
+    return
+
+  # With --trigger, hand the DR operation to the running daemon
+  if '--trigger' in options():
+    trigger_daemon(dr_mode, environments, resume)
+    return
+
+  # With --lower-ttl, --restore-ttl or --setup-dns, only the DNS records change
+  dns_options = [option for option in options() if option in DNS_OPTIONS]
+
+  # The Vault token and the AWS access key id and secret key are read from the
+  # environment, or prompted for once the network preparation has started
+  controller = DRController(os.getenv('VAULT_TOKEN'), os.getenv('AWS_ACCESS_KEY_ID'),
+                            os.getenv('AWS_SECRET_KEY'))
+
+  if command == 'plan' and '--diff' not in options():
+    controller.load_config()
+    controller.prompt_aws_keys()
+    controller.compile_plan(dr_mode, environments)
+    return
+
+  # A plan is run with the snapshot of the config it was compiled with
+  plan = None
+  if command != None:
+    try:
+      plan = dr_plan.load(plan_file)
+    except ValueError as e:
+      print("Error:", e)
+      sys.exit(1)
+    controller.load_config(plan.config_parser())
+    if '--diff' in options():
+      controller.prompt_vault_token()
+      controller.prompt_aws_keys()
+      disable_request_warnings()
+      controller.diff_plan(plan)
+      return
+    # The steps are rebuilt from the code, they must be those that were compiled
+    drift = dr_plan.step_drift(plan, controller.planned_steps)
+    if drift:
+      for line in drift:
+        print("Error:", line)
+      print("Error: The plan was compiled for other steps, compile it again")
+      sys.exit(1)
+    events.log("*** Executing the plan", plan_file + ":", plan.describe())
+  else:
+    controller.load_config()
+  disable_request_warnings()
+
+  if dns_options:
+    try:
+      pairs = controller.select_pairs(dr_mode, environments)
+    except ValueError:
+      print_usage()
+    controller.prompt_aws_keys()
+    controller.update_dns(dns_options[0], pairs)
+    return
+
+  if '--daemon' in options():
+    pairs = list(controller.cluster_pairs.values())
+  elif '--drill' in options():
+    # The first argument is the environment; a drill starts with its failover
+    try:
+      pairs = controller.select_pairs('failover', [dr_mode])
+    except ValueError:
+      print_usage()
+  elif plan != None:
+    pairs = list(plan.pairs)
+  else:
+    try:
+      pairs = controller.select_pairs(dr_mode, environments)
+    except ValueError:
+      print_usage()
+
+  # Resolve the nodes of all the clusters, open keep-alive connections to them
+  # and create the Route 53 client while the operator types, so that the first
+  # call of each step does not pay for the DNS lookups or the TCP and TLS
+  # handshakes.
+  controller.connect(route53=False)
+  controller.warm_up(pairs)
+  controller.prompt_aws_keys()
+  controller.start_route53()
+  controller.prompt_vault_token()
+  controller.warmup.report()
+
+  # In daemon mode, warm up everything and wait for triggers
+  if '--daemon' in options():
+    controller.warmup.wait()
+    # Prompt for missing recovery keys now rather than when triggered
+    if controller.prepare_enabled:
+      controller.prepare(list(controller.cluster_pairs.values()))
+    controller.report_startup()
+    try:
+      controller.serve()
+    except KeyboardInterrupt:
+      print("DR controller stopped")
+    finally:
+      controller.join_deferred()
+      controller.close()
+    return
+
+  controller.report_startup()
+
+  # In drill mode, run failover/failback cycles and compare their RTO with the
+  # last drill that passed
+  if '--drill' in options():
+    try:
+      passed = controller.drill(pairs[0], int(environments[0]) if environments else None)
+    finally:
+      controller.export()
+      controller.close()
+    if not passed:
+      sys.exit(1)
+    return
+
+  try:
+    results = controller.run_pairs(pairs, resume, STARTED)
+    # The failover is complete; keep the process alive for the deferred demotions
+    deferred_done = controller.join_deferred()
+  finally:
+    # Export the trace, also of a run that aborted
+    controller.export()
+    controller.close()
+
+  if not all(ok for ok, result in results.values()) or not deferred_done:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
 
 #---------------------------------------------------------------------------------------
 # End of program run_vault_dr.py
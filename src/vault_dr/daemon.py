@@ -0,0 +1,155 @@
+#--------------------------------------------------------------------------------
+# """daemon.py: Authenticated local trigger of the DR controller daemon"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# In daemon mode the DR controller starts once, ahead of any incident, and
+# keeps its clients and connections warm. A failover is triggered over a Unix
+# socket that only the owner of the daemon can open (mode 0600). Every request
+# must also carry the shared token of the token file (mode 0600, created by
+# the daemon on its first start), and on Linux the peer must run as the same
+# user as the daemon (or root).
+#
+# The protocol is one JSON object per line. The client sends
+#
+#   {"token": ..., "mode": "failover", "environments": ["prod"], "resume": false}
+#
+# and the daemon answers with {"accepted": true} (or {"error": ...}) as soon
+# as the request is authenticated, followed by a final line with the results.
+#
+# A server may also be opened to the members of a group (mode 0660), e.g. for
+# the recovery key custodians, who then need the token as well.
+#--------------------------------------------------------------------------------
+import grp, hmac, json, os, pwd, secrets, socket, socketserver, struct
+
+DEFAULT_SOCKET_PATH = 'vault_dr.sock'
+DEFAULT_TOKEN_FILE = 'vault_dr.token'
+
+#--------------------------------------------------------------------------------
+# Function to read the trigger token, creating the token file if there is none.
+# With a group, the members of the group may read a new token file.
+#--------------------------------------------------------------------------------
+def read_or_create_token(path, group=None):
+  try:
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+  except FileExistsError:
+    return read_token(path)
+  token = secrets.token_hex(32)
+  with os.fdopen(fd, 'w') as f:
+    if group:
+      os.fchown(f.fileno(), -1, grp.getgrnam(group).gr_gid)
+      os.fchmod(f.fileno(), 0o640)
+    f.write(token + '\n')
+  return token
+
+def read_token(path):
+  with open(path) as f:
+    return f.read().strip()
+
+#--------------------------------------------------------------------------------
+# Function to return the uid and gid of the process at the other end of a Unix
+# socket, or (None, None) where SO_PEERCRED is not available
+#--------------------------------------------------------------------------------
+def peer_credentials(connection):
+  if not hasattr(socket, 'SO_PEERCRED'):
+    return None, None
+  credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                      struct.calcsize('3i'))
+  pid, uid, gid = struct.unpack('3i', credentials)
+  return uid, gid
+
+#--------------------------------------------------------------------------------
+# Function to check whether a peer may use a server: the owner of the server,
+# root, or a member of its group, if it has one
+#--------------------------------------------------------------------------------
+def peer_allowed(uid, gid, group=None):
+  if uid == None or uid in (0, os.getuid()):
+    return True
+  if group == None:
+    return False
+  if gid == group.gr_gid:
+    return True
+  try:
+    return pwd.getpwuid(uid).pw_name in group.gr_mem
+  except KeyError:
+    return False
+
+class TriggerHandler(socketserver.StreamRequestHandler):
+
+  def reply(self, message):
+    self.wfile.write((json.dumps(message) + '\n').encode())
+    self.wfile.flush()
+
+  def handle(self):
+    uid, gid = peer_credentials(self.connection)
+    if not peer_allowed(uid, gid, self.server.group):
+      self.reply({'error': 'permission denied'})
+      return
+    try:
+      request = json.loads(self.rfile.readline())
+    except ValueError:
+      self.reply({'error': 'invalid request'})
+      return
+    if not isinstance(request, dict) or not hmac.compare_digest(
+        str(request.get('token', '')).encode(), self.server.token.encode()):
+      self.reply({'error': 'permission denied'})
+      return
+    request.pop('token')
+    self.server.handle_trigger(request, self.reply)
+
+class TriggerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+  #------------------------------------------------------------------------------
+  # handle_trigger(request, reply) runs an authenticated request; reply(message)
+  # sends one line back to the client. group is the name of a group whose
+  # members may use the socket too.
+  #------------------------------------------------------------------------------
+  def __init__(self, socket_path, token, handle_trigger, group=None):
+    if os.path.exists(socket_path):
+      os.unlink(socket_path)
+    self.token = token
+    self.handle_trigger = handle_trigger
+    self.group = grp.getgrnam(group) if group else None
+    old_umask = os.umask(0o177)
+    try:
+      socketserver.UnixStreamServer.__init__(self, socket_path, TriggerHandler)
+    finally:
+      os.umask(old_umask)
+    if self.group != None:
+      os.chown(socket_path, -1, self.group.gr_gid)
+      os.chmod(socket_path, 0o660)
+    else:
+      os.chmod(socket_path, 0o600)
+    self.socket_path = socket_path
+
+  def server_close(self):
+    socketserver.UnixStreamServer.server_close(self)
+    if os.path.exists(self.socket_path):
+      os.unlink(self.socket_path)
+
+#--------------------------------------------------------------------------------
+# Function to send a request to the daemon. Calls on_message with every line of
+# the answer and returns the last one.
+#--------------------------------------------------------------------------------
+def trigger(socket_path, token, request, on_message=None):
+  message = None
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+    connection.connect(socket_path)
+    connection.sendall((json.dumps(dict(request, token=token)) + '\n').encode())
+    with connection.makefile('r') as answers:
+      for line in answers:
+        message = json.loads(line)
+        if on_message != None:
+          on_message(message)
+  return message
@@ -0,0 +1,279 @@
+#--------------------------------------------------------------------------------
+# """dns_propagation.py: Waits for a Route 53 CNAME change to propagate"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# Instead of blindly sleeping for DNS_PROPAGATION_DELAY seconds after the CNAME
+# UPSERT, the propagation wait runs in two stages:
+#
+#   1. Poll every DNS provider the CNAME was changed in (see dns_providers.py)
+#      until all of them have the change in sync, e.g. Route 53 GetChange
+#      reports it INSYNC on all the Route 53 authoritative servers.
+#   2. Query each of the configured resolvers for the cluster CNAME until all
+#      of them answer with the new target.
+#
+# DNS_PROPAGATION_DELAY is only an upper bound for both stages together. The
+# providers are passed in (anything with a synced() method will do) and
+# resolvers are given as "host" or "host:port", so both can be pointed at
+# local stand-ins. A resolver is asked over UDP, and again over TCP if its
+# answer is truncated.
+#--------------------------------------------------------------------------------
+import socket, struct, random, time
+from vault_dr import events, tracing
+
+DNS_PORT = 53
+DNS_TYPE_CNAME = 5
+DNS_CLASS_IN = 1
+# TC: the answer did not fit into the UDP datagram
+DNS_FLAG_TC = 0x0200
+
+DEFAULT_POLL_INTERVAL = 2
+DEFAULT_QUERY_TIMEOUT = 2
+
+#--------------------------------------------------------------------------------
+# Function to normalize a DNS name or cluster domain URL for comparison,
+# e.g. https://Internal-Vault.elb.amazonaws.com. -> internal-vault.elb.amazonaws.com
+#--------------------------------------------------------------------------------
+def normalize_dns_name(name):
+  if name == None:
+    return None
+  if '://' in name:
+    name = name.split('://', 1)[1]
+  name = name.split('/', 1)[0].split(':', 1)[0]
+  return name.rstrip('.').lower()
+
+#--------------------------------------------------------------------------------
+# Function to split a resolver specification "host" or "host:port"
+#--------------------------------------------------------------------------------
+def parse_resolver(resolver):
+  resolver = resolver.strip()
+  if resolver.count(':') == 1:
+    host, port = resolver.split(':')
+    return host, int(port)
+  return resolver, DNS_PORT
+
+#--------------------------------------------------------------------------------
+# Functions to encode a DNS CNAME query and to decode the answer (RFC 1035)
+#--------------------------------------------------------------------------------
+def encode_name(name):
+  buf = b''
+  for label in normalize_dns_name(name).split('.'):
+    buf += struct.pack('!B', len(label)) + label.encode('ascii')
+  return buf + b'\x00'
+
+def decode_name(message, offset):
+  labels = []
+  end_offset = None
+  jumps = 0
+  while True:
+    length = message[offset]
+    if length & 0xC0 == 0xC0:
+      # Compressed name: the rest of the name is at the pointer offset
+      if end_offset == None:
+        end_offset = offset + 2
+      offset = struct.unpack('!H', message[offset:offset+2])[0] & 0x3FFF
+      jumps += 1
+      if jumps > 64:
+        raise ValueError('DNS name compression loop')
+      continue
+    offset += 1
+    if length == 0:
+      break
+    labels.append(message[offset:offset+length].decode('ascii'))
+    offset += length
+  if end_offset == None:
+    end_offset = offset
+  return '.'.join(labels), end_offset
+
+def encode_cname_query(query_id, name):
+  # Header: ID, flags (RD set), QDCOUNT=1, ANCOUNT=0, NSCOUNT=0, ARCOUNT=0
+  header = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+  return header + encode_name(name) + struct.pack('!HH', DNS_TYPE_CNAME, DNS_CLASS_IN)
+
+#--------------------------------------------------------------------------------
+# Raised for an answer with the TC flag set, which has to be asked again over TCP
+#--------------------------------------------------------------------------------
+class TruncatedAnswer(ValueError):
+  pass
+
+def decode_cname_answer(message, query_id, name):
+  if len(message) < 12:
+    raise ValueError('DNS answer shorter than its header')
+  (answer_id, flags, qdcount, ancount, nscount, arcount) = struct.unpack('!HHHHHH', message[:12])
+  if answer_id != query_id:
+    raise ValueError('DNS answer ID does not match the query ID')
+  if flags & DNS_FLAG_TC:
+    raise TruncatedAnswer('DNS answer truncated')
+  if flags & 0x000F != 0:
+    # Any RCODE other than NOERROR (e.g. NXDOMAIN) means no usable answer
+    return None
+  try:
+    offset = 12
+    for q in range(qdcount):
+      qname, offset = decode_name(message, offset)
+      offset += 4
+    for a in range(ancount):
+      rname, offset = decode_name(message, offset)
+      (rtype, rclass, ttl, rdlength) = struct.unpack('!HHIH', message[offset:offset+10])
+      offset += 10
+      if rtype == DNS_TYPE_CNAME and normalize_dns_name(rname) == normalize_dns_name(name):
+        target, ignore = decode_name(message, offset)
+        return normalize_dns_name(target)
+      offset += rdlength
+  except (IndexError, struct.error, UnicodeDecodeError):
+    raise ValueError('DNS answer cut short')
+  return None
+
+#--------------------------------------------------------------------------------
+# Function to ask a single resolver what the CNAME of name currently points to.
+# Returns the normalized target or None if the resolver has no answer.
+#--------------------------------------------------------------------------------
+def query_cname(resolver, name, timeout=DEFAULT_QUERY_TIMEOUT):
+  host, port = parse_resolver(resolver)
+  query_id = random.randint(0, 0xFFFF)
+  sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_DGRAM)
+  try:
+    sock.settimeout(timeout)
+    sock.sendto(encode_cname_query(query_id, name), (host, port))
+    while True:
+      message, addr = sock.recvfrom(4096)
+      try:
+        return decode_cname_answer(message, query_id, name)
+      except TruncatedAnswer:
+        break
+      except ValueError:
+        # Stray or malformed datagram, keep waiting for our answer
+        continue
+  finally:
+    sock.close()
+  return query_cname_tcp(host, port, name, timeout)
+
+#--------------------------------------------------------------------------------
+# Function to ask the same over TCP, for an answer that did not fit into a
+# datagram
+#--------------------------------------------------------------------------------
+def query_cname_tcp(host, port, name, timeout=DEFAULT_QUERY_TIMEOUT):
+  query_id = random.randint(0, 0xFFFF)
+  query = encode_cname_query(query_id, name)
+  with socket.create_connection((host, port), timeout) as sock:
+    sock.sendall(struct.pack('!H', len(query)) + query)
+    length = struct.unpack('!H', receive(sock, 2))[0]
+    return decode_cname_answer(receive(sock, length), query_id, name)
+
+def receive(sock, length):
+  data = b''
+  while len(data) < length:
+    chunk = sock.recv(length - len(data))
+    if not chunk:
+      raise ValueError('DNS connection closed after ' + str(len(data)) + ' of ' + str(length) +
+                       ' bytes')
+    data += chunk
+  return data
+
+#--------------------------------------------------------------------------------
+# Stage 1: Poll the providers of changes, a list of (provider, change ID), until
+# all of them have their change in sync or the deadline (a time.monotonic()
+# value) passes. Returns the names of the providers that are not in sync yet.
+#--------------------------------------------------------------------------------
+def wait_for_changes(changes, deadline, poll_interval=DEFAULT_POLL_INTERVAL, start=None):
+  if start == None:
+    start = time.monotonic()
+  pending = list(changes)
+  while True:
+    for provider, change_id in list(pending):
+      try:
+        synced = provider.synced(change_id)
+      except Exception as e:
+        events.log("Error:", e, "occurred while polling", provider.name, "change", change_id,
+                   level=events.WARNING)
+        synced = False
+      if synced:
+        pending.remove((provider, change_id))
+        events.log("*** DNS provider", provider.name, "has change", change_id, "in sync after",
+                   format(time.monotonic() - start, '.3f'), "seconds")
+    if not pending:
+      return []
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+      return [provider.name for provider, change_id in pending]
+    tracing.tracer.sleep(min(poll_interval, remaining), 'dns-change-poll')
+
+#--------------------------------------------------------------------------------
+# Stage 2: Query every resolver until all of them answer name with target or
+# the deadline passes. Returns the list of resolvers that have not yet converged.
+#--------------------------------------------------------------------------------
+def wait_for_resolvers(resolvers, name, target, deadline,
+                       poll_interval=DEFAULT_POLL_INTERVAL, timeout=DEFAULT_QUERY_TIMEOUT):
+  target = normalize_dns_name(target)
+  pending = list(resolvers)
+  while pending:
+    for resolver in list(pending):
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        return pending
+      try:
+        answer = query_cname(resolver, name, min(timeout, remaining))
+      except (OSError, ValueError, IndexError, struct.error):
+        answer = None
+      if answer == target:
+        pending.remove(resolver)
+    if not pending:
+      break
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+      return pending
+    tracing.tracer.sleep(min(poll_interval, remaining), 'resolver-poll')
+  return pending
+
+#--------------------------------------------------------------------------------
+# Function to wait until the CNAME change has propagated, bounded by max_delay
+# seconds. changes is a list of (provider, change ID). Without insync there is
+# no change to poll (Route 53 failover routing moves the CNAME by itself) and
+# only the resolvers are waited for. Returns the number of seconds actually
+# waited.
+#--------------------------------------------------------------------------------
+def wait_for_dns_propagation(changes, name, target, resolvers, max_delay,
+                             poll_interval=DEFAULT_POLL_INTERVAL, insync=True):
+  start = time.monotonic()
+  deadline = start + max_delay
+
+  if not insync and resolvers:
+    events.log("*** Waiting for resolvers", ', '.join(resolvers), "to resolve", name, "to",
+               normalize_dns_name(target))
+  elif not changes or any(change_id == None for provider, change_id in changes):
+    # Nothing to poll, fall back to the fixed delay
+    events.log("*** No DNS change ID available, sleeping for", max_delay,
+               "seconds for DNS changes to propagate")
+    tracing.tracer.sleep(max_delay, 'dns-propagation-delay')
+    return time.monotonic() - start
+  else:
+    pending = wait_for_changes(changes, deadline, poll_interval, start)
+    if pending:
+      events.log("*** DNS changes of", ', '.join(pending), "not in sync after", max_delay,
+                 "seconds, continuing anyway")
+      return time.monotonic() - start
+    if resolvers:
+      events.log("*** DNS changes are in sync after",
+                 format(time.monotonic() - start, '.3f'), "seconds, waiting for resolvers",
+                 ', '.join(resolvers), "to resolve", name, "to", normalize_dns_name(target))
+
+  if resolvers:
+    pending = wait_for_resolvers(resolvers, name, target, deadline, poll_interval)
+    if pending:
+      events.log("*** Resolvers", ', '.join(pending), "still not resolving", name, "to",
+                 normalize_dns_name(target), "after", max_delay, "seconds, continuing anyway")
+      return time.monotonic() - start
+
+  events.log("*** DNS change for", name, "propagated after",
+             format(time.monotonic() - start, '.3f'), "seconds")
+  return time.monotonic() - start
@@ -0,0 +1,404 @@
+#--------------------------------------------------------------------------------
+# """dns_providers.py: DNS systems the CNAME of a cluster pair is cut over in"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# Step 4 used to UPSERT the CNAME in one Route 53 hosted zone. Clients inside
+# the data centres may resolve the same name through an internal DNS server,
+# which has to be cut over too. A DnsProvider is one DNS system a CNAME lives
+# in:
+#
+#   * change(records, ttl) makes one change of several (name, target) CNAMEs
+#     and returns its change ID,
+#   * synced(change_id) tells whether the change is served yet,
+#   * check() raises if the provider cannot be used (wrong keys, unknown zone).
+#
+# Route53Provider changes the records of a hosted zone in one ChangeBatch and
+# polls GetChange until it is INSYNC; all of them share the Route 53 client of
+# the controller. Rfc2136Provider sends one DNS UPDATE message (RFC 2136),
+# signed with TSIG (RFC 8945) if a key is configured, over a TCP connection to
+# the primary server of the zone that is kept open between changes, and polls
+# that server until it answers with the new targets. A local stand-in such as
+# benchmarks/mock_dns.py will do as that server.
+#
+# Every pair names its providers in dns_providers (route53, the hosted zone of
+# the pair, if not set). Further providers are [DNS-Provider-<Name>] sections:
+#
+#   [DNS-Provider-Internal]
+#   type=rfc2136
+#   server=10.0.0.53:53
+#   zone=acme.com
+#   tsig_key_name=vault-dr
+#   tsig_algorithm=hmac-sha256
+#
+# The base64 TSIG secret is read from DNS_TSIG_SECRET_<NAME>. change_all()
+# makes the change in all the providers of a pair at once, and Step 4 is done
+# when the slowest of them has confirmed it.
+#--------------------------------------------------------------------------------
+import abc, base64, hashlib, hmac, os, random, socket, struct, threading, time
+from vault_dr import dns_propagation
+
+ROUTE53 = 'route53'
+RFC2136 = 'rfc2136'
+PROVIDER_TYPES = (ROUTE53, RFC2136)
+
+PROVIDER_SECTION_PREFIX = 'DNS-Provider-'
+# Provider of the pairs that do not name any, the hosted zone of the pair
+DEFAULT_PROVIDER = ROUTE53
+
+DEFAULT_TIMEOUT = 2
+DEFAULT_TSIG_ALGORITHM = 'hmac-sha256'
+TSIG_FUDGE = 300
+
+DNS_OPCODE_UPDATE = 5
+DNS_TYPE_SOA = 6
+DNS_TYPE_TSIG = 250
+DNS_CLASS_ANY = 255
+
+RCODES = {1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN', 4: 'NOTIMP', 5: 'REFUSED', 6: 'YXDOMAIN',
+          7: 'YXRRSET', 8: 'NXRRSET', 9: 'NOTAUTH', 10: 'NOTZONE'}
+
+# TSIG algorithm name -> hash function
+TSIG_ALGORITHMS = {
+  'hmac-md5.sig-alg.reg.int': hashlib.md5,
+  'hmac-sha1': hashlib.sha1,
+  'hmac-sha256': hashlib.sha256,
+  'hmac-sha512': hashlib.sha512,
+}
+
+class DnsProvider(abc.ABC):
+  kind = None
+
+  def __init__(self, name):
+    self.name = name
+
+  #------------------------------------------------------------------------------
+  # Function to return the key under which the changes of concurrent pairs are
+  # batched; pairs whose records go to the same key share one change
+  #------------------------------------------------------------------------------
+  def key(self):
+    return self.name
+
+  @abc.abstractmethod
+  def change(self, records, ttl):
+    pass
+
+  @abc.abstractmethod
+  def synced(self, change_id):
+    pass
+
+  def check(self):
+    pass
+
+  def close(self):
+    pass
+
+  def describe(self):
+    return self.name
+
+class Route53Provider(DnsProvider):
+  kind = ROUTE53
+
+  def __init__(self, name, client, hosted_zone_id):
+    DnsProvider.__init__(self, name)
+    self.client = client
+    self.hosted_zone_id = hosted_zone_id
+
+  def key(self):
+    return ROUTE53 + ':' + str(self.hosted_zone_id)
+
+  def describe(self):
+    return self.name + ' (Route 53 hosted zone ' + str(self.hosted_zone_id) + ')'
+
+  #------------------------------------------------------------------------------
+  # Function to UPSERT the CNAMEs in a single ChangeBatch. Returns the change ID.
+  #------------------------------------------------------------------------------
+  def change(self, records, ttl):
+    response = self.client.change_resource_record_sets(HostedZoneId=self.hosted_zone_id,
+                                  ChangeBatch= {
+                                     'Comment': ', '.join('update %s -> %s' % (source, target)
+                                                          for source, target in records),
+                                     'Changes': [{
+                                       'Action': 'UPSERT',
+                                       'ResourceRecordSet': {
+                                         'Name': source,
+                                         'Type': 'CNAME',
+                                         'TTL': ttl,
+                                         'ResourceRecords': [{'Value': target}]
+                                       }
+                                     } for source, target in records]
+                                  })
+    return response.get('ChangeInfo').get('Id')
+
+  def synced(self, change_id):
+    return self.client.get_change(Id=change_id).get('ChangeInfo').get('Status') == 'INSYNC'
+
+  def check(self):
+    self.client.get_hosted_zone(Id=self.hosted_zone_id)
+
+class Rfc2136Provider(DnsProvider):
+  kind = RFC2136
+
+  def __init__(self, name, server, zone, tsig_key_name=None, tsig_secret=None,
+               tsig_algorithm=DEFAULT_TSIG_ALGORITHM, timeout=DEFAULT_TIMEOUT):
+    DnsProvider.__init__(self, name)
+    self.server = server
+    self.zone = dns_propagation.normalize_dns_name(zone)
+    self.tsig_key_name = tsig_key_name or None
+    self.tsig_secret = tsig_secret
+    self.tsig_algorithm = tsig_algorithm.lower().rstrip('.')
+    if self.tsig_algorithm not in TSIG_ALGORITHMS:
+      raise ValueError('unknown TSIG algorithm ' + tsig_algorithm + ' of DNS provider ' + name)
+    if self.tsig_key_name != None and not self.tsig_secret:
+      raise ValueError('no TSIG secret for the key ' + self.tsig_key_name + ' of DNS provider ' +
+                       name + ' in DNS_TSIG_SECRET_' + name.upper())
+    self.timeout = timeout
+    # The connection to the server is shared by concurrent changes
+    self.lock = threading.Lock()
+    self.sock = None
+    # Records of the changes made, until the server answers with them
+    self.pending = {}
+
+  def describe(self):
+    return self.name + ' (RFC 2136 zone ' + self.zone + ' on ' + self.server + ')'
+
+  #------------------------------------------------------------------------------
+  # Function to replace the CNAMEs with one UPDATE message: each name has its
+  # CNAME RRset deleted and the new one added. Returns the change ID.
+  #------------------------------------------------------------------------------
+  def change(self, records, ttl):
+    for source, target in records:
+      name = dns_propagation.normalize_dns_name(source)
+      if name != self.zone and not name.endswith('.' + self.zone):
+        raise ValueError(source + ' is not in the zone ' + self.zone + ' of DNS provider ' +
+                         self.name)
+    query_id = random.randint(0, 0xFFFF)
+    message = self.sign(encode_update(query_id, self.zone, records, ttl), query_id)
+    answer = self.exchange(message)
+    (answer_id, flags) = struct.unpack('!HH', answer[:4])
+    if answer_id != query_id:
+      raise ValueError('DNS UPDATE answer ID does not match the query ID')
+    rcode = flags & 0x000F
+    if rcode != 0:
+      raise RuntimeError('DNS server ' + self.server + ' refused the update of ' + self.zone +
+                         ': ' + RCODES.get(rcode, 'RCODE ' + str(rcode)))
+    change_id = RFC2136 + '-' + self.name + '-%04x' % query_id
+    self.pending[change_id] = list(records)
+    return change_id
+
+  #------------------------------------------------------------------------------
+  # Function to return whether the server answers every record of the change
+  # with its new target. A change ID without records (e.g. one read back from
+  # the journal) was acknowledged by the server and counts as synced.
+  #------------------------------------------------------------------------------
+  def synced(self, change_id):
+    for source, target in self.pending.get(change_id, []):
+      if (dns_propagation.query_cname(self.server, source, self.timeout) !=
+          dns_propagation.normalize_dns_name(target)):
+        return False
+    self.pending.pop(change_id, None)
+    return True
+
+  def check(self):
+    # Any answer, even NXDOMAIN, shows that the server is there
+    dns_propagation.query_cname(self.server, self.zone, self.timeout)
+
+  #------------------------------------------------------------------------------
+  # Function to add a TSIG record to message, if a key is configured
+  #------------------------------------------------------------------------------
+  def sign(self, message, query_id):
+    if self.tsig_key_name == None:
+      return message
+    key_name = dns_propagation.encode_name(self.tsig_key_name)
+    algorithm = dns_propagation.encode_name(self.tsig_algorithm)
+    now = int(time.time())
+    time_signed = struct.pack('!HI', now >> 32, now & 0xFFFFFFFF)
+    digest = hmac.new(base64.b64decode(self.tsig_secret),
+                      message + key_name + struct.pack('!HI', DNS_CLASS_ANY, 0) + algorithm +
+                      time_signed + struct.pack('!HHH', TSIG_FUDGE, 0, 0),
+                      TSIG_ALGORITHMS[self.tsig_algorithm]).digest()
+    rdata = (algorithm + time_signed + struct.pack('!HH', TSIG_FUDGE, len(digest)) + digest +
+             struct.pack('!HHH', query_id, 0, 0))
+    arcount = struct.unpack('!H', message[10:12])[0] + 1
+    return (message[:10] + struct.pack('!H', arcount) + message[12:] + key_name +
+            struct.pack('!HHIH', DNS_TYPE_TSIG, DNS_CLASS_ANY, 0, len(rdata)) + rdata)
+
+  #------------------------------------------------------------------------------
+  # Function to send message over the kept-open TCP connection and return the
+  # answer. A connection the server closed in the meantime is replaced once.
+  #------------------------------------------------------------------------------
+  def exchange(self, message):
+    with self.lock:
+      for attempt in (1, 2):
+        reused = self.sock != None
+        try:
+          if self.sock == None:
+            host, port = dns_propagation.parse_resolver(self.server)
+            self.sock = socket.create_connection((host, port), self.timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+          self.sock.settimeout(self.timeout)
+          self.sock.sendall(struct.pack('!H', len(message)) + message)
+          length = struct.unpack('!H', self.receive(2))[0]
+          return self.receive(length)
+        except (OSError, EOFError):
+          self.close_socket()
+          if not reused or attempt == 2:
+            raise
+
+  def receive(self, length):
+    data = b''
+    while len(data) < length:
+      chunk = self.sock.recv(length - len(data))
+      if not chunk:
+        raise EOFError('DNS server ' + self.server + ' closed the connection')
+      data += chunk
+    return data
+
+  def close_socket(self):
+    if self.sock != None:
+      try:
+        self.sock.close()
+      except OSError:
+        pass
+      self.sock = None
+
+  def close(self):
+    with self.lock:
+      self.close_socket()
+
+#--------------------------------------------------------------------------------
+# Function to encode a DNS UPDATE message replacing the CNAMEs of records in
+# zone (RFC 2136 section 2)
+#--------------------------------------------------------------------------------
+def encode_update(query_id, zone, records, ttl):
+  # Header: ID, opcode UPDATE, ZOCOUNT=1, PRCOUNT=0, UPCOUNT, ADCOUNT=0
+  message = struct.pack('!HHHHHH', query_id, DNS_OPCODE_UPDATE << 11, 1, 0, 2 * len(records), 0)
+  message += dns_propagation.encode_name(zone) + struct.pack('!HH', DNS_TYPE_SOA,
+                                                             dns_propagation.DNS_CLASS_IN)
+  for source, target in records:
+    name = dns_propagation.encode_name(source)
+    rdata = dns_propagation.encode_name(target)
+    # Delete the CNAME RRset of the name, then add the new one
+    message += name + struct.pack('!HHIH', dns_propagation.DNS_TYPE_CNAME, DNS_CLASS_ANY, 0, 0)
+    message += (name + struct.pack('!HHIH', dns_propagation.DNS_TYPE_CNAME,
+                                   dns_propagation.DNS_CLASS_IN, ttl, len(rdata)) + rdata)
+  return message
+
+#--------------------------------------------------------------------------------
+# Function to make the change of records in every provider concurrently.
+# make(provider), if given, makes the change in one provider instead and
+# returns its change ID. Returns a dict of provider name -> change ID; raises
+# the first error once all the providers have answered.
+#--------------------------------------------------------------------------------
+def change_all(providers, records, ttl, make=None):
+  changes = {}
+  errors = []
+
+  def change(provider):
+    try:
+      if make != None:
+        changes[provider.name] = make(provider)
+      else:
+        changes[provider.name] = provider.change(records, ttl)
+    except Exception as e:
+      errors.append((provider, e))
+
+  threads = [threading.Thread(target=change, args=(provider,), daemon=True)
+             for provider in providers[1:]]
+  for thread in threads:
+    thread.start()
+  if providers:
+    change(providers[0])
+  for thread in threads:
+    thread.join()
+  if errors:
+    provider, error = errors[0]
+    raise RuntimeError('DNS provider ' + provider.describe() + ': ' + str(error)) from error
+  return changes
+
+#--------------------------------------------------------------------------------
+# The providers of the config. Route 53 providers are created on demand for
+# each hosted zone and all use the one Route 53 client of the controller.
+#--------------------------------------------------------------------------------
+class DnsProviders:
+
+  def __init__(self, sections=None):
+    # Options of every [DNS-Provider-<Name>] section by lower case name
+    self.sections = sections if sections != None else {}
+    self.providers = {}
+    self.lock = threading.Lock()
+
+  #------------------------------------------------------------------------------
+  # Function to return the providers of a pair by name, created on first use.
+  # route53 is the built-in provider of the hosted zone of the pair.
+  # Raises ValueError for an unknown provider.
+  #------------------------------------------------------------------------------
+  def get(self, names, route53, hosted_zone_id):
+    providers = []
+    for name in names or [DEFAULT_PROVIDER]:
+      name = name.lower()
+      if name == ROUTE53:
+        options = {'type': ROUTE53, 'hosted_zone_id': hosted_zone_id}
+      elif name in self.sections:
+        options = self.sections[name]
+      else:
+        raise ValueError('unknown DNS provider ' + name)
+      providers.append(self.create(name, options, route53))
+    return providers
+
+  def create(self, name, options, route53):
+    with self.lock:
+      if options['type'] == ROUTE53:
+        key = (name, options.get('hosted_zone_id'))
+        provider = self.providers.get(key)
+        if provider == None:
+          provider = self.providers[key] = Route53Provider(name, route53,
+                                                           options.get('hosted_zone_id'))
+        # The client may have been created after the provider
+        provider.client = route53
+        return provider
+      provider = self.providers.get((name, None))
+      if provider == None:
+        provider = self.providers[(name, None)] = Rfc2136Provider(
+          name, options['server'], options['zone'], options.get('tsig_key_name'),
+          os.getenv('DNS_TSIG_SECRET_' + name.upper()),
+          options.get('tsig_algorithm') or DEFAULT_TSIG_ALGORITHM,
+          float(options.get('timeout') or DEFAULT_TIMEOUT))
+      return provider
+
+  def close(self):
+    with self.lock:
+      for provider in self.providers.values():
+        provider.close()
+      self.providers = {}
+
+#--------------------------------------------------------------------------------
+# Function to read the [DNS-Provider-<Name>] sections. Raises ValueError for an
+# unknown type or a missing option.
+#--------------------------------------------------------------------------------
+def from_config(config):
+  sections = {}
+  for section in config.sections():
+    if not section.startswith(PROVIDER_SECTION_PREFIX):
+      continue
+    name = section[len(PROVIDER_SECTION_PREFIX):].lower()
+    options = dict(config.items(section))
+    options['type'] = options.get('type', '').strip().lower()
+    if options['type'] not in PROVIDER_TYPES:
+      raise ValueError('unknown type ' + repr(options['type']) + ' of DNS provider ' + name)
+    required = ('hosted_zone_id',) if options['type'] == ROUTE53 else ('server', 'zone')
+    for option in required:
+      if not options.get(option):
+        raise ValueError('DNS provider ' + name + ' has no ' + option)
+    sections[name] = options
+  return DnsProviders(sections)
@@ -0,0 +1,313 @@
+#--------------------------------------------------------------------------------
+# """dns_strategy.py: How the CNAME of a Vault cluster is moved to the new
+#    primary, and the worst-case client staleness each way guarantees"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# A client that resolved the CNAME just before Step 4 keeps using the old
+# primary until its cached answer expires, however quickly the change itself
+# propagates. The staleness is therefore bounded by the TTL the record had
+# before the cut-over, not by the one the UPSERT sets. The [DNS-Strategy]
+# section selects one of:
+#
+#   * static: the CNAME is UPSERTed with ttl (300) as it always was; clients
+#     may see the old primary for up to ttl seconds.
+#   * low-ttl: the CNAME always has low_ttl; up to low_ttl seconds.
+#   * pre-lower: for a planned failover the TTL is lowered to low_ttl ahead of
+#     time (--lower-ttl) and restored to ttl after the cut-over. Once ttl
+#     seconds have passed since the lowering, up to low_ttl seconds; before
+#     that, up to what is left of the old TTL.
+#   * failover-routing: the CNAME is a pair of Route 53 failover records
+#     (--setup-dns) with health checks of /v1/sys/health on both clusters. Only
+#     an active primary answers 200, so Route 53 answers with the new primary
+#     once it is promoted and the old one is down or demoted, without an
+#     UPSERT in Step 4. Up to health_check_interval * failure_threshold +
+#     low_ttl seconds after that.
+#--------------------------------------------------------------------------------
+import json, os, threading, time
+from urllib.parse import urlsplit
+from vault_dr import dns_propagation, events
+
+STATIC = 'static'
+LOW_TTL = 'low-ttl'
+PRE_LOWER = 'pre-lower'
+FAILOVER_ROUTING = 'failover-routing'
+
+DEFAULT_MODE = STATIC
+DEFAULT_TTL = 300
+DEFAULT_LOW_TTL = 30
+DEFAULT_STATE_FILE = 'vault_dr_dns.json'
+# Route 53 health checks run every 10 or 30 seconds and fail after 1 to 10
+# failed checks
+HEALTH_CHECK_INTERVALS = (10, 30)
+DEFAULT_HEALTH_CHECK_INTERVAL = 10
+MAX_FAILURE_THRESHOLD = 10
+DEFAULT_FAILURE_THRESHOLD = 3
+
+HEALTH_CHECK_PATH = '/v1/sys/health'
+
+class DnsStrategy:
+  mode = STATIC
+
+  def __init__(self, ttl=DEFAULT_TTL, low_ttl=DEFAULT_LOW_TTL):
+    self.ttl = ttl
+    self.low_ttl = low_ttl
+
+  #------------------------------------------------------------------------------
+  # Function to return the TTL the CNAME is UPSERTed with in Step 4
+  #------------------------------------------------------------------------------
+  def cutover_ttl(self):
+    return self.ttl
+
+  #------------------------------------------------------------------------------
+  # Function to return whether Step 4 UPSERTs the CNAME at all
+  #------------------------------------------------------------------------------
+  def updates_records(self):
+    return True
+
+  #------------------------------------------------------------------------------
+  # Function to return how many seconds after the cut-over a client may still
+  # resolve name to the old primary
+  #------------------------------------------------------------------------------
+  def max_staleness(self, name):
+    return self.ttl
+
+  def describe(self, name):
+    return ("clients may resolve " + name + " to the old primary for up to " +
+            format(self.max_staleness(name), '.0f') + " seconds after the change is INSYNC")
+
+  #------------------------------------------------------------------------------
+  # Functions to set the TTL of name, which points to target, to low_ttl (e.g.
+  # when switching to low-ttl) or back to ttl outside of a DR operation.
+  # update_records(records, ttl) UPSERTs the CNAMEs. Return the change ID.
+  #------------------------------------------------------------------------------
+  def lower(self, update_records, name, target):
+    change_id = update_records([(name, target)], self.low_ttl)
+    events.log("*** Lowered the TTL of", name, "to", self.low_ttl, "seconds")
+    return change_id
+
+  def restore(self, update_records, name, target):
+    change_id = update_records([(name, target)], self.ttl)
+    events.log("*** Restored the TTL of", name, "to", self.ttl, "seconds")
+    return change_id
+
+  #------------------------------------------------------------------------------
+  # Function to return whether the TTL is restored after the cut-over
+  #------------------------------------------------------------------------------
+  def restores_ttl(self):
+    return False
+
+  #------------------------------------------------------------------------------
+  # Function called once the cut-over of name to target has propagated.
+  # Returns a change ID or None.
+  #------------------------------------------------------------------------------
+  def after_cutover(self, update_records, name, target):
+    return None
+
+class LowTtlStrategy(DnsStrategy):
+  mode = LOW_TTL
+
+  def cutover_ttl(self):
+    return self.low_ttl
+
+  def max_staleness(self, name):
+    return self.low_ttl
+
+class PreLowerStrategy(DnsStrategy):
+  mode = PRE_LOWER
+
+  def __init__(self, ttl=DEFAULT_TTL, low_ttl=DEFAULT_LOW_TTL, state_file=DEFAULT_STATE_FILE):
+    DnsStrategy.__init__(self, ttl, low_ttl)
+    self.state_file = state_file
+    # Concurrent pairs restore their TTLs at the same time
+    self.lock = threading.Lock()
+
+  #------------------------------------------------------------------------------
+  # Functions to read and write when the TTL of each CNAME was lowered (wall
+  # clock, as the lowering is done by an earlier invocation)
+  #------------------------------------------------------------------------------
+  def read_state(self):
+    try:
+      with open(self.state_file) as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return {}
+
+  def write_state(self, state):
+    with open(self.state_file + '.tmp', 'w') as f:
+      json.dump(state, f, indent=2, sort_keys=True)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(self.state_file + '.tmp', self.state_file)
+
+  def lowered_at(self, name):
+    return self.read_state().get(name, {}).get('lowered_at')
+
+  #------------------------------------------------------------------------------
+  # Functions to lower the TTL of name ahead of a planned failover, recording
+  # when, and to restore it
+  #------------------------------------------------------------------------------
+  def lower(self, update_records, name, target):
+    change_id = update_records([(name, target)], self.low_ttl)
+    with self.lock:
+      state = self.read_state()
+      # Lowering twice must not move the time the old TTL runs out
+      if name not in state:
+        state[name] = {'lowered_at': time.time(), 'ttl': self.ttl}
+        self.write_state(state)
+    ready = state[name]['lowered_at'] + state[name]['ttl']
+    events.log("*** Lowered the TTL of", name, "to", self.low_ttl, "seconds; a failover from",
+               time.strftime("%a, %d %b %Y %H:%M:%S", time.localtime(ready)),
+               "on leaves clients on the old primary for up to", self.low_ttl, "seconds")
+    return change_id
+
+  def restore(self, update_records, name, target):
+    change_id = update_records([(name, target)], self.ttl)
+    with self.lock:
+      state = self.read_state()
+      if state.pop(name, None) != None:
+        self.write_state(state)
+    events.log("*** Restored the TTL of", name, "to", self.ttl, "seconds")
+    return change_id
+
+  def cutover_ttl(self):
+    return self.low_ttl
+
+  def max_staleness(self, name):
+    entry = self.read_state().get(name)
+    if entry == None:
+      return self.ttl
+    # Answers cached right before the lowering expire ttl seconds after it
+    return max(self.low_ttl, entry.get('lowered_at', 0) + entry.get('ttl', self.ttl) - time.time())
+
+  def describe(self, name):
+    description = DnsStrategy.describe(self, name)
+    if self.lowered_at(name) == None:
+      description += " (the TTL was not lowered ahead with --lower-ttl)"
+    return description
+
+  def restores_ttl(self):
+    return True
+
+  def after_cutover(self, update_records, name, target):
+    return self.restore(update_records, name, target)
+
+class FailoverRoutingStrategy(DnsStrategy):
+  mode = FAILOVER_ROUTING
+
+  def __init__(self, ttl=DEFAULT_TTL, low_ttl=DEFAULT_LOW_TTL,
+               health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL,
+               failure_threshold=DEFAULT_FAILURE_THRESHOLD):
+    DnsStrategy.__init__(self, ttl, low_ttl)
+    self.health_check_interval = health_check_interval
+    self.failure_threshold = failure_threshold
+
+  def updates_records(self):
+    return False
+
+  def max_staleness(self, name):
+    return self.health_check_interval * self.failure_threshold + self.low_ttl
+
+  def describe(self, name):
+    return ("Route 53 answers " + name + " with the new primary once its health check passes "
+            "and the one of the old primary fails; clients may resolve it to the old primary "
+            "for up to " + format(self.max_staleness(name), '.0f') + " seconds after that")
+
+  #------------------------------------------------------------------------------
+  # Function to create (or, with the same caller reference, look up) the
+  # health check of /v1/sys/health of a cluster. Returns its ID.
+  #------------------------------------------------------------------------------
+  def health_check(self, client, cluster_domain):
+    parts = urlsplit(cluster_domain)
+    https = parts.scheme == 'https'
+    port = parts.port or (443 if https else 80)
+    response = client.create_health_check(
+      CallerReference=('vault-dr-' + parts.hostname + '-' + str(port))[-64:],
+      HealthCheckConfig={
+        'Type': 'HTTPS' if https else 'HTTP',
+        'FullyQualifiedDomainName': parts.hostname,
+        'Port': port,
+        'ResourcePath': HEALTH_CHECK_PATH,
+        'RequestInterval': self.health_check_interval,
+        'FailureThreshold': self.failure_threshold
+      })
+    return response.get('HealthCheck').get('Id')
+
+  #------------------------------------------------------------------------------
+  # Function to replace the simple CNAME name by failover records pointing to
+  # the primary and secondary clusters, in one change. Returns the change ID.
+  #------------------------------------------------------------------------------
+  def setup(self, client, hosted_zone_id, name, primary_vault_cluster_domain,
+            secondary_vault_cluster_domain):
+    changes = []
+    existing = client.list_resource_record_sets(HostedZoneId=hosted_zone_id, StartRecordName=name,
+                                                StartRecordType='CNAME', MaxItems='1')
+    for record in existing.get('ResourceRecordSets', []):
+      if (dns_propagation.normalize_dns_name(record.get('Name')) ==
+          dns_propagation.normalize_dns_name(name) and record.get('Type') == 'CNAME' and
+          record.get('Failover') == None):
+        changes.append({'Action': 'DELETE', 'ResourceRecordSet': record})
+    for role, cluster_domain in (('PRIMARY', primary_vault_cluster_domain),
+                                 ('SECONDARY', secondary_vault_cluster_domain)):
+      health_check_id = self.health_check(client, cluster_domain)
+      events.log("*** Health check", health_check_id, "of", cluster_domain + HEALTH_CHECK_PATH,
+                 "for the", role, "record of", name)
+      changes.append({
+        'Action': 'UPSERT',
+        'ResourceRecordSet': {
+          'Name': name,
+          'Type': 'CNAME',
+          'SetIdentifier': name + '-' + role.lower(),
+          'Failover': role,
+          'TTL': self.low_ttl,
+          'HealthCheckId': health_check_id,
+          'ResourceRecords': [{'Value': dns_propagation.normalize_dns_name(cluster_domain)}]
+        }
+      })
+    response = client.change_resource_record_sets(HostedZoneId=hosted_zone_id, ChangeBatch={
+      'Comment': 'failover routing for ' + name,
+      'Changes': changes
+    })
+    events.log("*** Set up failover routing for", name + ";", self.describe(name))
+    return response.get('ChangeInfo').get('Id')
+
+#--------------------------------------------------------------------------------
+# Function to read the DNS strategy from the [DNS-Strategy] section.
+# Raises ValueError for an unknown mode, or a health check interval or failure
+# threshold Route 53 would reject.
+#--------------------------------------------------------------------------------
+def from_config(config):
+  section = 'DNS-Strategy'
+  mode = config.get(section, 'mode', fallback=DEFAULT_MODE).strip().lower()
+  ttl = config.getint(section, 'ttl', fallback=DEFAULT_TTL)
+  low_ttl = config.getint(section, 'low_ttl', fallback=DEFAULT_LOW_TTL)
+  if mode == STATIC:
+    return DnsStrategy(ttl, low_ttl)
+  if mode == LOW_TTL:
+    return LowTtlStrategy(ttl, low_ttl)
+  if mode == PRE_LOWER:
+    return PreLowerStrategy(ttl, low_ttl,
+                            config.get(section, 'state_file', fallback=DEFAULT_STATE_FILE))
+  if mode == FAILOVER_ROUTING:
+    health_check_interval = config.getint(section, 'health_check_interval',
+                                          fallback=DEFAULT_HEALTH_CHECK_INTERVAL)
+    if health_check_interval not in HEALTH_CHECK_INTERVALS:
+      raise ValueError('health_check_interval must be 10 or 30, not ' +
+                       str(health_check_interval))
+    failure_threshold = config.getint(section, 'failure_threshold',
+                                      fallback=DEFAULT_FAILURE_THRESHOLD)
+    if not 1 <= failure_threshold <= MAX_FAILURE_THRESHOLD:
+      raise ValueError('failure_threshold must be between 1 and ' + str(MAX_FAILURE_THRESHOLD) +
+                       ', not ' + str(failure_threshold))
+    return FailoverRoutingStrategy(ttl, low_ttl, health_check_interval, failure_threshold)
+  raise ValueError('unknown DNS strategy mode ' + mode)
@@ -0,0 +1,166 @@
+#--------------------------------------------------------------------------------
+# """drill.py: Failover/failback drills ("game days") with RTO regression tracking"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# Failovers practised by hand, one run at a time, leave no record of how long
+# they took. A drill runs a number of cycles against one cluster pair, each a
+# failover followed by a failback. Before every run it waits until the pair is
+# in a steady state: the primary reports the primary mode and the secondary is
+# a DR secondary in the stream-wals state. Every run is appended to a results
+# file, one JSON line per record, and fsync'ed like the journal:
+#
+#   {"event": "start", "drill": ..., "environment": "prod", "cycles": 3}
+#   {"event": "run", "drill": ..., "environment": "prod", "cycle": 1,
+#    "direction": "failover", "ok": true, "rto": 4.2, "total": 9.8, "steps": {"3-A": 0.1, ...}}
+#   {"event": "end", "drill": ..., "environment": "prod", "p95_rto": 4.5, "passed": true, ...}
+#
+# The p95 RTO of a drill is compared with that of the last drill of the same
+# environment that passed, its baseline. The drill fails if its p95 RTO is more
+# than tolerance (a fraction) above the baseline, if a run failed or if the
+# pair did not reach a steady state in time.
+#--------------------------------------------------------------------------------
+import time, uuid
+from vault_dr import events, journal
+
+DEFAULT_RESULTS_FILE = 'vault_dr_drills.jsonl'
+DEFAULT_CYCLES = 3
+DEFAULT_TOLERANCE = 0.2
+DEFAULT_STEADY_STATE_TIMEOUT = 300
+DEFAULT_STEADY_STATE_INTERVAL = 2
+
+#--------------------------------------------------------------------------------
+# Function to return the p-th percentile (0-100) of values, by nearest rank
+#--------------------------------------------------------------------------------
+def percentile(values, p):
+  if not values:
+    return float('nan')
+  ordered = sorted(values)
+  rank = max(int(-(-p * len(ordered) // 100)), 1)
+  return ordered[min(rank, len(ordered)) - 1]
+
+class Results(journal.Journal):
+
+  def __init__(self, path=DEFAULT_RESULTS_FILE):
+    journal.Journal.__init__(self, path)
+
+  #------------------------------------------------------------------------------
+  # Functions to record the start of a drill, one of its runs and its end
+  #------------------------------------------------------------------------------
+  def start(self, environment, cycles):
+    drill_id = uuid.uuid4().hex[:12]
+    self.append({'event': 'start', 'drill': drill_id, 'environment': environment,
+                 'cycles': cycles})
+    return drill_id
+
+  def run(self, drill_id, environment, cycle, direction, ok, rto, total, steps, error=None):
+    self.append({'event': 'run', 'drill': drill_id, 'environment': environment, 'cycle': cycle,
+                 'direction': direction, 'ok': ok, 'rto': rto, 'total': total, 'steps': steps,
+                 'error': error})
+
+  def end(self, drill_id, environment, summary):
+    self.append(dict(summary, event='end', drill=drill_id, environment=environment))
+
+  #------------------------------------------------------------------------------
+  # Function to return the end record of the last drill of environment that
+  # passed, other than drill_id, or None
+  #------------------------------------------------------------------------------
+  def baseline(self, environment, drill_id=None):
+    baseline = None
+    for record in self.records():
+      if (record.get('event') == 'end' and record.get('environment') == environment and
+          record.get('drill') != drill_id and record.get('passed') and
+          record.get('p95_rto') != None):
+        baseline = record
+    return baseline
+
+#--------------------------------------------------------------------------------
+# Function to wait until primary reports the primary mode and secondary is a
+# healthy DR secondary. sample(cluster_domain) returns a readiness.Sample.
+# Returns (steady, description of the last state seen).
+#--------------------------------------------------------------------------------
+def wait_for_steady_state(sample, primary, secondary, timeout=DEFAULT_STEADY_STATE_TIMEOUT,
+                          interval=DEFAULT_STEADY_STATE_INTERVAL):
+  expires = time.monotonic() + timeout
+  while True:
+    primary_sample = sample(primary)
+    secondary_sample = sample(secondary)
+    state = (primary + ' ' + describe(primary_sample) + ', ' +
+             secondary + ' ' + describe(secondary_sample))
+    if (primary_sample.error == None and primary_sample.mode == 'primary' and
+        secondary_sample.healthy_secondary()):
+      return True, state
+    if time.monotonic() + interval > expires:
+      return False, state
+    time.sleep(interval)
+
+def describe(sample):
+  if sample.error != None:
+    return 'unreachable (' + sample.error + ')'
+  return str(sample.mode) + ' ' + str(sample.state)
+
+#--------------------------------------------------------------------------------
+# Function to summarize the run records of a drill and compare its p95 RTO with
+# the baseline (an end record or None). problem says why the drill stopped
+# early, if it did.
+#--------------------------------------------------------------------------------
+def summarize(runs, baseline, tolerance=DEFAULT_TOLERANCE, problem=None):
+  rtos = [run['rto'] for run in runs if run['ok'] and run['rto'] != None]
+  summary = {'runs': len(runs), 'succeeded': len([run for run in runs if run['ok']]),
+             'p50_rto': percentile(rtos, 50) if rtos else None,
+             'p95_rto': percentile(rtos, 95) if rtos else None,
+             'baseline_p95_rto': baseline.get('p95_rto') if baseline != None else None,
+             'baseline_drill': baseline.get('drill') if baseline != None else None,
+             'tolerance': tolerance, 'problem': problem}
+  summary['regressed'] = (summary['p95_rto'] != None and summary['baseline_p95_rto'] != None and
+                          summary['p95_rto'] > summary['baseline_p95_rto'] * (1 + tolerance))
+  summary['passed'] = (problem == None and summary['runs'] > 0 and
+                       summary['succeeded'] == summary['runs'] and not summary['regressed'])
+  return summary
+
+def print_report(environment, runs, summary):
+  lines = ["", "%-10s %-9s %3s %10s %10s" % ("Cycle", "Direction", "OK", "RTO (s)", "total (s)")]
+  for run in runs:
+    lines.append("%-10s %-9s %3s %10s %10s" %
+                 (run['cycle'], run['direction'], 'yes' if run['ok'] else 'NO',
+                  format(run['rto'], '.3f') if run['rto'] != None else '-',
+                  format(run['total'], '.3f') if run['total'] != None else '-'))
+  names = []
+  for run in runs:
+    for name in run['steps']:
+      if name not in names:
+        names.append(name)
+  if names:
+    lines.append("")
+    lines.append("%-12s %6s %10s %10s" % ("Step", "Runs", "p50 (s)", "p95 (s)"))
+  for name in names:
+    values = [run['steps'][name] for run in runs if name in run['steps']]
+    lines.append("%-12s %6d %10.3f %10.3f" % (name, len(values), percentile(values, 50),
+                                              percentile(values, 95)))
+  lines.append("")
+  # Printed by the event log so that it comes out after the events of the runs
+  events.logger.report('\n'.join(lines))
+  if summary['p95_rto'] == None:
+    comparison = "no successful run"
+  elif summary['baseline_p95_rto'] == None:
+    comparison = ("p95 RTO " + format(summary['p95_rto'], '.3f') +
+                  " seconds, no baseline yet")
+  else:
+    comparison = ("p95 RTO " + format(summary['p95_rto'], '.3f') + " seconds against " +
+                  format(summary['baseline_p95_rto'], '.3f') + " of drill " +
+                  summary['baseline_drill'] + " (tolerance " +
+                  format(summary['tolerance'] * 100, 'g') + "%)" +
+                  (", REGRESSED" if summary['regressed'] else ""))
+  events.log("*** Drill of", environment, "PASSED:" if summary['passed'] else "FAILED:",
+             str(summary['succeeded']) + " of " + str(summary['runs']) + " runs succeeded,",
+             comparison + ("; " + summary['problem'] if summary['problem'] != None else ""))
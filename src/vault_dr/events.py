@@ -0,0 +1,231 @@
+#--------------------------------------------------------------------------------
+# """events.py: Structured, non-blocking event log of the DR operation"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# The step banners used to be printed by the step itself, so a slow terminal
+# (or an ssh session over a congested link) slowed down the failover, and the
+# debug output printed payloads with recovery keys and operation tokens in the
+# clear. log() only puts the event on a queue and returns; a writer thread
+# prints the same banner as before and appends the event, as one JSON line, to
+# the event log file:
+#
+#   {"t": 12.345678, "time": "2020-05-04T10:11:12.345+0000", "level": "info",
+#    "message": "Promoting the secondary ...", "run": "prod", "correlation": "3f2a...",
+#    "step": "3-E", "thread": "step-3-E"}
+#
+# t is the monotonic clock, as in the traces of tracing.py. The cluster pair
+# (run), its correlation ID and the step are those of the span open in the
+# calling thread. Fields whose name looks like a secret (a token, key, OTP or
+# password) are redacted, and so is every secret value seen before, e.g. the
+# Vault token or a recovery key, wherever it appears in an event.
+#--------------------------------------------------------------------------------
+import atexit, json, queue, re, sys, threading, time
+
+DEFAULT_EVENT_LOG = 'vault_dr_events.jsonl'
+
+DEBUG = 'debug'
+INFO = 'info'
+WARNING = 'warning'
+ERROR = 'error'
+
+REDACTED = '<redacted>'
+# Field names whose values are secrets; nonce and the key counts are not
+SECRET_FIELD = re.compile(r'token|key$|^key|otp$|secret|password', re.IGNORECASE)
+NOT_SECRET_FIELDS = ('otp_length', 'key_shares', 'key_threshold')
+# Shorter values are too likely to appear by chance to be redacted everywhere
+MIN_SECRET_LENGTH = 6
+
+#--------------------------------------------------------------------------------
+# Function to return the cluster pair, correlation ID and step of the span open
+# in the calling thread. tracing is imported here since it logs through this
+# module.
+#--------------------------------------------------------------------------------
+def trace_context():
+  from vault_dr import tracing
+  span = tracing.tracer.current()
+  step = None
+  walk = span
+  while walk != None and step == None:
+    if walk.kind == tracing.STEP:
+      step = walk.name
+    walk = walk.parent
+  if span == None:
+    return None, None, None
+  return span.inherited('run'), span.inherited('correlation'), step
+
+def secret_field(name):
+  return (isinstance(name, str) and name.lower() not in NOT_SECRET_FIELDS and
+          SECRET_FIELD.search(name) != None)
+
+class EventLogger:
+
+  def __init__(self):
+    self.queue = queue.Queue()
+    self.lock = threading.Lock()
+    self.thread = None
+    self.path = None
+    self.file = None
+    self.console = True
+    self.secrets = set()
+    self.dropped = 0
+
+  #------------------------------------------------------------------------------
+  # Function to write the events to path (none if path is empty or None) and,
+  # with console, to stdout
+  #------------------------------------------------------------------------------
+  def configure(self, path=DEFAULT_EVENT_LOG, console=True):
+    self.flush()
+    with self.lock:
+      if self.file != None and path != self.path:
+        self.file.close()
+        self.file = None
+      self.path = path or None
+      self.console = console
+
+  #------------------------------------------------------------------------------
+  # Function to redact value wherever it appears in later events
+  #------------------------------------------------------------------------------
+  def secret(self, value):
+    if isinstance(value, str) and len(value) >= MIN_SECRET_LENGTH and value not in self.secrets:
+      with self.lock:
+        self.secrets = self.secrets | {value}
+
+  #------------------------------------------------------------------------------
+  # Function to remember the values of the secret fields of a payload, headers
+  # or a response, at any depth
+  #------------------------------------------------------------------------------
+  def secrets_in(self, document):
+    if isinstance(document, dict):
+      for name, value in document.items():
+        if secret_field(name) and isinstance(value, str):
+          self.secret(value)
+        else:
+          self.secrets_in(value)
+    elif isinstance(document, (list, tuple)):
+      for value in document:
+        self.secrets_in(value)
+
+  #------------------------------------------------------------------------------
+  # Function to log an event. parts are joined like the arguments of print();
+  # fields are added to the JSON line. Never blocks on I/O.
+  #------------------------------------------------------------------------------
+  def log(self, *parts, level=INFO, **fields):
+    run, correlation, step = trace_context()
+    event = {'t': time.monotonic(), 'wall': time.time(), 'level': level,
+             'message': ' '.join(str(part) for part in parts), 'run': fields.pop('run', run),
+             'correlation': correlation, 'step': fields.pop('step', step),
+             'thread': threading.current_thread().name, 'fields': fields,
+             'stream': sys.stdout}
+    self.put(event)
+
+  #------------------------------------------------------------------------------
+  # Function to print text, e.g. a report of several lines, on the console in
+  # order with the events, without adding it to the event log file
+  #------------------------------------------------------------------------------
+  def report(self, text):
+    self.put({'text': str(text), 'stream': sys.stdout})
+
+  def put(self, event):
+    if self.thread == None:
+      with self.lock:
+        if self.thread == None:
+          self.thread = threading.Thread(target=self.run, name='event-log', daemon=True)
+          self.thread.start()
+    self.queue.put_nowait(event)
+
+  #------------------------------------------------------------------------------
+  # Function to wait until the events logged so far are written, for at most
+  # timeout seconds
+  #------------------------------------------------------------------------------
+  def flush(self, timeout=None):
+    if self.thread == None:
+      return True
+    done = threading.Event()
+    self.queue.put_nowait({'flushed': done})
+    return done.wait(timeout)
+
+  def redact(self, value, secrets):
+    if isinstance(value, dict):
+      return dict((name, REDACTED if secret_field(name) and item not in (None, '') else
+                   self.redact(item, secrets)) for name, item in value.items())
+    if isinstance(value, (list, tuple)):
+      return [self.redact(item, secrets) for item in value]
+    if isinstance(value, str):
+      for secret in secrets:
+        if secret in value:
+          value = value.replace(secret, REDACTED)
+      return value
+    if value == None or isinstance(value, (bool, int, float)):
+      return value
+    return self.redact(str(value), secrets)
+
+  def run(self):
+    while True:
+      event = self.queue.get()
+      try:
+        self.write(event)
+      except Exception:
+        # A full disk or a closed terminal must not stop the DR operation
+        self.dropped += 1
+      if self.queue.empty() and self.file != None:
+        try:
+          self.file.flush()
+        except Exception:
+          pass
+
+  def write(self, event):
+    if 'flushed' in event:
+      if self.file != None:
+        self.file.flush()
+      event['flushed'].set()
+      return
+    secrets = self.secrets
+    if 'text' in event:
+      if self.console:
+        event['stream'].write(self.redact(event['text'], secrets) + '\n')
+        event['stream'].flush()
+      return
+    message = self.redact(event['message'], secrets)
+    if self.console:
+      event['stream'].write(time.strftime("[%a, %d %b %Y %H:%M:%S]", time.localtime(event['wall'])) +
+                            ' ' + message + '\n')
+      event['stream'].flush()
+    with self.lock:
+      if self.file == None and self.path != None:
+        self.file = open(self.path, 'a')
+      log_file = self.file
+    if log_file == None:
+      return
+    record = {'t': round(event['t'], 6),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(event['wall'])) +
+                      '.%03d' % int(event['wall'] % 1 * 1000) +
+                      time.strftime('%z', time.localtime(event['wall'])),
+              'level': event['level'], 'message': message[4:] if message.startswith('*** ') else message,
+              'thread': event['thread']}
+    for name in ('run', 'correlation', 'step'):
+      if event[name] != None:
+        record[name] = event[name]
+    record.update(self.redact(event['fields'], secrets))
+    log_file.write(json.dumps(record, sort_keys=True, default=str) + '\n')
+
+logger = EventLogger()
+
+def log(*parts, level=INFO, **fields):
+  logger.log(*parts, level=level, **fields)
+
+def flush(timeout=None):
+  return logger.flush(timeout)
+
+# Write out what is still queued when the script exits
+atexit.register(lambda: logger.flush(5))
@@ -0,0 +1,143 @@
+#--------------------------------------------------------------------------------
+# """fencing.py: Bounded-time fencing of the old primary against a split brain"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# From the promotion of the secondary in Step 3-E until the demotion of the old
+# primary in Step 5-A, which waits for the CNAME change to propagate, both
+# clusters are primaries. Clients that still resolve the CNAME to a live old
+# primary write to it, and those writes have to be reconciled by hand.
+#
+# A fence stops the old primary from taking writes as soon as the promotion is
+# acknowledged, while the CNAME is being cut over, and gives up after deadline
+# seconds:
+#
+#   * demote: demote the old primary right away, as Step 5-A would. Step 5-A
+#     then has nothing left to do, but still waits for DNS as the rest of
+#     Step 5 does: Step 5-E points the old primary at the CNAME.
+#   * hook: run a command that blocks the listener of the old primary, e.g. by
+#     taking it out of its load balancer or closing its security group to the
+#     clients. The command gets the pair and both cluster domains in the
+#     environment and must exit with status 0 once the old primary is fenced.
+#     Step 5-A still demotes it, so the command must leave it reachable from
+#     this script.
+#
+# A failed attempt is retried every retry_interval seconds until the deadline.
+# The dual-primary window of a run is the time from the start of the promotion
+# until the old primary was fenced or demoted: an upper bound, as the promotion
+# takes effect somewhere within its API call.
+#--------------------------------------------------------------------------------
+import abc, os, shlex, subprocess
+from vault_dr import tracing
+
+OFF = 'off'
+DEMOTE = 'demote'
+HOOK = 'hook'
+MODES = (OFF, DEMOTE, HOOK)
+
+DEFAULT_MODE = OFF
+DEFAULT_DEADLINE = 5
+DEFAULT_RETRY_INTERVAL = 0.25
+
+class Fence(abc.ABC):
+  mode = OFF
+
+  def __init__(self, deadline=DEFAULT_DEADLINE, retry_interval=DEFAULT_RETRY_INTERVAL):
+    self.deadline = deadline
+    self.retry_interval = retry_interval
+
+  def describe(self):
+    return self.mode + ' within ' + format(self.deadline, 'g') + ' seconds'
+
+  #------------------------------------------------------------------------------
+  # Function to make one attempt at fencing the old primary of pair name.
+  # demote(deadline) demotes it through the Vault API. Raises an exception if
+  # the old primary is not fenced.
+  #------------------------------------------------------------------------------
+  @abc.abstractmethod
+  def fence(self, name, old_primary, new_primary, demote, deadline):
+    pass
+
+  #------------------------------------------------------------------------------
+  # Function to fence the old primary, retrying until deadline (a
+  # retry_policy.Deadline) passes. Returns None once it is fenced, or the error
+  # of the last attempt.
+  #------------------------------------------------------------------------------
+  def run(self, name, old_primary, new_primary, demote, deadline):
+    while True:
+      try:
+        self.fence(name, old_primary, new_primary, demote, deadline)
+        return None
+      except Exception as e:
+        error = e
+      if deadline.remaining() <= self.retry_interval:
+        return error
+      tracing.tracer.sleep(self.retry_interval, 'fence-retry')
+
+class DemoteFence(Fence):
+  mode = DEMOTE
+
+  def fence(self, name, old_primary, new_primary, demote, deadline):
+    demote(deadline)
+
+class HookFence(Fence):
+  mode = HOOK
+
+  def __init__(self, command, deadline=DEFAULT_DEADLINE, retry_interval=DEFAULT_RETRY_INTERVAL):
+    Fence.__init__(self, deadline, retry_interval)
+    self.command = shlex.split(command)
+
+  def describe(self):
+    return (self.mode + ' ' + os.path.basename(self.command[0]) + ' within ' +
+            format(self.deadline, 'g') + ' seconds')
+
+  def fence(self, name, old_primary, new_primary, demote, deadline):
+    environment = dict(os.environ, VAULT_DR_PAIR=name, VAULT_DR_OLD_PRIMARY=old_primary,
+                       VAULT_DR_NEW_PRIMARY=new_primary)
+    result = subprocess.run(self.command, env=environment, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, universal_newlines=True,
+                            timeout=max(deadline.remaining(), 0.001))
+    if result.returncode != 0:
+      output = result.stdout.strip().splitlines()
+      raise RuntimeError('fence hook ' + self.command[0] + ' exited with status ' +
+                         str(result.returncode) + (': ' + output[-1] if output else ''))
+
+#--------------------------------------------------------------------------------
+# Function to return the dual-primary window: from the start of the promotion
+# until the old primary was fenced (time.monotonic() values), or None if either
+# is unknown
+#--------------------------------------------------------------------------------
+def dual_primary_window(promoted, fenced):
+  if promoted == None or fenced == None:
+    return None
+  return max(fenced - promoted, 0.0)
+
+#--------------------------------------------------------------------------------
+# Function to read the [Fencing] section. Returns None if fencing is off.
+# Raises ValueError for an unknown mode or a hook mode without a command.
+#--------------------------------------------------------------------------------
+def from_config(config):
+  section = 'Fencing'
+  mode = config.get(section, 'mode', fallback=DEFAULT_MODE).strip().lower()
+  deadline = config.getfloat(section, 'deadline', fallback=DEFAULT_DEADLINE)
+  retry_interval = config.getfloat(section, 'retry_interval', fallback=DEFAULT_RETRY_INTERVAL)
+  if mode == OFF:
+    return None
+  if mode == DEMOTE:
+    return DemoteFence(deadline, retry_interval)
+  if mode == HOOK:
+    command = config.get(section, 'hook', fallback='').strip()
+    if command == '':
+      raise ValueError('fencing mode hook needs a hook command')
+    return HookFence(command, deadline, retry_interval)
+  raise ValueError('unknown fencing mode ' + mode)
@@ -0,0 +1,99 @@
+#--------------------------------------------------------------------------------
+# """http_pool.py: Pooled, keep-alive HTTP sessions per Vault cluster"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# Every Vault API call used to go through requests.request(), which opens a new
+# TCP connection and does a full TLS handshake to the cross-region ELB each
+# time. The SessionPool hands out one requests.Session per cluster domain. Each
+# session keeps its connections alive, so a call that finds an idle connection
+# in the pool skips the TCP and TLS handshakes. This is connection reuse only:
+# TLS sessions are not resumed, and every new connection (the pool growing, a
+# retry on another node, a connection the ELB closed) pays a full handshake.
+# prewarm() opens connections in the background (while the operator is still
+# at the prompts, for instance) so that even the first call of a step goes
+# over a warm connection.
+#--------------------------------------------------------------------------------
+import threading
+
+DEFAULT_POOL_MAXSIZE = 4
+DEFAULT_PREWARM_CONNECTIONS = 2
+DEFAULT_PREWARM_TIMEOUT = 5
+
+# Cheap unauthenticated endpoint used to open connections. A DR secondary only
+# answers 200 if drsecondarycode is set (see the "Gotchas" in the README).
+PREWARM_PATH = '/v1/sys/health?standbyok=true&drsecondarycode=200&perfstandbyok=true'
+
+class SessionPool:
+
+  def __init__(self, pool_maxsize=DEFAULT_POOL_MAXSIZE):
+    self.pool_maxsize = pool_maxsize
+    self.sessions = {}
+    self.lock = threading.Lock()
+
+  #------------------------------------------------------------------------------
+  # Function to return the keep-alive session for a cluster domain, creating it
+  # on first use
+  #------------------------------------------------------------------------------
+  def get(self, cluster_domain):
+    import requests
+    from requests.adapters import HTTPAdapter
+    with self.lock:
+      session = self.sessions.get(cluster_domain)
+      if session == None:
+        session = requests.Session()
+        # No transport level retries, http_request() decides when to retry. More
+        # than one host pool is kept for retries on other nodes behind the ELB.
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_maxsize,
+                              max_retries=0, pool_block=False)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.verify = False
+        session.headers['Connection'] = 'keep-alive'
+        self.sessions[cluster_domain] = session
+      return session
+
+  #------------------------------------------------------------------------------
+  # Function to open num_connections connections to each cluster domain in
+  # background threads. Returns the threads so that callers can join them if
+  # they want to wait; failures are ignored since the real call will retry.
+  #------------------------------------------------------------------------------
+  def prewarm(self, cluster_domains, num_connections=DEFAULT_PREWARM_CONNECTIONS,
+              timeout=DEFAULT_PREWARM_TIMEOUT):
+    threads = []
+    for cluster_domain in cluster_domains:
+      session = self.get(cluster_domain)
+      for i in range(min(num_connections, self.pool_maxsize)):
+        thread = threading.Thread(target=self.open_connection,
+                                  args=(session, cluster_domain, timeout),
+                                  daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+  def open_connection(self, session, cluster_domain, timeout):
+    import requests
+    try:
+      # Reading the body releases the connection back into the pool
+      session.get(cluster_domain + PREWARM_PATH, timeout=timeout, verify=False).content
+    except requests.exceptions.RequestException:
+      pass
+
+  #------------------------------------------------------------------------------
+  # Function to close all the sessions and their pooled connections
+  #------------------------------------------------------------------------------
+  def close(self):
+    with self.lock:
+      for session in self.sessions.values():
+        session.close()
+      self.sessions = {}
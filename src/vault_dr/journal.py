@@ -0,0 +1,137 @@
+#--------------------------------------------------------------------------------
+# """journal.py: Crash-safe journal of the completed DR steps, for --resume"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# If the script dies halfway, e.g. after Step 3-E promoted the secondary but
+# before Step 4 updated the CNAME, a rerun from Step 3-A fails since the
+# secondary is no longer a DR secondary. Every completed step is therefore
+# appended to a journal, one JSON line per record, and fsync'ed before the
+# steps that depend on it start:
+#
+#   {"event": "start", "run": "prod", "id": ..., "primary": ..., "secondary": ...}
+#   {"event": "step", "run": "prod", "id": ..., "step": "4", "outputs": {"changes": {"route53": ...}}}
+#   {"event": "end", "run": "prod", "id": ...}
+#
+# No secrets are written: operation tokens, OTPs, secondary activation tokens
+# and recovery keys stay in memory. A step whose outputs are secrets is run
+# again on --resume if a later step still needs them (see plan_resume()).
+#--------------------------------------------------------------------------------
+import json, os, threading, time, uuid
+
+DEFAULT_JOURNAL_PATH = 'vault_dr_journal.jsonl'
+
+class Journal:
+
+  def __init__(self, path=DEFAULT_JOURNAL_PATH):
+    self.path = path
+    self.lock = threading.Lock()
+
+  #------------------------------------------------------------------------------
+  # Function to append a record and make it durable before returning
+  #------------------------------------------------------------------------------
+  def append(self, record):
+    record = dict(record, time=time.strftime('%Y-%m-%dT%H:%M:%S%z'))
+    line = json.dumps(record, sort_keys=True) + '\n'
+    with self.lock:
+      created = not os.path.exists(self.path)
+      with open(self.path, 'ab+') as f:
+        # End a line torn by a crash, so that it does not swallow this record
+        if f.seek(0, os.SEEK_END) > 0:
+          f.seek(-1, os.SEEK_END)
+          if f.read(1) != b'\n':
+            line = '\n' + line
+        f.write(line.encode())
+        f.flush()
+        os.fsync(f.fileno())
+      if created:
+        # Make the new directory entry durable too
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+          os.fsync(directory)
+        finally:
+          os.close(directory)
+
+  def records(self):
+    records = []
+    if not os.path.exists(self.path):
+      return records
+    with open(self.path) as f:
+      for line in f:
+        try:
+          records.append(json.loads(line))
+        except ValueError:
+          # A record torn by a crash in the middle of a write was never committed
+          continue
+    return records
+
+  #------------------------------------------------------------------------------
+  # Functions to record the start of a run, a completed step and the end of a run
+  #------------------------------------------------------------------------------
+  def start(self, run_name, primary, secondary, cluster_cname):
+    run_id = uuid.uuid4().hex[:12]
+    self.append({'event': 'start', 'run': run_name, 'id': run_id, 'primary': primary,
+                 'secondary': secondary, 'cname': cluster_cname})
+    return run_id
+
+  def commit(self, run_id, run_name, step, outputs=None, source='run'):
+    self.append({'event': 'step', 'run': run_name, 'id': run_id, 'step': step,
+                 'outputs': outputs or {}, 'source': source})
+
+  def end(self, run_id, run_name):
+    self.append({'event': 'end', 'run': run_name, 'id': run_id})
+
+  #------------------------------------------------------------------------------
+  # Function to find the last run of a cluster pair in the same direction.
+  # Returns (run id, {step: outputs}, finished) or (None, {}, False).
+  #------------------------------------------------------------------------------
+  def last_run(self, run_name, primary, secondary):
+    run_id = None
+    steps = {}
+    finished = False
+    for record in self.records():
+      if record.get('run') != run_name:
+        continue
+      if record.get('event') == 'start':
+        if record.get('primary') == primary and record.get('secondary') == secondary:
+          run_id, steps, finished = record.get('id'), {}, False
+        else:
+          run_id, steps, finished = None, {}, False
+      elif record.get('id') == run_id and run_id != None:
+        if record.get('event') == 'step':
+          steps[record.get('step')] = record.get('outputs') or {}
+        elif record.get('event') == 'end':
+          finished = True
+    return run_id, steps, finished
+
+#--------------------------------------------------------------------------------
+# Function to decide which steps of a scheduler to run again on resume, given
+# the committed steps. A committed step in resumable (one whose effect is
+# permanent and whose outputs are all in the journal) is never run again.
+# Any other step runs again if a step that depends on it runs, since its
+# outputs (e.g. an operation token) were not journalled or describe live
+# state; a step in always_run always runs. Returns the steps to restore as done.
+#--------------------------------------------------------------------------------
+def plan_resume(scheduler, committed, resumable, always_run=()):
+  needed = {}
+  for name in reversed(scheduler.order):
+    if name in always_run:
+      needed[name] = True
+      continue
+    if name in committed and name in resumable:
+      needed[name] = False
+      continue
+    dependents = [n for n in scheduler.order if name in scheduler.steps[n].depends_on]
+    needed[name] = (any(needed[n] for n in dependents) or
+                    (name not in committed and not dependents))
+  return [name for name in scheduler.order if not needed[name]]
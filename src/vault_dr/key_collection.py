@@ -0,0 +1,209 @@
+#--------------------------------------------------------------------------------
+# """key_collection.py: Concurrent collection of recovery key shards from
+#    several custodians over an authenticated local socket"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# Steps 3-D and 5-D prompt for one recovery key after the other, so with key
+# custodians at different desks the DR operation waits for each of them in
+# turn. With key collection enabled, the script listens on a Unix socket
+# (authenticated like the trigger socket of the daemon, see daemon.py) from
+# the start. Each custodian sends their shard with
+#
+#   ./run_vault_dr.py --submit-key prod
+#
+# as soon as they are ready, even before the operation token generation has
+# started. Once Step 3-C (or 5-C) has the nonce of the attempt, every shard is
+# submitted to Vault as soon as it arrives, and every custodian sees the
+# progress until the operation token is complete:
+#
+#   {"token": ..., "run": "prod", "key": ..., "custodian": "alice"}
+#   {"accepted": true, "progress": 1, "required": 3, "complete": false}
+#   {"progress": 2, "required": 3, "complete": false}
+#   {"progress": 3, "required": 3, "complete": true}
+#
+# Keys are never printed or written anywhere.
+#--------------------------------------------------------------------------------
+import threading, time
+from vault_dr import daemon, events
+
+DEFAULT_SOCKET_PATH = 'vault_dr_keys.sock'
+DEFAULT_TOKEN_FILE = 'vault_dr_keys.token'
+DEFAULT_TIMEOUT = 900
+
+#--------------------------------------------------------------------------------
+# The shards of one operation token attempt. submit(key) sends a shard to Vault
+# and returns its response, or raises requests.exceptions.RequestException.
+#--------------------------------------------------------------------------------
+class KeyCollection:
+
+  def __init__(self, name, attempt, submit):
+    self.name = name
+    self.required = attempt.get('required')
+    self.progress = attempt.get('progress') or 0
+    self.final = attempt if attempt.get('complete') else None
+    self.submit = submit
+    # Accepted keys, in the order they were accepted
+    self.keys = []
+    self.pending = set()
+    self.closed = False
+    self.condition = threading.Condition()
+
+  def complete(self):
+    return self.final != None
+
+  #------------------------------------------------------------------------------
+  # Function to submit a shard. Returns None if Vault accepted it, or an error.
+  #------------------------------------------------------------------------------
+  def add(self, key, custodian):
+    import requests
+    with self.condition:
+      if self.complete():
+        return 'the operation token is already complete'
+      if self.closed:
+        return 'the key collection of ' + self.name + ' is closed'
+      if key in self.keys or key in self.pending:
+        return 'this key has already been provided'
+      self.pending.add(key)
+    try:
+      response = self.submit(key)
+    except requests.exceptions.RequestException as e:
+      with self.condition:
+        self.pending.discard(key)
+      return 'Vault rejected the key: ' + str(e)
+    with self.condition:
+      self.pending.discard(key)
+      self.keys.append(key)
+      # Responses to concurrent submissions may arrive out of order
+      self.progress = max(self.progress, response.get('progress') or 0)
+      if response.get('complete'):
+        self.final = response
+        self.progress = self.required
+      progress, complete = self.progress, self.complete()
+      self.condition.notify_all()
+    events.log("*** Recovery key of", custodian, "accepted for", self.name + ":", progress, "of",
+               self.required, "keys" + (", operation token complete" if complete else ""))
+    return None
+
+  #------------------------------------------------------------------------------
+  # Function to wait until the progress differs from progress, the operation
+  # token is complete or the collection is closed. Returns (progress, complete).
+  #------------------------------------------------------------------------------
+  def wait_for_change(self, progress, timeout=None):
+    with self.condition:
+      self.condition.wait_for(lambda: self.progress != progress or self.complete() or self.closed,
+                              timeout)
+      return self.progress, self.complete()
+
+  #------------------------------------------------------------------------------
+  # Function to wait for the last response of the attempt, the one with the
+  # encoded token. Returns None after timeout seconds.
+  #------------------------------------------------------------------------------
+  def wait(self, timeout=None):
+    with self.condition:
+      self.condition.wait_for(self.complete, timeout)
+      return self.final
+
+  def close(self):
+    with self.condition:
+      self.closed = True
+      self.condition.notify_all()
+
+class KeyCollector:
+
+  #------------------------------------------------------------------------------
+  # timeout is how long a custodian who is early may wait for the collection of
+  # their run to open. group is the name of the group of the custodians.
+  #------------------------------------------------------------------------------
+  def __init__(self, socket_path=DEFAULT_SOCKET_PATH, token_file=DEFAULT_TOKEN_FILE,
+               timeout=DEFAULT_TIMEOUT, group=None):
+    self.timeout = timeout
+    self.collections = {}
+    self.condition = threading.Condition()
+    token = daemon.read_or_create_token(token_file, group)
+    self.server = daemon.TriggerServer(socket_path, token, self.handle, group)
+
+  def start(self):
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    events.log("*** Collecting recovery keys on", self.server.socket_path)
+    return self
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  #------------------------------------------------------------------------------
+  # Functions to open the collection of an operation token attempt of a run,
+  # and to close it once the token is complete or the step gave up
+  #------------------------------------------------------------------------------
+  def open(self, name, attempt, submit):
+    collection = KeyCollection(name, attempt, submit)
+    with self.condition:
+      self.collections[name] = collection
+      self.condition.notify_all()
+    events.log("*** Waiting for", collection.required - collection.progress, "recovery keys for",
+               name,
+               "on", self.server.socket_path)
+    return collection
+
+  def close(self, name):
+    with self.condition:
+      collection = self.collections.pop(name, None)
+    if collection != None:
+      collection.close()
+
+  #------------------------------------------------------------------------------
+  # Function to find the open collection of a run, waiting for it to open. The
+  # run may be left out while only one collection is open.
+  #------------------------------------------------------------------------------
+  def collection(self, name, timeout):
+    def find():
+      if name:
+        return self.collections.get(name)
+      return list(self.collections.values())[0] if len(self.collections) == 1 else None
+    with self.condition:
+      self.condition.wait_for(lambda: find() != None, timeout)
+      return find()
+
+  def handle(self, request, reply):
+    key = request.get('key')
+    if not key:
+      reply({'error': 'no key given'})
+      return
+    collection = self.collection(request.get('run'), self.timeout)
+    if collection == None:
+      reply({'error': 'no recovery key collection open for ' + str(request.get('run'))})
+      return
+    error = collection.add(key, str(request.get('custodian') or 'a custodian'))
+    if error != None:
+      reply({'error': error})
+      return
+    progress, complete = collection.progress, collection.complete()
+    reply({'accepted': True, 'progress': progress, 'required': collection.required,
+           'complete': complete})
+    # Show the progress of the other custodians until the token is complete,
+    # including the last change if the step closes the collection right away
+    while not complete:
+      latest, complete = collection.wait_for_change(progress, self.timeout)
+      if latest == progress and not complete and collection.closed:
+        break
+      progress = latest
+      reply({'progress': progress, 'required': collection.required, 'complete': complete})
+
+#--------------------------------------------------------------------------------
+# Function to send a recovery key to the collector of a running DR operation.
+# Calls on_message with every line of the answer and returns the last one.
+#--------------------------------------------------------------------------------
+def submit_key(socket_path, token, run_name, key, custodian, on_message=None):
+  return daemon.trigger(socket_path, token, {'run': run_name, 'key': key, 'custodian': custodian},
+                        on_message)
@@ -0,0 +1,193 @@
+#--------------------------------------------------------------------------------
+# """multi_pair.py: Concurrent failover of several Vault cluster pairs"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# In a regional outage every cluster pair in the region has to fail over, and
+# running the script once per pair multiplies the RTO. A cluster pair is any
+# [Vault-Cluster-<Name>] section of vault_dr.cfg; run_pairs() fails over any
+# number of them concurrently, up to a concurrency limit, and a failing pair
+# does not stop the others.
+#
+# The CNAME updates of pairs that share a hosted zone, or another DNS provider
+# zone (see dns_providers.py), are combined by the CnameBatcher into a single
+# change: the first pair to reach Step 4 opens a short batching window, which
+# closes early once every pair still running in that zone has submitted its
+# record.
+#--------------------------------------------------------------------------------
+import threading, time
+from concurrent.futures import ThreadPoolExecutor
+from vault_dr import events, topology
+
+PAIR_SECTION_PREFIX = 'Vault-Cluster-'
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_BATCH_WINDOW = 1.0
+
+class ClusterPair:
+
+  def __init__(self, name, primary_vault_cluster_domain, secondary_vault_cluster_domain,
+               cluster_cname, hosted_zone_id, followers=(), secondary_id=None, dns_providers=()):
+    self.name = name
+    self.primary_vault_cluster_domain = primary_vault_cluster_domain
+    self.secondary_vault_cluster_domain = secondary_vault_cluster_domain
+    self.cluster_cname = cluster_cname
+    self.hosted_zone_id = hosted_zone_id
+    # (kind, cluster domain, secondary token ID) of the further secondaries,
+    # see topology.py
+    self.followers = list(followers)
+    # ID of the secondary token of the old primary in Step 5-B, derived from
+    # the primary unless configured (kept as token_id for the failback)
+    self.token_id = secondary_id
+    self.secondary_id = (secondary_id if secondary_id != None else
+                         topology.secondary_id(primary_vault_cluster_domain or ''))
+    # Names of the DNS providers the CNAME is changed in, the hosted zone in
+    # Route 53 if none
+    self.dns_providers = list(dns_providers)
+
+  #------------------------------------------------------------------------------
+  # Function to return the pair with the roles of the clusters swapped, as
+  # used for a failback
+  #------------------------------------------------------------------------------
+  def reversed(self):
+    return ClusterPair(self.name, self.secondary_vault_cluster_domain,
+                       self.primary_vault_cluster_domain, self.cluster_cname,
+                       self.hosted_zone_id, self.followers, self.token_id,
+                       self.dns_providers)
+
+#--------------------------------------------------------------------------------
+# Function to read all the cluster pairs of the config, keyed by lower case name.
+# Keys may be prefixed with the pair name as in the original sections
+# (prod_primary_vault_cluster_domain) or not (primary_vault_cluster_domain).
+# A pair may override the HostedZoneID of the [AWS-Route-53] section with
+# hosted_zone_id, and list its further DR and performance secondaries with
+# dr_secondaries and performance_secondaries, and the DNS providers to change
+# its CNAME in with dns_providers (comma separated [DNS-Provider-<Name>] names).
+#--------------------------------------------------------------------------------
+def read_cluster_pairs(config):
+  default_zone_id = config.get('AWS-Route-53', 'HostedZoneID', fallback=None)
+  pairs = {}
+  for section in config.sections():
+    if not section.startswith(PAIR_SECTION_PREFIX):
+      continue
+    name = section[len(PAIR_SECTION_PREFIX):].lower()
+    def option(key, fallback=None):
+      return config.get(section, name + '_' + key,
+                        fallback=config.get(section, key, fallback=fallback))
+    pairs[name] = ClusterPair(name, option('primary_vault_cluster_domain'),
+                              option('secondary_vault_cluster_domain'),
+                              option('cluster_cname'),
+                              option('hosted_zone_id', default_zone_id),
+                              topology.read_followers(option),
+                              dns_providers=[provider.strip().lower() for provider in
+                                             option('dns_providers', '').split(',')
+                                             if provider.strip() != ''])
+  return pairs
+
+#--------------------------------------------------------------------------------
+# Combines the CNAME updates of concurrent pairs into one change per zone: a
+# hosted zone or the key() of a DNS provider. update_records(key, [(source,
+# target), ...]) makes the actual change and returns its change ID.
+#--------------------------------------------------------------------------------
+class CnameBatcher:
+
+  def __init__(self, update_records, window=DEFAULT_BATCH_WINDOW):
+    self.update_records = update_records
+    self.window = window
+    self.condition = threading.Condition()
+    self.expected = {}
+    self.submitted = set()
+    self.batches = {}
+
+  #------------------------------------------------------------------------------
+  # Functions to declare how many pairs will submit a record for a zone, and to
+  # take a pair that failed before submitting its record out of that count
+  #------------------------------------------------------------------------------
+  def expect(self, key, count=1):
+    with self.condition:
+      self.expected[key] = self.expected.get(key, 0) + count
+
+  def withdraw(self, key, source):
+    with self.condition:
+      if (key, source) in self.submitted:
+        return
+      self.expected[key] = self.expected.get(key, 0) - 1
+      self.condition.notify_all()
+
+  #------------------------------------------------------------------------------
+  # Function to add a record to the open batch of its zone and block until the
+  # batch has been sent. Returns the change ID of the batch.
+  #------------------------------------------------------------------------------
+  def submit(self, key, source, target):
+    with self.condition:
+      batch = self.batches.get(key)
+      if batch == None:
+        batch = {'records': [], 'opened': time.monotonic(), 'sent': False,
+                 'change_id': None, 'error': None}
+        self.batches[key] = batch
+        leader = True
+      else:
+        leader = False
+      batch['records'].append((source, target))
+      self.submitted.add((key, source))
+      # This record is now accounted for by the batch
+      self.expected[key] = self.expected.get(key, 1) - 1
+      self.condition.notify_all()
+
+      if leader:
+        # Wait for the window to close or for every expected pair to submit
+        while self.expected.get(key, 0) > 0:
+          remaining = batch['opened'] + self.window - time.monotonic()
+          if remaining <= 0:
+            break
+          self.condition.wait(remaining)
+        del self.batches[key]
+      else:
+        while not batch['sent']:
+          self.condition.wait()
+
+    if leader:
+      try:
+        batch['change_id'] = self.update_records(key, batch['records'])
+      except BaseException as e:
+        batch['error'] = e
+      with self.condition:
+        batch['sent'] = True
+        self.condition.notify_all()
+
+    if batch['error'] != None:
+      raise batch['error']
+    return batch['change_id']
+
+#--------------------------------------------------------------------------------
+# Function to fail over the given pairs concurrently. run_pair(pair) runs one
+# failover; an exception (including SystemExit) only fails its own pair.
+# Returns a dict of pair name -> (succeeded, result or error).
+#--------------------------------------------------------------------------------
+def run_pairs(pairs, run_pair, max_concurrency=DEFAULT_MAX_CONCURRENCY, on_failure=None):
+  results = {}
+
+  def run_one(pair):
+    start = time.monotonic()
+    try:
+      results[pair.name] = (True, run_pair(pair))
+    except BaseException as e:
+      results[pair.name] = (False, e)
+      if on_failure != None:
+        on_failure(pair)
+      events.log("*** Failover of cluster pair", pair.name, "failed after",
+                 format(time.monotonic() - start, '.3f'), "seconds:", repr(e))
+
+  with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+    for pair in pairs:
+      executor.submit(run_one, pair)
+  return results
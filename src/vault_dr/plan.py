@@ -0,0 +1,427 @@
+#--------------------------------------------------------------------------------
+# """plan.py: Failover plans compiled ahead of time from vault_dr.cfg"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# A typo in vault_dr.cfg, a cluster that does not resolve or a hosted zone the
+# CNAME is not in is otherwise only found out halfway through an incident.
+#
+#   ./run_vault_dr.py plan failover prod
+#
+# compiles the DR operation into a plan file: the pairs with the roles of
+# their clusters resolved for the DR mode, the IDs of their secondary tokens,
+# the hosted zone, the ordered steps with their dependencies, and a snapshot
+# of the config the settings are read from. The plan is only written once
+# every URL, hostname and hosted zone ID is well-formed, every cluster
+# resolves and answers /v1/sys/health, every hosted zone exists and contains
+# its CNAME, and every other DNS provider of a pair answers and has the CNAME
+# in its zone. The file carries the SHA-256 digest of its contents and
+# is written read-only; a plan that was edited afterwards is refused.
+#
+#   ./run_vault_dr.py execute [vault_dr_plan.json]
+#
+# runs the plan as compiled, without reading vault_dr.cfg. It refuses to run
+# if the steps it would run differ from those of the plan, e.g. after an
+# upgrade of this script. And
+#
+#   ./run_vault_dr.py plan --diff [vault_dr_plan.json]
+#
+# shows what the run would change against the live state of the clusters and
+# of Route 53, and whether vault_dr.cfg changed since the plan was compiled.
+#--------------------------------------------------------------------------------
+import configparser, hashlib, json, os, re, socket, time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from vault_dr import dns_propagation, dns_providers, multi_pair
+
+VERSION = 1
+DEFAULT_PLAN_FILE = 'vault_dr_plan.json'
+DEFAULT_TIMEOUT = 5
+
+HEALTH_PATH = '/v1/sys/health'
+
+HOSTNAME = re.compile(r'^(?=.{1,253}\.?$)[A-Za-z0-9]([A-Za-z0-9-]{0,61}[A-Za-z0-9])?'
+                      r'(\.[A-Za-z0-9]([A-Za-z0-9-]{0,61}[A-Za-z0-9])?)*\.?$')
+HOSTED_ZONE_ID = re.compile(r'^(/hostedzone/)?[A-Za-z0-9]{1,32}$')
+
+#--------------------------------------------------------------------------------
+# A plan loaded from a plan file. pairs are ClusterPairs with the roles of the
+# clusters as compiled; steps maps each pair name to its ordered steps, each
+# a dict of name, depends_on and conditional.
+#--------------------------------------------------------------------------------
+class Plan:
+
+  def __init__(self, document):
+    self.document = document
+    self.dr_mode = document['dr_mode']
+    self.environments = tuple(document['environments'])
+    self.compiled_at = document['compiled_at']
+    self.config_file = document['config_file']
+    self.config_sha256 = document['config_sha256']
+    self.config = document['config']
+    self.pairs = tuple(multi_pair.ClusterPair(
+      pair['name'], pair['primary_vault_cluster_domain'], pair['secondary_vault_cluster_domain'],
+      pair['cluster_cname'], pair['hosted_zone_id'],
+      [(follower['kind'], follower['cluster_domain'], follower['secondary_id'])
+       for follower in pair['followers']],
+      pair['secondary_id'], pair.get('dns_providers', [])) for pair in document['pairs'])
+    self.steps = dict((pair['name'], tuple(pair['steps'])) for pair in document['pairs'])
+
+  def age(self):
+    return time.time() - self.compiled_at
+
+  #------------------------------------------------------------------------------
+  # Function to return the snapshot of the config as a RawConfigParser
+  #------------------------------------------------------------------------------
+  def config_parser(self):
+    config = configparser.RawConfigParser()
+    config.read_dict(self.config)
+    return config
+
+  def describe(self):
+    return (self.dr_mode + " of " + ', '.join(pair.name for pair in self.pairs) + ", compiled " +
+            time.strftime("%a, %d %b %Y %H:%M:%S", time.localtime(self.compiled_at)) +
+            " (" + format(self.age() / 60, '.0f') + " minutes ago)")
+
+#--------------------------------------------------------------------------------
+# Functions to return the SHA-256 of a file, or None if it cannot be read, and
+# of a plan document without its digest
+#--------------------------------------------------------------------------------
+def file_sha256(path):
+  try:
+    with open(path, 'rb') as f:
+      return hashlib.sha256(f.read()).hexdigest()
+  except OSError:
+    return None
+
+def digest(document):
+  content = dict((key, value) for key, value in document.items() if key != 'digest')
+  return hashlib.sha256(json.dumps(content, sort_keys=True, separators=(',', ':'))
+                        .encode()).hexdigest()
+
+#--------------------------------------------------------------------------------
+# Function to return the sections of a config as a dict, as stored in the plan
+#--------------------------------------------------------------------------------
+def config_snapshot(config):
+  return dict((section, dict(config.items(section, raw=True))) for section in config.sections())
+
+#--------------------------------------------------------------------------------
+# Function to check that the cluster pairs are well-formed. Returns the problems
+# found.
+#--------------------------------------------------------------------------------
+def validate(pairs):
+  problems = []
+
+  def check_url(name, what, url):
+    if not url:
+      problems.append(name + ': ' + what + ' is not set')
+      return
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+      problems.append(name + ': ' + what + ' ' + url + ' is not an http(s) URL')
+    elif not HOSTNAME.match(parts.hostname):
+      problems.append(name + ': ' + what + ' ' + url + ' has an invalid hostname')
+    elif parts.path not in ('', '/') or parts.query or parts.fragment:
+      problems.append(name + ': ' + what + ' ' + url + ' must not have a path')
+    else:
+      try:
+        parts.port
+      except ValueError:
+        problems.append(name + ': ' + what + ' ' + url + ' has an invalid port')
+
+  for pair in pairs:
+    check_url(pair.name, 'primary_vault_cluster_domain', pair.primary_vault_cluster_domain)
+    check_url(pair.name, 'secondary_vault_cluster_domain', pair.secondary_vault_cluster_domain)
+    if (pair.primary_vault_cluster_domain and
+        pair.primary_vault_cluster_domain == pair.secondary_vault_cluster_domain):
+      problems.append(pair.name + ': the primary and the secondary are the same cluster')
+    if not pair.cluster_cname or not HOSTNAME.match(pair.cluster_cname):
+      problems.append(pair.name + ': cluster_cname ' + str(pair.cluster_cname) +
+                      ' is not a hostname')
+    if not pair.hosted_zone_id or not HOSTED_ZONE_ID.match(pair.hosted_zone_id):
+      problems.append(pair.name + ': hosted zone ID ' + str(pair.hosted_zone_id) + ' is invalid')
+    if not pair.secondary_id:
+      problems.append(pair.name + ': no secondary token ID can be derived from ' +
+                      str(pair.primary_vault_cluster_domain))
+    for follower in pair.followers:
+      check_url(pair.name, follower[0] + ' secondary', follower[1])
+      if follower[1] in (pair.primary_vault_cluster_domain, pair.secondary_vault_cluster_domain):
+        problems.append(pair.name + ': ' + follower[1] + ' is a cluster of the pair and a follower')
+  names = [pair.cluster_cname for pair in pairs]
+  for cname in sorted(set(cname for cname in names if names.count(cname) > 1)):
+    problems.append('the CNAME ' + str(cname) + ' belongs to more than one pair')
+  return problems
+
+#--------------------------------------------------------------------------------
+# Function to check that every cluster of the pairs resolves and answers its
+# health endpoint (with any status: standbys and DR secondaries do not answer
+# 200), and that every hosted zone exists and contains its CNAME. providers(pair)
+# returns the DNS providers of a pair; the hosted zones are then those of its
+# Route 53 providers, and every other provider must answer and have the CNAME
+# in its zone. All checks run concurrently. Returns a list of dicts of target,
+# check, ok and detail.
+#--------------------------------------------------------------------------------
+def check_reachability(pairs, route53, timeout=DEFAULT_TIMEOUT, providers=None):
+  import requests
+  clusters = []
+  zones = []
+  others = []
+  failed = []
+  for pair in pairs:
+    for cluster_domain in ([pair.primary_vault_cluster_domain, pair.secondary_vault_cluster_domain] +
+                           [follower[1] for follower in pair.followers]):
+      if cluster_domain not in clusters:
+        clusters.append(cluster_domain)
+    if providers == None:
+      pair_zones, pair_others = [pair.hosted_zone_id], []
+    else:
+      try:
+        pair_providers = providers(pair)
+      except ValueError as e:
+        failed.append({'target': pair.name, 'check': 'dns-provider', 'ok': False, 'detail': str(e)})
+        continue
+      pair_zones = [provider.hosted_zone_id for provider in pair_providers
+                    if provider.kind == dns_providers.ROUTE53]
+      pair_others = [provider for provider in pair_providers
+                     if provider.kind != dns_providers.ROUTE53]
+    for hosted_zone_id in pair_zones:
+      if (hosted_zone_id, pair.cluster_cname) not in zones:
+        zones.append((hosted_zone_id, pair.cluster_cname))
+    for provider in pair_others:
+      if (provider, pair.cluster_cname) not in others:
+        others.append((provider, pair.cluster_cname))
+
+  def check_cluster(cluster_domain):
+    parts = urlsplit(cluster_domain)
+    try:
+      addresses = sorted(set(info[4][0] for info in socket.getaddrinfo(
+        parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80),
+        proto=socket.IPPROTO_TCP)))
+    except OSError as e:
+      return [{'target': cluster_domain, 'check': 'resolve', 'ok': False, 'detail': str(e)}]
+    results = [{'target': cluster_domain, 'check': 'resolve', 'ok': True,
+                'detail': ', '.join(addresses)}]
+    try:
+      response = requests.get(cluster_domain + HEALTH_PATH, verify=False, timeout=timeout)
+      results.append({'target': cluster_domain, 'check': 'health', 'ok': True,
+                      'detail': 'status ' + str(response.status_code)})
+    except requests.exceptions.RequestException as e:
+      results.append({'target': cluster_domain, 'check': 'health', 'ok': False,
+                      'detail': type(e).__name__ + ': ' + str(e)})
+    return results
+
+  def check_zone(zone):
+    hosted_zone_id, cluster_cname = zone
+    target = hosted_zone_id + ' ' + cluster_cname
+    try:
+      name = route53.get_hosted_zone(Id=hosted_zone_id).get('HostedZone').get('Name')
+    except Exception as e:
+      return [{'target': target, 'check': 'hosted-zone', 'ok': False,
+               'detail': type(e).__name__ + ': ' + str(e)}]
+    zone_name = dns_propagation.normalize_dns_name(name)
+    cname = dns_propagation.normalize_dns_name(cluster_cname)
+    if cname != zone_name and not cname.endswith('.' + zone_name):
+      return [{'target': target, 'check': 'hosted-zone', 'ok': False,
+               'detail': 'the CNAME is not in the zone ' + zone_name}]
+    return [{'target': target, 'check': 'hosted-zone', 'ok': True, 'detail': zone_name}]
+
+  def check_provider(other):
+    provider, cluster_cname = other
+    target = provider.name + ' ' + cluster_cname
+    try:
+      provider.check()
+    except Exception as e:
+      return [{'target': target, 'check': 'dns-provider', 'ok': False,
+               'detail': type(e).__name__ + ': ' + str(e)}]
+    cname = dns_propagation.normalize_dns_name(cluster_cname)
+    zone = getattr(provider, 'zone', None)
+    if zone != None and cname != zone and not cname.endswith('.' + zone):
+      return [{'target': target, 'check': 'dns-provider', 'ok': False,
+               'detail': 'the CNAME is not in the zone ' + zone}]
+    return [{'target': target, 'check': 'dns-provider', 'ok': True, 'detail': provider.describe()}]
+
+  jobs = ([(check_cluster, cluster) for cluster in clusters] + [(check_zone, zone) for zone in zones] +
+          [(check_provider, other) for other in others])
+  with ThreadPoolExecutor(max_workers=max(len(jobs), 1)) as executor:
+    results = list(executor.map(lambda job: job[0](job[1]), jobs))
+  return failed + [check for checks in results for check in checks]
+
+#--------------------------------------------------------------------------------
+# Function to return how the steps a run of each pair would run, as returned by
+# planned_steps(pair), differ from the steps of the plan
+#--------------------------------------------------------------------------------
+def step_drift(plan, planned_steps):
+  def describe_steps(steps):
+    return ' '.join(step['name'] + ('(' + ','.join(step['depends_on']) + ')'
+                                    if step['depends_on'] else '') for step in steps)
+
+  lines = []
+  for pair in plan.pairs:
+    compiled = [dict(step) for step in plan.steps.get(pair.name, ())]
+    steps = planned_steps(pair)
+    if steps != compiled:
+      lines.append(pair.name + ': the plan has the steps ' + describe_steps(compiled) +
+                   ' but a run would have ' + describe_steps(steps))
+  return lines
+
+#--------------------------------------------------------------------------------
+# Function to return a plan document. steps maps each pair name to its ordered
+# steps, config is the RawConfigParser the settings are read from.
+#--------------------------------------------------------------------------------
+def build(dr_mode, environments, pairs, steps, config, config_file, checks):
+  document = {
+    'version': VERSION,
+    'compiled_at': time.time(),
+    'dr_mode': dr_mode,
+    'environments': list(environments),
+    'config_file': os.path.abspath(config_file),
+    'config_sha256': file_sha256(config_file),
+    'config': config_snapshot(config),
+    'pairs': [{
+      'name': pair.name,
+      'primary_vault_cluster_domain': pair.primary_vault_cluster_domain,
+      'secondary_vault_cluster_domain': pair.secondary_vault_cluster_domain,
+      'cluster_cname': pair.cluster_cname,
+      'hosted_zone_id': pair.hosted_zone_id,
+      'secondary_id': pair.secondary_id,
+      'dns_providers': pair.dns_providers,
+      'followers': [{'kind': follower[0], 'cluster_domain': follower[1],
+                     'secondary_id': follower[2]} for follower in pair.followers],
+      'steps': steps[pair.name]
+    } for pair in pairs],
+    'checks': checks
+  }
+  document['digest'] = digest(document)
+  return document
+
+#--------------------------------------------------------------------------------
+# Functions to write a plan file read-only, and to load one. load() raises
+# ValueError for a plan file that is not a valid plan of this version or was
+# modified after it was compiled.
+#--------------------------------------------------------------------------------
+def write(document, path=DEFAULT_PLAN_FILE):
+  with open(path + '.tmp', 'w') as f:
+    json.dump(document, f, indent=2, sort_keys=True)
+    f.flush()
+    os.fsync(f.fileno())
+  os.chmod(path + '.tmp', 0o444)
+  os.replace(path + '.tmp', path)
+
+def load(path=DEFAULT_PLAN_FILE):
+  try:
+    with open(path) as f:
+      document = json.load(f)
+  except OSError as e:
+    raise ValueError('cannot read the plan file ' + path + ': ' + str(e))
+  except ValueError as e:
+    raise ValueError('the plan file ' + path + ' is not valid JSON: ' + str(e))
+  if not isinstance(document, dict) or document.get('version') != VERSION:
+    raise ValueError('the plan file ' + path + ' is not a version ' + str(VERSION) + ' plan')
+  if document.get('digest') != digest(document):
+    raise ValueError('the plan file ' + path + ' was modified after it was compiled')
+  try:
+    return Plan(document)
+  except (KeyError, TypeError) as e:
+    raise ValueError('the plan file ' + path + ' is incomplete: ' + repr(e))
+
+#--------------------------------------------------------------------------------
+# Function to return the live state a run of pair would change: the DR mode of
+# its clusters and of its DR secondaries, and the CNAME record. hdrs carries the
+# Vault token. A state that could not be read is an error string.
+#--------------------------------------------------------------------------------
+def live_state(pair, hdrs, route53, timeout=DEFAULT_TIMEOUT):
+  import requests
+  def mode(cluster_domain, kind='dr'):
+    try:
+      response = requests.get(cluster_domain + '/v1/sys/replication/' + kind + '/status',
+                              headers=hdrs, verify=False, timeout=timeout)
+      response.raise_for_status()
+      data = response.json().get('data') or {}
+      return str(data.get('mode')) + (' (' + data.get('state') + ')' if data.get('state') else '')
+    except (requests.exceptions.RequestException, ValueError) as e:
+      return 'unknown: ' + type(e).__name__
+
+  def record():
+    try:
+      records = route53.list_resource_record_sets(HostedZoneId=pair.hosted_zone_id,
+                                                  StartRecordName=pair.cluster_cname,
+                                                  StartRecordType='CNAME', MaxItems='2')
+    except Exception as e:
+      return 'unknown: ' + type(e).__name__
+    found = [record for record in records.get('ResourceRecordSets', [])
+             if dns_propagation.normalize_dns_name(record.get('Name')) ==
+             dns_propagation.normalize_dns_name(pair.cluster_cname) and record.get('Type') == 'CNAME']
+    if not found:
+      return None
+    return [(record.get('Failover'), record.get('ResourceRecords')[0].get('Value'), record.get('TTL'))
+            for record in found]
+
+  jobs = ([lambda: mode(pair.primary_vault_cluster_domain),
+           lambda: mode(pair.secondary_vault_cluster_domain), record] +
+          [lambda follower=follower: mode(follower[1], follower[0]) for follower in pair.followers])
+  with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+    results = list(executor.map(lambda job: job(), jobs))
+  return {'primary': results[0], 'secondary': results[1], 'cname': results[2],
+          'followers': results[3:]}
+
+#--------------------------------------------------------------------------------
+# Function to return the lines describing what running pair would change, given
+# its live state and the DNS strategy of the plan
+#--------------------------------------------------------------------------------
+def diff(pair, state, strategy):
+  lines = []
+  new_target = dns_propagation.normalize_dns_name(pair.secondary_vault_cluster_domain)
+  if not strategy.updates_records():
+    lines.append('  = ' + pair.cluster_cname + ': failover records, Route 53 moves it to ' +
+                 new_target + ' once the health checks change')
+  elif isinstance(state['cname'], str):
+    lines.append('  ! ' + pair.cluster_cname + ': the CNAME could not be read (' +
+                 state['cname'] + ')')
+  else:
+    current = [(value, ttl) for failover, value, ttl in (state['cname'] or []) if failover == None]
+    old = (dns_propagation.normalize_dns_name(current[0][0]) + ' (TTL ' + str(current[0][1]) + ')'
+           if current else 'no CNAME')
+    lines.append('  ~ ' + pair.cluster_cname + ': ' + old + ' -> ' + new_target +
+                 ' (TTL ' + str(strategy.cutover_ttl()) + ')')
+    if current and dns_propagation.normalize_dns_name(current[0][0]) == new_target:
+      lines.append('  ! ' + pair.cluster_cname + ' already points to the new primary')
+  lines.append('  ~ ' + pair.secondary_vault_cluster_domain + ': DR mode ' + state['secondary'] +
+               ' -> primary')
+  if not state['secondary'].startswith('secondary'):
+    lines.append('  ! ' + pair.secondary_vault_cluster_domain + ' is not a DR secondary: ' +
+                 'Step 3-A would abort the run (or --resume continues an unfinished one)')
+  lines.append('  ~ ' + pair.primary_vault_cluster_domain + ': DR mode ' + state['primary'] +
+               ' -> secondary of ' + pair.secondary_vault_cluster_domain)
+  if state['primary'].startswith('unknown'):
+    lines.append('  ! ' + pair.primary_vault_cluster_domain + ' does not answer: its demotion ' +
+                 'would be deferred until it does')
+  for follower, mode in zip(pair.followers, state['followers']):
+    lines.append('  ~ ' + follower[1] + ': ' + follower[0] + ' mode ' + mode +
+                 ', re-pointed at ' + pair.secondary_vault_cluster_domain)
+  return lines
+
+#--------------------------------------------------------------------------------
+# Function to return the lines describing how the config (a RawConfigParser of
+# the current vault_dr.cfg) differs from the snapshot in the plan
+#--------------------------------------------------------------------------------
+def config_drift(plan, config):
+  current = config_snapshot(config)
+  lines = []
+  for section in sorted(set(plan.config) | set(current)):
+    old = plan.config.get(section, {})
+    new = current.get(section, {})
+    for key in sorted(set(old) | set(new)):
+      if old.get(key) != new.get(key):
+        lines.append('  ! [' + section + '] ' + key + ': ' + str(old.get(key)) + ' in the plan, ' +
+                     str(new.get(key)) + ' now')
+  return lines
@@ -0,0 +1,106 @@
+#--------------------------------------------------------------------------------
+# """prepare.py: Prepare phase of a DR operation, run before the promotion"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# Generating a DR operation token takes an attempt, one call per recovery key,
+# and decoding the token against the OTP, twice per run (Steps 3-C/3-D and
+# 5-C/5-D), and a missing key or an expired credential is only found out
+# halfway through. The prepare phase does everything that can be done ahead of
+# time and records it in a Preparation:
+#
+#   * the number of recovery keys the secondary needs, and the keys found in
+#     the environment (prompting for the others now rather than in Step 3-D),
+#   * the TTL of the Vault token and of a pre-staged DR operation batch token
+#     (VAULT_DR_OPERATION_TOKEN), looked up on the current primary,
+#   * the AWS credentials and the hosted zone of the CNAME.
+#
+# A DR operation batch token that is valid for at least min_token_ttl seconds
+# replaces the token generation of Steps 3-C/3-D and 5-C/5-D. The daemon
+# prepares ahead of any incident and reuses a Preparation for max_age seconds.
+#--------------------------------------------------------------------------------
+import time
+from vault_dr import events
+
+DEFAULT_MIN_TOKEN_TTL = 900
+DEFAULT_MAX_AGE = 300
+
+class Preparation:
+
+  def __init__(self, name, primary_vault_cluster_domain, secondary_vault_cluster_domain,
+               min_token_ttl=DEFAULT_MIN_TOKEN_TTL):
+    self.name = name
+    self.primary_vault_cluster_domain = primary_vault_cluster_domain
+    self.secondary_vault_cluster_domain = secondary_vault_cluster_domain
+    self.min_token_ttl = min_token_ttl
+    self.prepared_at = time.monotonic()
+    self.seconds = None
+    # Recovery keys needed for an operation token, and those already at hand
+    self.required_keys = None
+    self.recovery_keys = []
+    # Keys that the key collection will gather from the custodians
+    self.collect_keys = False
+    # Pre-staged DR operation batch token and when it expires (monotonic), or
+    # None if its TTL could not be looked up
+    self.batch_token = None
+    self.batch_token_expires = None
+    self.vault_token_expires = None
+    self.problems = []
+
+  def age(self):
+    return time.monotonic() - self.prepared_at
+
+  def matches(self, primary_vault_cluster_domain, secondary_vault_cluster_domain):
+    return (self.primary_vault_cluster_domain == primary_vault_cluster_domain and
+            self.secondary_vault_cluster_domain == secondary_vault_cluster_domain)
+
+  #------------------------------------------------------------------------------
+  # Function to return the pre-staged DR operation batch token if it is still
+  # valid for at least min_token_ttl seconds, else None
+  #------------------------------------------------------------------------------
+  def operation_token(self):
+    if self.batch_token == None:
+      return None
+    if (self.batch_token_expires != None and
+        self.batch_token_expires - time.monotonic() < self.min_token_ttl):
+      return None
+    return self.batch_token
+
+  def missing_keys(self):
+    if self.required_keys == None:
+      return None
+    return max(0, self.required_keys - len(self.recovery_keys))
+
+  #------------------------------------------------------------------------------
+  # Function to describe the part of the token workflow left on the critical
+  # path of the run
+  #------------------------------------------------------------------------------
+  def critical_path_report(self):
+    if self.operation_token() != None:
+      ttl = ('TTL unknown' if self.batch_token_expires == None else
+             'valid for ' + format(self.batch_token_expires - time.monotonic(), '.0f') + ' seconds')
+      return ("no token generation left: Steps 3-D and 5-D use the pre-staged DR operation "
+              "batch token (" + ttl + ")")
+    keys = '?' if self.required_keys == None else str(self.required_keys)
+    missing = self.missing_keys()
+    return ("2 operation token generations left (1 attempt, " + keys + " key submissions and "
+            "1 decode each); " +
+            ("the keys are collected from the custodians" if self.collect_keys else
+             "the number of keys still to enter is unknown" if missing == None else
+             str(missing) + " keys still to enter"))
+
+  def report(self):
+    events.log("*** Prepared", self.name, "in", format(self.seconds or 0.0, '.3f'), "seconds:",
+               self.critical_path_report())
+    for problem in self.problems:
+      events.log("*** Warning: preparing", self.name + ":", problem)
@@ -0,0 +1,119 @@
+#--------------------------------------------------------------------------------
+# """promotion_gate.py: Replication-lag-aware gate before promoting the secondary"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# Promoting a secondary that is behind its primary loses the writes it has not
+# received yet. When the old primary is reachable, the gate samples last_wal on
+# the primary and last_remote_wal on the secondary every sample_interval
+# seconds, estimates the lag, the rate at which the secondary catches up and
+# the write rate of the primary, and lets the promotion go ahead as soon as the
+# lag is at most max_wal_lag WALs or max_wait seconds have passed, whichever
+# comes first.
+#
+# The data-loss window is the lag expressed in seconds of writes of the
+# primary: 0 once the secondary has caught up, lag / write rate otherwise, or
+# unknown (None) if the primary did not write while it was sampled. If a
+# cluster stops answering while the gate waits, the gate opens right away and
+# the data-loss window is unknown.
+#--------------------------------------------------------------------------------
+import collections, time
+from vault_dr import events, tracing
+
+DEFAULT_MAX_WAL_LAG = 0
+DEFAULT_MAX_WAIT = 30
+DEFAULT_SAMPLE_INTERVAL = 0.5
+# Samples the rates are estimated from
+DEFAULT_WINDOW = 10
+
+# Why the gate opened
+CAUGHT_UP = 'caught-up'
+DEADLINE = 'deadline'
+UNREACHABLE = 'unreachable'
+
+class LagEstimator:
+
+  def __init__(self, window=DEFAULT_WINDOW):
+    self.samples = collections.deque(maxlen=max(2, window))
+
+  def add(self, primary_wal, secondary_wal, now=None):
+    self.samples.append((time.monotonic() if now == None else now, primary_wal, secondary_wal))
+
+  def lag(self):
+    if not self.samples:
+      return None
+    now, primary_wal, secondary_wal = self.samples[-1]
+    return max(0, primary_wal - secondary_wal)
+
+  #------------------------------------------------------------------------------
+  # Functions to return the WALs per second written by the primary and the WALs
+  # per second by which the lag shrinks, or None with fewer than two samples
+  #------------------------------------------------------------------------------
+  def write_rate(self):
+    if len(self.samples) < 2 or self.samples[-1][0] <= self.samples[0][0]:
+      return None
+    (t0, p0, s0), (t1, p1, s1) = self.samples[0], self.samples[-1]
+    return (p1 - p0) / (t1 - t0)
+
+  def catch_up_rate(self):
+    if len(self.samples) < 2 or self.samples[-1][0] <= self.samples[0][0]:
+      return None
+    (t0, p0, s0), (t1, p1, s1) = self.samples[0], self.samples[-1]
+    return ((p0 - s0) - (p1 - s1)) / (t1 - t0)
+
+  #------------------------------------------------------------------------------
+  # Function to return the estimated seconds until the secondary has caught up,
+  # or None if it is not catching up
+  #------------------------------------------------------------------------------
+  def time_to_catch_up(self):
+    lag, rate = self.lag(), self.catch_up_rate()
+    if lag == 0:
+      return 0.0
+    if lag == None or rate == None or rate <= 0:
+      return None
+    return lag / rate
+
+  def data_loss_window(self):
+    lag, rate = self.lag(), self.write_rate()
+    if lag == 0:
+      return 0.0
+    if lag == None or rate == None or rate <= 0:
+      return None
+    return lag / rate
+
+def format_seconds(seconds):
+  return 'unknown' if seconds == None else format(seconds, '.3f') + ' seconds'
+
+#--------------------------------------------------------------------------------
+# Function to wait until the secondary has caught up. sample() returns the
+# current (primary WAL, secondary WAL), or None if a cluster did not answer.
+# Returns the LagEstimator and why the gate opened.
+#--------------------------------------------------------------------------------
+def wait_for_catch_up(sample, max_wal_lag=DEFAULT_MAX_WAL_LAG, max_wait=DEFAULT_MAX_WAIT,
+                      sample_interval=DEFAULT_SAMPLE_INTERVAL, window=DEFAULT_WINDOW):
+  estimator = LagEstimator(window)
+  expires = time.monotonic() + max_wait
+  while True:
+    wals = sample()
+    if wals == None:
+      return estimator, UNREACHABLE
+    estimator.add(*wals)
+    if estimator.lag() <= max_wal_lag:
+      return estimator, CAUGHT_UP
+    remaining = expires - time.monotonic()
+    if remaining <= 0:
+      return estimator, DEADLINE
+    events.log("*** Secondary is", estimator.lag(), "WALs behind, catching up in",
+               format_seconds(estimator.time_to_catch_up()) + ";", format(remaining, '.1f'),
+               "seconds left to wait")
+    tracing.tracer.sleep(min(sample_interval, remaining), 'promotion-gate')
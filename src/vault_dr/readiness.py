@@ -0,0 +1,330 @@
+#--------------------------------------------------------------------------------
+# """readiness.py: Continuous DR readiness monitor of the cluster pairs"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# Step 3-A only finds out that the secondary is unhealthy during the outage.
+# The ReadinessMonitor polls /v1/sys/replication/dr/status of both clusters of
+# every pair in a background thread and keeps the last samples of each in a
+# fixed-size ring buffer. It alerts, once per transition, when
+#
+#   * a cluster does not answer,
+#   * the pair does not have exactly one primary and one secondary, or the
+#     secondary is not in the stream-wals state (state drift),
+#   * the secondary is more than max_wal_lag WALs behind the primary, or
+#   * the secondary has not received a new WAL for stall_after seconds while
+#     the primary has written some.
+#
+# All the clusters are polled at once, from one event loop in the monitor
+# thread (see vault_client.py), so a poll takes as long as the slowest cluster
+# rather than the sum of all of them. sample() polls a single cluster through
+# the same clients, for the drill, which does not start the monitor.
+#
+# The primary and secondary are told apart by the mode they report, so the
+# monitor keeps working after a failover or failback. The failover reads the
+# cached, time-stamped status of the secondary and skips the live check of
+# Step 3-A when it is recent enough.
+#--------------------------------------------------------------------------------
+import threading, time
+from vault_dr import events
+
+DEFAULT_POLL_INTERVAL = 10
+DEFAULT_HISTORY = 360
+DEFAULT_MAX_STATUS_AGE = 30
+DEFAULT_MAX_WAL_LAG = 1000
+DEFAULT_STALL_AFTER = 60
+DEFAULT_TIMEOUT = 2
+
+STATUS_PATH = '/v1/sys/replication/dr/status'
+
+class Sample:
+  __slots__ = ('time', 'mode', 'state', 'wal', 'merkle_root', 'error')
+
+  def __init__(self, time, mode=None, state=None, wal=None, merkle_root=None, error=None):
+    self.time = time
+    self.mode = mode
+    self.state = state
+    self.wal = wal
+    self.merkle_root = merkle_root
+    self.error = error
+
+  def healthy_secondary(self):
+    return self.error == None and self.mode == 'secondary' and self.state == 'stream-wals'
+
+#--------------------------------------------------------------------------------
+# Fixed-size history of samples; the oldest sample is overwritten when full.
+# Merkle roots are kept as bytes rather than hex strings.
+#--------------------------------------------------------------------------------
+class RingBuffer:
+
+  def __init__(self, capacity=DEFAULT_HISTORY):
+    self.capacity = max(1, capacity)
+    self.items = [None] * self.capacity
+    self.next = 0
+    self.count = 0
+
+  def append(self, item):
+    self.items[self.next] = item
+    self.next = (self.next + 1) % self.capacity
+    self.count = min(self.count + 1, self.capacity)
+
+  def latest(self):
+    return self.items[(self.next - 1) % self.capacity] if self.count else None
+
+  #------------------------------------------------------------------------------
+  # Function to return the samples, oldest first
+  #------------------------------------------------------------------------------
+  def samples(self):
+    start = (self.next - self.count) % self.capacity
+    return [self.items[(start + i) % self.capacity] for i in range(self.count)]
+
+  def __len__(self):
+    return self.count
+
+def compact_merkle_root(merkle_root):
+  try:
+    return bytes.fromhex(merkle_root)
+  except (TypeError, ValueError):
+    return merkle_root
+
+def expand_merkle_root(merkle_root):
+  return merkle_root.hex() if isinstance(merkle_root, bytes) else merkle_root
+
+#--------------------------------------------------------------------------------
+# Function to alert on the console
+#--------------------------------------------------------------------------------
+def print_alert(pair_name, condition, raised, message):
+  events.log("*** DR readiness", "ALERT" if raised else "resolved", "for", pair_name + ":", message)
+
+class ReadinessMonitor:
+
+  #------------------------------------------------------------------------------
+  # pairs are the ClusterPairs to watch; on_alert(pair name, condition, raised,
+  # message) is called when a condition is raised or resolved
+  #------------------------------------------------------------------------------
+  def __init__(self, pairs, poll_interval=DEFAULT_POLL_INTERVAL, history=DEFAULT_HISTORY,
+               max_status_age=DEFAULT_MAX_STATUS_AGE, max_wal_lag=DEFAULT_MAX_WAL_LAG,
+               stall_after=DEFAULT_STALL_AFTER, timeout=DEFAULT_TIMEOUT, on_alert=print_alert):
+    self.pairs = list(pairs)
+    self.poll_interval = poll_interval
+    self.max_status_age = max_status_age
+    self.max_wal_lag = max_wal_lag
+    self.stall_after = stall_after
+    self.timeout = timeout
+    self.on_alert = on_alert
+    self.lock = threading.Lock()
+    self.history = {}
+    for pair in self.pairs:
+      for cluster_domain in (pair.primary_vault_cluster_domain, pair.secondary_vault_cluster_domain):
+        self.history[cluster_domain] = RingBuffer(history)
+    # Raised conditions per pair name
+    self.alerts = {}
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    # Event loop, connection pool and clients of the monitor thread, or of
+    # the caller of sample() if the monitor is not started
+    self.loop_lock = threading.Lock()
+    self.loop = None
+    self.pool = None
+    self.clients = {}
+
+  def start(self):
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.stopped.set()
+
+  #------------------------------------------------------------------------------
+  # Function of the monitor thread. A poll that fails keeps the thread alive;
+  # its clusters get an error sample so that the cached status is not used.
+  #------------------------------------------------------------------------------
+  def run(self):
+    while not self.stopped.is_set():
+      try:
+        self.poll()
+      except Exception as e:
+        events.log("*** DR readiness poll failed:", repr(e), level=events.ERROR)
+        self.mark_stale('poll failed: ' + type(e).__name__)
+      self.stopped.wait(self.poll_interval)
+    self.close()
+
+  def mark_stale(self, error):
+    now = time.monotonic()
+    with self.lock:
+      for history in self.history.values():
+        history.append(Sample(now, error=error))
+
+  #------------------------------------------------------------------------------
+  # Function to close the connections and the event loop
+  #------------------------------------------------------------------------------
+  def close(self):
+    with self.loop_lock:
+      if self.loop != None:
+        self.loop.run_until_complete(self.pool.close())
+        self.loop.close()
+        self.loop = None
+        self.clients = {}
+
+  #------------------------------------------------------------------------------
+  # Function to poll the DR status of one cluster
+  #------------------------------------------------------------------------------
+  def sample(self, cluster_domain):
+    return self.sample_all([cluster_domain])[cluster_domain]
+
+  #------------------------------------------------------------------------------
+  # Function to poll the DR status of all the clusters concurrently. asyncio is
+  # imported here to keep it out of the start-up of the script.
+  #------------------------------------------------------------------------------
+  def sample_all(self, cluster_domains):
+    import asyncio
+    from vault_dr import vault_client
+    with self.loop_lock:
+      if self.loop == None:
+        self.loop = asyncio.new_event_loop()
+        self.pool = vault_client.ConnectionPool()
+      for cluster_domain in cluster_domains:
+        if cluster_domain not in self.clients:
+          self.clients[cluster_domain] = vault_client.VaultClient(cluster_domain, pool=self.pool,
+                                                                  timeout=self.timeout)
+      async def gather():
+        return await asyncio.gather(*[self.sample_async(self.clients[cluster_domain])
+                                      for cluster_domain in cluster_domains])
+      return dict(zip(cluster_domains, self.loop.run_until_complete(gather())))
+
+  async def sample_async(self, client):
+    from vault_dr import vault_client
+    now = time.monotonic()
+    try:
+      status = await client.dr_status()
+    except vault_client.VaultError as e:
+      return Sample(now, error=e.reason)
+    return Sample(now, status.mode, status.state, status.wal(),
+                  compact_merkle_root(status.merkle_root))
+
+  def poll(self):
+    cluster_domains = []
+    for pair in self.pairs:
+      for cluster_domain in (pair.primary_vault_cluster_domain, pair.secondary_vault_cluster_domain):
+        if cluster_domain not in cluster_domains:
+          cluster_domains.append(cluster_domain)
+    samples = self.sample_all(cluster_domains)
+    with self.lock:
+      for cluster_domain in cluster_domains:
+        self.history[cluster_domain].append(samples[cluster_domain])
+    for pair in self.pairs:
+      self.check(pair, dict((cluster_domain, samples[cluster_domain]) for cluster_domain in
+                            (pair.primary_vault_cluster_domain, pair.secondary_vault_cluster_domain)))
+
+  #------------------------------------------------------------------------------
+  # Function to raise or resolve the alert conditions of a pair from its latest
+  # samples
+  #------------------------------------------------------------------------------
+  def check(self, pair, samples):
+    conditions = {}
+    for cluster_domain, sample in samples.items():
+      if sample.error != None:
+        conditions['unreachable ' + cluster_domain] = (cluster_domain + ' does not answer (' +
+                                                       sample.error + ')')
+    by_mode = dict((sample.mode, (cluster_domain, sample)) for cluster_domain, sample in samples.items()
+                   if sample.error == None)
+    if len(by_mode) == len(samples):
+      if set(by_mode) != set(['primary', 'secondary']):
+        conditions['state'] = 'replication modes are ' + ', '.join(sorted(str(mode) for mode in by_mode))
+      else:
+        primary_domain, primary = by_mode['primary']
+        secondary_domain, secondary = by_mode['secondary']
+        if secondary.state != 'stream-wals':
+          conditions['state'] = secondary_domain + ' is in state ' + str(secondary.state)
+        if primary.wal != None and secondary.wal != None:
+          lag = primary.wal - secondary.wal
+          if lag > self.max_wal_lag:
+            conditions['lag'] = (secondary_domain + ' is ' + str(lag) + ' WALs behind ' +
+                                 primary_domain)
+          stalled = self.stalled_for(primary_domain, secondary_domain)
+          if stalled != None and stalled >= self.stall_after:
+            conditions['stall'] = (secondary_domain + ' has not received a WAL for ' +
+                                   format(stalled, '.1f') + ' seconds')
+
+    with self.lock:
+      raised = self.alerts.setdefault(pair.name, {})
+      new = [(condition, message) for condition, message in conditions.items()
+             if condition not in raised]
+      resolved = [(condition, raised[condition]) for condition in list(raised)
+                  if condition not in conditions]
+      for condition, message in new:
+        raised[condition] = message
+      for condition, message in resolved:
+        del raised[condition]
+    for condition, message in new:
+      self.on_alert(pair.name, condition, True, message)
+    for condition, message in resolved:
+      self.on_alert(pair.name, condition, False, message)
+
+  #------------------------------------------------------------------------------
+  # Function to return for how long the WAL of the secondary has not moved while
+  # the WAL of the primary has, or None if it moved in the last sample
+  #------------------------------------------------------------------------------
+  def stalled_for(self, primary_domain, secondary_domain):
+    with self.lock:
+      secondary = [s for s in self.history[secondary_domain].samples() if s.error == None]
+      primary = [s for s in self.history[primary_domain].samples() if s.error == None]
+    if len(secondary) < 2 or not primary:
+      return None
+    latest = secondary[-1]
+    since = latest
+    for sample in reversed(secondary[:-1]):
+      if sample.wal != latest.wal or sample.mode != latest.mode:
+        break
+      since = sample
+    if since is latest:
+      return None
+    primary_moved = any(s.wal != primary[-1].wal for s in primary if s.time >= since.time)
+    return (latest.time - since.time) if primary_moved else None
+
+  #------------------------------------------------------------------------------
+  # Function to return the latest sample of a cluster and its age in seconds,
+  # or (None, None) if it has not been polled
+  #------------------------------------------------------------------------------
+  def cached(self, cluster_domain):
+    with self.lock:
+      history = self.history.get(cluster_domain)
+      sample = history.latest() if history != None else None
+    if sample == None:
+      return None, None
+    return sample, time.monotonic() - sample.time
+
+  #------------------------------------------------------------------------------
+  # Function to return the latest sample of a cluster if it is a healthy DR
+  # secondary and no older than max_status_age, or None
+  #------------------------------------------------------------------------------
+  def fresh_healthy_secondary(self, cluster_domain):
+    sample, age = self.cached(cluster_domain)
+    if sample != None and age <= self.max_status_age and sample.healthy_secondary():
+      return sample, age
+    return None, None
+
+  #------------------------------------------------------------------------------
+  # Function to return the last time the primary was sampled with a WAL that the
+  # secondary has received since, i.e. no write before it can be lost, or None.
+  # Used to bound the data-loss window when the primary is down.
+  #------------------------------------------------------------------------------
+  def replicated_until(self, primary_domain, secondary_domain):
+    with self.lock:
+      secondary = self.history[secondary_domain].latest() if secondary_domain in self.history else None
+      primary = self.history[primary_domain].samples() if primary_domain in self.history else []
+    if secondary == None or secondary.error != None or secondary.mode != 'secondary' or secondary.wal == None:
+      return None
+    times = [sample.time for sample in primary if sample.error == None and sample.mode == 'primary' and
+             sample.wal != None and sample.wal <= secondary.wal]
+    return max(times) if times else None
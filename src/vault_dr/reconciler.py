@@ -0,0 +1,107 @@
+#--------------------------------------------------------------------------------
+# """reconciler.py: Deferred demotion of an unreachable old primary"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# In a real regional outage the old primary is unreachable, and all of Step 5
+# (demote, operation token, update-primary) would only burn through retries.
+# Once the secondary is promoted and DNS points at it, the failover is done as
+# far as clients are concerned. The Reconciler then watches the old primary
+# with cheap /v1/sys/health probes in a background thread and runs the
+# demotion and re-pointing as soon as the old primary answers again.
+#--------------------------------------------------------------------------------
+import threading, time
+from vault_dr import events
+
+DEFAULT_PROBE_INTERVAL = 10
+DEFAULT_PROBE_TIMEOUT = 2
+DEFAULT_MAX_WAIT = 86400
+
+# Unauthenticated health check that answers 200 on a DR secondary too
+HEALTH_PATH = '/v1/sys/health?standbyok=true&perfstandbyok=true&drsecondarycode=200'
+
+# Health status codes of an unsealed, active or standby node
+HEALTHY_STATUS_CODES = (200, 429, 472, 473)
+
+#--------------------------------------------------------------------------------
+# Function to check, with a single short request, whether a cluster answers
+#--------------------------------------------------------------------------------
+def probe(session, cluster_domain, timeout=DEFAULT_PROBE_TIMEOUT):
+  import requests
+  try:
+    if session == None:
+      response = requests.get(cluster_domain + HEALTH_PATH, verify=False, timeout=timeout)
+    else:
+      response = session.get(cluster_domain + HEALTH_PATH, verify=False, timeout=timeout)
+    return response.status_code in HEALTHY_STATUS_CODES
+  except requests.exceptions.RequestException:
+    return False
+
+class Reconciler:
+
+  #------------------------------------------------------------------------------
+  # action is called without arguments once the cluster answers the probe
+  #------------------------------------------------------------------------------
+  def __init__(self, session, cluster_domain, action, probe_interval=DEFAULT_PROBE_INTERVAL,
+               probe_timeout=DEFAULT_PROBE_TIMEOUT, max_wait=DEFAULT_MAX_WAIT):
+    self.session = session
+    self.cluster_domain = cluster_domain
+    self.action = action
+    self.probe_interval = probe_interval
+    self.probe_timeout = probe_timeout
+    self.max_wait = max_wait
+    self.stopped = threading.Event()
+    self.done = False
+    # Why the deferred demotion failed, if it did
+    self.error = None
+    self.thread = threading.Thread(target=self.run, daemon=True)
+
+  def start(self):
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.stopped.set()
+
+  def join(self, timeout=None):
+    self.thread.join(timeout)
+    return self.done
+
+  def run(self):
+    start = time.monotonic()
+    probes = 0
+    while not self.stopped.is_set():
+      probes += 1
+      if probe(self.session, self.cluster_domain, self.probe_timeout):
+        events.log("*** Old primary", self.cluster_domain, "is reachable again after",
+                   format(time.monotonic() - start, '.3f'), "seconds and", probes,
+                   "probes, about to run its deferred demotion")
+        try:
+          self.action()
+          self.done = True
+        except SystemExit:
+          # http_request() gives up with sys.exit(), which only ends this thread
+          self.error = 'aborted'
+        except Exception as e:
+          self.error = repr(e)
+        if self.error != None:
+          events.log("*** Deferred demotion of", self.cluster_domain, "failed (" + self.error + ").",
+                     "It must be demoted and re-pointed manually.", level=events.ERROR)
+        return
+      if time.monotonic() - start + self.probe_interval > self.max_wait:
+        break
+      self.stopped.wait(self.probe_interval)
+    self.error = 'gave up waiting'
+    events.log("*** Gave up waiting for old primary", self.cluster_domain, "after",
+               format(time.monotonic() - start, '.3f'), "seconds and", probes, "probes.",
+               "It must be demoted and re-pointed manually.", level=events.ERROR)
@@ -0,0 +1,200 @@
+#--------------------------------------------------------------------------------
+# """retry_policy.py: Deadline-aware retry policy for the Vault API calls"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# The old retry scheme slept 2**(n-1)*30 seconds for up to 10 retries, so one
+# flaky endpoint could stall a DR run for hours. Retries are now bounded in
+# time rather than in count:
+#
+#   * Every run has a deadline and every step has a deadline that never
+#     extends past the run deadline.
+#   * Errors are classified: 4xx responses fail fast, 5xx responses and
+#     connection errors are retried after a sub-second decorrelated jitter
+#     delay, and timeouts are retried on a different node behind the ELB.
+#     A POST that timed out reading the answer fails fast instead: Vault may
+#     have applied it, and promote, demote and update-primary must not be sent
+#     twice. A run resumed with --resume checks the live state first.
+#   * Every request has an explicit connect and read timeout, capped by the
+#     time left before the step deadline.
+#
+# Every retry decision is logged with its timing so the policy can be tuned.
+#--------------------------------------------------------------------------------
+import random, socket, time
+from urllib.parse import urlsplit, urlunsplit
+from vault_dr import events
+
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 10
+DEFAULT_BASE_DELAY = 0.1
+DEFAULT_MAX_DELAY = 1.0
+DEFAULT_STEP_TIMEOUT = 120
+DEFAULT_RUN_TIMEOUT = 900
+
+# Error classes
+FAIL_FAST = 'fail-fast'
+RETRY = 'retry'
+RETRY_OTHER_NODE = 'retry-other-node'
+
+# Requests that may be sent again after a read timeout
+IDEMPOTENT_VERBS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+#--------------------------------------------------------------------------------
+# A point in time (on the monotonic clock) by which an operation must finish.
+# A step deadline is capped by the deadline of the run it belongs to.
+#--------------------------------------------------------------------------------
+class Deadline:
+
+  def __init__(self, seconds, step=None, policy=None, parent=None):
+    self.start = time.monotonic()
+    self.expires = self.start + seconds
+    if parent != None:
+      self.expires = min(self.expires, parent.expires)
+    self.step = step
+    self.policy = policy
+
+  def remaining(self):
+    return self.expires - time.monotonic()
+
+  def expired(self):
+    return self.remaining() <= 0
+
+  def elapsed(self):
+    return time.monotonic() - self.start
+
+#--------------------------------------------------------------------------------
+# Picks the node behind an ELB to send a request to. On a timeout the request
+# is sent to another of the addresses the ELB hostname resolves to, with the
+# original Host header, instead of hammering the node that timed out.
+#--------------------------------------------------------------------------------
+class NodeSelector:
+
+  def __init__(self):
+    self.addresses = {}
+
+  def resolve(self, host, port):
+    if host not in self.addresses:
+      try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        self.addresses[host] = sorted(set(info[4][0] for info in infos))
+      except OSError:
+        self.addresses[host] = []
+    return self.addresses[host]
+
+  #------------------------------------------------------------------------------
+  # Function to return (url, host header) for a node other than the ones in
+  # tried, or (url, None) if there is no other node to fall back to
+  #------------------------------------------------------------------------------
+  def other_node(self, url, tried):
+    parts = urlsplit(url)
+    host = parts.hostname
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    for address in self.resolve(host, port):
+      if address not in tried:
+        tried.add(address)
+        netloc = ('[%s]' % address) if ':' in address else address
+        if parts.port:
+          netloc += ':%d' % parts.port
+        return urlunsplit((parts.scheme, netloc, parts.path, parts.query, parts.fragment)), parts.netloc
+    return url, None
+
+class RetryPolicy:
+
+  def __init__(self, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+               base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY,
+               step_timeout=DEFAULT_STEP_TIMEOUT, run_timeout=DEFAULT_RUN_TIMEOUT):
+    self.connect_timeout = connect_timeout
+    self.read_timeout = read_timeout
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.step_timeout = step_timeout
+    self.run_timeout = run_timeout
+    self.run_deadline = None
+    self.nodes = NodeSelector()
+
+  #------------------------------------------------------------------------------
+  # Functions to start a run deadline and to derive step deadlines from it.
+  # Concurrent runs pass their own run deadline; otherwise the one of the
+  # latest run is used.
+  #------------------------------------------------------------------------------
+  def start_run(self):
+    self.run_deadline = Deadline(self.run_timeout, 'run', self)
+    return self.run_deadline
+
+  def step_deadline(self, step, run_deadline=None):
+    if run_deadline == None:
+      if self.run_deadline == None:
+        self.start_run()
+      run_deadline = self.run_deadline
+    return Deadline(self.step_timeout, step, self, run_deadline)
+
+  #------------------------------------------------------------------------------
+  # Function to return the (connect, read) timeouts of the next attempt,
+  # capped by the time left before the deadline
+  #------------------------------------------------------------------------------
+  def timeouts(self, deadline):
+    remaining = max(deadline.remaining(), 0.001)
+    return (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+
+  #------------------------------------------------------------------------------
+  # Function to classify a failed attempt, given the requests exception it
+  # raised (and its response for HTTP errors) and the verb of the request
+  #------------------------------------------------------------------------------
+  def classify(self, error, response=None, verb=None):
+    import requests
+    if isinstance(error, requests.exceptions.Timeout):
+      if (isinstance(error, requests.exceptions.ConnectTimeout) or verb == None or
+          verb.upper() in IDEMPOTENT_VERBS):
+        return RETRY_OTHER_NODE
+      return FAIL_FAST
+    if isinstance(error, requests.exceptions.HTTPError) and response != None:
+      if 400 <= response.status_code < 500:
+        return FAIL_FAST
+      return RETRY
+    if isinstance(error, requests.exceptions.ConnectionError):
+      return RETRY
+    return FAIL_FAST
+
+  #------------------------------------------------------------------------------
+  # Function to compute the next delay with decorrelated jitter:
+  # delay = min(max_delay, random between base_delay and 3 * previous delay)
+  #------------------------------------------------------------------------------
+  def next_delay(self, previous_delay):
+    previous_delay = max(previous_delay, self.base_delay)
+    return min(self.max_delay, random.uniform(self.base_delay, previous_delay * 3))
+
+  #------------------------------------------------------------------------------
+  # Function to log a retry decision with its timing
+  #------------------------------------------------------------------------------
+  def log_decision(self, deadline, verb, url, attempt, error_class, error, decision, delay=None):
+    fields = ["*** Retry decision: step", deadline.step, verb, url,
+              "attempt", attempt, "failed with", error_class, "(" + str(error) + ")",
+              "after", format(deadline.elapsed(), '.3f'), "seconds in step;", decision]
+    if delay != None:
+      fields += ["in", format(delay, '.3f'), "seconds"]
+    fields += ["(step deadline in", format(max(deadline.remaining(), 0), '.3f'), "seconds)"]
+    events.log(*fields, level=events.WARNING, attempt=attempt, error_class=error_class,
+               delay=delay)
+
+#--------------------------------------------------------------------------------
+# Function to build a RetryPolicy from the [Retry-Policy] section of the config
+#--------------------------------------------------------------------------------
+def from_config(config):
+  section = 'Retry-Policy'
+  return RetryPolicy(
+    connect_timeout=config.getfloat(section, 'connect_timeout', fallback=DEFAULT_CONNECT_TIMEOUT),
+    read_timeout=config.getfloat(section, 'read_timeout', fallback=DEFAULT_READ_TIMEOUT),
+    base_delay=config.getfloat(section, 'base_delay', fallback=DEFAULT_BASE_DELAY),
+    max_delay=config.getfloat(section, 'max_delay', fallback=DEFAULT_MAX_DELAY),
+    step_timeout=config.getfloat(section, 'step_timeout', fallback=DEFAULT_STEP_TIMEOUT),
+    run_timeout=config.getfloat(section, 'run_timeout', fallback=DEFAULT_RUN_TIMEOUT))
@@ -0,0 +1,193 @@
+#--------------------------------------------------------------------------------
+# """scheduler.py: Runs the DR steps as a DAG, overlapping independent steps"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# Each DR step is a node that declares the steps it depends on. The scheduler
+# starts a step on a thread pool as soon as all of its dependencies are done,
+# so only true dependencies end up on the critical path. If a step fails (or
+# calls sys.exit()), no new steps are started and the error is raised again in
+# the calling thread once the running steps have finished. A step with a
+# condition that is false when it becomes ready is skipped, and so are all the
+# steps that depend on it.
+#
+# Every step runs in a tracing span, a child of the span passed to run().
+# on_step_done, if set, is called with every step that completed, in the
+# thread of the step and before the steps that depend on it can start. A step
+# restored from an earlier run with restore() counts as done without running.
+#
+# After a run, report() prints the critical path (the chain of dependencies
+# that determined the total time) and the slack of every step, i.e. how much
+# longer the step could have taken without delaying the run.
+#--------------------------------------------------------------------------------
+import time
+from vault_dr import events, tracing
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+DEFAULT_MAX_WORKERS = 4
+
+class Step:
+
+  def __init__(self, name, action, depends_on=(), description='', condition=None):
+    self.name = name
+    self.action = action
+    self.depends_on = tuple(depends_on)
+    self.description = description
+    self.condition = condition
+    self.skipped = False
+    self.failed = False
+    self.restored = False
+    self.start = None
+    self.end = None
+    self.result = None
+
+  def duration(self):
+    if self.start == None or self.end == None:
+      return 0.0
+    return self.end - self.start
+
+class StepScheduler:
+
+  def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+    self.max_workers = max_workers
+    self.steps = {}
+    self.order = []
+    self.run_start = None
+    self.run_end = None
+    self.on_step_done = None
+
+  #------------------------------------------------------------------------------
+  # Function to add a step. action (and condition, if given) are called with
+  # no arguments; the return value of action is kept in step.result.
+  #------------------------------------------------------------------------------
+  def add(self, name, action, depends_on=(), description='', condition=None):
+    for dependency in depends_on:
+      if dependency not in self.steps:
+        raise ValueError('Step ' + name + ' depends on unknown step ' + dependency)
+    step = Step(name, action, depends_on, description, condition)
+    self.steps[name] = step
+    self.order.append(name)
+    return step
+
+  def result(self, name):
+    return self.steps[name].result
+
+  def restore(self, name):
+    self.steps[name].restored = True
+
+  def run_step(self, step, parent_span=None):
+    with tracing.tracer.span(step.name, tracing.STEP, parent_span,
+                             description=step.description):
+      step.start = time.monotonic()
+      try:
+        step.result = step.action()
+      except BaseException:
+        step.failed = True
+        raise
+      finally:
+        step.end = time.monotonic()
+      if self.on_step_done != None:
+        self.on_step_done(step)
+    return step
+
+  #------------------------------------------------------------------------------
+  # Function to run all the steps, each as soon as its dependencies are done
+  #------------------------------------------------------------------------------
+  def run(self, parent_span=None):
+    self.run_start = time.monotonic()
+    done = set(name for name in self.order if self.steps[name].restored)
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+      while True:
+        if error == None:
+          for name in self.order:
+            step = self.steps[name]
+            if (name not in done and step not in running.values() and
+                all(dependency in done for dependency in step.depends_on)):
+              if (any(self.steps[dependency].skipped for dependency in step.depends_on) or
+                  (step.condition != None and not step.condition())):
+                step.skipped = True
+                done.add(name)
+                continue
+              running[executor.submit(self.run_step, step, parent_span)] = step
+        if not running:
+          break
+        finished, pending = wait(list(running), return_when=FIRST_COMPLETED)
+        for future in finished:
+          step = running.pop(future)
+          exception = future.exception()
+          if exception != None:
+            if error == None:
+              error = exception
+          else:
+            done.add(step.name)
+    self.run_end = time.monotonic()
+    if error != None:
+      raise error
+
+  #------------------------------------------------------------------------------
+  # Function to compute, from the measured durations, the earliest and latest
+  # start of every step, its slack and the critical path
+  #------------------------------------------------------------------------------
+  def critical_path(self):
+    earliest_finish = {}
+    for name in self.order:
+      step = self.steps[name]
+      earliest_start = max([earliest_finish[d] for d in step.depends_on] or [0.0])
+      earliest_finish[name] = earliest_start + step.duration()
+    makespan = max(earliest_finish.values() or [0.0])
+
+    latest_finish = {}
+    for name in reversed(self.order):
+      dependents = [n for n in self.order if name in self.steps[n].depends_on]
+      latest_finish[name] = min([latest_finish[n] - self.steps[n].duration()
+                                 for n in dependents] or [makespan])
+    slack = dict((name, max(latest_finish[name] - earliest_finish[name], 0.0))
+                 for name in self.order)
+
+    path = []
+    candidates = [n for n in self.order if abs(earliest_finish[n] - makespan) < 1e-9]
+    current = candidates[-1] if candidates else None
+    while current != None:
+      path.insert(0, current)
+      step = self.steps[current]
+      earliest_start = earliest_finish[current] - step.duration()
+      previous = [d for d in step.depends_on if abs(earliest_finish[d] - earliest_start) < 1e-9]
+      current = previous[-1] if previous else None
+    return path, slack
+
+  #------------------------------------------------------------------------------
+  # Function to print the critical path and the slack of every step
+  #------------------------------------------------------------------------------
+  def report(self):
+    path, slack = self.critical_path()
+    total = (self.run_end or time.monotonic()) - (self.run_start or time.monotonic())
+    events.log("*** Critical path:", ' -> '.join(path),
+               "(" + format(sum(self.steps[n].duration() for n in path), '.3f'), "of",
+               format(total, '.3f'), "seconds)", critical_path=path)
+    # Print the table at once, so that concurrent runs do not interleave it
+    lines = ["%-12s %10s %10s %10s  %s" % ("Step", "Start (s)", "Time (s)", "Slack (s)", "Depends on")]
+    for name in self.order:
+      step = self.steps[name]
+      if step.skipped:
+        lines.append("%-12s %10s %10s %10s  %s" % (name, '-', 'skipped', '-', ', '.join(step.depends_on)))
+        continue
+      if step.restored:
+        lines.append("%-12s %10s %10s %10s  %s" % (name, '-', 'resumed', '-', ', '.join(step.depends_on)))
+        continue
+      start = (step.start - self.run_start) if step.start != None else 0.0
+      lines.append("%-12s %10.3f %10.3f %10.3f  %s" % (name + (' *' if name in path else ''), start,
+                                                       step.duration(), slack[name],
+                                                       ', '.join(step.depends_on)))
+    events.logger.report('\n'.join(lines))
@@ -0,0 +1,127 @@
+#--------------------------------------------------------------------------------
+# """topology.py: The DR and performance secondaries that follow the primary of
+#    a cluster pair, and their re-pointing at the new primary"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# Besides the secondary of the pair, which becomes the new primary, and the old
+# primary, which Step 5 turns into its secondary, a primary may have further
+# followers: DR secondaries and performance secondaries. They are listed in
+# the section of the pair:
+#
+#   [Vault-Cluster-Prod]
+#   dr_secondaries=https://vault-dr2.acme.com
+#   performance_secondaries=https://vault-eu.acme.com,https://vault-ap.acme.com
+#
+# The followers stay the same after a failover or failback; they always follow
+# whichever cluster of the pair is the primary. The new primary issues a
+# secondary activation token for every follower, and every follower is
+# re-pointed with update-primary, all of them concurrently. A follower has
+# converged once its replication status is stream-wals again.
+#--------------------------------------------------------------------------------
+import ipaddress, time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from vault_dr import events, tracing
+
+DR = 'dr'
+PERFORMANCE = 'performance'
+
+DEFAULT_POLL_INTERVAL = 1
+
+#--------------------------------------------------------------------------------
+# Function to return the ID a primary gives the secondary token of the cluster
+# cluster_domain: the first label of its hostname, or its address
+#--------------------------------------------------------------------------------
+def secondary_id(cluster_domain):
+  hostname = urlsplit(cluster_domain).hostname or cluster_domain
+  try:
+    return str(ipaddress.ip_address(hostname)).replace('.', '-').replace(':', '-')
+  except ValueError:
+    return hostname.split('.')[0][:40]
+
+class Follower:
+
+  def __init__(self, kind, cluster_domain, secondary_id=None):
+    self.kind = kind
+    self.cluster_domain = cluster_domain
+    # ID of its secondary tokens, resolved by the plan if there is one
+    self.token_id = secondary_id
+    # Secondary activation token issued by the new primary, and the DR
+    # operation token update-primary needs on a DR secondary
+    self.secondary_token = None
+    self.operation_token = None
+    # When (monotonic) it was re-pointed and when it streamed again
+    self.updated = None
+    self.converged = None
+    self.error = None
+
+  def label(self):
+    return self.kind + ' secondary ' + self.cluster_domain
+
+  def path(self, endpoint):
+    return '/v1/sys/replication/' + self.kind + '/' + endpoint
+
+  def secondary_id(self):
+    return self.token_id if self.token_id != None else secondary_id(self.cluster_domain)
+
+#--------------------------------------------------------------------------------
+# Function to return the followers of a pair as a list of (kind, cluster domain,
+# secondary token ID). option(key) reads a key of the section of the pair.
+#--------------------------------------------------------------------------------
+def read_followers(option):
+  followers = []
+  for kind, key in ((DR, 'dr_secondaries'), (PERFORMANCE, 'performance_secondaries')):
+    for cluster_domain in (option(key) or '').split(','):
+      if cluster_domain.strip() != '':
+        followers.append((kind, cluster_domain.strip(), secondary_id(cluster_domain.strip())))
+  return followers
+
+#--------------------------------------------------------------------------------
+# Function to run action(follower) on all the followers that have not failed
+# yet, concurrently. An exception (including SystemExit) only fails its own
+# follower and is kept in its error. Returns the followers that failed.
+#--------------------------------------------------------------------------------
+def fan_out(followers, action):
+  # Every follower gets a span in the step that fans out
+  parent = tracing.tracer.current()
+
+  def run_one(follower):
+    try:
+      with tracing.tracer.span(follower.label(), tracing.STEP, parent):
+        action(follower)
+    except BaseException as e:
+      follower.error = e
+      events.log("*** Re-pointing the", follower.label(), "failed:", repr(e))
+
+  pending = [follower for follower in followers if follower.error == None]
+  if pending:
+    with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+      list(executor.map(run_one, pending))
+  return [follower for follower in followers if follower.error != None]
+
+#--------------------------------------------------------------------------------
+# Function to print when the followers converged, relative to start
+# (monotonic). Returns whether all of them did.
+#--------------------------------------------------------------------------------
+def report(name, followers, start):
+  for follower in followers:
+    if follower.converged != None:
+      events.log("*** The", follower.label(), "of", name, "streams from the new primary",
+                 format(follower.converged - start, '.3f'), "seconds after the start of the run")
+  failed = [follower for follower in followers if follower.converged == None]
+  if failed:
+    events.log("*** Followers of", name, "NOT converged:",
+               ', '.join(follower.label() + ' (' + (repr(follower.error) if follower.error != None else
+                                                   'not streaming') + ')' for follower in failed))
+  return not failed
@@ -0,0 +1,281 @@
+#--------------------------------------------------------------------------------
+# """tracing.py: Spans of the DR steps, HTTP calls and sleeps, with JSON trace
+#    and Prometheus textfile export"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# The step banners only have second resolution. The Tracer records a span on
+# the monotonic clock for every step, every HTTP call (with its retry count,
+# status code and bytes) and every sleep. A span started while another one is
+# open in the same thread becomes its child, so an HTTP call is attributed to
+# the step (and the cluster pair) that made it.
+#
+# At the end of a run the spans are written as JSON trace events, which can be
+# loaded into chrome://tracing or Perfetto, and as a Prometheus textfile for
+# the node exporter textfile collector. The downtime window of every run (from
+# its start until the new CNAME has propagated) is compared with the 90-day
+# error budget of 77 seconds of a 99.999% SLO.
+#--------------------------------------------------------------------------------
+import json, os, threading, time
+from contextlib import contextmanager
+from vault_dr import events
+
+DEFAULT_ERROR_BUDGET = 77
+
+# Upper bounds in seconds of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Span kinds
+RUN = 'run'
+STEP = 'step'
+HTTP = 'http'
+SLEEP = 'sleep'
+DOWNTIME = 'downtime'
+
+class Span:
+
+  def __init__(self, name, kind, parent=None, attributes=None):
+    self.name = name
+    self.kind = kind
+    self.parent = parent
+    self.attributes = dict(attributes or {})
+    self.thread = threading.current_thread().name
+    self.start = time.monotonic()
+    self.end = None
+
+  def duration(self):
+    return (self.end if self.end != None else time.monotonic()) - self.start
+
+  #------------------------------------------------------------------------------
+  # Function to return an attribute of this span or of the closest ancestor
+  # that has it, e.g. the pair name of the run an HTTP call belongs to
+  #------------------------------------------------------------------------------
+  def inherited(self, key, default=None):
+    span = self
+    while span != None:
+      if key in span.attributes:
+        return span.attributes[key]
+      span = span.parent
+    return default
+
+class Tracer:
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.spans = []
+    self.local = threading.local()
+    # The monotonic clock has no epoch; keep one wall clock reading to map it
+    self.epoch_monotonic = time.monotonic()
+    self.epoch_wall = time.time()
+
+  #------------------------------------------------------------------------------
+  # Function to drop the spans of earlier runs, e.g. between the failovers of
+  # a long-running daemon
+  #------------------------------------------------------------------------------
+  def reset(self):
+    with self.lock:
+      self.spans = []
+
+  def first_end(self, kind, after=0.0):
+    ends = [span.end for span in self.finished(kind) if span.start >= after]
+    return min(ends) if ends else None
+
+  def current(self):
+    stack = getattr(self.local, 'stack', None)
+    return stack[-1] if stack else None
+
+  #------------------------------------------------------------------------------
+  # Function to open a span in the current thread. parent defaults to the
+  # innermost span open in this thread; pass one to link a span started in a
+  # worker thread to the run that started it.
+  #------------------------------------------------------------------------------
+  @contextmanager
+  def span(self, name, kind=STEP, parent=None, **attributes):
+    span = Span(name, kind, parent if parent != None else self.current(), attributes)
+    if not hasattr(self.local, 'stack'):
+      self.local.stack = []
+    self.local.stack.append(span)
+    try:
+      yield span
+    except BaseException as e:
+      span.attributes['error'] = type(e).__name__
+      raise
+    finally:
+      span.end = time.monotonic()
+      self.local.stack.pop()
+      with self.lock:
+        self.spans.append(span)
+
+  #------------------------------------------------------------------------------
+  # Function to record a span that has already ended
+  #------------------------------------------------------------------------------
+  def record(self, name, kind, start, end, parent=None, **attributes):
+    span = Span(name, kind, parent if parent != None else self.current(), attributes)
+    span.start = start
+    span.end = end
+    with self.lock:
+      self.spans.append(span)
+    return span
+
+  def sleep(self, seconds, reason, parent=None):
+    with self.span(reason, SLEEP, parent, seconds=seconds):
+      time.sleep(seconds)
+
+  def finished(self, kind=None):
+    with self.lock:
+      return [span for span in self.spans if kind == None or span.kind == kind]
+
+  def wall_time(self, monotonic):
+    return self.epoch_wall + (monotonic - self.epoch_monotonic)
+
+  #------------------------------------------------------------------------------
+  # Function to return the spans as JSON trace events (complete events in
+  # microseconds, one track per thread)
+  #------------------------------------------------------------------------------
+  def trace_events(self):
+    threads = {}
+    events = []
+    for span in sorted(self.finished(), key=lambda span: span.start):
+      tid = threads.setdefault(span.thread, len(threads) + 1)
+      args = dict(span.attributes)
+      run = span.inherited('run')
+      if run != None:
+        args['run'] = run
+      events.append({'name': span.name, 'cat': span.kind, 'ph': 'X', 'pid': os.getpid(),
+                     'tid': tid, 'ts': round(self.wall_time(span.start) * 1e6),
+                     'dur': round(span.duration() * 1e6), 'args': args})
+    for name, tid in threads.items():
+      events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                     'args': {'name': name}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+  #------------------------------------------------------------------------------
+  # Function to return the metrics of the spans in the Prometheus text format
+  #------------------------------------------------------------------------------
+  def prometheus_metrics(self, error_budget=DEFAULT_ERROR_BUDGET):
+    def labels(**values):
+      return '{' + ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                            for key, value in sorted(values.items())) + '}'
+    lines = []
+    def metric(name, help_text, kind, samples):
+      lines.append('# HELP %s %s' % (name, help_text))
+      lines.append('# TYPE %s %s' % (name, kind))
+      for label_values, value in samples:
+        lines.append('%s%s %s' % (name, labels(**label_values) if label_values else '', repr(float(value))))
+
+    metric('vault_dr_step_duration_seconds', 'Duration of each DR step of the last run.', 'gauge',
+           [({'run': span.inherited('run', ''), 'step': span.name}, span.duration())
+            for span in self.finished(STEP)])
+
+    http = {}
+    for span in self.finished(HTTP):
+      key = (span.inherited('run', ''), span.attributes.get('verb'), str(span.attributes.get('status')))
+      count, retries, received, seconds = http.get(key, (0, 0, 0, 0.0))
+      http[key] = (count + 1, retries + span.attributes.get('retries', 0),
+                   received + span.attributes.get('bytes', 0), seconds + span.duration())
+    for name, help_text, index in (
+        ('vault_dr_http_requests_total', 'Vault API calls of the last run.', 0),
+        ('vault_dr_http_retries_total', 'Retried attempts of the Vault API calls of the last run.', 1),
+        ('vault_dr_http_response_bytes_total', 'Response bytes of the Vault API calls of the last run.', 2),
+        ('vault_dr_http_duration_seconds_total', 'Time spent in Vault API calls of the last run.', 3)):
+      metric(name, help_text, 'counter',
+             [({'run': run, 'verb': verb, 'status': status}, values[index])
+              for (run, verb, status), values in sorted(http.items())])
+
+    sleeps = {}
+    for span in self.finished(SLEEP):
+      key = (span.inherited('run', ''), span.name)
+      sleeps[key] = sleeps.get(key, 0.0) + span.duration()
+    metric('vault_dr_sleep_seconds_total', 'Time spent sleeping in the last run.', 'counter',
+           [({'run': run, 'reason': reason}, seconds) for (run, reason), seconds in sorted(sleeps.items())])
+
+    downtime = self.finished(DOWNTIME)
+    metric('vault_dr_downtime_seconds', 'Downtime window of the last run, from its start until '
+           'the new CNAME had propagated.', 'gauge',
+           [({'run': span.inherited('run', '')}, span.duration()) for span in downtime])
+    metric('vault_dr_data_loss_window_seconds', 'Estimated window of writes the new primary had '
+           'not received when it was promoted in the last run.', 'gauge',
+           [({'run': span.inherited('run', '')}, span.attributes['data_loss_window'])
+            for span in self.finished(STEP) if span.attributes.get('data_loss_window') != None])
+    metric('vault_dr_dns_max_staleness_seconds', 'Worst-case time clients of the last run may '
+           'still have resolved the CNAME to the old primary, as guaranteed by the DNS strategy.',
+           'gauge',
+           [({'run': span.inherited('run', '')}, span.attributes['dns_max_staleness'])
+            for span in self.finished(STEP) if span.attributes.get('dns_max_staleness') != None])
+    # Latency histogram of the probes of the post-failover verification
+    latencies = {}
+    for span in self.finished(HTTP):
+      if span.attributes.get('step') == 'verify' and span.attributes.get('check') != None:
+        latencies.setdefault((span.inherited('run', ''), span.attributes['check']), []).append(
+          span.duration())
+    samples = []
+    for (run, check), values in sorted(latencies.items()):
+      for bound in LATENCY_BUCKETS + (float('inf'),):
+        samples.append(({'run': run, 'check': check, 'le': '+Inf' if bound == float('inf') else repr(bound)},
+                        sum(1 for value in values if value <= bound)))
+    lines.append('# HELP vault_dr_verification_latency_seconds Latency of the probes of the '
+                 'post-failover verification of the last run.')
+    lines.append('# TYPE vault_dr_verification_latency_seconds histogram')
+    for label_values, value in samples:
+      lines.append('vault_dr_verification_latency_seconds_bucket%s %s' % (labels(**label_values),
+                                                                          repr(float(value))))
+    for (run, check), values in sorted(latencies.items()):
+      lines.append('vault_dr_verification_latency_seconds_sum%s %s' % (labels(run=run, check=check),
+                                                                       repr(float(sum(values)))))
+      lines.append('vault_dr_verification_latency_seconds_count%s %s' % (labels(run=run, check=check),
+                                                                         repr(float(len(values)))))
+    metric('vault_dr_topology_converged_seconds', 'Time from the start of the last run until the old '
+           'primary and all further secondaries followed the new primary.', 'gauge',
+           [({'run': span.inherited('run', '')}, span.attributes['topology_converged'])
+            for span in self.finished(RUN) if span.attributes.get('topology_converged') != None])
+    metric('vault_dr_dual_primary_window_seconds', 'Upper bound of the time both clusters of the '
+           'last run were primaries, until the old primary was fenced or demoted.', 'gauge',
+           [({'run': span.inherited('run', '')}, span.attributes['dual_primary_window'])
+            for span in self.finished(RUN) if span.attributes.get('dual_primary_window') != None])
+    metric('vault_dr_error_budget_seconds', '90-day downtime error budget.', 'gauge',
+           [({}, error_budget)])
+    metric('vault_dr_last_run_timestamp_seconds', 'End of the last run.', 'gauge',
+           [({'run': span.inherited('run', '')}, self.wall_time(span.end))
+            for span in self.finished(RUN)])
+    return '\n'.join(lines) + '\n'
+
+  #------------------------------------------------------------------------------
+  # Functions to write the exports. The textfile collector may read the file at
+  # any time, so it is written to a temporary file and renamed.
+  #------------------------------------------------------------------------------
+  def write_trace(self, path):
+    with open(path, 'w') as f:
+      json.dump(self.trace_events(), f)
+
+  def write_prometheus(self, path, error_budget=DEFAULT_ERROR_BUDGET):
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as f:
+      f.write(self.prometheus_metrics(error_budget))
+    os.replace(temporary, path)
+
+  #------------------------------------------------------------------------------
+  # Function to print the downtime window of every run against the error budget
+  #------------------------------------------------------------------------------
+  def print_budget_report(self, error_budget=DEFAULT_ERROR_BUDGET):
+    for span in self.finished(DOWNTIME):
+      downtime = span.duration()
+      events.log("*** Downtime window of", span.inherited('run', 'the run') + ":",
+                 format(downtime, '.3f'), "seconds of the 90-day error budget of", error_budget,
+                 "seconds (" + format(100 * downtime / error_budget, '.1f') + "%);",
+                 ("within budget" if downtime <= error_budget else
+                  "OVER BUDGET by " + format(downtime - error_budget, '.3f') + " seconds"))
+
+#--------------------------------------------------------------------------------
+# The tracer of this process
+#--------------------------------------------------------------------------------
+tracer = Tracer()
@@ -0,0 +1,352 @@
+#--------------------------------------------------------------------------------
+# """vault_client.py: asyncio client of the Vault DR replication API"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# run_vault_dr.py builds every Vault call inline and makes it with
+# http_request(), one blocking call (and so one thread) at a time. A
+# VaultClient has one coroutine per DR replication endpoint and returns its
+# answer as a model object instead of a dict:
+#
+#   dr_status()                                      -> DRStatus
+#   operation_token_status(), start_operation_token()
+#   update_operation_token(key, nonce)               -> OperationTokenAttempt
+#   cancel_operation_token()                         -> None
+#   promote(dr_operation_token)                      -> None
+#   demote()                                         -> None
+#   secondary_token(id)                              -> SecondaryToken
+#   update_primary(dr_operation_token, token)        -> None
+#
+# so that the status of, or the operation on, any number of clusters can be
+# awaited together from one event loop, e.g.
+#
+#   statuses = await asyncio.gather(*[client.dr_status() for client in clients])
+#
+# The HTTP/1.1 requests are written on asyncio streams, so the client needs
+# nothing outside the standard library. The clients of a ConnectionPool share
+# its keep-alive connections, at most maxsize per cluster. Like the requests
+# sessions of http_pool.py, TLS certificates are not verified and nothing is
+# retried: a call that fails or takes longer than its timeout raises a
+# VaultError and the caller decides whether to try again. An answer that is
+# not JSON raises a VaultError too rather than coming back as is. A pool and
+# its clients belong to the event loop they are first used in.
+#--------------------------------------------------------------------------------
+import asyncio, json, ssl
+from urllib.parse import urlsplit
+
+DEFAULT_TIMEOUT = 10
+DEFAULT_POOL_MAXSIZE = 4
+
+DR_PREFIX = '/v1/sys/replication/dr'
+
+class VaultError(Exception):
+
+  #------------------------------------------------------------------------------
+  # status is the HTTP status code (None if there was no answer), errors the
+  # "errors" list of the answer and reason a short cause for alerts, e.g.
+  # timeout, HTTP 503 or ConnectionRefusedError
+  #------------------------------------------------------------------------------
+  def __init__(self, message, url=None, status=None, errors=None, reason=None):
+    Exception.__init__(self, message)
+    self.url = url
+    self.status = status
+    self.errors = errors or []
+    self.reason = reason or ('HTTP ' + str(status) if status != None else 'VaultError')
+
+#--------------------------------------------------------------------------------
+# Answer of GET /sys/replication/dr/status. mode is primary, secondary or
+# disabled; state e.g. running, stream-wals or idle. data is the whole "data"
+# document, for the fields not copied here.
+#--------------------------------------------------------------------------------
+class DRStatus:
+  __slots__ = ('mode', 'state', 'cluster_id', 'merkle_root', 'last_wal', 'last_remote_wal',
+               'primary_cluster_addr', 'known_secondaries', 'data')
+
+  def __init__(self, data):
+    self.mode = data.get('mode')
+    self.state = data.get('state')
+    self.cluster_id = data.get('cluster_id')
+    self.merkle_root = data.get('merkle_root')
+    self.last_wal = data.get('last_wal')
+    self.last_remote_wal = data.get('last_remote_wal')
+    self.primary_cluster_addr = data.get('primary_cluster_addr')
+    self.known_secondaries = data.get('known_secondaries') or []
+    self.data = data
+
+  #------------------------------------------------------------------------------
+  # Function to return the last WAL written (primary) or received (secondary)
+  #------------------------------------------------------------------------------
+  def wal(self):
+    return self.last_remote_wal if self.mode == 'secondary' else self.last_wal
+
+  def healthy_secondary(self):
+    return self.mode == 'secondary' and self.state == 'stream-wals'
+
+#--------------------------------------------------------------------------------
+# Answer of the generate-operation-token endpoints. Once complete, the DR
+# operation token is encoded_token XOR otp (see decode_operation_token()).
+#--------------------------------------------------------------------------------
+class OperationTokenAttempt:
+  __slots__ = ('started', 'nonce', 'progress', 'required', 'complete', 'otp', 'otp_length',
+               'encoded_token')
+
+  def __init__(self, data):
+    self.started = bool(data.get('started'))
+    self.nonce = data.get('nonce') or ''
+    self.progress = data.get('progress') or 0
+    self.required = data.get('required') or 0
+    self.complete = bool(data.get('complete'))
+    self.otp = data.get('otp') or ''
+    self.otp_length = data.get('otp_length') or 0
+    self.encoded_token = data.get('encoded_token') or ''
+
+#--------------------------------------------------------------------------------
+# Wrapped secondary activation token returned by a DR primary
+#--------------------------------------------------------------------------------
+class SecondaryToken:
+  __slots__ = ('token', 'ttl', 'creation_time', 'wrapped_accessor')
+
+  def __init__(self, wrap_info):
+    self.token = wrap_info.get('token')
+    self.ttl = wrap_info.get('ttl')
+    self.creation_time = wrap_info.get('creation_time')
+    self.wrapped_accessor = wrap_info.get('wrapped_accessor')
+
+#--------------------------------------------------------------------------------
+# Function to return the DR operation token of a complete attempt
+#--------------------------------------------------------------------------------
+def decode_operation_token(attempt):
+  import base64
+  encoded = base64.b64decode(attempt.encoded_token)
+  return bytes(a ^ b for a, b in zip(encoded, attempt.otp.encode())).decode()
+
+class Connection:
+
+  def __init__(self, reader, writer):
+    self.reader = reader
+    self.writer = writer
+    self.reused = False
+
+  def close(self):
+    self.writer.close()
+
+#--------------------------------------------------------------------------------
+# Keep-alive connections per cluster (scheme, host and port), at most maxsize
+# of them open to a cluster at a time
+#--------------------------------------------------------------------------------
+class ConnectionPool:
+
+  def __init__(self, maxsize=DEFAULT_POOL_MAXSIZE):
+    self.maxsize = maxsize
+    self.idle = {}
+    self.slots = {}
+    self.ssl_context = ssl.create_default_context()
+    self.ssl_context.check_hostname = False
+    self.ssl_context.verify_mode = ssl.CERT_NONE
+
+  async def acquire(self, origin):
+    slots = self.slots.get(origin)
+    if slots == None:
+      slots = self.slots[origin] = asyncio.Semaphore(self.maxsize)
+    await slots.acquire()
+    idle = self.idle.get(origin) or []
+    while idle:
+      connection = idle.pop()
+      if not connection.reader.at_eof():
+        connection.reused = True
+        return connection
+      connection.close()
+    try:
+      scheme, host, port = origin
+      reader, writer = await asyncio.open_connection(
+        host, port, ssl=self.ssl_context if scheme == 'https' else None,
+        server_hostname=host if scheme == 'https' else None)
+    except BaseException:
+      slots.release()
+      raise
+    return Connection(reader, writer)
+
+  #------------------------------------------------------------------------------
+  # Function to give a connection back, keeping it open if keep_alive
+  #------------------------------------------------------------------------------
+  def release(self, origin, connection, keep_alive):
+    if keep_alive:
+      self.idle.setdefault(origin, []).append(connection)
+    else:
+      connection.close()
+    self.slots[origin].release()
+
+  async def close(self):
+    idle = self.idle
+    self.idle = {}
+    for connections in idle.values():
+      for connection in connections:
+        connection.close()
+    for connections in idle.values():
+      for connection in connections:
+        try:
+          await connection.writer.wait_closed()
+        except (OSError, ssl.SSLError):
+          pass
+
+class VaultClient:
+
+  #------------------------------------------------------------------------------
+  # cluster_domain is e.g. https://vault-east.internal:8200; token is sent as
+  # X-Vault-Token unless it is None. Clients share pool if given one.
+  #------------------------------------------------------------------------------
+  def __init__(self, cluster_domain, token=None, pool=None, timeout=DEFAULT_TIMEOUT):
+    self.cluster_domain = cluster_domain.rstrip('/')
+    url = urlsplit(self.cluster_domain)
+    self.origin = (url.scheme, url.hostname, url.port or (443 if url.scheme == 'https' else 80))
+    self.host = url.netloc
+    self.token = token
+    self.pool = pool if pool != None else ConnectionPool()
+    self.timeout = timeout
+
+  async def dr_status(self, timeout=None):
+    document = await self.request('GET', DR_PREFIX + '/status', timeout=timeout, token=False)
+    return DRStatus(document.get('data') or {})
+
+  async def operation_token_status(self, timeout=None):
+    return OperationTokenAttempt(await self.request(
+      'GET', DR_PREFIX + '/secondary/generate-operation-token/attempt', timeout=timeout))
+
+  async def start_operation_token(self, timeout=None):
+    return OperationTokenAttempt(await self.request(
+      'POST', DR_PREFIX + '/secondary/generate-operation-token/attempt', {}, timeout))
+
+  async def update_operation_token(self, key, nonce, timeout=None):
+    return OperationTokenAttempt(await self.request(
+      'POST', DR_PREFIX + '/secondary/generate-operation-token/update',
+      {'key': key, 'nonce': nonce}, timeout))
+
+  async def cancel_operation_token(self, timeout=None):
+    await self.request('DELETE', DR_PREFIX + '/secondary/generate-operation-token/attempt',
+                       timeout=timeout)
+
+  async def promote(self, dr_operation_token, primary_cluster_addr=None, timeout=None):
+    payload = {'dr_operation_token': dr_operation_token}
+    if primary_cluster_addr != None:
+      payload['primary_cluster_addr'] = primary_cluster_addr
+    await self.request('POST', DR_PREFIX + '/secondary/promote', payload, timeout)
+
+  async def demote(self, timeout=None):
+    await self.request('POST', DR_PREFIX + '/primary/demote', {}, timeout)
+
+  async def secondary_token(self, id, ttl=None, timeout=None):
+    payload = {'id': id}
+    if ttl != None:
+      payload['ttl'] = ttl
+    document = await self.request('POST', DR_PREFIX + '/primary/secondary-token', payload, timeout)
+    wrap_info = document.get('wrap_info')
+    if not wrap_info or not wrap_info.get('token'):
+      raise VaultError('no secondary token in the answer', self.cluster_domain +
+                       DR_PREFIX + '/primary/secondary-token')
+    return SecondaryToken(wrap_info)
+
+  async def update_primary(self, dr_operation_token, token, primary_api_addr=None, timeout=None):
+    payload = {'dr_operation_token': dr_operation_token, 'token': token}
+    if primary_api_addr != None:
+      payload['primary_api_addr'] = primary_api_addr
+    await self.request('POST', DR_PREFIX + '/secondary/update-primary', payload, timeout)
+
+  #------------------------------------------------------------------------------
+  # Function to make one API call and return its JSON document ({} if the
+  # answer has no body). Raises VaultError if the call fails, answers with an
+  # error status or does not answer within timeout seconds.
+  #------------------------------------------------------------------------------
+  async def request(self, verb, path, payload=None, timeout=None, token=True):
+    url = self.cluster_domain + path
+    body = json.dumps(payload).encode() if payload != None else b''
+    head = [verb + ' ' + path + ' HTTP/1.1', 'Host: ' + self.host, 'Connection: keep-alive',
+            'Content-Length: ' + str(len(body))]
+    if body:
+      head.append('Content-Type: application/json')
+    if token and self.token != None:
+      head.append('X-Vault-Token: ' + self.token)
+    message = ('\r\n'.join(head) + '\r\n\r\n').encode() + body
+    try:
+      status, raw = await asyncio.wait_for(self.exchange(message),
+                                           timeout if timeout != None else self.timeout)
+    except asyncio.TimeoutError:
+      raise VaultError(verb + ' ' + url + ' timed out', url, reason='timeout')
+    except (OSError, ssl.SSLError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+            ValueError) as e:
+      raise VaultError(verb + ' ' + url + ' failed: ' + type(e).__name__ + ': ' + str(e), url,
+                       reason=type(e).__name__)
+    try:
+      document = json.loads(raw) if raw.strip() else {}
+    except ValueError:
+      raise VaultError(verb + ' ' + url + ' answered ' + str(status) + ' with a body that is not '
+                       'JSON: ' + raw[:200].decode(errors='replace'), url, status,
+                       reason='invalid JSON')
+    if status >= 400:
+      errors = document.get('errors') if isinstance(document, dict) else None
+      raise VaultError(verb + ' ' + url + ' answered ' + str(status) +
+                       (': ' + '; '.join(str(e) for e in errors) if errors else ''),
+                       url, status, errors)
+    return document
+
+  #------------------------------------------------------------------------------
+  # Function to send message and read the answer over a pooled connection. A
+  # kept-alive connection the server closed in the meantime is replaced once.
+  #------------------------------------------------------------------------------
+  async def exchange(self, message):
+    while True:
+      connection = await self.pool.acquire(self.origin)
+      keep_alive = False
+      try:
+        connection.writer.write(message)
+        await connection.writer.drain()
+        try:
+          status_line = await connection.reader.readuntil(b'\r\n')
+        except (ConnectionError, asyncio.IncompleteReadError):
+          if connection.reused:
+            continue
+          raise
+        status, raw, keep_alive = await self.read_answer(connection.reader, status_line)
+        return status, raw
+      finally:
+        self.pool.release(self.origin, connection, keep_alive)
+
+  async def read_answer(self, reader, status_line):
+    version, status = status_line.decode('latin-1').split(' ', 2)[:2]
+    headers = {}
+    while True:
+      line = await reader.readuntil(b'\r\n')
+      if line == b'\r\n':
+        break
+      name, _, value = line.decode('latin-1').partition(':')
+      headers[name.strip().lower()] = value.strip()
+    keep_alive = (version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close')
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+      chunks = []
+      while True:
+        size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+        if size == 0:
+          # Trailers, up to the empty line
+          while await reader.readuntil(b'\r\n') != b'\r\n':
+            pass
+          break
+        chunks.append(await reader.readexactly(size))
+        await reader.readexactly(2)
+      raw = b''.join(chunks)
+    elif 'content-length' in headers:
+      raw = await reader.readexactly(int(headers['content-length']))
+    elif status in ('204', '304'):
+      raw = b''
+    else:
+      raw = await reader.read()
+      keep_alive = False
+    return int(status), raw, keep_alive
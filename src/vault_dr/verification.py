@@ -0,0 +1,248 @@
+#--------------------------------------------------------------------------------
+# """verification.py: Post-failover verification of the new primary"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# "Operation Successful" only means that every API call of the run succeeded.
+# Once the CNAME has propagated, the verification checks that the new primary
+# actually serves clients, on every Vault node of the cluster (the
+# api_address of each node listed by /v1/sys/ha-status), through its ELB
+# hostname and through the cluster CNAME:
+#
+#   * health: /v1/sys/health answers with replication_dr_mode primary, with
+#     standbyok and perfstandbyok so that standby nodes answer 200 as well,
+#   * dr-status: /v1/sys/replication/dr/status reports mode primary, with the
+#     same cluster_id on every target,
+#   * synthetic: a read-only GET of synthetic_path with the Vault token
+#     answers 2xx (/v1/auth/token/lookup-self by default).
+#
+# All the checks of all the targets run concurrently. A check passes once it
+# has succeeded successes times in a row; a failed probe is retried every
+# interval seconds. Whatever has not passed by the deadline fails. Every
+# probe is a fresh connection, as a client would make, and its latency goes
+# into the histogram of its check.
+#--------------------------------------------------------------------------------
+import bisect, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urlunsplit
+from vault_dr import events, tracing
+
+DEFAULT_DEADLINE = 30
+DEFAULT_TIMEOUT = 2
+DEFAULT_SUCCESSES = 3
+DEFAULT_INTERVAL = 1
+DEFAULT_SYNTHETIC_PATH = '/v1/auth/token/lookup-self'
+
+# Standby and performance standby nodes answer 429 and 473 without these
+HEALTH_PATH = '/v1/sys/health?standbyok=true&perfstandbyok=true'
+HEALTHY_STATUS_CODES = (200, 429, 473)
+STATUS_PATH = '/v1/sys/replication/dr/status'
+HA_STATUS_PATH = '/v1/sys/ha-status'
+
+# Checks
+HEALTH = 'health'
+DR_STATUS = 'dr-status'
+SYNTHETIC = 'synthetic'
+
+class LatencyHistogram:
+
+  def __init__(self, buckets=tracing.LATENCY_BUCKETS):
+    self.buckets = tuple(buckets)
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.values = []
+    # The probes of all the targets of a check observe concurrently
+    self.lock = threading.Lock()
+
+  def observe(self, seconds):
+    with self.lock:
+      self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+      self.values.append(seconds)
+
+  def percentile(self, p):
+    if not self.values:
+      return None
+    values = sorted(self.values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+  def describe(self):
+    if not self.values:
+      return 'no probes'
+    buckets = ['<=' + format(bound, 'g') + 's: ' + str(count)
+               for bound, count in zip(self.buckets, self.counts) if count]
+    if self.counts[-1]:
+      buckets.append('>' + format(self.buckets[-1], 'g') + 's: ' + str(self.counts[-1]))
+    return (str(len(self.values)) + ' probes, p50 ' + format(self.percentile(50), '.3f') + 's, p95 ' +
+            format(self.percentile(95), '.3f') + 's, max ' + format(max(self.values), '.3f') + 's (' +
+            ', '.join(buckets) + ')')
+
+#--------------------------------------------------------------------------------
+# One check of one target: target is the URL of a Vault node, of the ELB or of
+# the CNAME, node the hostname of the node, or None
+#--------------------------------------------------------------------------------
+class Check:
+
+  def __init__(self, name, target, node=None):
+    self.name = name
+    self.target = target
+    self.node = node
+    self.passed = False
+    self.probes = 0
+    self.error = None
+    self.cluster_id = None
+
+  def label(self):
+    return self.name + ' via ' + ('node ' + self.node + ' (' + self.target + ')'
+                                  if self.node != None else self.target)
+
+class Verification:
+
+  def __init__(self, checks, seconds):
+    self.checks = checks
+    self.seconds = seconds
+    self.histograms = {}
+    self.problems = []
+
+  def passed(self):
+    return not self.problems and all(check.passed for check in self.checks)
+
+  def report(self, name):
+    events.log("*** Verification of the new primary of", name,
+               "PASSED" if self.passed() else "FAILED",
+               "in", format(self.seconds, '.3f'), "seconds:",
+               sum(1 for check in self.checks if check.passed), "of", len(self.checks),
+               "checks passed")
+    for check in self.checks:
+      if not check.passed:
+        events.log("*** Check", check.label(), "failed after", check.probes, "probes:", check.error)
+    for problem in self.problems:
+      events.log("***", problem)
+    for check_name, histogram in sorted(self.histograms.items()):
+      events.log("*** Latency of", check_name + ":", histogram.describe())
+
+#--------------------------------------------------------------------------------
+# Function to return the (URL, node hostname) targets of the Vault nodes of
+# cluster_domain, as listed by /v1/sys/ha-status, then of cluster_domain (its
+# ELB) and of the cluster CNAME, and the error of the node listing or None
+#--------------------------------------------------------------------------------
+def targets(cluster_domain, cluster_cname, hdrs, timeout=DEFAULT_TIMEOUT):
+  import requests
+  found = []
+  error = None
+  try:
+    response = requests.get(cluster_domain + HA_STATUS_PATH, headers=hdrs, verify=False,
+                            timeout=timeout)
+    response.raise_for_status()
+    body = response.json()
+    for node in (body.get('data') or body).get('nodes') or []:
+      if node.get('api_address'):
+        found.append((node['api_address'].rstrip('/'), node.get('hostname') or
+                      urlsplit(node['api_address']).hostname))
+    if not found:
+      error = 'no node has an api_address'
+  except (requests.exceptions.RequestException, ValueError) as e:
+    error = type(e).__name__ + ': ' + str(e)
+  found.append((cluster_domain, None))
+  if cluster_cname:
+    parts = urlsplit(cluster_domain)
+    netloc = cluster_cname + (':%d' % parts.port if parts.port else '')
+    found.append((urlunsplit((parts.scheme, netloc, '', '', '')), None))
+  return found, error
+
+#--------------------------------------------------------------------------------
+# Function to probe a check once. Returns (passed, error).
+#--------------------------------------------------------------------------------
+def probe(check, hdrs, synthetic_path, timeout, histogram, parent=None):
+  import requests
+  path = {HEALTH: HEALTH_PATH, DR_STATUS: STATUS_PATH, SYNTHETIC: synthetic_path}[check.name]
+  headers = dict(hdrs) if check.name != HEALTH else {}
+  with tracing.tracer.span('GET ' + path, tracing.HTTP, parent, step='verify', verb='GET',
+                           url=check.target + path, check=check.name, retries=0, status=None,
+                           bytes=0) as span:
+    start = time.monotonic()
+    try:
+      response = requests.get(check.target + path, headers=headers, verify=False, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+      return False, type(e).__name__ + ': ' + str(e)
+    finally:
+      histogram.observe(time.monotonic() - start)
+    span.attributes['status'] = response.status_code
+    span.attributes['bytes'] = len(response.content)
+  try:
+    body = response.json()
+  except ValueError:
+    body = {}
+  if check.name == HEALTH:
+    if (response.status_code not in HEALTHY_STATUS_CODES or
+        body.get('replication_dr_mode') != 'primary'):
+      return False, ('status ' + str(response.status_code) + ', replication_dr_mode ' +
+                     str(body.get('replication_dr_mode')))
+  elif check.name == DR_STATUS:
+    data = body.get('data') or {}
+    check.cluster_id = data.get('cluster_id')
+    if response.status_code != 200 or data.get('mode') != 'primary':
+      return False, 'status ' + str(response.status_code) + ', mode ' + str(data.get('mode'))
+  elif response.status_code // 100 != 2:
+    return False, 'status ' + str(response.status_code)
+  return True, None
+
+#--------------------------------------------------------------------------------
+# Function to verify the new primary cluster_domain, reached on each of its
+# nodes, through its ELB and through cluster_cname, within deadline seconds.
+# hdrs carries the Vault token. Returns a Verification.
+#--------------------------------------------------------------------------------
+def verify(cluster_domain, cluster_cname, hdrs, deadline=DEFAULT_DEADLINE,
+           timeout=DEFAULT_TIMEOUT, successes=DEFAULT_SUCCESSES, interval=DEFAULT_INTERVAL,
+           synthetic_path=DEFAULT_SYNTHETIC_PATH):
+  start = time.monotonic()
+  expires = start + deadline
+  names = [HEALTH, DR_STATUS] + ([SYNTHETIC] if synthetic_path else [])
+  found, error = targets(cluster_domain, cluster_cname, hdrs, timeout)
+  checks = [Check(name, target, node) for target, node in found for name in names]
+  verification = Verification(checks, 0.0)
+  if error != None:
+    verification.problems.append('the nodes of ' + cluster_domain + ' could not be listed: ' + error)
+  verification.histograms = dict((name, LatencyHistogram()) for name in names)
+  parent = tracing.tracer.current()
+
+  # The checks run in worker threads; their spans belong to the step
+  def run_check(check):
+    in_a_row = 0
+    while in_a_row < successes:
+      remaining = expires - time.monotonic()
+      if remaining <= 0:
+        check.error = (check.error or 'no answer') + ' (deadline passed)'
+        return
+      check.probes += 1
+      ok, error = probe(check, hdrs, synthetic_path, min(timeout, remaining),
+                        verification.histograms[check.name], parent)
+      if ok:
+        in_a_row += 1
+      else:
+        in_a_row = 0
+        check.error = error
+        remaining = expires - time.monotonic()
+        if remaining > 0:
+          tracing.tracer.sleep(min(interval, remaining), 'verify', parent)
+    check.passed = True
+
+  with ThreadPoolExecutor(max_workers=len(checks)) as executor:
+    list(executor.map(run_check, checks))
+
+  # Every target must lead to the same cluster
+  cluster_ids = set(check.cluster_id for check in checks
+                    if check.name == DR_STATUS and check.passed)
+  if len(cluster_ids) > 1:
+    verification.problems.append('the targets lead to different clusters: ' +
+                                 ', '.join(sorted(str(cluster_id) for cluster_id in cluster_ids)))
+  verification.seconds = time.monotonic() - start
+  return verification
@@ -0,0 +1,145 @@
+#--------------------------------------------------------------------------------
+# """warmup.py: Network preparation that runs while the operator is typing"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# Resolving the ELB hostnames, the TCP and TLS handshakes to both clusters and
+# creating (and checking) the Route 53 client take a good part of a second
+# across regions, and used to start only once the operator had entered the
+# Vault token and the AWS keys. A Warmup runs every such task in a background
+# thread from the start, and times the operator input (the prompts go through
+# prompt()). The part of the network preparation that overlapped the input is
+# time the DR operation no longer waits for; report() prints it.
+#--------------------------------------------------------------------------------
+import threading, time
+from vault_dr import events
+
+class Task:
+
+  def __init__(self, name, action):
+    self.name = name
+    self.action = action
+    self.start = None
+    self.end = None
+    self.result = None
+    self.error = None
+    self.reported = False
+    self.thread = threading.Thread(target=self.run, daemon=True)
+
+  def run(self):
+    self.start = time.monotonic()
+    try:
+      self.result = self.action()
+    except Exception as e:
+      self.error = e
+    finally:
+      self.end = time.monotonic()
+
+class Warmup:
+
+  def __init__(self):
+    self.started = time.monotonic()
+    self.tasks = []
+    # (start, end) of every operator input
+    self.inputs = []
+    self.lock = threading.Lock()
+
+  #------------------------------------------------------------------------------
+  # Function to start action() in the background as a task called name. Several
+  # tasks may share a name (one connection each, for instance).
+  #------------------------------------------------------------------------------
+  def add(self, name, action):
+    task = Task(name, action)
+    with self.lock:
+      self.tasks.append(task)
+    task.thread.start()
+    return task
+
+  #------------------------------------------------------------------------------
+  # Function to wait for the tasks called name (all tasks by default), for at
+  # most timeout seconds. Returns whether they all finished.
+  #------------------------------------------------------------------------------
+  def wait(self, name=None, timeout=None):
+    expires = None if timeout == None else time.monotonic() + timeout
+    with self.lock:
+      tasks = [task for task in self.tasks if name == None or task.name == name]
+    for task in tasks:
+      task.thread.join(None if expires == None else max(expires - time.monotonic(), 0))
+    return all(task.end != None for task in tasks)
+
+  #------------------------------------------------------------------------------
+  # Function to print a warning for every task called name (any task by
+  # default) that failed and was not reported yet
+  #------------------------------------------------------------------------------
+  def report_failures(self, name=None):
+    with self.lock:
+      failed = [task for task in self.tasks if (name == None or task.name == name) and
+                task.error != None and not task.reported]
+      for task in failed:
+        task.reported = True
+    for task in failed:
+      events.log("*** Warning:", task.name, "failed:", repr(task.error))
+
+  #------------------------------------------------------------------------------
+  # Function to read operator input with read() (input() or getpass(), say) and
+  # time it
+  #------------------------------------------------------------------------------
+  def prompt(self, read):
+    start = time.monotonic()
+    try:
+      return read()
+    finally:
+      with self.lock:
+        self.inputs.append((start, time.monotonic()))
+
+  #------------------------------------------------------------------------------
+  # Function to return how many seconds of the network preparation overlapped
+  # the operator input: the time the tasks kept at least one thread busy
+  # during an input. Tasks still running count up to now.
+  #------------------------------------------------------------------------------
+  def hidden(self):
+    now = time.monotonic()
+    with self.lock:
+      busy = sorted((task.start, task.end if task.end != None else now)
+                    for task in self.tasks if task.start != None)
+      inputs = list(self.inputs)
+    merged = []
+    for start, end in busy:
+      if merged and start <= merged[-1][1]:
+        merged[-1][1] = max(merged[-1][1], end)
+      else:
+        merged.append([start, end])
+    return sum(max(0.0, min(end, input_end) - max(start, input_start))
+               for start, end in merged for input_start, input_end in inputs)
+
+  def report(self):
+    now = time.monotonic()
+    with self.lock:
+      tasks = list(self.tasks)
+      typing = sum(end - start for start, end in self.inputs)
+    names = []
+    for task in tasks:
+      if task.name not in names:
+        names.append(task.name)
+    parts = []
+    for name in names:
+      group = [task for task in tasks if task.name == name]
+      done = [task for task in group if task.end != None]
+      seconds = max([(task.end if task.end != None else now) - task.start
+                     for task in group if task.start != None] or [0.0])
+      parts.append(name + ' ' + format(seconds, '.3f') + 's' +
+                   (' (' + str(len(done)) + ' of ' + str(len(group)) + ' done)'
+                    if len(done) < len(group) else ''))
+    events.log("*** Network preparation (" + ', '.join(parts) + "):", format(self.hidden(), '.3f'),
+               "seconds of it hidden behind", format(typing, '.3f'), "seconds of operator input")
+    self.report_failures()
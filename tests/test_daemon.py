@@ -0,0 +1,83 @@
+#--------------------------------------------------------------------------------
+# """test_daemon.py: Triggers of the DR controller, one DR operation at a time"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+import configparser, os, threading, time
+import pytest
+import run_vault_dr
+from vault_dr import events, tracing
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'vault_dr.cfg')
+
+@pytest.fixture
+def controller():
+  events.logger.configure('', False)
+  tracing.tracer.reset()
+  config = configparser.RawConfigParser()
+  config.read(CONFIG_FILE)
+  controller = run_vault_dr.DRController('token', None, None, CONFIG_FILE)
+  controller.load_config(config)
+  # The config logs to a file
+  events.logger.configure('', False)
+  controller.export = lambda: None
+  return controller
+
+def trigger(controller, environment):
+  replies = []
+  controller.handle_trigger({'mode': 'failover', 'environments': [environment]}, replies.append)
+  return replies
+
+def test_only_one_of_concurrent_triggers_is_accepted(controller):
+  environment = list(controller.cluster_pairs)[0]
+  release = threading.Event()
+  calls = []
+  def run_pairs(pairs, resume=False, triggered=None, busy_held=False):
+    calls.append(busy_held)
+    # The trigger holds the lock for the whole DR operation
+    assert controller.busy.locked()
+    release.wait(5)
+    return dict((pair.name, (True, None)) for pair in pairs)
+  controller.run_pairs = run_pairs
+
+  replies = []
+  threads = [threading.Thread(target=lambda: replies.append(trigger(controller, environment)))
+             for i in range(4)]
+  for thread in threads:
+    thread.start()
+  time.sleep(0.2)
+  release.set()
+  for thread in threads:
+    thread.join(5)
+
+  accepted = [reply for reply in replies if reply[0] == {'accepted': True}]
+  rejected = [reply for reply in replies if reply[0] != {'accepted': True}]
+  assert calls == [True]
+  assert len(accepted) == 1
+  assert accepted[0][1]['results'] == {environment: True}
+  assert rejected == [[{'error': 'a DR operation is already running'}]] * 3
+  assert not controller.busy.locked()
+
+def test_failed_operation_releases_the_lock(controller):
+  environment = list(controller.cluster_pairs)[0]
+  def run_pairs(pairs, resume=False, triggered=None, busy_held=False):
+    raise SystemExit(1)
+  controller.run_pairs = run_pairs
+  replies = trigger(controller, environment)
+  assert replies[0] == {'accepted': True}
+  assert replies[1]['error'].startswith('DR operation failed')
+  assert not controller.busy.locked()
+
+def test_invalid_trigger_is_rejected_without_taking_the_lock(controller):
+  assert trigger(controller, 'nowhere') == [{'error': 'unknown environment nowhere'}]
+  assert not controller.busy.locked()
@@ -0,0 +1,169 @@
+#--------------------------------------------------------------------------------
+# """test_dns_propagation.py: CNAME query encoding and decoding, the polling of
+#    DNS providers and the agreement of resolvers"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+import struct, time
+import pytest
+from vault_dr import dns_propagation, events
+from mock_dns import MockDnsServer
+
+NAME = 'vault.acme.com'
+TARGET = 'east.acme.com'
+
+@pytest.fixture(autouse=True)
+def quiet_events():
+  events.logger.configure('', False)
+
+@pytest.fixture
+def server():
+  server = MockDnsServer('acme.com').start()
+  yield server
+  server.stop()
+
+def question():
+  return dns_propagation.encode_name(NAME) + struct.pack('!HH', dns_propagation.DNS_TYPE_CNAME,
+                                                         dns_propagation.DNS_CLASS_IN)
+
+#--------------------------------------------------------------------------------
+# Function to build the answer to a CNAME query of NAME, with the owner of the
+# answer compressed to a pointer to the question
+#--------------------------------------------------------------------------------
+def answer(query_id, flags=0x8180, target=TARGET):
+  rdata = dns_propagation.encode_name(target)
+  record = (struct.pack('!H', 0xC00C) +
+            struct.pack('!HHIH', dns_propagation.DNS_TYPE_CNAME, dns_propagation.DNS_CLASS_IN, 30,
+                        len(rdata)) + rdata)
+  return struct.pack('!HHHHHH', query_id, flags, 1, 1, 0, 0) + question() + record
+
+class Provider:
+
+  def __init__(self, name, synced_after=None, error=None):
+    self.name = name
+    self.synced_after = synced_after
+    self.error = error
+    self.polls = 0
+
+  def synced(self, change_id):
+    self.polls += 1
+    if self.error != None:
+      raise self.error
+    return self.synced_after != None and self.polls >= self.synced_after
+
+def test_normalize_dns_name():
+  assert dns_propagation.normalize_dns_name('https://Internal-Vault.elb.amazonaws.com.:8200/v1') == \
+    'internal-vault.elb.amazonaws.com'
+  assert dns_propagation.normalize_dns_name(None) == None
+
+def test_parse_resolver():
+  assert dns_propagation.parse_resolver('10.0.0.2') == ('10.0.0.2', 53)
+  assert dns_propagation.parse_resolver(' 127.0.0.1:5353 ') == ('127.0.0.1', 5353)
+
+def test_encode_cname_query():
+  query = dns_propagation.encode_cname_query(0x1234, 'Vault.Acme.com.')
+  assert struct.unpack('!HHHHHH', query[:12]) == (0x1234, 0x0100, 1, 0, 0, 0)
+  name, offset = dns_propagation.decode_name(query, 12)
+  assert name == NAME
+  assert struct.unpack('!HH', query[offset:]) == (dns_propagation.DNS_TYPE_CNAME,
+                                                   dns_propagation.DNS_CLASS_IN)
+
+def test_decode_cname_answer_with_compression():
+  assert dns_propagation.decode_cname_answer(answer(7, target='East.Acme.com'), 7, NAME) == TARGET
+
+def test_decode_cname_answer_of_another_name():
+  assert dns_propagation.decode_cname_answer(answer(7), 7, 'other.acme.com') == None
+
+def test_decode_cname_answer_nxdomain():
+  message = struct.pack('!HHHHHH', 7, 0x8183, 1, 0, 0, 0) + question()
+  assert dns_propagation.decode_cname_answer(message, 7, NAME) == None
+
+def test_decode_cname_answer_id_mismatch():
+  with pytest.raises(ValueError):
+    dns_propagation.decode_cname_answer(answer(7), 8, NAME)
+
+def test_decode_cname_answer_truncated():
+  with pytest.raises(dns_propagation.TruncatedAnswer):
+    dns_propagation.decode_cname_answer(answer(7, 0x8380), 7, NAME)
+
+def test_decode_cname_answer_cut_short():
+  message = answer(7)
+  for length in (4, len(message) - 20, len(message) - 3):
+    with pytest.raises(ValueError):
+      dns_propagation.decode_cname_answer(message[:length], 7, NAME)
+
+def test_decode_name_compression_loop():
+  with pytest.raises(ValueError):
+    dns_propagation.decode_name(b'\x00' * 12 + struct.pack('!H', 0xC00C), 12)
+
+def test_query_cname(server):
+  server.set(NAME, TARGET)
+  assert dns_propagation.query_cname(server.server, NAME, 1) == TARGET
+  assert dns_propagation.query_cname(server.server, 'missing.acme.com', 1) == None
+
+def test_query_cname_retries_truncated_answer_over_tcp():
+  server = MockDnsServer('acme.com', truncate=True).start()
+  try:
+    server.set(NAME, TARGET)
+    assert dns_propagation.query_cname(server.server, NAME, 1) == TARGET
+    assert server.queries == 2
+    assert server.connections == 1
+  finally:
+    server.stop()
+
+def test_wait_for_changes_in_sync():
+  route53, internal = Provider('route53', 1), Provider('internal', 3)
+  start = time.monotonic()
+  assert dns_propagation.wait_for_changes([(route53, 'C1'), (internal, 'C2')], start + 5, 0.01) == []
+  assert route53.polls == 1
+  assert internal.polls == 3
+
+def test_wait_for_changes_deadline():
+  start = time.monotonic()
+  pending = dns_propagation.wait_for_changes([(Provider('route53', 1), 'C1'),
+                                              (Provider('internal'), 'C2'),
+                                              (Provider('broken', error=RuntimeError('down')), 'C3')],
+                                             start + 0.2, 0.05)
+  elapsed = time.monotonic() - start
+  assert pending == ['internal', 'broken']
+  assert 0.2 <= elapsed < 1
+
+def test_wait_for_resolvers_agree(server):
+  other = MockDnsServer('acme.com').start()
+  try:
+    server.set(NAME, TARGET)
+    other.set(NAME, TARGET + '.')
+    assert dns_propagation.wait_for_resolvers([server.server, other.server], NAME,
+                                              'https://East.acme.com:8200', time.monotonic() + 5,
+                                              0.01, 1) == []
+  finally:
+    other.stop()
+
+def test_wait_for_resolvers_disagree(server):
+  other = MockDnsServer('acme.com').start()
+  try:
+    server.set(NAME, TARGET)
+    other.set(NAME, 'west.acme.com')
+    start = time.monotonic()
+    pending = dns_propagation.wait_for_resolvers([server.server, other.server], NAME, TARGET,
+                                                 start + 0.3, 0.05, 0.2)
+    assert pending == [other.server]
+    assert time.monotonic() - start < 1.5
+  finally:
+    other.stop()
+
+def test_wait_for_dns_propagation(server):
+  server.set(NAME, TARGET)
+  waited = dns_propagation.wait_for_dns_propagation([(Provider('route53', 2), 'C1')], NAME, TARGET,
+                                                    [server.server], 5, 0.01)
+  assert waited < 5
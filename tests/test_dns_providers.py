@@ -0,0 +1,150 @@
+#--------------------------------------------------------------------------------
+# """test_dns_providers.py: RFC 2136 updates of the Rfc2136Provider against
+#    mock_dns.py"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+import base64, struct
+import pytest
+from vault_dr import dns_propagation, dns_providers, events
+from mock_dns import MockDnsServer
+
+ZONE = 'acme.com'
+NAME = 'vault.acme.com'
+TARGET = 'east.acme.com'
+KEY_NAME = 'vault-dr'
+SECRET = base64.b64encode(b'a TSIG secret of the test').decode()
+
+@pytest.fixture(autouse=True)
+def quiet_events():
+  events.logger.configure('', False)
+
+@pytest.fixture
+def servers():
+  started = []
+  def start(**options):
+    server = MockDnsServer(ZONE, **options).start()
+    started.append(server)
+    return server
+  yield start
+  for server in started:
+    server.stop()
+
+@pytest.fixture
+def providers():
+  created = []
+  def create(name, server, **options):
+    provider = dns_providers.Rfc2136Provider(name, server.server, ZONE, **options)
+    created.append(provider)
+    return provider
+  yield create
+  for provider in created:
+    provider.close()
+
+def test_update_replaces_each_cname():
+  message = dns_providers.encode_update(0x1234, ZONE, [(NAME, TARGET), ('www.acme.com', NAME)], 30)
+  query_id, flags, zocount, prcount, upcount, adcount = struct.unpack('!HHHHHH', message[:12])
+  assert (query_id, flags >> 11, zocount, prcount, upcount, adcount) == (0x1234, 5, 1, 0, 4, 0)
+  zone, offset = dns_propagation.decode_name(message, 12)
+  assert zone.rstrip('.') == ZONE
+  assert struct.unpack('!HH', message[offset:offset + 4]) == (dns_providers.DNS_TYPE_SOA,
+                                                              dns_propagation.DNS_CLASS_IN)
+  offset += 4
+  updates = []
+  for i in range(upcount):
+    name, offset = dns_propagation.decode_name(message, offset)
+    rtype, rclass, ttl, rdlength = struct.unpack('!HHIH', message[offset:offset + 10])
+    offset += 10
+    target = dns_propagation.decode_name(message, offset)[0].rstrip('.') if rdlength else None
+    offset += rdlength
+    updates.append((name.rstrip('.'), rtype, rclass, ttl, target))
+  cname, any_class, in_class = (dns_propagation.DNS_TYPE_CNAME, dns_providers.DNS_CLASS_ANY,
+                                dns_propagation.DNS_CLASS_IN)
+  assert updates == [(NAME, cname, any_class, 0, None), (NAME, cname, in_class, 30, TARGET),
+                     ('www.acme.com', cname, any_class, 0, None),
+                     ('www.acme.com', cname, in_class, 30, NAME)]
+  assert offset == len(message)
+
+def test_change_is_served_once_synced(servers, providers):
+  server = servers()
+  server.set(NAME, 'west.acme.com')
+  provider = providers('internal', server)
+  change_id = provider.change([(NAME, TARGET)], 30)
+  assert server.updates == 1
+  assert server.cname(NAME) == TARGET
+  assert provider.synced(change_id)
+
+def test_signed_update_is_accepted(servers, providers):
+  server = servers(tsig_key_name=KEY_NAME, tsig_secret=SECRET)
+  provider = providers('internal', server, tsig_key_name=KEY_NAME, tsig_secret=SECRET)
+  provider.change([(NAME, TARGET)], 30)
+  assert (server.updates, server.refused) == (1, 0)
+  assert server.cname(NAME) == TARGET
+
+@pytest.mark.parametrize('options', [
+  {},
+  {'tsig_key_name': KEY_NAME, 'tsig_secret': base64.b64encode(b'another secret').decode()},
+  {'tsig_key_name': 'another-key', 'tsig_secret': SECRET},
+])
+def test_update_without_the_right_signature_is_refused(servers, providers, options):
+  server = servers(tsig_key_name=KEY_NAME, tsig_secret=SECRET)
+  provider = providers('internal', server, **options)
+  with pytest.raises(RuntimeError, match='NOTAUTH'):
+    provider.change([(NAME, TARGET)], 30)
+  assert (server.updates, server.refused) == (0, 1)
+  assert server.cname(NAME) == None
+
+def test_refused_update_raises(servers, providers):
+  server = servers(rcode=5)
+  provider = providers('internal', server)
+  with pytest.raises(RuntimeError, match='refused the update of acme.com: REFUSED'):
+    provider.change([(NAME, TARGET)], 30)
+  assert server.cname(NAME) == None
+
+def test_name_outside_the_zone_is_not_sent(servers, providers):
+  server = servers()
+  provider = providers('internal', server)
+  with pytest.raises(ValueError, match='not in the zone'):
+    provider.change([('vault.example.com', TARGET)], 30)
+  assert server.connections == 0
+
+def test_connection_is_kept_and_replaced_once_closed(servers, providers):
+  server = servers()
+  provider = providers('internal', server)
+  provider.change([(NAME, 'west.acme.com')], 30)
+  provider.change([(NAME, 'south.acme.com')], 30)
+  assert server.connections == 1
+  server.drop_connections()
+  provider.change([(NAME, TARGET)], 30)
+  assert server.connections == 2
+  assert server.updates == 3
+  assert server.cname(NAME) == TARGET
+
+def test_change_all_changes_every_provider_and_raises_the_error(servers, providers):
+  good = servers()
+  refusing = servers(rcode=5)
+  internal = providers('internal', good)
+  other = providers('other', refusing)
+  with pytest.raises(RuntimeError) as error:
+    dns_providers.change_all([other, internal], [(NAME, TARGET)], 30)
+  assert str(error.value).startswith('DNS provider ' + other.describe() + ':')
+  assert 'REFUSED' in str(error.value)
+  # The error of one provider does not stop the change in the others
+  assert good.cname(NAME) == TARGET
+
+def test_change_all_returns_the_change_of_each_provider(servers, providers):
+  first, second = servers(), servers()
+  changes = dns_providers.change_all([providers('first', first), providers('second', second)],
+                                     [(NAME, TARGET)], 30)
+  assert sorted(changes) == ['first', 'second']
+  assert first.cname(NAME) == TARGET and second.cname(NAME) == TARGET
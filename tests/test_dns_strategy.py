@@ -0,0 +1,44 @@
+#--------------------------------------------------------------------------------
+# """test_dns_strategy.py: Reading the DNS strategy from the config"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+import configparser
+import pytest
+from vault_dr import dns_strategy
+
+def read(**options):
+  config = configparser.ConfigParser()
+  config['DNS-Strategy'] = dict({'mode': 'failover-routing'}, **options)
+  return dns_strategy.from_config(config)
+
+def test_failover_routing_reads_the_health_check_settings():
+  strategy = read(health_check_interval='30', failure_threshold='2', low_ttl='20')
+  assert strategy.mode == dns_strategy.FAILOVER_ROUTING
+  assert strategy.health_check_interval == 30
+  assert strategy.failure_threshold == 2
+  assert strategy.max_staleness('vault.example.com') == 80
+
+@pytest.mark.parametrize('interval', ['5', '20', '60'])
+def test_health_check_interval_route53_rejects_fails_loading(interval):
+  with pytest.raises(ValueError, match='health_check_interval'):
+    read(health_check_interval=interval)
+
+@pytest.mark.parametrize('threshold', ['0', '11'])
+def test_failure_threshold_route53_rejects_fails_loading(threshold):
+  with pytest.raises(ValueError, match='failure_threshold'):
+    read(failure_threshold=threshold)
+
+def test_unknown_mode_fails_loading():
+  with pytest.raises(ValueError, match='unknown DNS strategy mode'):
+    read(mode='geo')
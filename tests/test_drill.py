@@ -0,0 +1,100 @@
+#--------------------------------------------------------------------------------
+# """test_drill.py: p95 RTO of drills against the baseline of a recorded
+#    results file"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+import json
+import pytest
+from vault_dr import drill
+
+# Three drills of prod and one of dev: the last one of prod failed, so the
+# baseline of prod is still drill b2 (p95 RTO 5.0 seconds)
+RECORDED = [
+  {'event': 'start', 'drill': 'b1', 'environment': 'prod', 'cycles': 1},
+  {'event': 'end', 'drill': 'b1', 'environment': 'prod', 'p95_rto': 4.0, 'passed': True},
+  {'event': 'start', 'drill': 'b2', 'environment': 'prod', 'cycles': 1},
+  {'event': 'end', 'drill': 'b2', 'environment': 'prod', 'p95_rto': 5.0, 'passed': True},
+  {'event': 'start', 'drill': 'd1', 'environment': 'dev', 'cycles': 1},
+  {'event': 'end', 'drill': 'd1', 'environment': 'dev', 'p95_rto': 1.0, 'passed': True},
+  {'event': 'start', 'drill': 'b3', 'environment': 'prod', 'cycles': 1},
+  {'event': 'end', 'drill': 'b3', 'environment': 'prod', 'p95_rto': 9.0, 'passed': False},
+]
+
+@pytest.fixture
+def results(tmp_path):
+  path = tmp_path / 'drills.jsonl'
+  path.write_text(''.join(json.dumps(record) + '\n' for record in RECORDED))
+  return drill.Results(str(path))
+
+def runs(*rtos):
+  return [{'cycle': index // 2 + 1, 'direction': ('failover', 'failback')[index % 2],
+           'ok': rto != None, 'rto': rto, 'total': rto, 'steps': {}}
+          for index, rto in enumerate(rtos)]
+
+def test_percentile_is_by_nearest_rank():
+  values = [float(value) for value in range(1, 21)]
+  assert drill.percentile(values, 50) == 10.0
+  assert drill.percentile(values, 95) == 19.0
+  assert drill.percentile(values, 100) == 20.0
+  assert drill.percentile([3.0], 95) == 3.0
+
+def test_baseline_is_the_last_passing_drill_of_the_environment(results):
+  assert results.baseline('prod')['drill'] == 'b2'
+  assert results.baseline('dev')['drill'] == 'd1'
+  assert results.baseline('test') == None
+  # A drill is never its own baseline
+  assert results.baseline('prod', drill_id='b2')['drill'] == 'b1'
+
+def test_drill_within_the_tolerance_passes(results):
+  # p95 of 5.8 is within 20% of 5.0
+  summary = drill.summarize(runs(4.0, 5.8, 4.5, 5.0), results.baseline('prod'), 0.2)
+  assert summary['p95_rto'] == 5.8
+  assert summary['baseline_p95_rto'] == 5.0
+  assert summary['baseline_drill'] == 'b2'
+  assert not summary['regressed']
+  assert summary['passed']
+
+def test_drill_beyond_the_tolerance_regresses(results):
+  # p95 of 6.5 is more than 20% above 5.0 but within 40%
+  summary = drill.summarize(runs(4.0, 6.5, 4.5, 5.0), results.baseline('prod'), 0.2)
+  assert summary['p95_rto'] == 6.5
+  assert summary['regressed']
+  assert not summary['passed']
+  assert not drill.summarize(runs(4.0, 6.5), results.baseline('prod'), 0.4)['regressed']
+
+def test_failed_run_fails_the_drill_without_counting_in_the_p95(results):
+  summary = drill.summarize(runs(4.0, None, 4.5), results.baseline('prod'), 0.2)
+  assert summary['runs'] == 3 and summary['succeeded'] == 2
+  assert summary['p95_rto'] == 4.5
+  assert not summary['regressed']
+  assert not summary['passed']
+
+def test_first_drill_has_no_baseline(results):
+  summary = drill.summarize(runs(30.0), results.baseline('test'), 0.2)
+  assert summary['baseline_p95_rto'] == None
+  assert not summary['regressed']
+  assert summary['passed']
+  assert not drill.summarize([], None, problem='no steady state')['passed']
+
+def test_recorded_drill_becomes_the_next_baseline(results):
+  drill_id = results.start('prod', 2)
+  drill_runs = runs(4.0, 4.2)
+  for run in drill_runs:
+    results.run(drill_id, 'prod', run['cycle'], run['direction'], run['ok'], run['rto'],
+                run['total'], run['steps'])
+  summary = drill.summarize(drill_runs, results.baseline('prod', drill_id), 0.2)
+  results.end(drill_id, 'prod', summary)
+  assert summary['passed']
+  assert results.baseline('prod')['drill'] == drill_id
+  assert results.baseline('prod')['p95_rto'] == 4.2
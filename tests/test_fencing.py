@@ -0,0 +1,58 @@
+#--------------------------------------------------------------------------------
+# """test_fencing.py: Place of the fence in the steps of a run"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+import configparser, os
+import pytest
+import run_vault_dr
+from vault_dr import fencing
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'vault_dr.cfg')
+
+def planned_steps(mode):
+  config = configparser.RawConfigParser()
+  config.read(CONFIG_FILE)
+  config.set('Fencing', 'mode', mode)
+  if mode == fencing.HOOK:
+    config.set('Fencing', 'hook', 'true')
+  controller = run_vault_dr.DRController('token', None, None, CONFIG_FILE)
+  controller.load_config(config)
+  pair = list(controller.cluster_pairs.values())[0]
+  return dict((step['name'], step['depends_on']) for step in controller.planned_steps(pair))
+
+def ancestors(steps, name):
+  found = set()
+  pending = list(steps[name])
+  while pending:
+    dependency = pending.pop()
+    if dependency not in found:
+      found.add(dependency)
+      pending += steps[dependency]
+  return found
+
+def test_shipped_config_does_not_fence():
+  config = configparser.RawConfigParser()
+  config.read(CONFIG_FILE)
+  assert fencing.from_config(config) == None
+
+@pytest.mark.parametrize('mode', [fencing.OFF, fencing.DEMOTE, fencing.HOOK])
+def test_step_5_waits_for_dns(mode):
+  steps = planned_steps(mode)
+  for name in ('5-A', '5-C', '5-D', '5-E'):
+    assert '4-wait' in ancestors(steps, name)
+
+def test_demote_fence_starts_with_the_promotion():
+  steps = planned_steps(fencing.DEMOTE)
+  assert steps['fence'] == ['3-E', 'probe']
+  assert 'fence' in steps['5-A']
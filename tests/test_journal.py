@@ -0,0 +1,125 @@
+#--------------------------------------------------------------------------------
+# """test_journal.py: Resuming a run from the journal and checking it against
+#    the live state of the clusters"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+import json
+import pytest
+import run_vault_dr
+from mock_vault import MockVaultCluster
+from mock_route53 import StubRoute53
+from vault_dr import events, http_pool, tracing
+from vault_dr import journal as dr_journal
+from vault_dr.scheduler import StepScheduler
+
+CNAME = 'vault.test.acme.com'
+RECONCILE_CONFIG = {'probe_interval': 0.05, 'probe_timeout': 2, 'max_wait': 10}
+
+@pytest.fixture(autouse=True)
+def quiet_events():
+  events.logger.configure('', False)
+  tracing.tracer.reset()
+
+@pytest.fixture
+def journal(tmp_path):
+  return dr_journal.Journal(str(tmp_path / 'journal.jsonl'))
+
+@pytest.fixture
+def clusters(monkeypatch):
+  for i in range(1, 4):
+    monkeypatch.setenv('VAULT_RECOVERY_KEY_' + str(i), 'test-recovery-key-' + str(i))
+  monkeypatch.delenv('VAULT_DR_OPERATION_TOKEN', raising=False)
+  primary = MockVaultCluster('west', 'primary', latency=0.0).start()
+  secondary = MockVaultCluster('east', 'secondary', latency=0.0).start()
+  sessions = http_pool.SessionPool()
+  yield primary, secondary, sessions
+  sessions.close()
+  primary.stop()
+  secondary.stop()
+
+def steps():
+  scheduler = StepScheduler()
+  run_vault_dr.add_steps(scheduler, run_vault_dr.DRRun('test', 'https://west', 'https://east',
+                                                       CNAME, 'ZTEST', '', None, [], 1, 60, None))
+  return scheduler
+
+def resumed(committed):
+  return dr_journal.plan_resume(steps(), committed, run_vault_dr.RESUMABLE_STEPS, ['probe'])
+
+def test_committed_resumable_steps_are_not_run_again():
+  committed = dict((name, {}) for name in ('3-A', '3-B', '3-C', '3-D', '3-E', '4'))
+  assert sorted(resumed(committed)) == ['3-A', '3-B', '3-C', '3-D', '3-E', '4']
+
+def test_steps_whose_outputs_were_not_journalled_run_again():
+  # The operation token of Step 3-D is not in the journal, so Step 3-C runs
+  # again for it, and so do the steps it depends on
+  assert resumed(dict((name, {}) for name in ('3-A', '3-B', '3-C'))) == []
+  # Step 5-A demoted the old primary for good, Steps 5-C/5-D still need it
+  committed = dict((name, {}) for name in ('3-A', '3-B', '3-C', '3-D', '3-E', '4', '4-wait', '5-A'))
+  assert 'probe' not in resumed(committed)
+  assert '5-A' in resumed(committed)
+  assert '5-C' not in resumed(committed)
+
+def test_truncated_last_line_is_ignored_and_does_not_swallow_the_next_record(journal):
+  run_id = journal.start('test', 'https://west', 'https://east', CNAME)
+  journal.commit(run_id, 'test', '3-A')
+  journal.commit(run_id, 'test', '3-E')
+  # The script died in the middle of writing the record of Step 4
+  with open(journal.path, 'rb+') as f:
+    data = f.read()
+    f.seek(0)
+    f.truncate()
+    f.write(data[:-20])
+  assert journal.last_run('test', 'https://west', 'https://east') == (run_id, {'3-A': {}}, False)
+  journal.commit(run_id, 'test', '4', {'changes': {'route53': 'C1'}})
+  assert journal.last_run('test', 'https://west', 'https://east') == (
+    run_id, {'3-A': {}, '4': {'changes': {'route53': 'C1'}}}, False)
+
+def test_last_run_only_resumes_the_same_direction(journal):
+  run_id = journal.start('test', 'https://west', 'https://east', CNAME)
+  journal.commit(run_id, 'test', '3-E')
+  assert journal.last_run('test', 'https://east', 'https://west') == (None, {}, False)
+  journal.end(run_id, 'test')
+  assert journal.last_run('test', 'https://west', 'https://east') == (run_id, {'3-E': {}}, True)
+
+def resume(clusters, journal):
+  primary, secondary, sessions = clusters
+  scheduler = StepScheduler()
+  run_vault_dr.run_dr('test', primary.url, secondary.url, CNAME, 'ZTEST', 'token', StubRoute53(),
+                      [], 0.01, 10, sessions, RECONCILE_CONFIG, scheduler=scheduler,
+                      journal=journal, resume=True)
+  return scheduler
+
+def test_promotion_missing_from_the_journal_is_committed_from_the_live_state(clusters, journal):
+  primary, secondary, sessions = clusters
+  run_id = journal.start('test', primary.url, secondary.url, CNAME)
+  for step in ('3-A', '3-B', '3-C', '3-D'):
+    journal.commit(run_id, 'test', step)
+  # Step 3-E went through just before the script died
+  secondary.reset('primary')
+  scheduler = resume(clusters, journal)
+  assert scheduler.steps['3-E'].restored
+  records = [json.loads(line) for line in open(journal.path)]
+  assert {'step': '3-E', 'source': 'live-state'}.items() <= records[5].items()
+  assert records[-1]['event'] == 'end'
+  assert (primary.mode, secondary.mode) == ('secondary', 'primary')
+
+def test_promotion_the_new_primary_does_not_show_aborts_the_resume(clusters, journal):
+  primary, secondary, sessions = clusters
+  run_id = journal.start('test', primary.url, secondary.url, CNAME)
+  for step in ('3-A', '3-B', '3-C', '3-D', '3-E'):
+    journal.commit(run_id, 'test', step)
+  with pytest.raises(SystemExit):
+    resume(clusters, journal)
+  assert (primary.mode, secondary.mode) == ('primary', 'secondary')
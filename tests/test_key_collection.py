@@ -0,0 +1,142 @@
+#--------------------------------------------------------------------------------
+# """test_key_collection.py: Collection of recovery keys from scripted
+#    custodians over the key collection socket"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# Every custodian is a thread that sends its key with submit_key, as
+# run_vault_dr.py --submit-key does, and keeps the messages it got back. Vault
+# is a function that counts the keys of the attempt.
+#--------------------------------------------------------------------------------
+import threading, time
+import pytest
+from vault_dr import daemon, events, key_collection
+
+REQUIRED = 3
+
+class Vault:
+
+  def __init__(self, latency=0.2):
+    self.latency = latency
+    self.keys = []
+    self.lock = threading.Lock()
+
+  def submit(self, key):
+    time.sleep(self.latency)
+    with self.lock:
+      self.keys.append(key)
+      progress = len(self.keys)
+    return {'progress': progress, 'required': REQUIRED, 'complete': progress >= REQUIRED,
+            'encoded_token': 'token' if progress >= REQUIRED else ''}
+
+class Custodian(threading.Thread):
+
+  def __init__(self, collector, token, key, run='prod'):
+    threading.Thread.__init__(self, daemon=True)
+    self.collector = collector
+    self.token = token
+    self.key = key
+    self.run_name = run
+    self.messages = []
+
+  def run(self):
+    key_collection.submit_key(self.collector.server.socket_path, self.token, self.run_name,
+                              self.key, 'custodian of ' + self.key, self.messages.append)
+
+@pytest.fixture
+def collector(tmp_path):
+  events.logger.configure('', False)
+  collector = key_collection.KeyCollector(str(tmp_path / 'keys.sock'), str(tmp_path / 'keys.token'),
+                                          timeout=5).start()
+  collector.token = daemon.read_token(str(tmp_path / 'keys.token'))
+  yield collector
+  collector.stop()
+
+def attempt():
+  return {'nonce': 'nonce', 'required': REQUIRED, 'progress': 0, 'complete': False}
+
+def custodians(collector, keys, token=None):
+  started = [Custodian(collector, token or collector.token, key) for key in keys]
+  for custodian in started:
+    custodian.start()
+  return started
+
+def test_concurrent_custodians_complete_the_token(collector):
+  vault = Vault()
+  collection = collector.open('prod', attempt(), vault.submit)
+  # Custodians who are early wait for the collection to open
+  started = custodians(collector, ['key-1', 'key-2', 'key-3'])
+  start = time.monotonic()
+  final = collection.wait(5)
+  seconds = time.monotonic() - start
+  collector.close('prod')
+  for custodian in started:
+    custodian.join(5)
+  assert final['encoded_token'] == 'token'
+  assert sorted(collection.keys) == ['key-1', 'key-2', 'key-3']
+  # The keys were submitted to Vault at the same time, not one after the other
+  assert seconds < REQUIRED * vault.latency
+  for custodian in started:
+    assert custodian.messages[0]['accepted'] == True
+    assert custodian.messages[-1]['progress'] == REQUIRED
+    assert custodian.messages[-1]['complete'] == True
+
+def test_wrong_token_is_rejected(collector):
+  vault = Vault()
+  collection = collector.open('prod', attempt(), vault.submit)
+  custodian = custodians(collector, ['key-1'], 'wrong-token')[0]
+  custodian.join(5)
+  assert custodian.messages == [{'error': 'permission denied'}]
+  assert vault.keys == []
+  assert collection.progress == 0
+
+def test_duplicate_key_is_rejected(collector):
+  vault = Vault()
+  collection = collector.open('prod', attempt(), vault.submit)
+  first = custodians(collector, ['key-1'])[0]
+  collection.wait_for_change(0, 5)
+  second = custodians(collector, ['key-1'])[0]
+  second.join(5)
+  assert second.messages == [{'error': 'this key has already been provided'}]
+  assert vault.keys == ['key-1']
+  # The first custodian sees the progress until the collection closes
+  collector.close('prod')
+  first.join(5)
+  assert not first.is_alive()
+  assert first.messages[0] == {'accepted': True, 'progress': 1, 'required': REQUIRED,
+                               'complete': False}
+
+def test_collection_times_out_without_enough_keys(collector):
+  vault = Vault()
+  collection = collector.open('prod', attempt(), vault.submit)
+  started = custodians(collector, ['key-1', 'key-2'])
+  start = time.monotonic()
+  assert collection.wait(0.5) == None
+  assert time.monotonic() - start >= 0.5
+  assert collection.progress == 2
+  collector.close('prod')
+  for custodian in started:
+    custodian.join(5)
+    assert not custodian.is_alive()
+
+def test_custodian_gives_up_when_no_collection_opens(tmp_path):
+  events.logger.configure('', False)
+  collector = key_collection.KeyCollector(str(tmp_path / 'keys.sock'), str(tmp_path / 'keys.token'),
+                                          timeout=0.2).start()
+  try:
+    answer = key_collection.submit_key(collector.server.socket_path,
+                                       daemon.read_token(str(tmp_path / 'keys.token')), 'prod',
+                                       'key-1', 'alice')
+  finally:
+    collector.stop()
+  assert answer == {'error': 'no recovery key collection open for prod'}
@@ -0,0 +1,161 @@
+#--------------------------------------------------------------------------------
+# """test_multi_pair.py: CNAME batching window, leader/follower handoff and
+#    failure isolation of concurrent pairs"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+import sys, threading, time
+import pytest
+from vault_dr import events
+from vault_dr.multi_pair import ClusterPair, CnameBatcher, run_pairs
+
+@pytest.fixture(autouse=True)
+def quiet_events():
+  events.logger.configure('', False)
+  yield
+  events.flush()
+  events.logger.configure('', False)
+
+class Zone:
+
+  def __init__(self, error=None):
+    self.calls = []
+    self.error = error
+    self.lock = threading.Lock()
+
+  def update_records(self, key, records):
+    with self.lock:
+      self.calls.append((key, sorted(records), time.monotonic()))
+      if self.error != None:
+        raise self.error
+      return 'change-' + str(len(self.calls))
+
+def submit_all(batcher, key, sources, delay=0.0):
+  results = {}
+  def submit(source):
+    try:
+      results[source] = batcher.submit(key, source, source + '.target')
+    except Exception as e:
+      results[source] = e
+  threads = []
+  for source in sources:
+    thread = threading.Thread(target=submit, args=(source,))
+    thread.start()
+    threads.append(thread)
+    time.sleep(delay)
+  for thread in threads:
+    thread.join(5)
+  return results
+
+def test_batch_is_sent_once_every_expected_pair_submitted():
+  zone = Zone()
+  batcher = CnameBatcher(zone.update_records, window=5.0)
+  batcher.expect('ZONE', 3)
+  start = time.monotonic()
+  results = submit_all(batcher, 'ZONE', ['a', 'b', 'c'], delay=0.05)
+  assert time.monotonic() - start < 1.0
+  assert len(zone.calls) == 1
+  assert zone.calls[0][1] == [('a', 'a.target'), ('b', 'b.target'), ('c', 'c.target')]
+  # The followers get the change ID of the leader's change
+  assert results == {'a': 'change-1', 'b': 'change-1', 'c': 'change-1'}
+
+def test_batch_is_sent_when_the_window_closes():
+  zone = Zone()
+  batcher = CnameBatcher(zone.update_records, window=0.3)
+  batcher.expect('ZONE', 3)
+  start = time.monotonic()
+  results = submit_all(batcher, 'ZONE', ['a', 'b'])
+  elapsed = time.monotonic() - start
+  assert 0.3 <= elapsed < 1.0
+  assert len(zone.calls) == 1
+  assert results == {'a': 'change-1', 'b': 'change-1'}
+
+def test_withdrawn_pair_releases_the_window():
+  zone = Zone()
+  batcher = CnameBatcher(zone.update_records, window=5.0)
+  batcher.expect('ZONE', 2)
+  threading.Timer(0.1, batcher.withdraw, ('ZONE', 'b')).start()
+  start = time.monotonic()
+  results = submit_all(batcher, 'ZONE', ['a'])
+  assert time.monotonic() - start < 1.0
+  assert results == {'a': 'change-1'}
+
+def test_zones_are_batched_separately():
+  zone = Zone()
+  batcher = CnameBatcher(zone.update_records, window=5.0)
+  batcher.expect('ZONE-1')
+  batcher.expect('ZONE-2')
+  results = submit_all(batcher, 'ZONE-1', ['a'])
+  results.update(submit_all(batcher, 'ZONE-2', ['b']))
+  assert [call[0] for call in zone.calls] == ['ZONE-1', 'ZONE-2']
+  assert results == {'a': 'change-1', 'b': 'change-2'}
+
+def test_error_of_the_leader_is_raised_in_every_pair():
+  error = RuntimeError('Throttling')
+  zone = Zone(error)
+  batcher = CnameBatcher(zone.update_records, window=5.0)
+  batcher.expect('ZONE', 3)
+  results = submit_all(batcher, 'ZONE', ['a', 'b', 'c'], delay=0.05)
+  assert len(zone.calls) == 1
+  assert results == {'a': error, 'b': error, 'c': error}
+
+def test_failing_pair_does_not_fail_the_others():
+  pairs = [ClusterPair(name, name + '-primary', name + '-secondary', 'vault.example.com',
+                       'ZONE') for name in ('ok', 'error', 'exit')]
+  failed = []
+  def run_pair(pair):
+    time.sleep(0.05)
+    if pair.name == 'error':
+      raise RuntimeError('sealed')
+    if pair.name == 'exit':
+      sys.exit(1)
+    return pair.name + ' done'
+  results = run_pairs(pairs, run_pair, max_concurrency=3,
+                      on_failure=lambda pair: failed.append(pair.name))
+  assert results['ok'] == (True, 'ok done')
+  assert results['error'][0] == False and isinstance(results['error'][1], RuntimeError)
+  assert results['exit'][0] == False and isinstance(results['exit'][1], SystemExit)
+  assert sorted(failed) == ['error', 'exit']
+
+def test_pairs_run_concurrently_up_to_the_limit():
+  pairs = [ClusterPair(str(index), 'primary', 'secondary', 'vault.example.com', 'ZONE')
+           for index in range(4)]
+  running = []
+  peak = []
+  lock = threading.Lock()
+  def run_pair(pair):
+    with lock:
+      running.append(pair.name)
+      peak.append(len(running))
+    time.sleep(0.1)
+    with lock:
+      running.remove(pair.name)
+  results = run_pairs(pairs, run_pair, max_concurrency=2)
+  assert max(peak) == 2
+  assert all(ok for ok, result in results.values())
+
+def test_reversed_pair_keeps_the_configured_secondary_id():
+  pair = ClusterPair('prod', 'east.example.com', 'west.example.com', 'vault.example.com',
+                     'ZONE', secondary_id='3', dns_providers=['internal'])
+  failback = pair.reversed()
+  assert failback.primary_vault_cluster_domain == 'west.example.com'
+  assert failback.secondary_vault_cluster_domain == 'east.example.com'
+  assert failback.secondary_id == '3'
+  assert failback.dns_providers == ['internal']
+  assert failback.reversed().secondary_id == '3'
+
+def test_reversed_pair_derives_the_secondary_id_from_its_primary():
+  pair = ClusterPair('prod', 'east.example.com', 'west.example.com', 'vault.example.com',
+                     'ZONE')
+  assert pair.secondary_id == 'east'
+  assert pair.reversed().secondary_id == 'west'
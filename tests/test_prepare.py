@@ -0,0 +1,92 @@
+#--------------------------------------------------------------------------------
+# """test_prepare.py: Prepare phase of a run without a preparation of the
+#    daemon, inside the run and alongside Steps 3-A and 3-B"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+import configparser, os
+import pytest
+import run_vault_dr
+import mock_vault
+from mock_vault import MockVaultCluster
+from mock_route53 import StubRoute53
+from vault_dr import events, http_pool, prepare, tracing
+from vault_dr.scheduler import StepScheduler
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'vault_dr.cfg')
+RECONCILE_CONFIG = {'probe_interval': 0.05, 'probe_timeout': 2, 'max_wait': 10}
+
+@pytest.fixture
+def clusters(monkeypatch):
+  events.logger.configure('', False)
+  for i in range(1, 4):
+    monkeypatch.setenv('VAULT_RECOVERY_KEY_' + str(i), 'test-recovery-key-' + str(i))
+  monkeypatch.delenv('VAULT_DR_OPERATION_TOKEN', raising=False)
+  primary = MockVaultCluster('west', 'primary', latency=0.0).start()
+  secondary = MockVaultCluster('east', 'secondary', latency=0.0).start()
+  sessions = http_pool.SessionPool()
+  yield primary, secondary, sessions
+  sessions.close()
+  primary.stop()
+  secondary.stop()
+
+def run(clusters, prepare_in_run=True):
+  primary, secondary, sessions = clusters
+  scheduler = StepScheduler()
+  tracing.tracer.reset()
+  run_vault_dr.run_dr('test', primary.url, secondary.url, 'vault.test.acme.com', 'ZTEST', 'token',
+                      StubRoute53(), [], 0.01, 10, sessions, RECONCILE_CONFIG,
+                      scheduler=scheduler, prepare_in_run=prepare_in_run)
+  return scheduler
+
+def attempts():
+  return [span for span in tracing.tracer.finished(tracing.HTTP)
+          if span.attributes.get('verb') == 'POST' and
+          span.attributes.get('url', '').endswith('/generate-operation-token/attempt')]
+
+def test_run_prepares_alongside_step_3(clusters):
+  scheduler = run(clusters)
+  prepared = scheduler.steps['prepare']
+  assert prepared.depends_on == ()
+  assert 'prepare' in scheduler.steps['3-C'].depends_on
+  # The prepare phase is timed in the span of the run
+  run_span = tracing.tracer.finished(tracing.RUN)[-1]
+  assert run_span.start <= prepared.start and prepared.end <= run_span.end
+  # Without a batch token, Steps 3-C and 5-C still generate operation tokens
+  assert len(attempts()) == 2
+
+def test_run_with_a_batch_token_waits_for_the_probe_only(clusters, monkeypatch):
+  monkeypatch.setenv('VAULT_DR_OPERATION_TOKEN', mock_vault.issue_batch_token(3600))
+  scheduler = run(clusters)
+  assert scheduler.steps['prepare'].depends_on == ('probe',)
+  assert attempts() == []
+
+def test_run_without_prepare_has_no_prepare_step(clusters):
+  scheduler = run(clusters, prepare_in_run=False)
+  assert 'prepare' not in scheduler.steps
+  assert scheduler.steps['3-C'].depends_on == ('3-A', '3-B')
+
+def test_only_a_fresh_preparation_of_the_same_direction_is_reused():
+  config = configparser.RawConfigParser()
+  config.read(CONFIG_FILE)
+  controller = run_vault_dr.DRController('token', None, None, CONFIG_FILE)
+  controller.load_config(config)
+  pair = list(controller.cluster_pairs.values())[0]
+  assert controller.fresh_preparation(pair) == None
+  preparation = prepare.Preparation(pair.name, pair.primary_vault_cluster_domain,
+                                    pair.secondary_vault_cluster_domain)
+  controller.prepared[pair.name] = preparation
+  assert controller.fresh_preparation(pair) is preparation
+  assert controller.fresh_preparation(pair.reversed()) == None
+  preparation.prepared_at -= controller.prepare_max_age + 1
+  assert controller.fresh_preparation(pair) == None
@@ -0,0 +1,149 @@
+#--------------------------------------------------------------------------------
+# """test_retry_policy.py: Classification of failed Vault API calls and the
+#    deadlines of http_request"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+import socket, time
+import pytest
+import requests
+import run_vault_dr
+from mock_vault import MockVaultCluster
+from vault_dr import events, retry_policy, tracing
+from vault_dr.retry_policy import FAIL_FAST, RETRY, RETRY_OTHER_NODE
+
+STATUS_PATH = '/v1/sys/replication/dr/status'
+
+@pytest.fixture(autouse=True)
+def quiet_events():
+  events.logger.configure('', False)
+  tracing.tracer.reset()
+
+@pytest.fixture
+def cluster():
+  cluster = MockVaultCluster('west', 'primary', latency=0.0).start()
+  yield cluster
+  cluster.stop()
+
+@pytest.fixture
+def silent_node():
+  # Takes connections into its backlog and never answers them
+  sock = socket.socket()
+  sock.bind(('127.0.0.1', 0))
+  sock.listen(16)
+  yield 'http://127.0.0.1:%d' % sock.getsockname()[1]
+  sock.close()
+
+def closed_port():
+  sock = socket.socket()
+  sock.bind(('127.0.0.1', 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return 'http://127.0.0.1:%d' % port
+
+def policy(**options):
+  settings = dict(connect_timeout=0.5, read_timeout=0.3, base_delay=0.02, max_delay=0.1,
+                  step_timeout=5)
+  settings.update(options)
+  return retry_policy.RetryPolicy(**settings)
+
+def http_error(status):
+  response = requests.models.Response()
+  response.status_code = status
+  return requests.exceptions.HTTPError(response=response), response
+
+def request(url, deadline, verb=run_vault_dr.GET, hdrs=None):
+  return run_vault_dr.http_request(None, verb, url, {}, hdrs or {}, deadline, abort=False)
+
+def retries():
+  return [span.attributes['retries'] for span in tracing.tracer.finished(tracing.HTTP)]
+
+@pytest.mark.parametrize('status, error_class', [(400, FAIL_FAST), (403, FAIL_FAST),
+                                                 (404, FAIL_FAST), (500, RETRY), (503, RETRY)])
+def test_http_errors(status, error_class):
+  assert policy().classify(*http_error(status)) == error_class
+
+@pytest.mark.parametrize('error, verb, error_class', [
+  (requests.exceptions.ConnectionError(), 'POST', RETRY),
+  (requests.exceptions.ConnectTimeout(), 'POST', RETRY_OTHER_NODE),
+  (requests.exceptions.ReadTimeout(), 'GET', RETRY_OTHER_NODE),
+  (requests.exceptions.ReadTimeout(), 'DELETE', RETRY_OTHER_NODE),
+  # Vault may have applied a promote, demote or update-primary that timed out
+  (requests.exceptions.ReadTimeout(), 'POST', FAIL_FAST),
+  (requests.exceptions.InvalidURL(), 'GET', FAIL_FAST),
+])
+def test_errors(error, verb, error_class):
+  assert policy().classify(error, None, verb) == error_class
+
+def test_4xx_fails_fast(cluster):
+  cluster.inject_fault(STATUS_PATH, 403, 1)
+  with pytest.raises(requests.exceptions.HTTPError):
+    request(cluster.url + STATUS_PATH, policy().step_deadline('test'))
+  assert retries() == [0]
+
+def test_5xx_is_retried(cluster):
+  cluster.inject_fault(STATUS_PATH, 503, 2)
+  answer = request(cluster.url + STATUS_PATH, policy().step_deadline('test'))
+  assert answer['data']['mode'] == 'primary'
+  assert retries() == [2]
+
+def test_connection_error_is_retried_until_the_deadline():
+  retry = policy(step_timeout=0.5)
+  deadline = retry.step_deadline('test')
+  with pytest.raises(requests.exceptions.ConnectionError):
+    request(closed_port() + STATUS_PATH, deadline)
+  assert retries()[0] > 1
+  # The last delay would have run past the deadline, so it was not slept
+  assert 0 <= deadline.remaining() < retry.max_delay + retry.base_delay
+
+def test_timeout_is_retried_on_another_node(cluster, silent_node):
+  class Nodes:
+    tried = []
+    def other_node(self, url, tried):
+      Nodes.tried.append(url)
+      return cluster.url + STATUS_PATH, 'vault.acme.com'
+  retry = policy()
+  retry.nodes = Nodes()
+  answer = request(silent_node + STATUS_PATH, retry.step_deadline('test'))
+  assert answer['data']['mode'] == 'primary'
+  assert Nodes.tried == [silent_node + STATUS_PATH]
+  assert retries() == [1]
+
+def test_post_that_timed_out_is_not_sent_again(silent_node):
+  retry = policy()
+  with pytest.raises(requests.exceptions.ReadTimeout):
+    request(silent_node + '/v1/sys/replication/dr/secondary/promote', retry.step_deadline('test'),
+            run_vault_dr.POST)
+  assert retries() == [0]
+
+def test_other_node_is_another_address_of_the_host():
+  nodes = retry_policy.NodeSelector()
+  nodes.addresses['vault.acme.com'] = ['10.0.0.1', '10.0.0.2']
+  tried = set()
+  url = 'https://vault.acme.com:8200' + STATUS_PATH
+  assert nodes.other_node(url, tried) == ('https://10.0.0.1:8200' + STATUS_PATH,
+                                          'vault.acme.com:8200')
+  assert nodes.other_node(url, tried) == ('https://10.0.0.2:8200' + STATUS_PATH,
+                                          'vault.acme.com:8200')
+  assert nodes.other_node(url, tried) == (url, None)
+
+def test_timeouts_and_backoff_are_capped_by_the_deadline():
+  retry = policy(connect_timeout=3, read_timeout=10, step_timeout=0.2)
+  deadline = retry.step_deadline('test')
+  connect, read = retry.timeouts(deadline)
+  assert connect <= 0.2 and read <= 0.2
+  # A step deadline never passes the run deadline
+  run_deadline = retry_policy.Deadline(0.05)
+  assert retry.step_deadline('test', run_deadline).expires == run_deadline.expires
+  for previous in (0, 0.05, 1, 10):
+    assert retry.base_delay <= retry.next_delay(previous) <= retry.max_delay
@@ -0,0 +1,145 @@
+#--------------------------------------------------------------------------------
+# """test_scheduler.py: Order, conditions, failures and critical path of the
+#    step DAG"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+import sys, threading, time
+import pytest
+from vault_dr import events
+from vault_dr.scheduler import StepScheduler
+
+@pytest.fixture(autouse=True)
+def quiet_events():
+  events.logger.configure('', False)
+  yield
+  events.flush()
+  events.logger.configure('', False)
+
+class Recorder:
+
+  def __init__(self):
+    self.started = []
+    self.lock = threading.Lock()
+
+  def action(self, name, seconds=0.0, result=True):
+    def run():
+      with self.lock:
+        self.started.append(name)
+      time.sleep(seconds)
+      return result
+    return run
+
+def test_steps_start_once_their_dependencies_are_done():
+  recorder = Recorder()
+  scheduler = StepScheduler()
+  scheduler.add('A', recorder.action('A', 0.1))
+  scheduler.add('B', recorder.action('B', 0.1))
+  scheduler.add('C', recorder.action('C'), ['A'])
+  scheduler.add('D', recorder.action('D'), ['B', 'C'])
+  scheduler.run()
+  steps = scheduler.steps
+  assert steps['C'].start >= steps['A'].end
+  assert steps['D'].start >= max(steps['B'].end, steps['C'].end)
+  # Independent steps overlap
+  assert steps['B'].start < steps['A'].end
+  assert recorder.started.index('D') == 3
+
+def test_unknown_dependency_is_rejected():
+  scheduler = StepScheduler()
+  with pytest.raises(ValueError, match='unknown step B'):
+    scheduler.add('A', lambda: None, ['B'])
+
+def test_false_condition_skips_the_step_and_its_dependents():
+  recorder = Recorder()
+  scheduler = StepScheduler()
+  scheduler.add('A', recorder.action('A'))
+  scheduler.add('B', recorder.action('B'), ['A'], condition=lambda: False)
+  scheduler.add('C', recorder.action('C'), ['B'])
+  scheduler.add('D', recorder.action('D'), ['A'], condition=lambda: True)
+  scheduler.run()
+  assert sorted(recorder.started) == ['A', 'D']
+  assert scheduler.steps['B'].skipped and scheduler.steps['C'].skipped
+  assert not scheduler.steps['D'].skipped
+
+def test_false_result_is_kept_and_dependents_still_run():
+  recorder = Recorder()
+  scheduler = StepScheduler()
+  scheduler.add('verify', recorder.action('verify', result=False))
+  scheduler.add('after', recorder.action('after'), ['verify'])
+  scheduler.run()
+  assert scheduler.result('verify') == False
+  assert not scheduler.steps['verify'].failed
+  assert scheduler.result('after') == True
+
+def test_exit_stops_new_steps_and_is_raised_once_running_steps_finish():
+  recorder = Recorder()
+  scheduler = StepScheduler()
+  def abort():
+    time.sleep(0.05)
+    sys.exit()
+  scheduler.add('abort', abort)
+  scheduler.add('slow', recorder.action('slow', 0.2))
+  scheduler.add('after-abort', recorder.action('after-abort'), ['abort'])
+  scheduler.add('after-slow', recorder.action('after-slow'), ['slow'])
+  with pytest.raises(SystemExit):
+    scheduler.run()
+  assert recorder.started == ['slow']
+  assert scheduler.steps['abort'].failed
+  # The running step was waited for
+  assert scheduler.steps['slow'].end != None and scheduler.run_end >= scheduler.steps['slow'].end
+
+def test_error_is_raised_in_the_calling_thread():
+  scheduler = StepScheduler()
+  def fail():
+    raise RuntimeError('step failed')
+  scheduler.add('fail', fail)
+  with pytest.raises(RuntimeError, match='step failed'):
+    scheduler.run()
+
+def test_restored_step_counts_as_done():
+  recorder = Recorder()
+  scheduler = StepScheduler()
+  scheduler.add('A', recorder.action('A'))
+  scheduler.add('B', recorder.action('B'), ['A'])
+  scheduler.restore('A')
+  scheduler.run()
+  assert recorder.started == ['B']
+
+def scheduled(durations, dependencies):
+  scheduler = StepScheduler()
+  for name, seconds in durations:
+    scheduler.add(name, lambda: None, dependencies.get(name, ()))
+    scheduler.steps[name].start, scheduler.steps[name].end = 10.0, 10.0 + seconds
+  scheduler.run_start, scheduler.run_end = 10.0, 15.0
+  return scheduler
+
+def test_critical_path_and_slack():
+  scheduler = scheduled([('A', 1.0), ('B', 3.0), ('C', 1.0), ('D', 0.5)],
+                        {'C': ['A', 'B'], 'D': ['A']})
+  path, slack = scheduler.critical_path()
+  assert path == ['B', 'C']
+  assert slack == pytest.approx({'A': 2.0, 'B': 0.0, 'C': 0.0, 'D': 2.5})
+
+def test_report_marks_the_critical_path(capsys):
+  events.logger.configure('', True)
+  scheduler = scheduled([('A', 1.0), ('B', 3.0), ('C', 1.0)], {'C': ['A', 'B']})
+  scheduler.steps['A'].skipped = True
+  scheduler.report()
+  events.flush()
+  output = capsys.readouterr().out
+  assert 'Critical path: B -> C (4.000 of 5.000 seconds)' in output
+  lines = dict((line.split()[0], line.split()[1:]) for line in output.splitlines()
+               if line.split() and line.split()[0] in ('A', 'B', 'C'))
+  assert lines['A'][:3] == ['-', 'skipped', '-']
+  assert lines['B'][0] == '*' and lines['C'][0] == '*'
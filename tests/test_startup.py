@@ -0,0 +1,45 @@
+#--------------------------------------------------------------------------------
+# """test_startup.py: Import budget of the entry points of run_vault_dr.py"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+# Runs each entry point of bench_startup.py (--help, a usage error, --trigger,
+# --submit-key, plan, plan --diff and execute) with "python -X importtime" in
+# a new process, as bench_startup.py does, and fails if boto3 or requests show
+# up in its import trace or if the median import time of a few runs is over
+# the budget of the entry point.
+#--------------------------------------------------------------------------------
+import statistics
+import pytest
+import bench_startup
+
+RUNS = 3
+
+@pytest.mark.parametrize('entry_point', list(bench_startup.ENTRY_POINTS))
+def test_entry_point_imports_within_budget(entry_point, tmp_path):
+  arguments, budget = bench_startup.ENTRY_POINTS[entry_point]
+  (tmp_path / 'vault_dr.cfg').write_text(bench_startup.CONFIG % {'dir': str(tmp_path)})
+  (tmp_path / 'vault_dr.token').write_text('bench-token\n')
+  command = 'run_vault_dr.py ' + ' '.join(arguments)
+  times = []
+  heavy = set()
+  for run in range(RUNS):
+    total, modules = bench_startup.run_once(arguments, str(tmp_path))
+    assert modules, 'no import trace from ' + command
+    times.append(total)
+    heavy |= set(module for module in modules
+                 if module.split('.')[0] in bench_startup.HEAVY_MODULES)
+  assert not heavy, command + ' imports ' + ', '.join(sorted(heavy))
+  median = statistics.median(times)
+  assert median <= budget, ('%s took %.1f ms to import, over the budget of %d ms' %
+                            (command, median, budget))
@@ -0,0 +1,59 @@
+#--------------------------------------------------------------------------------
+# """test_verification.py: Verification of the new primary through each of its
+#    nodes, standby nodes included"""
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------------
+import pytest
+import requests
+from mock_vault import MockVaultCluster
+from vault_dr import events, verification
+
+@pytest.fixture
+def nodes():
+  events.logger.configure('', False)
+  # Three nodes of the same cluster: the active node and two standbys
+  active = MockVaultCluster('new-primary', 'primary')
+  standby = MockVaultCluster('new-primary', 'primary', standby='standby')
+  perf_standby = MockVaultCluster('new-primary', 'primary', standby='perfstandby')
+  members = [active, standby, perf_standby]
+  for node in members:
+    node.start()
+  active.ha_nodes = [('active', active.url), ('standby', standby.url),
+                     ('perf-standby', perf_standby.url)]
+  yield members
+  for node in members:
+    node.stop()
+
+def test_standby_nodes_answer_bare_health_with_their_status(nodes):
+  active, standby, perf_standby = nodes
+  assert requests.get(active.url + '/v1/sys/health').status_code == 200
+  assert requests.get(standby.url + '/v1/sys/health').status_code == 429
+  assert requests.get(perf_standby.url + '/v1/sys/health').status_code == 473
+
+def test_verification_passes_through_standby_nodes(nodes):
+  active = nodes[0]
+  result = verification.verify(active.url, None, {'X-Vault-Token': 'token'}, deadline=5,
+                               timeout=1, successes=2, interval=0.05)
+  assert result.problems == []
+  assert [check.label() for check in result.checks if not check.passed] == []
+  assert set(check.node for check in result.checks) == {'active', 'standby', 'perf-standby', None}
+  assert result.passed()
+
+def test_health_still_requires_a_dr_primary(nodes):
+  standby = nodes[1]
+  standby.mode = 'secondary'
+  check = verification.Check(verification.HEALTH, standby.url, 'standby')
+  ok, error = verification.probe(check, {}, None, 1, verification.LatencyHistogram())
+  assert not ok
+  assert 'replication_dr_mode secondary' in error